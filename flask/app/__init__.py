@@ -13,11 +13,15 @@ from app import (
     tissue_samples,
     analyses,
     variants,
+    exports,
     groups,
     users,
+    metrics,
     manage,
     error_handler,
 )
+from .data_version import register_data_version_events
+from .instrumentation import register_instrumentation
 
 
 def create_app(config):
@@ -32,6 +36,8 @@ def create_app(config):
 
     config_logger(app)
     register_extensions(app)
+    register_instrumentation(app)
+    metrics.register_metrics(app)
     manage.register_commands(app)
     register_blueprints(app)
 
@@ -49,16 +55,19 @@ def register_blueprints(app):
     app.register_blueprint(analyses.analyses_blueprint)
     app.register_blueprint(genes.genes_blueprint)
     app.register_blueprint(variants.variants_blueprint)
+    app.register_blueprint(exports.exports_blueprint)
 
     app.register_blueprint(buckets.bucket_blueprint)
     app.register_blueprint(groups.groups_blueprint)
     app.register_blueprint(users.users_blueprint)
+    app.register_blueprint(metrics.metrics_blueprint)
 
     app.register_blueprint(error_handler.error_blueprint)
 
 
 def register_extensions(app):
     db.init_app(app)
+    register_data_version_events()
     migrate.init_app(app, db)
     login.init_app(app)
     oauth.init_app(app)
@@ -1,15 +1,18 @@
 from dataclasses import asdict
 from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
 
 from flask_login import current_user, login_required
-from sqlalchemy import distinct, func, or_
-from sqlalchemy.orm import aliased, contains_eager, selectinload
+from sqlalchemy import func, or_
+from sqlalchemy.orm import aliased, contains_eager, joinedload, selectinload
 
 from flask import Blueprint, Response, abort, current_app as app, jsonify, request
 from sqlalchemy.orm.session import make_transient
+from werkzeug.datastructures import MultiDict
 
 from . import models
 from .extensions import db
+from .permissions import permission_filter
 from .utils import (
     check_admin,
     clone_entity,
@@ -21,6 +24,7 @@ from .utils import (
     filter_updated_or_abort,
     mixin,
     paged,
+    paginate_query,
     paginated_response,
     transaction_or_abort,
     validate_json,
@@ -32,14 +36,46 @@ analyses_blueprint = Blueprint(
 )
 
 
-@analyses_blueprint.route("/api/analyses", methods=["GET"], endpoint="analyses_list")
-@login_required
-@paged
-def list_analyses(page: int, limit: int) -> Response:
+# columns of the CSV listing, also written by export jobs
+csv_columns = [
+    "pipeline",
+    "analysis_state",
+    "participant_codenames",
+    "family_codenames",
+    "priority",
+    "requester",
+    "assignee",
+    "updated",
+    "result_path",
+    "notes",
+    "analysis_id",
+]
+
+
+def csv_rows(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [
+        {k: v if k != "pipeline" else v.pipeline_name for k, v in result.items()}
+        for result in results
+    ]
 
+
+def analysis_results(
+    args: MultiDict,
+    page: int,
+    limit: Optional[int],
+    user_id: Any,
+    shared_with: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], int, int, Optional[str]]:
+    """
+    Filters, orders and pages the analyses visible to user_id, or all analyses if it is
+    None, by the query string parameters in args. Returns the serialized page, the
+    total number of analyses, the page number and the cursor of the following page.
+    If the group_code shared_with is given, only analyses of datasets shared with that
+    group are kept.
+    """
     app.logger.debug("Parsing query parameters..")
 
-    order_by = request.args.get("order_by", type=str)
+    order_by = args.get("order_by", type=str)
     allowed_columns = [
         "updated",
         "result_path",
@@ -70,36 +106,32 @@ def list_analyses(page: int, limit: int) -> Response:
 
     if order:
         app.logger.debug("Validating 'order_dir' parameter..")
-        order_dir = request.args.get("order_dir", type=str)
-        if order_dir == "desc":
-            order = order.desc()
-        elif order_dir == "asc":
-            order = order.asc()
-        else:
+        order_dir = args.get("order_dir", type=str)
+        if order_dir not in ("asc", "desc"):
             abort(400, description="order_dir must be either 'asc' or 'desc'")
         app.logger.debug("Ordering by '%s' in '%s' direction", order_by, order_dir)
 
     app.logger.debug("Validating filter parameters..")
 
     filters = []
-    assignee = request.args.get("assignee", type=str)
+    assignee = args.get("assignee", type=str)
     if assignee:
         app.logger.debug("Filter by assignee: '%s'", assignee)
         filters.append(func.instr(assignee_user.username, assignee))
-    requester = request.args.get("requester", type=str)
+    requester = args.get("requester", type=str)
     if requester:
         app.logger.debug("Filter by requester: '%s'", requester)
         filters.append(func.instr(requester_user.username, requester))
-    notes = request.args.get("notes", type=str)
+    notes = args.get("notes", type=str)
     if notes:
         app.logger.debug("Filter by notes: '%s'", notes)
         filters.append(func.instr(models.Analysis.notes, notes))
     # this edges into the [GET] /:id endpoint, but the index/show payloads diverge, causing issues for the FE, and this is technically still a filter
-    analysis_id = request.args.get("analysis_id", type=str)
+    analysis_id = args.get("analysis_id", type=str)
     if analysis_id:
         app.logger.debug("Filter by analysis_id: '%s'", analysis_id)
         filters.append(func.instr(models.Analysis.analysis_id, analysis_id))
-    priority = request.args.get("priority", type=str)
+    priority = args.get("priority", type=str)
     if priority:
         app.logger.debug("Filter by priority: '%s'", priority)
         filters.append(
@@ -109,19 +141,19 @@ def list_analyses(page: int, limit: int) -> Response:
                 priority,
             )
         )
-    result_path = request.args.get("result_path", type=str)
+    result_path = args.get("result_path", type=str)
     if result_path:
         app.logger.debug("Filter by result_path: '%s'", result_path)
         filters.append(func.instr(models.Analysis.result_path, result_path))
-    updated = request.args.get("updated", type=str)
+    updated = args.get("updated", type=str)
     if updated:
         app.logger.debug("Filter by updated: '%s'", updated)
         filters.append(filter_updated_or_abort(models.Analysis.updated, updated))
-    requested = request.args.get("requested", type=str)
+    requested = args.get("requested", type=str)
     if requested:
         app.logger.debug("Filter by requested: '%s'", requested)
         filters.append(filter_updated_or_abort(models.Analysis.requested, requested))
-    analysis_state = request.args.get("analysis_state", type=str)
+    analysis_state = args.get("analysis_state", type=str)
     if analysis_state:
         app.logger.debug("Filter by analysis_state: '%s'", analysis_state)
         filters.append(
@@ -131,7 +163,7 @@ def list_analyses(page: int, limit: int) -> Response:
                 analysis_state,
             )
         )
-    pipeline_id = request.args.get("pipeline_id", type=str)
+    pipeline_id = args.get("pipeline_id", type=str)
     if pipeline_id:
         try:
             filters.append(
@@ -143,15 +175,6 @@ def list_analyses(page: int, limit: int) -> Response:
             abort(400, description=err)
         app.logger.debug("Filter by pipeline_id: '%s'", pipeline_id)
 
-    app.logger.debug("Getting user_id..")
-
-    if app.config.get("LOGIN_DISABLED") or current_user.is_admin:
-        user_id = request.args.get("user")
-    else:
-        user_id = current_user.user_id
-
-    app.logger.debug("user_id: '%s'", user_id)
-
     app.logger.debug("Querying and applying filters..")
 
     query = models.Analysis.query.options(
@@ -168,25 +191,13 @@ def list_analyses(page: int, limit: int) -> Response:
         query = query.join(assignee_user, models.Analysis.assignee)
     if requester:
         query = query.join(requester_user, models.Analysis.requester)
-    if user_id:  # Regular user or assumed identity, return only permitted analyses
-        query = (
-            query.join(models.datasets_analyses_table)
-            .join(
-                models.groups_datasets_table,
-                models.datasets_analyses_table.columns.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id, *filters)
-        )
-    else:  # Admin or LOGIN_DISABLED, authorized to query all analyses
-        query = query.filter(*filters)
+    # Regular users or assumed identities only see analyses of permitted datasets,
+    # admins or LOGIN_DISABLED are authorized to query all analyses
+    query = query.filter(
+        permission_filter(models.Analysis, user_id, shared_with), *filters
+    )
 
-    participant_codename = request.args.get("participant_codename", type=str)
+    participant_codename = args.get("participant_codename", type=str)
     if participant_codename:
         app.logger.debug(
             "Filtering by participant_codename: '%s' (subquery)", participant_codename
@@ -207,7 +218,7 @@ def list_analyses(page: int, limit: int) -> Response:
         )
         query = query.filter(models.Analysis.analysis_id.in_(subquery))
 
-    family_codename = request.args.get("family_codename", type=str)
+    family_codename = args.get("family_codename", type=str)
     if family_codename:
         app.logger.debug(
             "Filtering by family_codename: '%s' (subquery)", family_codename
@@ -223,10 +234,8 @@ def list_analyses(page: int, limit: int) -> Response:
         )
         query = query.filter(models.Analysis.analysis_id.in_(subquery))
 
-    if request.args.get("search"):  # multifield search
-        app.logger.debug(
-            "Searching across multiple fields by '%s'", request.args.get("search")
-        )
+    if args.get("search"):  # multifield search
+        app.logger.debug("Searching across multiple fields by '%s'", args.get("search"))
         subquery = (
             models.Analysis.query.join(models.Analysis.datasets)
             .join(models.Dataset.tissue_sample)
@@ -234,19 +243,15 @@ def list_analyses(page: int, limit: int) -> Response:
             .join(models.Participant.family)
             .filter(
                 or_(
-                    func.instr(
-                        models.Family.family_codename, request.args.get("search")
-                    ),
-                    func.instr(
-                        models.Family.family_aliases, request.args.get("search")
-                    ),
+                    func.instr(models.Family.family_codename, args.get("search")),
+                    func.instr(models.Family.family_aliases, args.get("search")),
                     func.instr(
                         models.Participant.participant_codename,
-                        request.args.get("search"),
+                        args.get("search"),
                     ),
                     func.instr(
                         models.Participant.participant_aliases,
-                        request.args.get("search"),
+                        args.get("search"),
                     ),
                 )
             )
@@ -255,10 +260,15 @@ def list_analyses(page: int, limit: int) -> Response:
         )
         query = query.filter(models.Analysis.analysis_id.in_(subquery))
 
-    total_count = query.with_entities(
-        func.count(distinct(models.Analysis.analysis_id))
-    ).scalar()
-    analyses = query.order_by(order).limit(limit).offset(page * (limit or 0)).all()
+    analyses, total_count, page, next_cursor = paginate_query(
+        query,
+        args,
+        models.Analysis.analysis_id,
+        page,
+        limit,
+        order_column=order,
+        descending=order is not None and order_dir == "desc",
+    )
 
     app.logger.info("Query successful")
 
@@ -280,34 +290,35 @@ def list_analyses(page: int, limit: int) -> Response:
         }
         for analysis in analyses
     ]
+    return results, total_count, page, next_cursor
+
+
+@analyses_blueprint.route("/api/analyses", methods=["GET"], endpoint="analyses_list")
+@login_required
+@paged
+def list_analyses(page: int, limit: int) -> Response:
+    app.logger.debug("Getting user_id..")
+
+    if app.config.get("LOGIN_DISABLED") or current_user.is_admin:
+        user_id = request.args.get("user")
+    else:
+        user_id = current_user.user_id
+
+    app.logger.debug("user_id: '%s'", user_id)
+
+    results, total_count, page, next_cursor = analysis_results(
+        request.args, page, limit, user_id
+    )
 
     if expects_json(request):
         app.logger.debug("Returning paginated response..")
-        return paginated_response(results, page, total_count, limit)
+        return paginated_response(results, page, total_count, limit, next_cursor)
     elif expects_csv(request):
         app.logger.debug("Returning paginated response..")
-
-        results = [
-            {k: v if k != "pipeline" else v.pipeline_name for k, v in result.items()}
-            for result in results
-        ]
-
         return csv_response(
-            results,
+            csv_rows(results),
             filename="analyses_report.csv",
-            colnames=[
-                "pipeline",
-                "analysis_state",
-                "participant_codenames",
-                "family_codenames",
-                "priority",
-                "requester",
-                "assignee",
-                "updated",
-                "result_path",
-                "notes",
-                "analysis_id",
-            ],
+            colnames=csv_columns,
         )
 
     abort(406, "Only 'text/csv' and 'application/json' HTTP accept headers supported")
@@ -325,28 +336,27 @@ def get_analysis(id: int):
 
     app.logger.debug("user_id: '%s'", user_id)
 
+    # everything serialized below for each dataset is loaded up front
+    datasets = contains_eager(models.Analysis.datasets).options(
+        selectinload(models.Dataset.groups),
+        joinedload(models.Dataset.tissue_sample).options(
+            joinedload(models.TissueSample.created_by),
+            joinedload(models.TissueSample.updated_by),
+            joinedload(models.TissueSample.participant).options(
+                joinedload(models.Participant.family),
+                joinedload(models.Participant.institution),
+            ),
+        ),
+    )
+
     if user_id:
         app.logger.debug("Querying based on group permissions..")
+        # only the permitted datasets of the analysis are loaded
         analysis = (
             models.Analysis.query.filter(models.Analysis.analysis_id == id)
-            .options(contains_eager(models.Analysis.datasets))
-            .join(
-                models.datasets_analyses_table,
-                models.Analysis.analysis_id
-                == models.datasets_analyses_table.columns.analysis_id,
-            )
-            .join(models.Dataset)
-            .join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
+            .options(datasets)
+            .join(models.Analysis.datasets)
+            .filter(permission_filter(models.Dataset, user_id))
             .join(models.Pipeline)
             .one_or_none()
         )
@@ -354,6 +364,7 @@ def get_analysis(id: int):
         app.logger.debug("Querying freely with admin privileges..")
         analysis = (
             models.Analysis.query.filter(models.Analysis.analysis_id == id)
+            .options(datasets)
             .outerjoin(models.Analysis.datasets)
             .join(models.Pipeline)
             .one_or_none()
@@ -435,24 +446,10 @@ def create_analysis():
 
     app.logger.debug("user_id: '%s'", user_id)
 
-    if user_id:
-        app.logger.debug("Querying datasets based on group permissions..")
-        found_datasets_query = (
-            models.Dataset.query.join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
-        )
-    else:
-        app.logger.debug("Querying datasets freely with admin privileges..")
-        found_datasets_query = models.Dataset.query
+    app.logger.debug("Querying datasets based on group permissions, if any..")
+    found_datasets_query = models.Dataset.query.filter(
+        permission_filter(models.Dataset, user_id)
+    )
 
     app.logger.debug(
         "Verifying that requested datasets are available and permitted to this user.."
@@ -568,22 +565,9 @@ def create_reanalysis(id: int):
     app.logger.debug("user_id: '%s'", user_id)
 
     app.logger.info("Checking if datasets are available to user...")
-    if user_id:
-        found_datasets_query = (
-            models.Dataset.query.join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
-        )
-    else:
-        found_datasets_query = models.Dataset.query
+    found_datasets_query = models.Dataset.query.filter(
+        permission_filter(models.Dataset, user_id)
+    )
 
     found_datasets = found_datasets_query.filter(
         models.Dataset.dataset_id.in_(datasets)
@@ -713,27 +697,10 @@ def update_analysis(id: int):
 
     if user_id:
         app.logger.debug("Querying based on group permissions..")
-        analysis = (
-            models.Analysis.query.filter(models.Analysis.analysis_id == id)
-            .join(
-                models.datasets_analyses_table,
-                models.Analysis.analysis_id
-                == models.datasets_analyses_table.columns.analysis_id,
-            )
-            .join(models.Dataset)
-            .join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
-            .first_or_404()
-        )
+        analysis = models.Analysis.query.filter(
+            models.Analysis.analysis_id == id,
+            permission_filter(models.Analysis, user_id),
+        ).first_or_404()
     else:
         app.logger.debug("Querying freely with admin privileges..")
         analysis = models.Analysis.query.filter(
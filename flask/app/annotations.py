@@ -0,0 +1,220 @@
+"""
+Variant annotations are stored once per locus and allele in variant_annotation and shared by the
+per-analysis variant rows that reference them, instead of being repeated for every analysis that
+called the variant.
+
+store_variant_annotations resolves the annotation of each variant being loaded, inserting new loci
+and updating changed ones. backfill_variant_annotations moves the annotations of variants loaded
+before the split, while the legacy columns are still on the variant table.
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.sql import bindparam, tuple_
+
+from . import models
+from .extensions import db
+
+# Identifies a variant_annotation row
+LOCUS_COLUMNS = ["chromosome", "position", "reference_allele", "alt_allele"]
+
+# Every stored annotation, besides the locus and its bin
+ANNOTATION_COLUMNS = [
+    column.name
+    for column in models.VariantAnnotation.__table__.columns
+    if column.name not in ["annotation_id", "bin", *LOCUS_COLUMNS]
+]
+
+# The columns that used to be on the variant table and are moved, the bin is generated
+LEGACY_COLUMNS = LOCUS_COLUMNS + ANNOTATION_COLUMNS
+
+Locus = Tuple[str, int, str, str]
+
+
+def variant_locus(row: Dict[str, Any]) -> Locus:
+    return (
+        str(row["chromosome"]),
+        int(row["position"]),
+        row["reference_allele"],
+        row["alt_allele"],
+    )
+
+
+def store_variant_annotations(
+    rows: List[Dict[str, Any]], batch_size: int = 1000
+) -> List[int]:
+    """
+    rows - variants with their annotation columns, eg. from get_report_records()
+
+    Makes sure every locus of the rows has a variant_annotation row holding the annotations given
+    here, which take precedence over those stored by earlier reports. If a locus appears more than
+    once, the last row wins. Expects to be the only writer to the table, as new rows are inserted
+    without locking and read back for their ids. Does not commit.
+
+    Returns the annotation_id of each row.
+    """
+    table = models.VariantAnnotation.__table__
+    annotations = {}
+    for row in rows:
+        annotations[variant_locus(row)] = {
+            column: row.get(column) for column in LOCUS_COLUMNS + ANNOTATION_COLUMNS
+        }
+
+    def stored(loci: List[Locus]) -> Dict[Locus, Any]:
+        found = {}
+        for start in range(0, len(loci), batch_size):
+            for stored_row in db.session.execute(
+                sa.select([table]).where(
+                    tuple_(*[table.c[column] for column in LOCUS_COLUMNS]).in_(
+                        loci[start : start + batch_size]
+                    )
+                )
+            ):
+                found[variant_locus(stored_row)] = stored_row
+        return found
+
+    existing = stored(list(annotations))
+    missing = [locus for locus in annotations if locus not in existing]
+    for start in range(0, len(missing), batch_size):
+        db.session.execute(
+            table.insert(),
+            [annotations[locus] for locus in missing[start : start + batch_size]],
+        )
+    changed = [
+        {
+            "_annotation_id": existing[locus].annotation_id,
+            **{column: annotations[locus][column] for column in ANNOTATION_COLUMNS},
+        }
+        for locus in existing
+        if any(
+            existing[locus][column] != annotations[locus][column]
+            for column in ANNOTATION_COLUMNS
+        )
+    ]
+    if changed:
+        update = table.update().where(
+            table.c.annotation_id == bindparam("_annotation_id")
+        )
+        for start in range(0, len(changed), batch_size):
+            db.session.execute(update, changed[start : start + batch_size])
+    if missing:
+        existing.update(stored(missing))
+
+    return [existing[variant_locus(row)].annotation_id for row in rows]
+
+
+def variant_calls(
+    rows: List[Dict[str, Any]], annotation_ids: List[int]
+) -> List[Dict[str, Any]]:
+    """
+    Returns the rows as variant table rows referencing their annotations, without the columns
+    stored in variant_annotation.
+    """
+    columns = [column.name for column in models.Variant.__table__.columns]
+    return [
+        {**{column: row.get(column) for column in columns}, "annotation_id": id}
+        for row, id in zip(rows, annotation_ids)
+    ]
+
+
+# The variant table as it is before the legacy columns are dropped
+legacy_variant = sa.table(
+    "variant",
+    sa.column("variant_id"),
+    sa.column("annotation_id"),
+    *[sa.column(column) for column in LEGACY_COLUMNS],
+)
+
+
+def insert_legacy_annotations(lower: int, upper: int) -> Any:
+    """
+    Returns an INSERT ... SELECT adding the loci of variants with ids in [lower, upper] that
+    are not yet annotated, taking each locus' annotations from its most recently loaded variant.
+    """
+    annotation = models.VariantAnnotation.__table__
+    newer = legacy_variant.alias("newer")
+    latest = (
+        sa.select([sa.func.max(newer.c.variant_id)])
+        .where(
+            sa.and_(
+                newer.c.annotation_id.is_(None),
+                newer.c.variant_id.between(lower, upper),
+            )
+        )
+        .group_by(*[newer.c[column] for column in LOCUS_COLUMNS])
+    )
+    stored = sa.exists().where(
+        sa.and_(
+            *[
+                annotation.c[column] == legacy_variant.c[column]
+                for column in LOCUS_COLUMNS
+            ]
+        )
+    )
+    return annotation.insert().from_select(
+        LEGACY_COLUMNS,
+        sa.select([legacy_variant.c[column] for column in LEGACY_COLUMNS]).where(
+            sa.and_(legacy_variant.c.variant_id.in_(latest), ~stored)
+        ),
+    )
+
+
+def link_legacy_annotations(lower: int, upper: int) -> Any:
+    """
+    Returns an UPDATE pointing the variants with ids in [lower, upper] at the annotation of their locus.
+    """
+    annotation = models.VariantAnnotation.__table__
+    return (
+        legacy_variant.update()
+        .where(
+            sa.and_(
+                legacy_variant.c.annotation_id.is_(None),
+                legacy_variant.c.variant_id.between(lower, upper),
+            )
+        )
+        .values(
+            annotation_id=sa.select([annotation.c.annotation_id])
+            .where(
+                sa.and_(
+                    *[
+                        annotation.c[column] == legacy_variant.c[column]
+                        for column in LOCUS_COLUMNS
+                    ]
+                )
+            )
+            .as_scalar()
+        )
+    )
+
+
+def backfill_variant_annotations(
+    chunk_size: int = 50000, echo: Optional[Callable[[str], None]] = None
+) -> int:
+    """
+    Moves the annotations of variants loaded before variant_annotation existed out of the legacy
+    variant columns, chunk_size variant ids at a time, committing each chunk. Chunks go from the
+    newest variants to the oldest, so each locus keeps the annotations of its latest report, as if
+    the reports had been loaded again. Variants already linked to an annotation are left alone,
+    so an interrupted backfill is resumed by running it again.
+
+    Returns the number of variants linked.
+    """
+    lowest, highest = db.session.execute(
+        sa.select(
+            [
+                sa.func.min(legacy_variant.c.variant_id),
+                sa.func.max(legacy_variant.c.variant_id),
+            ]
+        ).where(legacy_variant.c.annotation_id.is_(None))
+    ).first()
+    linked = 0
+    if highest is None:
+        return linked
+    for upper in range(highest, lowest - 1, -chunk_size):
+        lower = max(upper - chunk_size + 1, lowest)
+        db.session.execute(insert_legacy_annotations(lower, upper))
+        linked += db.session.execute(link_legacy_annotations(lower, upper)).rowcount
+        db.session.commit()
+        if echo:
+            echo(f"{linked} variants linked, down to variant {lower}")
+    return linked
@@ -0,0 +1,75 @@
+"""
+UCSC-style hierarchical binning for genomic intervals.
+
+Every interval is assigned the smallest bin that fully contains it, so an
+overlap query only has to look at the handful of bins that can possibly hold
+a feature overlapping the requested range instead of scanning the whole table.
+See Kent et al., "The Human Genome Browser at UCSC" (2002) for the original scheme.
+
+Coordinates here are 0-based, half-open [start, end) like the UCSC browser.
+Stager stores 1-based, fully closed coordinates, so convert before calling in.
+"""
+
+from typing import List
+
+# Standard scheme: 128kb bins at the finest level, each level 8x coarser,
+# which covers chromosomes up to 512Mb (chr1 in GRCh37 is ~249Mb)
+BIN_OFFSETS = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+BIN_FIRST_SHIFT = 17
+BIN_NEXT_SHIFT = 3
+MAX_BIN_END = 1 << (BIN_FIRST_SHIFT + BIN_NEXT_SHIFT * (len(BIN_OFFSETS) - 1))
+
+
+def bin_from_range(start: int, end: int) -> int:
+    """
+    Returns the smallest bin that fully contains the 0-based, half-open interval [start, end).
+    """
+    if start < 0 or end > MAX_BIN_END or start >= end:
+        raise ValueError(f"Invalid range for binning: [{start}, {end})")
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        if start_bin == end_bin:
+            return offset + start_bin
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    # Unreachable given the bounds check above, the top level holds everything
+    return 0
+
+
+def overlapping_bins(start: int, end: int) -> List[int]:
+    """
+    Returns every bin that may contain a feature overlapping the 0-based, half-open interval [start, end).
+    """
+    if start < 0 or start >= end:
+        raise ValueError(f"Invalid range for binning: [{start}, {end})")
+    end = min(end, MAX_BIN_END)
+    bins = []
+    start_bin = start >> BIN_FIRST_SHIFT
+    end_bin = (end - 1) >> BIN_FIRST_SHIFT
+    for offset in BIN_OFFSETS:
+        bins.extend(range(offset + start_bin, offset + end_bin + 1))
+        start_bin >>= BIN_NEXT_SHIFT
+        end_bin >>= BIN_NEXT_SHIFT
+    return bins
+
+
+def position_bin(position: int) -> int:
+    """
+    Returns the bin for a single 1-based position, as stored for variants.
+    """
+    return bin_from_range(position - 1, position)
+
+
+def bin_sql(start: str, end: str) -> str:
+    """
+    Returns bin_from_range for the 0-based, half-open [start, end) SQL expressions, in SQL.
+    """
+    shift = BIN_FIRST_SHIFT
+    cases = []
+    for offset in BIN_OFFSETS[:-1]:
+        cases.append(
+            f"WHEN ({start}) >> {shift} = (({end}) - 1) >> {shift} THEN {offset} + (({start}) >> {shift})"
+        )
+        shift += BIN_NEXT_SHIFT
+    return f"CASE {' '.join(cases)} ELSE 0 END"
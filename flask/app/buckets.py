@@ -1,9 +1,18 @@
-from flask import jsonify, Blueprint, current_app as app
+from bisect import bisect_left, bisect_right
+from heapq import merge
+from itertools import islice, takewhile
+from threading import Lock, Thread
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from flask import abort, jsonify, request, Blueprint, current_app as app
 from flask_login import current_user, login_required
 from minio import Minio
 from sqlalchemy.orm import joinedload
 
 from . import models
+from .extensions import db
+from .utils import get_minio_client
 
 
 bucket_blueprint = Blueprint(
@@ -11,22 +20,159 @@ bucket_blueprint = Blueprint(
     __name__,
 )
 
+# Candidate paths checked against dataset_file per query
+LINKED_CHECK_CHUNK_SIZE = 1000
+
+
+class BucketListingCache:
+    """
+    Sorted object listings per bucket, shared by every request in a worker.
+
+    A bucket is listed again once its listing is older than the TTL, unless
+    a notification listener is keeping it up to date, in which case created
+    and removed objects are applied to the listing as they arrive.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = Lock()
+        self.bucket_names: Optional[List[str]] = None
+        self.bucket_names_listed = 0.0
+        self.listings: Dict[str, List[str]] = {}
+        self.listed: Dict[str, float] = {}
+        self.listening = set()
+
+    def fresh(self, listed: float) -> bool:
+        return monotonic() - listed < self.ttl
+
+    def buckets(self, client: Minio) -> List[str]:
+        with self.lock:
+            if self.bucket_names is not None and self.fresh(self.bucket_names_listed):
+                return self.bucket_names
+        names = sorted(bucket.name for bucket in client.list_buckets())
+        with self.lock:
+            self.bucket_names, self.bucket_names_listed = names, monotonic()
+        return names
+
+    def objects(self, client: Minio, bucket: str) -> List[str]:
+        """
+        Returns the sorted object names in the bucket. Listings are never
+        mutated in place, so the result is a consistent snapshot.
+        """
+        with self.lock:
+            if bucket in self.listings and (
+                bucket in self.listening or self.fresh(self.listed[bucket])
+            ):
+                return self.listings[bucket]
+        app.logger.debug("Listing objects in bucket '%s'..", bucket)
+        names = sorted(
+            obj.object_name for obj in client.list_objects(bucket, recursive=True)
+        )
+        with self.lock:
+            self.listings[bucket], self.listed[bucket] = names, monotonic()
+        return names
+
+    def apply_event(self, event: Dict[str, Any]) -> None:
+        """
+        Applies an S3 bucket notification, as yielded by
+        Minio.listen_bucket_notification, to the cached listings.
+        """
+        for record in event.get("Records", []):
+            bucket = record["s3"]["bucket"]["name"]
+            name = record["s3"]["object"]["key"]
+            with self.lock:
+                names = self.listings.get(bucket)
+                if names is None:
+                    continue
+                i = bisect_left(names, name)
+                present = i < len(names) and names[i] == name
+                if record["eventName"].startswith("s3:ObjectCreated:"):
+                    if not present:
+                        self.listings[bucket] = names[:i] + [name] + names[i:]
+                elif record["eventName"].startswith("s3:ObjectRemoved:"):
+                    if present:
+                        self.listings[bucket] = names[:i] + names[i + 1 :]
+
+    def listen(
+        self, bucket: str, events: Callable[[], Iterable[Dict[str, Any]]]
+    ) -> None:
+        """
+        Applies notifications for the bucket from the stream opened by events on
+        a background thread, unless one is already running. The bucket's listing
+        skips the TTL while the stream is open and falls back to it afterwards.
+        """
+
+        def consume():
+            try:
+                for event in events():
+                    self.apply_event(event)
+            finally:
+                with self.lock:
+                    self.listening.discard(bucket)
+
+        with self.lock:
+            if bucket in self.listening:
+                return
+            self.listening.add(bucket)
+        Thread(target=consume, name=f"minio-events-{bucket}", daemon=True).start()
+
+    def invalidate(self, bucket: str = None) -> None:
+        with self.lock:
+            self.bucket_names = None
+            if bucket:
+                self.listings.pop(bucket, None)
+                self.listed.pop(bucket, None)
+
+
+def get_listing_cache() -> BucketListingCache:
+    cache = app.extensions.get("minio_listing")
+    if cache is None:
+        cache = app.extensions["minio_listing"] = BucketListingCache(
+            app.config["MINIO_LISTING_TTL"]
+        )
+    return cache
+
+
+def unlinked_paths(candidates: Iterator[str], limit: Optional[int]) -> List[str]:
+    """
+    Returns up to limit of the candidate paths that no dataset file links to,
+    checking them against the unique path index a chunk at a time.
+    """
+    unlinked = []
+    while limit is None or len(unlinked) < limit:
+        chunk = list(islice(candidates, LINKED_CHECK_CHUNK_SIZE))
+        if not chunk:
+            break
+        linked = {
+            path
+            for path, in db.session.query(models.DatasetFile.path).filter(
+                models.DatasetFile.path.in_(chunk)
+            )
+        }
+        unlinked.extend(path for path in chunk if path not in linked)
+    return unlinked if limit is None else unlinked[:limit]
+
 
 @bucket_blueprint.route("/api/unlinked", methods=["GET"])
 @login_required
 def get_unlinked_files():
 
-    # temporary solution since Minio can't access the app without context
-    with app.app_context():
-        minioClient = Minio(
-            app.config.get("MINIO_ENDPOINT"),
-            access_key=app.config.get("MINIO_ACCESS_KEY"),
-            secret_key=app.config.get("MINIO_SECRET_KEY"),
-            secure=False,
-        )
+    prefix = request.args.get("prefix", default="", type=str)
+    after = request.args.get("after", default="", type=str)
+    try:
+        limit = request.args.get("limit")
+        if limit is not None:  # unspecified limit means return everything
+            limit = int(limit)
+            if limit <= 0:
+                raise ValueError
+    except ValueError:
+        abort(400, description="limit must be a positive integer")
+
+    minio_client = get_minio_client()
+    cache = get_listing_cache()
 
     app.logger.debug("Getting all minio bucket names..")
-    all_bucket_names = [bucket.name for bucket in minioClient.list_buckets()]
+    all_bucket_names = set(cache.buckets(minio_client))
 
     # Remove buckets the current user does not have access to assuming group_code.lower() == bucket name
     app.logger.debug("Getting all buckets that user has access to..")
@@ -39,25 +185,41 @@ def get_unlinked_files():
     valid_bucket_names = []
     for group in user.groups:
         code = group.group_code.lower()
-        if code in all_bucket_names:
+        if code in all_bucket_names and (
+            f"{code}/".startswith(prefix) or prefix.startswith(f"{code}/")
+        ):
             valid_bucket_names.append(code)
 
     app.logger.debug("Getting all files in valid minio buckets..")
-    all_files = []
+    listings = []
     for bucket in valid_bucket_names:
-        objs = minioClient.list_objects(bucket, recursive=True)
-        for obj in objs:
-            all_files.append(bucket + "/" + obj.object_name)
-
-    app.logger.debug("Getting all linked files..")
-    linked_files = {f.path: ":)" for f in models.DatasetFile.query.all()}
+        if app.config["MINIO_LISTEN_NOTIFICATIONS"]:
+            cache.listen(
+                bucket,
+                lambda bucket=bucket: minio_client.listen_bucket_notification(
+                    bucket, events=("s3:ObjectCreated:*", "s3:ObjectRemoved:*")
+                ),
+            )
+        names = cache.objects(minio_client, bucket)
+        # Narrow each sorted listing to the requested prefix and page
+        bucket_prefix = f"{bucket}/"
+        object_prefix = prefix[len(bucket_prefix) :]
+        start = bisect_left(names, object_prefix)
+        if after.startswith(bucket_prefix):
+            start = max(start, bisect_right(names, after[len(bucket_prefix) :]))
+        elif after > bucket_prefix:  # the whole bucket sorts before it
+            continue
+        listings.append(
+            bucket_prefix + name
+            for name in takewhile(
+                lambda name: name.startswith(object_prefix),
+                islice(names, start, None),
+            )
+        )
 
-    # Put all unlinked files in new list
-    unlinked_files = []
-    for file_name in all_files:
-        if file_name not in linked_files:
-            unlinked_files.append(file_name)
+    app.logger.debug("Checking which files are linked..")
+    unlinked_files = unlinked_paths(merge(*listings), limit)
 
     app.logger.debug("Returning JSON array..")
 
-    return jsonify(sorted(unlinked_files))
+    return jsonify(unlinked_files)
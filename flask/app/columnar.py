@@ -0,0 +1,64 @@
+"""
+Apache Arrow building blocks for the columnar (Parquet and Arrow IPC stream)
+summary reports, which keep each column's database type instead of formatting
+every cell as a string.
+"""
+from io import BytesIO
+from typing import Any
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy.sql import sqltypes
+
+PARQUET_MIMETYPE = "application/vnd.apache.parquet"
+ARROW_STREAM_MIMETYPE = "application/vnd.apache.arrow.stream"
+
+
+def arrow_type(sql_type: Any) -> pa.DataType:
+    if isinstance(sql_type, sqltypes.Boolean):
+        return pa.bool_()
+    if isinstance(sql_type, sqltypes.Integer):
+        return pa.int64()
+    if isinstance(sql_type, (sqltypes.Float, sqltypes.Numeric)):
+        return pa.float64()
+    if isinstance(sql_type, sqltypes.DateTime):
+        return pa.timestamp("us")
+    if isinstance(sql_type, sqltypes.Date):
+        return pa.date32()
+    return pa.string()
+
+
+def to_arrow(values: Any, type: pa.DataType, dictionary: bool = False) -> pa.Array:
+    """
+    Converts a column of query results, in which pandas represents missing numbers as
+    NaN, to an Arrow array of type with missing values as nulls. Dictionary encoding
+    stores each distinct value once, for columns that repeat a few values many times.
+    """
+    values = pd.Series(values)
+    if pa.types.is_floating(type) or pa.types.is_integer(type):
+        values = pd.to_numeric(values)
+    array = pa.array(values, type=type, from_pandas=True)
+    return array.dictionary_encode() if dictionary else array
+
+
+def runs_to_lists(values: pa.Array, starts: np.ndarray) -> pa.ListArray:
+    """
+    Makes each run values[starts[i]:starts[i + 1]] one list, without copying the values.
+    """
+    offsets = np.append(starts, len(values)).astype(np.int32)
+    return pa.ListArray.from_arrays(pa.array(offsets), values)
+
+
+def write_table(table: pa.Table, format: str) -> bytes:
+    """
+    Serializes the table as a Parquet file or an Arrow IPC stream.
+    """
+    sink = BytesIO()
+    if format == "parquet":
+        pq.write_table(table, sink, compression="zstd")
+    else:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue()
@@ -0,0 +1,90 @@
+"""
+Counters in the single row of the data_version table, each bumped in the same
+transaction as any write to the tables it versions, so that caches can cheaply
+check whether what they hold is still current.
+"""
+from typing import Any
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+from . import models
+from .extensions import db
+
+# Each data_version column and the tables whose writes bump it
+VERSIONED_TABLES = {
+    # The tables reports are built from. Deleting a family, participant, tissue sample,
+    # dataset, analysis or group cascades to genotypes or dataset permissions, and
+    # codenames appear in the reports, so writes to any of them change reports.
+    "version": {
+        "variant",
+        "variant_annotation",
+        "genotype",
+        "groups_datasets",
+        "gene",
+        "family",
+        "participant",
+        "tissue_sample",
+        "dataset",
+        "analysis",
+        "group",
+    },
+    # Which datasets each user can see. Deleting a user, group or dataset also deletes
+    # its rows from these association tables.
+    "permission_version": {"groups_datasets", "users_groups"},
+}
+
+# Set in a connection's info to the columns to bump when its transaction commits
+DATA_CHANGED = "stager_data_changed"
+
+
+def data_version(column: str = "version") -> int:
+    return db.session.query(getattr(models.DataVersion, column)).scalar() or 0
+
+
+def note_data_change(conn, clauseelement, multiparams, params) -> None:
+    if isinstance(clauseelement, UpdateBase):
+        table = getattr(getattr(clauseelement, "table", None), "name", None)
+        columns = [
+            column for column, tables in VERSIONED_TABLES.items() if table in tables
+        ]
+        if columns:
+            conn.info.setdefault(DATA_CHANGED, set()).update(columns)
+
+
+def forget_data_change(conn) -> None:
+    conn.info.pop(DATA_CHANGED, None)
+
+
+def bump_data_version(session: Session) -> None:
+    """
+    Increments the versions of the tables written to as part of the commit.
+    """
+    # pending changes would otherwise only be flushed after this hook
+    session.flush()
+    connection = session.connection()
+    columns = connection.info.pop(DATA_CHANGED, None)
+    if not columns:
+        return
+    table = models.DataVersion.__table__
+    result = connection.execute(
+        table.update().values({column: table.c[column] + 1 for column in columns})
+    )
+    if result.rowcount == 0:
+        connection.execute(
+            table.insert().values(
+                data_version_id=1,
+                **{column: int(column in columns) for column in VERSIONED_TABLES},
+            )
+        )
+
+
+def register_data_version_events() -> None:
+    if event.contains(Engine, "before_execute", note_data_change):
+        return
+    event.listen(Engine, "before_execute", note_data_change)
+    event.listen(Engine, "commit", forget_data_change)
+    event.listen(Engine, "rollback", forget_data_change)
+    event.listen(db.session, "before_commit", bump_data_version)
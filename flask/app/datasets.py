@@ -1,12 +1,15 @@
 from dataclasses import asdict
+from typing import Any, Dict, List, Optional, Tuple
 
 from flask import Blueprint, Response, abort, current_app as app, jsonify, request
 from flask_login import current_user, login_required
-from sqlalchemy import distinct, func
+from sqlalchemy import func
 from sqlalchemy.orm import contains_eager, joinedload, selectinload
+from werkzeug.datastructures import MultiDict
 
 from . import models
 from .extensions import db
+from .permissions import permission_filter
 from .utils import (
     check_admin,
     csv_response,
@@ -16,6 +19,7 @@ from .utils import (
     filter_in_enum_or_abort,
     filter_updated_or_abort,
     mixin,
+    paginate_query,
     paged,
     paginated_response,
     transaction_or_abort,
@@ -45,11 +49,35 @@ datasets_blueprint = Blueprint(
 )
 
 
-@datasets_blueprint.route("/api/datasets", methods=["GET"], strict_slashes=False)
-@login_required
-@paged
-def list_datasets(page: int, limit: int) -> Response:
-    order_by = request.args.get("order_by", type=str)
+# columns of the CSV listing, also written by export jobs
+csv_columns = [
+    "family_codename",
+    "participant_codename",
+    "tissue_sample_type",
+    "dataset_type",
+    "condition",
+    "notes",
+    "linked_files",
+    "updated",
+    "updated_by",
+    "dataset_id",
+]
+
+
+def dataset_results(
+    args: MultiDict,
+    page: int,
+    limit: Optional[int],
+    user_id: Any,
+    shared_with: Optional[str] = None,
+) -> Tuple[List[Dict[str, Any]], int, int, Optional[str]]:
+    """
+    Filters, orders and pages the datasets visible to user_id, or all datasets if it is
+    None, by the query string parameters in args. Returns the serialized page, the
+    total number of datasets, the page number and the cursor of the following page.
+    If the group_code shared_with is given, only datasets shared with that group are kept.
+    """
+    order_by = args.get("order_by", type=str)
     allowed_columns = [
         "dataset_type",
         "condition",
@@ -82,48 +110,41 @@ def list_datasets(page: int, limit: int) -> Response:
         abort(400, description=f"order_by must be one of {allowed_columns}")
 
     if order:
-        order_dir = request.args.get("order_dir", type=str)
-        if order_dir == "desc":
-            order = (order.desc(), models.Dataset.dataset_id.desc())
-        elif order_dir == "asc":
-            order = (order.asc(), models.Dataset.dataset_id.asc())
-        else:
+        order_dir = args.get("order_dir", type=str)
+        if order_dir not in ("asc", "desc"):
             abort(400, description="order_dir must be either 'asc' or 'desc'")
-    else:
-        # Default ordering
-        order = (models.Dataset.dataset_id,)
     filters = []
-    notes = request.args.get("notes", type=str)
+    notes = args.get("notes", type=str)
     if notes:
         filters.append(func.instr(models.Dataset.notes, notes))
-    updated_by = request.args.get("updated_by", type=str)
+    updated_by = args.get("updated_by", type=str)
     if updated_by:
         filters.append(func.instr(models.User.username, updated_by))
-    dataset_id = request.args.get("dataset_id", type=str)
+    dataset_id = args.get("dataset_id", type=str)
     if dataset_id:
         filters.append(models.Dataset.dataset_id == dataset_id)
-    linked_files = request.args.get("linked_files", type=str)
+    linked_files = args.get("linked_files", type=str)
     if linked_files:
         filters.append(func.instr(models.DatasetFile.path, linked_files))
-    participant_codename = request.args.get("participant_codename", type=str)
+    participant_codename = args.get("participant_codename", type=str)
     if participant_codename:
         filters.append(
             func.instr(models.Participant.participant_codename, participant_codename)
         )
-    family_codename = request.args.get("family_codename", type=str)
+    family_codename = args.get("family_codename", type=str)
     if family_codename:
         filters.append(func.instr(models.Family.family_codename, family_codename))
-    dataset_type = request.args.get("dataset_type", type=str)
+    dataset_type = args.get("dataset_type", type=str)
     if dataset_type:
         filters.append(models.Dataset.dataset_type.in_(dataset_type.split(",")))
-    condition = request.args.get("condition", type=str)
+    condition = args.get("condition", type=str)
     if condition:
         filters.append(
             filter_in_enum_or_abort(
                 models.Dataset.condition, models.DatasetCondition, condition
             )
         )
-    tissue_sample_type = request.args.get("tissue_sample_type", type=str)
+    tissue_sample_type = args.get("tissue_sample_type", type=str)
     if tissue_sample_type:
         filters.append(
             filter_in_enum_or_abort(
@@ -132,22 +153,20 @@ def list_datasets(page: int, limit: int) -> Response:
                 tissue_sample_type,
             )
         )
-    updated = request.args.get("updated", type=str)
+    updated = args.get("updated", type=str)
     if updated:
         filters.append(filter_updated_or_abort(models.Dataset.updated, updated))
 
-    if app.config.get("LOGIN_DISABLED") or current_user.is_admin:
-        user_id = request.args.get("user")
-    else:
-        user_id = current_user.user_id
-
     query = (
         models.Dataset.query.options(
             # tell the ORM that our join contains models we'd like to eager load, so it doesn't try to load them lazily
             # in my test, this sped up loading time by ~3x
             contains_eager(models.Dataset.tissue_sample)
             .contains_eager(models.TissueSample.participant)
-            .contains_eager(models.Participant.family),
+            .options(
+                contains_eager(models.Participant.family),
+                joinedload(models.Participant.institution),
+            ),
             # eager load groups and files for speed, since we're not joining here, we can't order or search by these fields
             # ordering is probably not a great loss b/c one-to-many makes it tough,
             # but if we want to search, a solution might be a subquery (something similar to the filter in analyses.py:194-208)
@@ -162,20 +181,13 @@ def list_datasets(page: int, limit: int) -> Response:
         .join(models.Dataset.updated_by)
     )
 
-    if user_id:  # Regular user or assumed identity, return only permitted datasets
-        query = (
-            query.join(models.groups_datasets_table)
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id, *filters)
-        )
-    else:  # Admin or LOGIN_DISABLED, authorized to query all datasets
-        query = query.options(joinedload(models.Dataset.groups)).filter(*filters)
+    # Regular users or assumed identities only see permitted datasets,
+    # admins or LOGIN_DISABLED are authorized to query all datasets
+    query = query.filter(
+        permission_filter(models.Dataset, user_id, shared_with), *filters
+    )
 
-    group_code = request.args.get("group_code", type=str)
+    group_code = args.get("group_code", type=str)
     if group_code:
         subquery = (
             models.Dataset.query.join(models.Dataset.groups)
@@ -187,11 +199,15 @@ def list_datasets(page: int, limit: int) -> Response:
         query = query.filter(models.Dataset.dataset_id.in_(subquery))
 
     # total_count always refers to the number of unique datasets in the database
-    total_count = query.with_entities(
-        func.count(distinct(models.Dataset.dataset_id))
-    ).scalar()
-
-    datasets = query.order_by(*order).limit(limit).offset(page * (limit or 0)).all()
+    datasets, total_count, page, next_cursor = paginate_query(
+        query,
+        args,
+        models.Dataset.dataset_id,
+        page,
+        limit,
+        order_column=order,
+        descending=order is not None and order_dir == "desc",
+    )
 
     results = [
         {
@@ -218,25 +234,27 @@ def list_datasets(page: int, limit: int) -> Response:
         limit or -1,
         total_count,
     )
+    return results, total_count, page, next_cursor
+
+
+@datasets_blueprint.route("/api/datasets", methods=["GET"], strict_slashes=False)
+@login_required
+@paged
+def list_datasets(page: int, limit: int) -> Response:
+    if app.config.get("LOGIN_DISABLED") or current_user.is_admin:
+        user_id = request.args.get("user")
+    else:
+        user_id = current_user.user_id
+
+    results, total_count, page, next_cursor = dataset_results(
+        request.args, page, limit, user_id
+    )
 
     if expects_json(request):
-        return paginated_response(results, page, total_count, limit)
+        return paginated_response(results, page, total_count, limit, next_cursor)
     elif expects_csv(request):
         return csv_response(
-            results,
-            filename="datasets_report.csv",
-            colnames=[
-                "family_codename",
-                "participant_codename",
-                "tissue_sample_type",
-                "dataset_type",
-                "condition",
-                "notes",
-                "linked_files",
-                "updated",
-                "updated_by",
-                "dataset_id",
-            ],
+            results, filename="datasets_report.csv", colnames=csv_columns
         )
 
     abort(406, "Only 'text/csv' and 'application/json' HTTP accept headers supported")
@@ -250,39 +268,25 @@ def get_dataset(id: int):
     else:
         user_id = current_user.user_id
 
-    if user_id:
-        dataset = (
-            models.Dataset.query.filter_by(dataset_id=id)
-            .options(
-                joinedload(models.Dataset.analyses),
-                joinedload(models.Dataset.created_by),
-                joinedload(models.Dataset.updated_by),
-                joinedload(models.Dataset.tissue_sample)
-                .joinedload(models.TissueSample.participant)
-                .joinedload(models.Participant.family),
-            )
-            .join(models.groups_datasets_table)
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
-            .first_or_404()
+    dataset = (
+        models.Dataset.query.filter(
+            models.Dataset.dataset_id == id, permission_filter(models.Dataset, user_id)
         )
-    else:
-        dataset = (
-            models.Dataset.query.filter_by(dataset_id=id)
+        .options(
+            joinedload(models.Dataset.analyses),
+            joinedload(models.Dataset.created_by),
+            joinedload(models.Dataset.updated_by),
+            joinedload(models.Dataset.tissue_sample)
+            .joinedload(models.TissueSample.participant)
             .options(
-                joinedload(models.Dataset.analyses),
-                joinedload(models.Dataset.created_by),
-                joinedload(models.Dataset.updated_by),
-                joinedload(models.Dataset.tissue_sample)
-                .joinedload(models.TissueSample.participant)
-                .joinedload(models.Participant.family),
-            )
-            .first_or_404()
+                joinedload(models.Participant.family),
+                joinedload(models.Participant.institution),
+                joinedload(models.Participant.created_by),
+                joinedload(models.Participant.updated_by),
+            ),
         )
+        .first_or_404()
+    )
 
     return jsonify(
         {
@@ -322,20 +326,9 @@ def update_dataset(id: int):
     else:
         user_id = current_user.user_id
 
-    if user_id:
-        dataset = (
-            models.Dataset.query.filter_by(dataset_id=id)
-            .join(models.groups_datasets_table)
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
-            .first_or_404()
-        )
-    else:
-        dataset = models.Dataset.query.filter_by(dataset_id=id).first_or_404()
+    dataset = models.Dataset.query.filter(
+        models.Dataset.dataset_id == id, permission_filter(models.Dataset, user_id)
+    ).first_or_404()
 
     enum_error = mixin(dataset, request.json, editable_columns)
 
@@ -0,0 +1,580 @@
+"""
+Export jobs compute large CSV downloads in the background, so that reports and listings
+that take minutes do not hold a gunicorn thread or run into the proxy's timeouts.
+
+A job is submitted with the query string parameters of the equivalent GET request and runs
+on a small thread pool in the worker that received it. It reads EXPORT_CHUNK_SIZE rows at a
+time, the listings by following their cursors and the gene panel reports with a server-side
+cursor, and writes them gzipped to EXPORT_DIR or, when a group is given, to that group's
+MinIO bucket. Progress is recorded after every chunk, which is also when a cancelled job
+notices and stops, and a heartbeat keeps the job from looking interrupted during long chunks
+and uploads. Clients poll the job and download the file once it is done. Each worker checks
+for jobs left behind by stopped workers on a timer of its own.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from csv import DictWriter
+from dataclasses import asdict
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+from threading import Event, Thread
+from time import sleep
+from typing import Any, Callable, Dict, Iterator, Optional, TextIO
+
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    abort,
+    current_app as app,
+    jsonify,
+    request,
+    send_file,
+    url_for,
+)
+from flask_login import current_user, login_required
+from werkzeug.datastructures import MultiDict
+
+import pandas as pd
+from . import analyses, datasets, models, variants
+from .extensions import db
+from .utils import get_minio_client, transaction_or_abort, validate_json
+
+
+exports_blueprint = Blueprint(
+    "exports",
+    __name__,
+)
+
+# Each kind of export and the attachment name of its file
+export_kinds = {
+    "datasets": "datasets_report.csv.gz",
+    "analyses": "analyses_report.csv.gz",
+    "variants": "variant_wise_report.csv.gz",
+    "participants": "participant_wise_report.csv.gz",
+}
+
+# Parameters that page a listing, which export jobs set themselves
+paging_params = ("page", "limit", "cursor")
+
+ACTIVE_STATES = (models.ExportState.Pending, models.ExportState.Running)
+
+
+class ExportCancelled(Exception):
+    pass
+
+
+def get_export_pool() -> ThreadPoolExecutor:
+    """
+    Returns this worker's export thread pool, created on first use so that each gunicorn
+    worker process gets its own.
+    """
+    pool = app.extensions.get("export_pool")
+    if pool is None:
+        pool = app.extensions["export_pool"] = ThreadPoolExecutor(
+            max_workers=app.config["EXPORT_WORKERS"], thread_name_prefix="export"
+        )
+        app.extensions["export_queued"] = set()
+    return pool
+
+
+def submit_export(export_id: int) -> None:
+    """
+    Queues the job on this worker's pool, or runs it now if EXPORT_WORKERS is 0.
+    """
+    flask_app = app._get_current_object()
+    if not app.config["EXPORT_WORKERS"]:
+        run_export(flask_app, export_id)
+        return
+    pool = get_export_pool()
+    queued = app.extensions["export_queued"]
+    if export_id not in queued:
+        queued.add(export_id)
+        pool.submit(run_export, flask_app, export_id)
+
+
+def run_export(flask_app: Flask, export_id: int) -> None:
+    with flask_app.app_context():
+        try:
+            run_job(export_id)
+        except:
+            app.logger.error("Export %d could not be run", export_id, exc_info=True)
+        finally:
+            app.extensions.get("export_queued", set()).discard(export_id)
+            db.session.remove()
+
+
+def update_job(export_id: int, *criteria: Any, **values: Any) -> bool:
+    """
+    Sets the values of the job if it matches the criteria, returning whether it did.
+    Runs on its own connection and commits at once, so that it neither disturbs a report
+    being read through the session nor waits for it.
+    """
+    table = models.ExportJob.__table__
+    with db.engine.begin() as connection:
+        result = connection.execute(
+            table.update()
+            .where(table.c.export_id == export_id)
+            .where(*criteria)
+            .values(**values)
+        )
+    return result.rowcount == 1
+
+
+@contextmanager
+def heartbeat(export_id: int) -> Iterator[None]:
+    """
+    Bumps the updated time of the running job from a background thread while the block
+    runs, so that a long chunk or upload is not mistaken for an interrupted job.
+    """
+    flask_app = app._get_current_object()
+    table = models.ExportJob.__table__
+    interval = app.config["EXPORT_STALE_SECONDS"] / 3
+    stopped = Event()
+
+    def beat():
+        with flask_app.app_context():
+            while not stopped.wait(interval):
+                try:
+                    update_job(
+                        export_id,
+                        table.c.state == models.ExportState.Running,
+                        updated=datetime.utcnow(),
+                    )
+                except Exception:
+                    app.logger.warning(
+                        "Export %d heartbeat failed", export_id, exc_info=True
+                    )
+
+    thread = Thread(target=beat, name=f"export-heartbeat-{export_id}", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def run_job(export_id: int) -> None:
+    """
+    Claims the pending job and writes its file, recording the outcome. Nothing is done if
+    another worker claimed the job first or it was cancelled while queued.
+    """
+    table = models.ExportJob.__table__
+    now = datetime.utcnow()
+    if not update_job(
+        export_id,
+        table.c.state == models.ExportState.Pending,
+        state=models.ExportState.Running,
+        started=now,
+        updated=now,
+    ):
+        return
+    job = models.ExportJob.query.get(export_id)
+    params = json.loads(job.params)
+    app.logger.info("Running %s export %d: %s", job.kind, export_id, params)
+
+    def progress(rows: int) -> None:
+        if not update_job(
+            export_id,
+            table.c.state == models.ExportState.Running,
+            rows=rows,
+            updated=datetime.utcnow(),
+        ):
+            raise ExportCancelled
+
+    os.makedirs(app.config["EXPORT_DIR"], exist_ok=True)
+    path = os.path.join(app.config["EXPORT_DIR"], f"{export_id}.csv.gz")
+    partial = f"{path}.part"
+    object_name = None
+    try:
+        # chunks and the upload can each take longer than progress is recorded
+        with heartbeat(export_id):
+            with gzip.open(
+                partial, "wt", encoding="utf-8", newline="", compresslevel=6
+            ) as out:
+                rows = write_export(job.kind, params, out, progress, job.group_code)
+            # a read transaction left open would hold back the purge of old row versions
+            db.session.rollback()
+            size = os.path.getsize(partial)
+            if job.group_code:
+                object_name = f"exports/{export_id}/{export_kinds[job.kind]}"
+                get_minio_client().fput_object(
+                    job.group_code,
+                    object_name,
+                    partial,
+                    content_type="application/gzip",
+                )
+                os.remove(partial)
+            else:
+                os.replace(partial, path)
+
+        now = datetime.utcnow()
+        if update_job(
+            export_id,
+            table.c.state == models.ExportState.Running,
+            state=models.ExportState.Done,
+            path=object_name or path,
+            rows=rows,
+            size=size,
+            finished=now,
+            updated=now,
+        ):
+            app.logger.info("Export %d wrote %d rows", export_id, rows)
+            return
+        # cancelled or deleted while the file was being stored
+        raise ExportCancelled
+    except ExportCancelled:
+        app.logger.info("Export %d was cancelled", export_id)
+        db.session.rollback()
+        remove_export_file(object_name and job.group_code, object_name or path)
+    except Exception as err:
+        app.logger.error("Export %d failed", export_id, exc_info=True)
+        db.session.rollback()
+        remove_export_file(object_name and job.group_code, object_name or path)
+        now = datetime.utcnow()
+        update_job(
+            export_id,
+            table.c.state == models.ExportState.Running,
+            state=models.ExportState.Failed,
+            # aborts carry their message as the description
+            error=getattr(err, "description", None) or str(err) or type(err).__name__,
+            finished=now,
+            updated=now,
+        )
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def write_export(
+    kind: str,
+    params: Dict[str, str],
+    out: TextIO,
+    progress: Callable[[int], None],
+    group_code: Optional[str] = None,
+) -> int:
+    """
+    Writes the CSV of the export to out a chunk at a time, calling progress with the rows
+    written so far after each chunk. Returns the number of rows written. The file of a
+    group's export is readable by all of its members, so it only has datasets shared with
+    that group, even if the requester can see more through their other groups.
+    """
+    chunk_size = app.config["EXPORT_CHUNK_SIZE"]
+    # set to the requester for regular users when the job was submitted
+    user_id = params.get("user")
+
+    if kind in ("variants", "participants"):
+        genes = variants.parse_gene_panel(params.get("panel", ""))
+        query = variants.chunked_report_order(
+            variants.summary_query(genes, user_id, group_code), kind
+        )
+        out.write(
+            pd.DataFrame(columns=variants.report_csv_columns(kind)).to_csv(index=False)
+        )
+        rows = 0
+        for report_df in variants.report_frames(query, kind, chunk_size):
+            out.write(report_df.to_csv(encoding="utf-8", index=False, header=False))
+            rows += len(report_df)
+            progress(rows)
+        return rows
+
+    if kind == "datasets":
+        results_for, columns = datasets.dataset_results, datasets.csv_columns
+        to_rows = lambda results: results
+    else:
+        results_for, columns = analyses.analysis_results, analyses.csv_columns
+        to_rows = analyses.csv_rows
+    # the same quoting as csv_response
+    writer = DictWriter(out, fieldnames=columns, extrasaction="ignore")
+    writer.writeheader()
+    rows, page, cursor = 0, 0, None
+    while True:
+        args = MultiDict(params)
+        if cursor:
+            args["cursor"] = cursor
+        results, _, page, cursor = results_for(
+            args, page, chunk_size, user_id, group_code
+        )
+        writer.writerows(to_rows(results))
+        rows += len(results)
+        # drop what this chunk loaded before reading the next one
+        db.session.rollback()
+        progress(rows)
+        if not cursor:
+            return rows
+
+
+def remove_export_file(group_code: str, path: str) -> None:
+    if not path:
+        return
+    try:
+        if group_code:
+            get_minio_client().remove_object(group_code, path)
+        elif os.path.exists(path):
+            os.remove(path)
+    except Exception:
+        app.logger.warning("Could not remove export file %s", path, exc_info=True)
+
+
+def recover_stale_exports() -> None:
+    """
+    Fails running jobs that have made no progress for EXPORT_STALE_SECONDS, as the worker
+    running them must have stopped, and queues pending jobs that have waited as long on
+    this worker, as the worker they were submitted to may have stopped before running them.
+    """
+    table = models.ExportJob.__table__
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=app.config["EXPORT_STALE_SECONDS"])
+    db.session.execute(
+        table.update()
+        .where(table.c.state == models.ExportState.Running)
+        .where(table.c.updated < stale)
+        .values(
+            state=models.ExportState.Failed,
+            error="Interrupted",
+            finished=now,
+            updated=now,
+        )
+    )
+    orphans = db.session.execute(
+        table.select()
+        .with_only_columns([table.c.export_id])
+        .where(table.c.state == models.ExportState.Pending)
+        .where(table.c.created < stale)
+    ).fetchall()
+    # also ends the transaction, so that jobs are read as the pool last left them
+    db.session.commit()
+    for (export_id,) in orphans:
+        app.logger.warning("Picking up export %d, pending since %s", export_id, stale)
+        submit_export(export_id)
+
+
+@exports_blueprint.before_app_first_request
+def start_export_recovery() -> None:
+    """
+    Runs recover_stale_exports every half EXPORT_STALE_SECONDS on a background thread,
+    started with the first request of each gunicorn worker process.
+    """
+    if app.extensions.get("export_recovery"):
+        return
+    flask_app = app._get_current_object()
+    interval = app.config["EXPORT_STALE_SECONDS"] / 2
+
+    def recover():
+        while True:
+            sleep(interval)
+            with flask_app.app_context():
+                try:
+                    recover_stale_exports()
+                except Exception:
+                    app.logger.error("Could not recover stale exports", exc_info=True)
+                finally:
+                    db.session.remove()
+
+    thread = Thread(target=recover, name="export-recovery", daemon=True)
+    app.extensions["export_recovery"] = thread
+    thread.start()
+
+
+def cancel_job(export_id: int) -> bool:
+    """
+    Cancels the job if it is pending or running, returning whether it was. A running job
+    notices when it next records its progress.
+    """
+    table = models.ExportJob.__table__
+    now = datetime.utcnow()
+    result = db.session.execute(
+        table.update()
+        .where(table.c.export_id == export_id)
+        .where(table.c.state.in_(ACTIVE_STATES))
+        .values(state=models.ExportState.Cancelled, finished=now, updated=now)
+    )
+    # expires the session's jobs, so they are read again with their new state
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def is_admin() -> bool:
+    return app.config.get("LOGIN_DISABLED") or current_user.is_admin
+
+
+def export_or_404(id: int) -> models.ExportJob:
+    job = models.ExportJob.query.get(id)
+    # regular users only see their own jobs
+    if job is None or not (is_admin() or job.requester_id == current_user.user_id):
+        abort(404, description="Export not found")
+    return job
+
+
+def export_response(job: models.ExportJob) -> Dict[str, Any]:
+    return {
+        **asdict(job),
+        "params": json.loads(job.params),
+        "download": job.state == models.ExportState.Done
+        and url_for("exports.download_export", id=job.export_id),
+    }
+
+
+@exports_blueprint.route("/api/exports", methods=["GET"], strict_slashes=False)
+@login_required
+def list_exports():
+    """
+    The export jobs of the logged in user, newest first. Admins see every user's jobs.
+    """
+    query = models.ExportJob.query
+    if not is_admin():
+        query = query.filter(models.ExportJob.requester_id == current_user.user_id)
+    jobs = query.order_by(models.ExportJob.export_id.desc()).all()
+    return jsonify([export_response(job) for job in jobs])
+
+
+@exports_blueprint.route("/api/exports", methods=["POST"], strict_slashes=False)
+@login_required
+@validate_json
+def create_export():
+    """
+    Submits an export job, answering 202 with the job to poll.
+
+    kind is datasets or analyses for GET /api/datasets or /api/analyses with a text/csv
+    Accept header, or variants or participants for GET /api/summary/<kind>. params holds
+    the query string parameters that request would have, such as filters, order_by or the
+    gene panel. Pass a group_code to store the file in that group's MinIO bucket instead
+    of on the server, which limits the export to the datasets shared with that group.
+    """
+    if type(request.json) is not dict:
+        abort(400, description="Expected object")
+    kind = request.json.get("kind")
+    if kind not in export_kinds:
+        abort(400, description=f"kind must be one of {list(export_kinds)}")
+    params = request.json.get("params", {})
+    if type(params) is not dict or not all(
+        type(value) is str for value in params.values()
+    ):
+        abort(400, description="params should be an object of strings")
+    params = {key: value for key, value in params.items() if key not in paging_params}
+
+    if is_admin():
+        requester_id = (
+            None if app.config.get("LOGIN_DISABLED") else current_user.user_id
+        )
+    else:
+        requester_id = current_user.user_id
+        # regular users only ever export what they can see
+        params["user"] = str(requester_id)
+
+    if kind in ("variants", "participants"):
+        # aborts with 400 now rather than failing the job later
+        variants.parse_gene_panel(params.get("panel", ""))
+
+    group_code = request.json.get("group_code")
+    if group_code is not None:
+        group = models.Group.query.filter_by(group_code=group_code).one_or_none()
+        if group is None:
+            abort(404, description="Group not found")
+        if not is_admin() and group not in current_user.groups:
+            abort(403, description="Not a member of the group")
+
+    if (
+        requester_id is not None
+        and models.ExportJob.query.filter(
+            models.ExportJob.requester_id == requester_id,
+            models.ExportJob.state.in_(ACTIVE_STATES),
+        ).count()
+        >= app.config["EXPORT_MAX_ACTIVE"]
+    ):
+        abort(
+            429,
+            description=f"At most {app.config['EXPORT_MAX_ACTIVE']} exports may be pending or running at once",
+        )
+
+    job = models.ExportJob(
+        kind=kind,
+        params=json.dumps(params),
+        requester_id=requester_id,
+        group_code=group_code,
+    )
+    db.session.add(job)
+    transaction_or_abort(db.session.commit)
+    export_id = job.export_id
+    app.logger.info("Submitted %s export %d", kind, export_id)
+
+    submit_export(export_id)
+    # an export run in this request replaces the session
+    job = models.ExportJob.query.get(export_id)
+    response = jsonify(export_response(job))
+    response.status_code = 202
+    response.headers["Location"] = url_for("exports.get_export", id=export_id)
+    return response
+
+
+@exports_blueprint.route("/api/exports/<int:id>", methods=["GET"])
+@login_required
+def get_export(id: int):
+    return jsonify(export_response(export_or_404(id)))
+
+
+@exports_blueprint.route("/api/exports/<int:id>/download", methods=["GET"])
+@login_required
+def download_export(id: int):
+    """
+    The gzipped CSV of a finished export job.
+    """
+    job = export_or_404(id)
+    if job.state != models.ExportState.Done:
+        abort(409, description=f"Export is {job.state.value}")
+    filename = export_kinds[job.kind]
+
+    if not job.group_code:
+        if not os.path.exists(job.path):
+            abort(410, description="Export file is no longer available")
+        return send_file(
+            job.path,
+            "application/gzip",
+            as_attachment=True,
+            download_name=filename,
+        )
+
+    obj = get_minio_client().get_object(job.group_code, job.path)
+
+    def stream():
+        try:
+            yield from obj.stream(64 * 1024)
+        finally:
+            obj.close()
+            obj.release_conn()
+
+    response = Response(stream(), mimetype="application/gzip")
+    response.headers.set("Content-Disposition", "attachment", filename=filename)
+    return response
+
+
+@exports_blueprint.route("/api/exports/<int:id>/cancel", methods=["POST"])
+@login_required
+def cancel_export(id: int):
+    """
+    Cancels a pending or running export job. A running job stops after its current chunk.
+    """
+    job = export_or_404(id)
+    if not cancel_job(id):
+        abort(409, description=f"Export is already {job.state.value}")
+    app.logger.info("Cancelled export %d", id)
+    return jsonify(export_response(job))
+
+
+@exports_blueprint.route("/api/exports/<int:id>", methods=["DELETE"])
+@login_required
+def delete_export(id: int):
+    """
+    Deletes an export job and its file, cancelling it first if it has not finished.
+    """
+    job = export_or_404(id)
+    cancel_job(id)
+    # reloaded after the commit, in case the job finished since it was read
+    if job.state == models.ExportState.Done:
+        remove_export_file(job.group_code, job.path)
+    db.session.delete(job)
+    transaction_or_abort(db.session.commit)
+    return "Deletion successful", 204
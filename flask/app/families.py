@@ -1,11 +1,18 @@
 from dataclasses import asdict
+from typing import Any, List
 
 from flask import abort, jsonify, request, Response, Blueprint, current_app as app
 from flask_login import login_user, logout_user, current_user, login_required
 from .extensions import db, login
 from . import models
 from sqlalchemy.orm import contains_eager, joinedload
+from .permissions import permission_filter
 from .utils import check_admin, validate_json, transaction_or_abort
+from .variants import (
+    participant_analyses,
+    refresh_variant_summary,
+    variant_summary_keys,
+)
 
 family_blueprint = Blueprint(
     "families",
@@ -60,22 +67,14 @@ def list_families():
     if user_id:
         app.logger.debug("Processing query - restricted based on user id.")
         families = (
-            models.Family.query.options(contains_eager(models.Family.participants))
+            models.Family.query.options(
+                contains_eager(models.Family.participants).joinedload(
+                    models.Participant.institution
+                )
+            )
             .filter(models.Family.family_codename.like(starts_with))
             .join(models.Participant)
-            .join(models.TissueSample)
-            .join(models.Dataset)
-            .join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
+            .filter(permission_filter(models.Participant, user_id))
             .order_by(column)
             .limit(max_rows)
         )
@@ -83,7 +82,9 @@ def list_families():
         app.logger.debug("Processing query - unrestricted based on user id.")
         families = (
             models.Family.query.options(
-                joinedload(models.Family.participants),
+                joinedload(models.Family.participants).joinedload(
+                    models.Participant.institution
+                ),
                 joinedload(models.Family.created_by),
                 joinedload(models.Family.updated_by),
             )
@@ -113,6 +114,20 @@ def list_families():
     )
 
 
+def audit_loads(participants: Any, tissue_samples: Any) -> List[Any]:
+    """
+    Eager loads what get_family serializes of each participant and tissue sample,
+    given the loader options that reach them.
+    """
+    return [
+        participants.joinedload(models.Participant.institution),
+        participants.joinedload(models.Participant.created_by),
+        participants.joinedload(models.Participant.updated_by),
+        tissue_samples.joinedload(models.TissueSample.created_by),
+        tissue_samples.joinedload(models.TissueSample.updated_by),
+    ]
+
+
 @family_blueprint.route("/api/families/<int:id>", methods=["GET"])
 @login_required
 def get_family(id: int):
@@ -126,37 +141,29 @@ def get_family(id: int):
 
     if user_id:
         app.logger.debug("Processing query - restricted based on user id.")
+        participants = contains_eager(models.Family.participants)
+        tissue_samples = participants.contains_eager(models.Participant.tissue_samples)
         family = (
             models.Family.query.filter_by(family_id=id)
             .options(
-                contains_eager(models.Family.participants)
-                .contains_eager(models.Participant.tissue_samples)
-                .contains_eager(models.TissueSample.datasets)
+                tissue_samples.contains_eager(models.TissueSample.datasets),
+                *audit_loads(participants, tissue_samples),
             )
             .join(models.Participant)
             .join(models.TissueSample)
             .join(models.Dataset)
-            .join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
+            .filter(permission_filter(models.Dataset, user_id))
             .one_or_none()
         )
     else:
         app.logger.debug("Processing query - unrestricted based on user id.")
+        participants = joinedload(models.Family.participants)
+        tissue_samples = participants.joinedload(models.Participant.tissue_samples)
         family = (
             models.Family.query.filter_by(family_id=id)
             .options(
-                joinedload(models.Family.participants)
-                .joinedload(models.Participant.tissue_samples)
-                .joinedload(models.TissueSample.datasets),
+                tissue_samples.joinedload(models.TissueSample.datasets),
+                *audit_loads(participants, tissue_samples),
                 joinedload(models.Family.created_by),
                 joinedload(models.Family.updated_by),
             )
@@ -249,35 +256,17 @@ def update_family(id: int):
         user_id = current_user.user_id
         app.logger.debug("User is regular with ID '%s'", user_id)
 
-    if user_id:
-        app.logger.debug("Processing query - restricted based on user id.")
-        family = (
-            models.Family.query.filter_by(family_id=id)
-            .join(models.Participant)
-            .join(models.TissueSample)
-            .join(models.Dataset)
-            .join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
-            .first_or_404()
-        )
-    else:
-        app.logger.debug("Processing query - unrestricted based on user id.")
-        family = models.Family.query.filter_by(family_id=id).first_or_404()
+    app.logger.debug("Processing query - restricted based on user id, if any.")
+    family = models.Family.query.filter(
+        models.Family.family_id == id, permission_filter(models.Family, user_id)
+    ).first_or_404()
 
     app.logger.debug(
         "Family codename is being changed from '%s' to '%s'",
         family.family_codename,
         fam_codename,
     )
+    codename_changed = family.family_codename != fam_codename
     family.family_codename = fam_codename
 
     app.logger.debug("Family code update is peformed by user: '%s'", user_id)
@@ -285,6 +274,15 @@ def update_family(id: int):
         family.updated_by_id = user_id
 
     try:
+        if codename_changed:
+            app.logger.debug("Refreshing variant summaries with the family codename..")
+            refresh_variant_summary(
+                variant_summary_keys(
+                    participant_analyses(
+                        models.Participant.family_id == family.family_id
+                    )
+                )
+            )
 
         db.session.commit()
         app.logger.debug("Update successful, returning JSON...")
@@ -1,7 +1,10 @@
+from bisect import bisect_left
 from dataclasses import asdict
-from typing import Any, Dict
-from flask import abort, jsonify, request, Blueprint
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from flask import abort, current_app as app, jsonify, request, Blueprint
 from flask_login import login_required
+import numpy as np
 from sqlalchemy import func
 from sqlalchemy.orm import contains_eager, joinedload
 from .extensions import db
@@ -14,21 +17,299 @@ genes_blueprint = Blueprint(
 )
 
 
+class GeneIndex:
+    """
+    The gene table's coordinates as per-chromosome NumPy arrays of start, end and
+    ensembl_id sorted by start, for resolving gene panels without a database round trip.
+    The table is GRCh37 reference data, so the index is shared by every request in a worker.
+    """
+
+    def __init__(self, rows: Iterable[Tuple[int, str, int, int]], version: Any = None):
+        self.version = version
+        self.checked = monotonic()
+        rows = list(rows)
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        chromosomes = np.array([row[1] for row in rows], dtype=object)
+        starts = np.array([row[2] for row in rows], dtype=np.int64)
+        ends = np.array([row[3] for row in rows], dtype=np.int64)
+
+        self.chromosome_names: List[str] = sorted(set(chromosomes))
+        self.chromosomes: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        # the longest gene on each chromosome bounds how far back a covering gene can start
+        self.longest: Dict[str, int] = {}
+        # Where each gene is in its chromosome's arrays, ordered by ensembl_id
+        gene_chromosome = np.zeros(len(rows), dtype=np.int64)
+        gene_offset = np.zeros(len(rows), dtype=np.int64)
+        for code, name in enumerate(self.chromosome_names):
+            rows_on = np.flatnonzero(chromosomes == name)
+            rows_on = rows_on[np.argsort(starts[rows_on], kind="stable")]
+            self.chromosomes[name] = (starts[rows_on], ends[rows_on], ids[rows_on])
+            self.longest[name] = int((ends[rows_on] - starts[rows_on]).max(initial=0))
+            gene_chromosome[rows_on] = code
+            gene_offset[rows_on] = np.arange(len(rows_on))
+        order = np.argsort(ids)
+        self.ids = ids[order]
+        self.gene_chromosome = gene_chromosome[order]
+        self.gene_offset = gene_offset[order]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def lookup(self, ensembl_ids: Iterable[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the positions in self.ids of the requested genes that exist and
+        the requested ensembl_ids that do not.
+        """
+        requested = np.unique(np.fromiter(ensembl_ids, dtype=np.int64))
+        positions = np.searchsorted(self.ids, requested)
+        found = positions < len(self.ids)
+        found[found] = self.ids[positions[found]] == requested[found]
+        return positions[found], requested[~found]
+
+    def missing(self, ensembl_ids: Iterable[int]) -> List[int]:
+        return self.lookup(ensembl_ids)[1].tolist()
+
+    def overlapping(self, chromosome: str, positions: Iterable[int]) -> List[List[int]]:
+        """
+        Returns the ensembl_ids of the genes covering each 1-based position on the chromosome.
+        """
+        positions = np.fromiter(positions, dtype=np.int64)
+        if chromosome not in self.chromosomes:
+            return [[] for _ in positions]
+        starts, ends, ids = self.chromosomes[chromosome]
+        lows = np.searchsorted(starts, positions - self.longest[chromosome], "left")
+        highs = np.searchsorted(starts, positions, "right")
+        return [
+            ids[low:high][ends[low:high] >= position].tolist()
+            for position, low, high in zip(positions, lows, highs)
+        ]
+
+    def regions(self, ensembl_ids: Iterable[int]) -> List[Tuple[str, int, int]]:
+        """
+        Returns the 1-based, closed (chromosome, start, end) intervals covered by the
+        genes, with overlapping and adjacent genes merged so each region appears once.
+        Unknown ensembl_ids are ignored.
+        """
+        positions, _ = self.lookup(ensembl_ids)
+        regions = []
+        for code in np.unique(self.gene_chromosome[positions]):
+            name = self.chromosome_names[code]
+            starts, ends, _ = self.chromosomes[name]
+            # the arrays are sorted by start, so sorted offsets are in order of start
+            offsets = np.sort(
+                self.gene_offset[positions[self.gene_chromosome[positions] == code]]
+            )
+            starts, ends = starts[offsets], ends[offsets]
+            reach = np.maximum.accumulate(ends)
+            # a gene begins a new region if it starts past every gene before it
+            first = np.flatnonzero(np.append(True, starts[1:] > reach[:-1] + 1))
+            last = np.append(first[1:], len(starts)) - 1
+            regions.extend(
+                (name, int(start), int(end))
+                for start, end in zip(starts[first], reach[last])
+            )
+        return regions
+
+
+def gene_table_version() -> Tuple[Any, ...]:
+    """
+    A cheap fingerprint of the gene table that changes when genes are added,
+    removed or moved.
+    """
+    return tuple(
+        db.session.query(
+            func.count(Gene.ensembl_id),
+            func.max(Gene.ensembl_id),
+            func.sum(Gene.ensembl_id),
+            func.sum(Gene.start),
+            func.sum(Gene.end),
+        ).one()
+    )
+
+
+def cached_index(key: str, version: Callable[[], Any], build: Callable[[Any], Any]):
+    """
+    Returns the worker's index stored under key, building it on first use. Once it is
+    older than GENE_INDEX_TTL seconds, version() fingerprints the underlying table and
+    the index is only rebuilt if the table has changed.
+    """
+    index = app.extensions.get(key)
+    if index is not None and monotonic() - index.checked < app.config["GENE_INDEX_TTL"]:
+        return index
+    current = version()
+    if index is not None and index.version == current:
+        index.checked = monotonic()
+        return index
+    app.logger.debug("Loading the %s..", key.replace("_", " "))
+    index = app.extensions[key] = build(current)
+    return index
+
+
+def get_gene_index() -> GeneIndex:
+    return cached_index(
+        "gene_index",
+        gene_table_version,
+        lambda version: GeneIndex(
+            db.session.query(Gene.ensembl_id, Gene.chromosome, Gene.start, Gene.end),
+            version,
+        ),
+    )
+
+
+def alias_kind_rank(kind: Optional[str]) -> int:
+    """
+    Ranks current HGNC symbols before previous symbols, and those before synonyms
+    and aliases of any other kind.
+    """
+    kind = (kind or "").lower()
+    if "current" in kind:
+        return 0
+    if "previous" in kind:
+        return 1
+    return 2
+
+
+class GeneAliasIndex:
+    """
+    Case-insensitive search over gene alias names for autocomplete. Names are kept
+    sorted so prefixes are found by bisection, and every 1 to NGRAM character substring
+    of a name has a sorted posting list of the aliases containing it. Longer searches
+    intersect the postings of their n-grams and check the few remaining candidates.
+    """
+
+    NGRAM = 3
+
+    def __init__(
+        self, rows: Iterable[Tuple[int, int, str, Optional[str]]], version: Any = None
+    ):
+        self.version = version
+        self.checked = monotonic()
+        # in table order, which is the order of an unfiltered listing
+        rows = sorted(rows)
+        self.aliases = [
+            {"ensembl_id": ensembl_id, "name": name, "kind": kind}
+            for _, ensembl_id, name, kind in rows
+        ]
+        self.names = [name.lower() for _, _, name, _ in rows]
+        self.kind_ranks = np.array(
+            [alias_kind_rank(kind) for _, _, _, kind in rows], dtype=np.int64
+        )
+        # ranks aliases that match a search equally well by kind, then by name
+        order = sorted(
+            range(len(rows)), key=lambda i: (self.kind_ranks[i], self.names[i], i)
+        )
+        self.rank = np.empty(len(rows), dtype=np.int64)
+        self.rank[order] = np.arange(len(rows))
+
+        by_name = sorted(range(len(rows)), key=lambda i: (self.names[i], i))
+        self.by_name = np.array(by_name, dtype=np.int64)
+        self.sorted_names = [self.names[i] for i in by_name]
+
+        postings: Dict[str, List[int]] = {}
+        for i, name in enumerate(self.names):
+            grams = {
+                name[start : start + size]
+                for size in range(1, self.NGRAM + 1)
+                for start in range(len(name) - size + 1)
+            }
+            for gram in grams:
+                postings.setdefault(gram, []).append(i)
+        self.postings = {
+            gram: np.array(ids, dtype=np.int64) for gram, ids in postings.items()
+        }
+
+    def matches(self, term: str) -> np.ndarray:
+        """
+        Returns the sorted positions of the aliases whose names contain the lowercase term.
+        """
+        empty = np.array([], dtype=np.int64)
+        if len(term) <= self.NGRAM:
+            return self.postings.get(term, empty)
+        grams = {term[i : i + self.NGRAM] for i in range(len(term) - self.NGRAM + 1)}
+        candidates, *rest = sorted(
+            (self.postings.get(gram, empty) for gram in grams), key=len
+        )
+        for postings in rest:
+            if not len(candidates):
+                break
+            candidates = np.intersect1d(candidates, postings, assume_unique=True)
+        return candidates[
+            np.fromiter(
+                (term in self.names[i] for i in candidates), bool, len(candidates)
+            )
+        ]
+
+    def name_range(self, low: str, high: str) -> np.ndarray:
+        """Returns the positions of the aliases with low <= name < high"""
+        return self.by_name[
+            bisect_left(self.sorted_names, low) : bisect_left(self.sorted_names, high)
+        ]
+
+    def search(
+        self, term: str, offset: int = 0, limit: Optional[int] = None
+    ) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Returns a page of the aliases whose names contain term and how many there are
+        in total. Exact matches come first, then current HGNC symbols, previous symbols
+        and synonyms, each with names starting with term before other matches.
+        Without a term, all aliases are listed in table order.
+        """
+        stop = None if limit is None else offset + limit
+        if not term:
+            return self.aliases[offset:stop], len(self.aliases)
+        term = term.lower()
+        found = self.matches(term)
+        successor = term[:-1] + chr(ord(term[-1]) + 1)
+        exact = np.isin(found, self.name_range(term, term + "\0"))
+        prefix = np.isin(found, self.name_range(term, successor))
+        ranked = found[
+            np.lexsort((self.rank[found], ~prefix, self.kind_ranks[found], ~exact))
+        ]
+        return [self.aliases[i] for i in ranked[offset:stop]], len(found)
+
+
+def gene_alias_version() -> Tuple[Any, ...]:
+    """
+    A cheap fingerprint of the gene alias table that changes when aliases are
+    added, removed or renamed.
+    """
+    return tuple(
+        db.session.query(
+            func.count(GeneAlias.alias_id),
+            func.max(GeneAlias.alias_id),
+            func.sum(GeneAlias.alias_id),
+            func.sum(GeneAlias.ensembl_id),
+            func.sum(func.length(GeneAlias.name)),
+            func.sum(func.length(GeneAlias.kind)),
+        ).one()
+    )
+
+
+def get_gene_alias_index() -> GeneAliasIndex:
+    return cached_index(
+        "gene_alias_index",
+        gene_alias_version,
+        lambda version: GeneAliasIndex(
+            db.session.query(
+                GeneAlias.alias_id, GeneAlias.ensembl_id, GeneAlias.name, GeneAlias.kind
+            ),
+            version,
+        ),
+    )
+
+
 @genes_blueprint.route("/api/summary/genes", methods=["GET"])
 @paged
 @login_required
 def genes(page: int, limit: int):
-    """index route for genes"""
+    """
+    index route for genes, optionally searching aliases with ?search=, which is
+    answered from the in-memory alias index
+    """
     search = request.args.get("search", type=str)
-    gene_query = GeneAlias.query
-    if search:
-        gene_query = gene_query.filter(func.instr(GeneAlias.name, search))
-
-    total_count = gene_query.with_entities(
-        func.count(func.distinct(GeneAlias.alias_id))
-    ).scalar()
-
-    results = gene_query.limit(limit).offset(page * (limit or 0)).all()
+    results, total_count = get_gene_alias_index().search(
+        search, page * (limit or 0), limit
+    )
 
     if expects_json(request):
         return paginated_response(results, page, total_count, limit)
@@ -2,12 +2,19 @@ from urllib.parse import quote
 
 from flask import abort, jsonify, request, Response, Blueprint, current_app as app
 from flask_login import current_user, login_required
-from minio import Minio
 
 from . import models
+from .buckets import get_listing_cache
 from .extensions import db
 from .madmin import stager_buckets_policy
-from .utils import check_admin, get_minio_admin, transaction_or_abort, validate_json
+from .minio_sync import admin_call, sync_minio
+from .utils import (
+    check_admin,
+    get_minio_admin,
+    get_minio_client,
+    transaction_or_abort,
+    validate_json,
+)
 
 
 groups_blueprint = Blueprint(
@@ -101,7 +108,8 @@ def update_group(group_code) -> Response:
     Change the display name or user membership of a group. Both request body fields
     are optional and they will only be changed if provided. Administrator-only.
 
-    Potential problems: MinIO operations failing result in an inconsistent state.
+    MinIO operations that still fail after retrying are recorded in the
+    reconciliation log to be replayed.
     """
 
     app.logger.debug("Getting new group users, if any..")
@@ -130,8 +138,6 @@ def update_group(group_code) -> Response:
             abort(422, description="Group name in use")
         group.group_name = request.json["group_name"]
 
-    minio_admin = get_minio_admin()
-
     if strlist_users:
         app.logger.debug("Checking if users to be added exist..")
         users = models.User.query.filter(
@@ -141,20 +147,35 @@ def update_group(group_code) -> Response:
         if len(users) != len(request.json["users"]):
             abort(404, description="Invalid username provided")
 
-        app.logger.debug("Clearing users from db and minio group..")
+        access_keys = [user.minio_access_key for user in users if user.minio_access_key]
+        stale_members = []
         if len(group.users) != 0:
-            group_info = minio_admin.get_group(group_code)
-            minio_admin.group_remove(group_code, *group_info["members"])
-            group.users = []
-
-        app.logger.debug("Adding users to group..")
-        for user in users:
-            # Add to db groups
-            group.users.append(user)
-            # Update/add them to the minio groups
-            minio_admin.group_add(group_code, user.minio_access_key)
-        # Reset policy for group in case the group did not exist
-        minio_admin.set_policy(group_code, group=group_code)
+            group_info = get_minio_admin().get_group(group_code)
+            stale_members = [
+                member
+                for member in group_info.get("members", [])
+                if member not in access_keys
+            ]
+
+        app.logger.debug("Replacing group users in db and minio group..")
+        group.users = users
+        # Removing former members and adding the requested ones touch disjoint
+        # members, so they run concurrently
+        sync_minio(
+            [
+                [admin_call("group_remove", group_code, *stale_members)]
+                if stale_members
+                else [],
+                [
+                    admin_call("group_add", group_code, *access_keys),
+                    # Reset policy for group in case the group did not exist
+                    admin_call("set_policy", group_code, group=group_code),
+                ]
+                if access_keys
+                else [],
+            ],
+            f"PATCH /api/groups/{group_code}",
+        )
 
     transaction_or_abort(db.session.commit)
     app.logger.debug("Changes successful; returning JSON..")
@@ -200,12 +221,7 @@ def create_group():
     ):
         abort(422, description="Group already exists")
 
-    minio_client = Minio(
-        app.config["MINIO_ENDPOINT"],
-        access_key=app.config["MINIO_ACCESS_KEY"],
-        secret_key=app.config["MINIO_SECRET_KEY"],
-        secure=False,
-    )
+    minio_client = get_minio_client()
 
     minio_admin = get_minio_admin()
 
@@ -217,6 +233,7 @@ def create_group():
         minio_client.make_bucket(
             bucket_name=group_code, location=app.config["MINIO_REGION_NAME"]
         )
+        get_listing_cache().invalidate()
     except:
         abort(422, description="Invalid bucket name")
 
@@ -242,8 +259,7 @@ def create_group():
     # Add users to minio group if applicable, creating group as well
     if strlist_users:
         app.logger.debug("Adding users to minio group..")
-        for user in users:
-            minio_admin.group_add(group_code, user.minio_access_key)
+        minio_admin.group_add(group_code, *[user.minio_access_key for user in users])
 
         # Set group access policy to the bucket by the same name
         minio_admin.set_policy(group_code, group=group_code)
@@ -0,0 +1,182 @@
+"""
+Request-scoped instrumentation. While a request is handled, SQLAlchemy engine events count
+its queries, the time spent executing them and the rows they returned, and code paths
+wrapped in timed() add up the time spent in pandas and in serializing responses. The totals
+are sent back in a Server-Timing header if INSTRUMENT_REQUESTS is set and logged as one
+JSON line per request if REQUEST_LOG is set. With either, statements repeated more than
+N_PLUS_ONE_THRESHOLD times in one request are logged as likely N+1 query patterns.
+"""
+from collections import Counter
+from contextlib import contextmanager
+import json
+import logging
+from time import perf_counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from flask import Flask, Response, current_app as app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# the JSON line logged per request when REQUEST_LOG is set
+request_logger = logging.getLogger("app.requests")
+
+
+class RequestMetrics:
+    """
+    What one request spent its time on. Times are in seconds.
+    """
+
+    def __init__(self):
+        self.start = perf_counter()
+        self.queries = 0
+        self.rows = 0
+        self.db_time = 0.0
+        # time spent in timed() sections, by name
+        self.times: Dict[str, float] = {}
+        self.statements: Counter = Counter()
+
+    def add_query(self, statement: str, elapsed: float, rows: int) -> None:
+        self.queries += 1
+        self.db_time += elapsed
+        # drivers report -1 when they do not know, eg. for unbuffered results
+        self.rows += max(rows, 0)
+        self.statements[statement] += 1
+
+    def add_time(self, name: str, elapsed: float) -> None:
+        self.times[name] = self.times.get(name, 0.0) + elapsed
+
+    def repeated(self, threshold: int) -> List[Tuple[str, int]]:
+        """
+        Returns the statements executed more than threshold times, most repeated first.
+        """
+        return [
+            (statement, count)
+            for statement, count in self.statements.most_common()
+            if count > threshold
+        ]
+
+    def server_timing(self) -> str:
+        """
+        Formats the metrics as a Server-Timing header value, in milliseconds.
+        """
+        metrics = [
+            f'db;dur={self.db_time * 1000:.1f};desc="{self.queries} queries, {self.rows} rows"'
+        ]
+        metrics += [
+            f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in self.times.items()
+        ]
+        metrics.append(f"app;dur={(perf_counter() - self.start) * 1000:.1f}")
+        return ", ".join(metrics)
+
+
+def current_metrics() -> Optional[RequestMetrics]:
+    """
+    Returns the metrics of the request being handled, if it is instrumented.
+    """
+    return g.get("request_metrics") if has_app_context() else None
+
+
+@contextmanager
+def timed(name: str) -> Iterator[None]:
+    """
+    Adds the time spent in the block to the request's metrics under name, eg. "pandas".
+    """
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        metrics.add_time(name, perf_counter() - start)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_metrics() is not None:
+        context.stager_query_start = perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    metrics = current_metrics()
+    start = getattr(context, "stager_query_start", None)
+    if metrics is not None and start is not None:
+        metrics.add_query(statement, perf_counter() - start, cursor.rowcount)
+
+
+def timed_json_encoder(encoder: Any) -> Any:
+    """
+    Returns a subclass of the app's JSON encoder that times jsonify as serialization.
+    """
+
+    class TimedJSONEncoder(encoder):
+        def encode(self, obj):
+            with timed("serialize"):
+                return super().encode(obj)
+
+    return TimedJSONEncoder
+
+
+def start_request_metrics() -> None:
+    g.request_metrics = RequestMetrics()
+
+
+def finish_request_metrics(response: Response) -> Response:
+    # streamed bodies are generated after this, so their queries go uncounted
+    metrics = g.pop("request_metrics", None)
+    if metrics is None:
+        return response
+    if app.config["INSTRUMENT_REQUESTS"]:
+        response.headers["Server-Timing"] = metrics.server_timing()
+
+    repeated = metrics.repeated(app.config["N_PLUS_ONE_THRESHOLD"])
+    for statement, count in repeated:
+        app.logger.warning(
+            "Possible N+1 queries: statement executed %s times in %s %s: %s",
+            count,
+            request.method,
+            request.path,
+            " ".join(statement.split())[:300],
+        )
+
+    if app.config["REQUEST_LOG"]:
+        request_logger.info(
+            json.dumps(
+                {
+                    "method": request.method,
+                    "path": request.path,
+                    "endpoint": request.endpoint,
+                    "status": response.status_code,
+                    "duration_ms": round((perf_counter() - metrics.start) * 1000, 1),
+                    "queries": metrics.queries,
+                    "db_ms": round(metrics.db_time * 1000, 1),
+                    "rows": metrics.rows,
+                    **{
+                        f"{name}_ms": round(elapsed * 1000, 1)
+                        for name, elapsed in metrics.times.items()
+                    },
+                    "repeated_statements": len(repeated),
+                }
+            )
+        )
+    return response
+
+
+def discard_request_metrics(error: Optional[BaseException]) -> None:
+    # The test client can pop a preserved request context after its app context
+    if has_app_context():
+        g.pop("request_metrics", None)
+
+
+def register_instrumentation(app: Flask) -> None:
+    if not app.config["INSTRUMENT_REQUESTS"] and not app.config["REQUEST_LOG"]:
+        return
+    if not event.contains(Engine, "before_cursor_execute", before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    app.json_encoder = timed_json_encoder(app.json_encoder)
+    app.before_request(start_request_metrics)
+    app.after_request(finish_request_metrics)
+    app.teardown_request(discard_request_metrics)
+    if app.config["REQUEST_LOG"]:
+        request_logger.setLevel(logging.INFO)
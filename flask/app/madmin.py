@@ -1,116 +1,377 @@
-import json, os, subprocess
-from typing import Any, Dict, List, Optional, Union
+"""
+Client for the MinIO admin REST API, the same API that `mc admin` calls.
+
+Requests are signed with AWS Signature Version 4 and sent over a pooled
+urllib3 session, so admin operations no longer start a process each. Return
+values keep the shape of the `mc --json` output this module used to parse.
+"""
+from datetime import datetime
+import hashlib
+import hmac
+import json
+import os
+from typing import Any, Dict, List, Optional, Tuple, Union
+from urllib.parse import quote
+
+from argon2.low_level import Type, hash_secret_raw
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+import urllib3
+
+from .metrics import minio_admin_timer
+
+# Encrypted payloads (github.com/minio/madmin-go EncryptData) are laid out as
+# salt | AEAD id | nonce | sio stream of 16KiB fragments, each with a 16 byte tag
+SALT_SIZE = 32
+NONCE_SIZE = 8
+FRAGMENT_SIZE = 1 << 14
+TAG_SIZE = 16
+ARGON2ID_AES_GCM = 0
+ARGON2ID_CHACHA20_POLY1305 = 1
+PBKDF2_AES_GCM = 2
+
+
+class MinioAdminError(RuntimeError):
+    """
+    Raised when the admin API rejects a request. args[0] is the error message.
+    """
+
+    def __init__(self, message: str, status: int, code: str = None):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+
+
+def derive_key(aead_id: int, password: bytes, salt: bytes) -> bytes:
+    if aead_id == PBKDF2_AES_GCM:
+        return hashlib.pbkdf2_hmac("sha256", password, salt, 8192, 32)
+    return hash_secret_raw(
+        password,
+        salt,
+        time_cost=1,
+        memory_cost=64 * 1024,
+        parallelism=4,
+        hash_len=32,
+        type=Type.ID,
+    )
+
+
+def get_aead(aead_id: int, key: bytes) -> Union[AESGCM, ChaCha20Poly1305]:
+    if aead_id in (ARGON2ID_AES_GCM, PBKDF2_AES_GCM):
+        return AESGCM(key)
+    if aead_id == ARGON2ID_CHACHA20_POLY1305:
+        return ChaCha20Poly1305(key)
+    raise ValueError(f"Unknown AEAD id {aead_id}")
+
+
+def fragment_nonce(nonce: bytes, sequence: int) -> bytes:
+    return nonce + sequence.to_bytes(4, byteorder="little")
+
+
+def encrypt_data(password: str, data: bytes) -> bytes:
+    """
+    Encrypts data for the admin API with a key derived from password, which is
+    the secret key of the credentials making the request.
+    """
+    salt = os.urandom(SALT_SIZE)
+    nonce = os.urandom(NONCE_SIZE)
+    aead = get_aead(
+        ARGON2ID_AES_GCM, derive_key(ARGON2ID_AES_GCM, password.encode(), salt)
+    )
+    # The first nonce authenticates the (empty) associated data for the stream
+    associated_data = b"\x00" + aead.encrypt(fragment_nonce(nonce, 0), b"", None)
+    fragments = [
+        data[i : i + FRAGMENT_SIZE] for i in range(0, len(data), FRAGMENT_SIZE)
+    ] or [b""]
+    ciphertext = [salt, bytes([ARGON2ID_AES_GCM]), nonce]
+    for sequence, fragment in enumerate(fragments, start=1):
+        if sequence == len(fragments):
+            associated_data = b"\x80" + associated_data[1:]
+        ciphertext.append(
+            aead.encrypt(fragment_nonce(nonce, sequence), fragment, associated_data)
+        )
+    return b"".join(ciphertext)
+
+
+def decrypt_data(password: str, data: bytes) -> bytes:
+    """
+    Decrypts a payload returned by the admin API, raising ValueError if it is
+    malformed or was not encrypted with password.
+    """
+    header_size = SALT_SIZE + 1 + NONCE_SIZE
+    if len(data) < header_size + TAG_SIZE:
+        raise ValueError("Encrypted payload is too short")
+    salt, aead_id, nonce = (
+        data[:SALT_SIZE],
+        data[SALT_SIZE],
+        data[SALT_SIZE + 1 : header_size],
+    )
+    aead = get_aead(aead_id, derive_key(aead_id, password.encode(), salt))
+    associated_data = b"\x00" + aead.encrypt(fragment_nonce(nonce, 0), b"", None)
+    stream = data[header_size:]
+    size = FRAGMENT_SIZE + TAG_SIZE
+    fragments = [stream[i : i + size] for i in range(0, len(stream), size)]
+    plaintext = []
+    try:
+        for sequence, fragment in enumerate(fragments, start=1):
+            if sequence == len(fragments):
+                associated_data = b"\x80" + associated_data[1:]
+            plaintext.append(
+                aead.decrypt(fragment_nonce(nonce, sequence), fragment, associated_data)
+            )
+    except Exception as err:  # cryptography raises InvalidTag without a message
+        raise ValueError("Could not decrypt payload") from err
+    return b"".join(plaintext)
+
+
+def sign_v4(
+    method: str,
+    path: str,
+    query: str,
+    headers: Dict[str, str],
+    payload_hash: str,
+    access_key: str,
+    secret_key: str,
+    region: str,
+    now: datetime,
+    service: str = "s3",
+) -> str:
+    """
+    Returns the Authorization header for a request signed with AWS Signature
+    Version 4. headers must include every header to sign, in lowercase.
+    """
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    scope = f"{amz_date[:8]}/{region}/{service}/aws4_request"
+    signed_headers = ";".join(sorted(headers))
+    canonical_request = "\n".join(
+        [
+            method,
+            quote(path),
+            query,
+            "".join(f"{name}:{headers[name].strip()}\n" for name in sorted(headers)),
+            signed_headers,
+            payload_hash,
+        ]
+    )
+    string_to_sign = "\n".join(
+        [
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ]
+    )
+    key = f"AWS4{secret_key}".encode()
+    for part in scope.split("/"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    return (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+        f"SignedHeaders={signed_headers}, Signature={signature}"
+    )
+
+
+def user_info(access_key: str, user: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Reshapes a madmin UserInfo like `mc admin user info --json` prints it.
+    """
+    result = {
+        "status": "success",
+        "accessKey": access_key,
+        "policyName": user.get("policyName", ""),
+        "userStatus": user.get("status"),
+    }
+    if user.get("memberOf"):
+        result["memberOf"] = user["memberOf"]
+    return result
 
 
 class MinioAdmin:
-    _name = "app"
+    _prefix = "/minio/admin/v3/"
 
-    def __init__(self, endpoint: str, access_key: str, secret_key: str, secure=False):
+    def __init__(
+        self,
+        endpoint: str,
+        access_key: str,
+        secret_key: str,
+        secure=False,
+        region: str = "us-east-1",
+        http_client: urllib3.PoolManager = None,
+    ):
         protocol = "https" if secure else "http"
-        self._url = f"{protocol}://{access_key}:{secret_key}@{endpoint}"
-
-    def _exec(self, cmd: List[str], params: List[str] = []) -> str:
-        env = os.environ.copy()
-        env[f"MC_HOST_{self._name}"] = self._url
-        result = subprocess.run(
-            ["mc", "--config-dir", "/tmp/.mc", "--json", "admin"]
-            + cmd
-            + [self._name]
-            + params,
-            env=env,
-            capture_output=True,
-            text=True,
+        self._url = f"{protocol}://{endpoint}"
+        self._host = endpoint
+        self._access_key = access_key
+        self._secret_key = secret_key
+        self._region = region
+        self._http = http_client or urllib3.PoolManager(
+            maxsize=10,
+            timeout=urllib3.Timeout(connect=5, read=60),
+            retries=urllib3.Retry(
+                total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504]
+            ),
         )
-        if result.returncode != 0:
-            raise RuntimeError(result.stdout)
-        return result.stdout
+
+    def _request(
+        self,
+        method: str,
+        command: str,
+        params: Optional[Dict[str, str]] = None,
+        body: bytes = b"",
+    ) -> bytes:
+        path = self._prefix + command
+        query = "&".join(
+            f"{quote(key, safe='')}={quote(value, safe='')}"
+            for key, value in sorted((params or {}).items())
+        )
+        payload_hash = hashlib.sha256(body).hexdigest()
+        now = datetime.utcnow()
+        headers = {
+            "host": self._host,
+            "x-amz-content-sha256": payload_hash,
+            "x-amz-date": now.strftime("%Y%m%dT%H%M%SZ"),
+        }
+        headers["authorization"] = sign_v4(
+            method,
+            path,
+            query,
+            headers,
+            payload_hash,
+            self._access_key,
+            self._secret_key,
+            self._region,
+            now,
+        )
+        with minio_admin_timer(command):
+            response = self._http.request(
+                method,
+                f"{self._url}{path}?{query}" if query else f"{self._url}{path}",
+                body=body or None,
+                headers=headers,
+            )
+            if response.status >= 300:
+                try:
+                    error = json.loads(response.data)
+                    raise MinioAdminError(
+                        error["Message"], response.status, error["Code"]
+                    )
+                except (ValueError, KeyError, TypeError):
+                    raise MinioAdminError(
+                        response.data.decode(errors="replace") or response.reason,
+                        response.status,
+                    )
+        return response.data
+
+    def _json(self, *args, **kwargs) -> Any:
+        return json.loads(self._request(*args, **kwargs))
 
     def list_users(self) -> List[Dict[str, Any]]:
-        raw = self._exec(["user", "list"]).strip()
-        if not raw:
-            return []
-        return [json.loads(user) for user in raw.split("\n")]
+        users = json.loads(
+            decrypt_data(self._secret_key, self._request("GET", "list-users"))
+        )
+        return [user_info(access_key, user) for access_key, user in users.items()]
 
     def get_user(self, access_key) -> Dict[str, Any]:
-        raw_user = self._exec(["user", "info"], [access_key])
-        return json.loads(raw_user)
+        return user_info(
+            access_key, self._json("GET", "user-info", {"accessKey": access_key})
+        )
 
     def add_user(self, access_key: str, secret_key: str) -> None:
-        self._exec(["user", "add"], [access_key, secret_key])
+        body = json.dumps({"secretKey": secret_key, "status": "enabled"})
+        self._request(
+            "PUT",
+            "add-user",
+            {"accessKey": access_key},
+            encrypt_data(self._secret_key, body.encode()),
+        )
 
     def disable_user(self, access_key: str) -> None:
-        self._exec(["user", "disable"], [access_key])
+        self._request(
+            "PUT", "set-user-status", {"accessKey": access_key, "status": "disabled"}
+        )
 
     def enable_user(self, access_key: str) -> None:
-        self._exec(["user", "enable"], [access_key])
+        self._request(
+            "PUT", "set-user-status", {"accessKey": access_key, "status": "enabled"}
+        )
 
     def remove_user(self, access_key: str) -> None:
-        self._exec(["user", "remove"], [access_key])
+        self._request("DELETE", "remove-user", {"accessKey": access_key})
 
     def list_groups(self) -> List[str]:
-        raw = self._exec(["group", "list"]).strip()
-        if not raw:
-            return []
-        result = json.loads(raw)
-        if "groups" not in result:
-            return []
-        return result["groups"]
+        return self._json("GET", "groups") or []
 
     def get_group(self, group: str) -> Dict[str, Any]:
-        raw_group = self._exec(["group", "info"], [group])
-        return json.loads(raw_group)
+        info = self._json("GET", "group", {"group": group})
+        result = {
+            "status": "success",
+            "groupName": info.get("name", group),
+            "groupStatus": info.get("status"),
+            "groupPolicy": info.get("policy", ""),
+        }
+        # Like mc, leave out members entirely when there are none
+        if info.get("members"):
+            result["members"] = info["members"]
+        return result
+
+    def _update_group_members(
+        self, group: str, members: Tuple[str, ...], remove: bool
+    ) -> None:
+        body = {"group": group, "members": list(members), "isRemove": remove}
+        self._request("PUT", "update-group-members", body=json.dumps(body).encode())
 
     def group_add(self, group: str, *args: str) -> None:
         """
         Add as many listed users as possible to the group, creating the group
-        if it does not exist already.
+        if it does not exist already. All users are added in a single request.
         """
-        self._exec(["group", "add"], [group, *args])
+        self._update_group_members(group, args, remove=False)
 
     def disable_group(self, group: str) -> None:
-        self._exec(["group", "disable"], [group])
+        self._request("PUT", "set-group-status", {"group": group, "status": "disabled"})
 
     def enable_group(self, group: str) -> None:
-        self._exec(["group", "enable"], [group])
+        self._request("PUT", "set-group-status", {"group": group, "status": "enabled"})
 
     def group_remove(self, group: str, *users: str) -> None:
         """
         Remove as many listed users as possible from the group, or remove the
         group if no arguments are provided and it is empty.
         """
-        self._exec(["group", "remove"], [group, *users])
+        self._update_group_members(group, users, remove=True)
 
     def list_policies(self) -> List[Dict[str, Any]]:
-        raw = self._exec(["policy", "list"]).strip()
-        if not raw:
-            return []
-        return [json.loads(policy) for policy in raw.split("\n")]
+        policies = self._json("GET", "list-canned-policies")
+        return [{"status": "success", "policy": name} for name in sorted(policies)]
 
     def get_policy(self, policy: str) -> Dict[str, Any]:
-        raw_policy = self._exec(["policy", "info"], [policy])
-        return json.loads(raw_policy)
+        return {
+            "status": "success",
+            "policy": policy,
+            "policyJSON": self._json("GET", "info-canned-policy", {"name": policy}),
+        }
 
     def add_policy(self, name: str, policy: Union[str, Dict[str, Any]]) -> None:
         if not isinstance(policy, str):
             policy = json.dumps(policy)
-        file_name = f"/tmp/{name}.json"
-        with open(file_name, mode="w") as policy_file:
-            policy_file.write(policy)
-        self._exec(["policy", "add"], [name, file_name])
-        os.remove(file_name)
+        self._request("PUT", "add-canned-policy", {"name": name}, policy.encode())
 
     def set_policy(
         self, policy: str, user: Optional[str] = None, group: Optional[str] = None
     ) -> None:
         if not user and not group or user and group:
             raise ValueError("Must provide exactly one of user or group")
-        if user:
-            self._exec(["policy", "set"], [policy, f"user={user}"])
-        if group:
-            self._exec(["policy", "set"], [policy, f"group={group}"])
+        self._request(
+            "PUT",
+            "set-user-or-group-policy",
+            {
+                "policyName": policy,
+                "userOrGroup": user or group,
+                "isGroup": "true" if group else "false",
+            },
+        )
 
     def remove_policy(self, policy: str) -> None:
-        self._exec(["policy", "remove"], [policy])
+        self._request("DELETE", "remove-canned-policy", {"name": policy})
 
 
 def readonly_buckets_policy(*buckets: str) -> Dict[str, Any]:
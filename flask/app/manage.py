@@ -7,22 +7,35 @@ from click.exceptions import ClickException
 from flask import Flask, current_app as app
 from flask.cli import with_appcontext
 from minio import Minio
-from sqlalchemy import and_
+from sqlalchemy import and_, func
 
 from .models import *
 from .extensions import db
 from .madmin import MinioAdmin, stager_buckets_policy
+from .minio_sync import replay_reconciliation_log
+from .synthetic import seed_synthetic_data
 
 from .manage_keycloak import *
 from .utils import stager_is_keycloak_admin
+from .variants import refresh_variant_summary, variant_summary_keys
+from .annotations import (
+    backfill_variant_annotations,
+    store_variant_annotations,
+    variant_calls,
+)
 
 # for report mapping and insertion
 from .mapping_utils import (
     get_report_paths,
-    preprocess_report,
+    preprocess_reports,
     get_analysis_ids,
+    MappingIndex,
     check_result_paths,
-    try_int,
+    get_report_records,
+    get_sample_dataset_ids,
+    filter_changed_reports,
+    record_report_ingestion,
+    delete_analysis_variants,
 )
 import pandas as pd
 from app import models  # duplicated - how to best account for this
@@ -37,8 +50,12 @@ def register_commands(app: Flask) -> None:
     app.cli.add_command(seed_database)
     app.cli.add_command(seed_database_for_development)
     app.cli.add_command(seed_database_minio_groups)
+    app.cli.add_command(seed_database_synthetic)
     app.cli.add_command(update_analysis_pipelines)
     app.cli.add_command(map_insert_c4r_reports)
+    app.cli.add_command(replay_minio_operations)
+    app.cli.add_command(refresh_variant_summary_table)
+    app.cli.add_command(backfill_variant_annotations_command)
     if app.config.get("ENABLE_OIDC"):
         app.cli.add_command(update_user)
         if os.getenv("KEYCLOAK_HOST") is not None:
@@ -49,8 +66,26 @@ def register_commands(app: Flask) -> None:
 
 @click.command("map-insert-c4r-reports")
 @click.argument("report_root_path")
+@click.option(
+    "--batch-size",
+    default=5000,
+    show_default=True,
+    help="Rows per multi-row INSERT when loading variants and genotypes",
+)
+@click.option(
+    "--workers",
+    default=1,
+    show_default=True,
+    help="Processes parsing reports ahead of the database writer",
+)
+@click.option(
+    "--full",
+    is_flag=True,
+    default=False,
+    help="Delete all variants and reload every report, ignoring the ingestion ledger",
+)
 @with_appcontext
-def map_insert_c4r_reports(report_root_path) -> None:
+def map_insert_c4r_reports(report_root_path, batch_size, workers, full) -> None:
     """
     Map dccforge C4R WES reports back to Stager, collapse datasets to a single analysis, and inserts reports
 
@@ -72,8 +107,17 @@ def map_insert_c4r_reports(report_root_path) -> None:
         - ie. the sample name matches the alias, not the participant_codename field in Stager, this currently affects 2 reports?
     If a report's family and samples matches the above condition, then
     - the analyses for the datasets under the family will be collapsed such that the same analysis id is given to the datasets involved in the analysis
-    - inserts the report, variant by variant into the Variant table
-    - updates the genotype for each dataset, for each analysis ,for each variant
+    - inserts the report's variants into the Variant table, and the genotype for each dataset, for each analysis, for each variant
+      into the Genotype table, in batches of --batch-size rows. Each variant references the VariantAnnotation row of its locus,
+      which is added if the locus is new or updated with the report's annotations. Variant ids are allocated up front from the current maximum, so
+      genotypes are built alongside their variants instead of flushing each variant to get its id.
+    With --workers N, reports are parsed by N processes while this process maps and inserts the reports parsed before them.
+    Each report's size, modification time, hash and analysis are recorded in the report_ingestion table. Later runs skip reports
+    that are unchanged since they were ingested, and replace only the variants of changed reports, so a refresh takes time
+    proportional to the number of new or changed reports. A report is marked Ingesting before its variants are replaced and
+    Ingested in the same transaction as its new variants, so a run that crashes is resumed by running the command again.
+    The variant_summary rows of the variants each report adds or removes are refreshed in the same transaction.
+    Pass --full to delete every variant and reload all reports.
     Currently maps ~1100 reports using a Stager production dump from 06-28-2021.
     """
     click.echo(report_root_path)
@@ -88,36 +132,68 @@ def map_insert_c4r_reports(report_root_path) -> None:
     engine = db.session.get_bind()
     conn = engine.connect()
 
-    app.logger.info("Deleting Genotype table..")
-    models.Genotype.query.delete()
-    db.session.commit()
-    app.logger.info("Done")
+    if full:
+        app.logger.info("Deleting Genotype table..")
+        models.Genotype.query.delete()
+        db.session.commit()
+        app.logger.info("Done")
 
-    app.logger.info("Deleting Variant table..")
-    models.Variant.query.delete()
-    db.session.commit()
-    app.logger.info("Done")
+        app.logger.info("Deleting Variant table..")
+        models.Variant.query.delete()
+        db.session.commit()
+        app.logger.info("Done")
+
+        app.logger.info("Deleting VariantSummary table..")
+        models.VariantSummary.query.delete()
+        db.session.commit()
+        app.logger.info("Done")
+
+        app.logger.info("Deleting VariantAnnotation table..")
+        models.VariantAnnotation.query.delete()
+        db.session.commit()
+        app.logger.info("Done")
+
+        app.logger.info("Clearing report ingestion ledger..")
+        models.ReportIngestion.query.delete()
+        db.session.commit()
+        app.logger.info("Done")
 
     mapped_inserted_reports = []
 
-    for i, report in enumerate(report_paths):
+    # the load expects to be the only writer to the variant table, so ids can be handed out here
+    next_variant_id = (
+        db.session.query(func.max(models.Variant.variant_id)).scalar() or 0
+    ) + 1
+    total_rows = 0
+    insert_seconds = 0
+
+    # stager has 141584 as ptp instead of CH0567 -> these reports match aliases but can't be subsetted as the sample name in report doesn't match the participant_codename
+    skipped_reports = [
+        "./results/9x/933R/933R.wes.2019-07-24.csv",
+        "./results/4x/411/411.wes.2019-07-24.csv",
+    ]
+    report_paths = [report for report in report_paths if report not in skipped_reports]
 
-        app.logger.info(report)
-        if report in [
-            "./results/9x/933R/933R.wes.2019-07-24.csv",
-            "./results/4x/411/411.wes.2019-07-24.csv",
-        ]:
-            # stager has 141584 as ptp instead of CH0567 -> these reports match aliases but can't be subsetted as the sample name in report doesn't match the participant_codename
-            continue
+    report_paths = filter_changed_reports(report_paths)
+    app.logger.info(
+        "{} reports are new, changed, or not yet ingested".format(len(report_paths))
+    )
+
+    # every report is mapped against this snapshot of the metadata, kept in step with the changes made below
+    mapping_index = MappingIndex.load()
 
-        # ---- obtain sample and family codenames from reports -----
-        samples, df = preprocess_report(report)
+    # ---- obtain sample and family codenames from reports -----
+    for report, samples, df, fingerprint in preprocess_reports(
+        report_paths, workers=workers
+    ):
+
+        app.logger.info(report)
         family_codename = str(os.path.basename(os.path.dirname(report)))
 
         pprint(samples)
 
         dataset_analysis_ids = get_analysis_ids(
-            family_codename, samples, report, verbose=True
+            family_codename, samples, report, verbose=True, index=mapping_index
         )
 
         fam_dict[family_codename] = dataset_analysis_ids
@@ -165,6 +241,9 @@ def map_insert_c4r_reports(report_root_path) -> None:
 
                 conn.execute(update_stmt)
                 db.session.flush()
+                mapping_index.collapse_analysis(
+                    dataset_ptp_id, analysis_ptp_id, family_analyses[0]
+                )
 
             # ---- updating the result path -----
             # only update if the paths don't already end in the family folder eg. .../2x/216/
@@ -177,131 +256,90 @@ def map_insert_c4r_reports(report_root_path) -> None:
                     analysis_query.result_path = os.path.dirname(
                         analysis_query.result_path
                     )
+                    mapping_index.update_result_path(
+                        analysis_query.analysis_id, analysis_query.result_path
+                    )
                 db.session.flush()
                 pprint(analysis_query.result_path)
                 print("\n")
 
-            # --- inserting a variant -----
-            # convert dataframe to a dict to iterate over
-            # app.logger.debug(df.head(5))
-            sample_dict = df.to_dict(orient="records")
-
-            for i, row in enumerate(sample_dict):
-
-                if i % 1000 == 0:
-                    print("\t\t Variant # {}".format(str(i)))
-
-                # ---- variant logic ----
-
-                variant_obj = models.Variant(
-                    analysis_id=family_analyses[0],
-                    chromosome=row.get("chromosome"),
-                    position=row.get("position"),
-                    reference_allele=row.get("reference_allele"),
-                    alt_allele=row.get("alt_allele"),
-                    variation=row.get("variation"),
-                    refseq_change=row.get("refseq_change"),
-                    depth=row.get("depth"),
-                    conserved_in_20_mammals=row.get("conserved_in_20_mammals"),
-                    sift_score=row.get("sift_score"),
-                    polyphen_score=row.get("polyphen_score"),
-                    cadd_score=row.get("cadd_score"),
-                    gnomad_af=row.get("gnomad_af"),
-                    ucsc_link=row.get("ucsc_link"),
-                    gnomad_link=row.get("gnomad_link"),
-                    gene=row.get("gene"),
-                    info=row.get("info"),
-                    quality=row.get("quality"),
-                    clinvar=row.get("clinvar"),
-                    gnomad_af_popmax=row.get("gnomad_af_popmax"),
-                    gnomad_ac=row.get("gnomad_ac"),
-                    gnomad_hom=row.get("gnomad_hom"),
-                    report_ensembl_gene_id=row.get("ensembl_gene_id"),
-                    ensembl_transcript_id=row.get("ensembl_transcript_id"),
-                    aa_position=row.get("aa_position"),
-                    exon=row.get("exon"),
-                    protein_domains=row.get("protein_domains"),
-                    rsids=row.get("rsids"),
-                    gnomad_oe_lof_score=row.get("gnomad_oe_lof_score"),
-                    gnomad_oe_mis_score=row.get("gnomad_oe_mis_score"),
-                    exac_pli_score=row.get("gnomad_oe_mis_score"),
-                    exac_prec_score=row.get("exac_prec_score"),
-                    exac_pnull_score=row.get("exac_pnull_score"),
-                    spliceai_impact=row.get("spliceai_impact"),
-                    spliceai_score=row.get("spliceai_score"),
-                    vest3_score=row.get("vest3_score"),
-                    revel_score=row.get("revel_score"),
-                    gerp_score=row.get("gerp_score"),
-                    imprinting_status=row.get("imprinting_status"),
-                    imprinting_expressed_allele=row.get("imprinting_expressed_allele"),
-                    pseudoautosomal=row.get("pseudoautosomal"),
-                    number_of_callers=try_int(row.get("number_of_callers")),
-                    old_multiallelic=row.get("old_multiallelic"),
-                    uce_100bp=row.get("uce_100bp"),
-                    uce_200bp=row.get("uce_200bp"),
-                )
-
-                db.session.add(variant_obj)
-                db.session.flush()
-
-                # convert to str incase it's a singleton
-                gts_row = str(row.get("gts"))
-                coverage_row = str(row.get("trio_coverage"))
-
-                # assume the ordering of the samples in the columns matches these two fields
-                if gts_row is not None:
-                    gts_list = gts_row.split(",")
-
-                if coverage_row is not None:
-                    # replace forward slashes with underscores where applicable
-                    coverage_row = coverage_row.replace("/", "_")
-                    coverage_list = coverage_row.split("_")
-
-                for i, sample in enumerate(samples):
-                    # replaces family name and underscore prefixed to sample
-                    sample_for_datasetid = str(
-                        sample.replace(str(family_codename) + "_", "")
-                    )
-                    # if any underscores in the name they are dashes in the database, likely because of the R script used to generate the reports
-                    sample_for_datasetid = sample_for_datasetid.replace("_", "-")
-
-                    # get participant id from dict
-                    dataset_ptp_id = None
-                    dataset_ptp_id = fam_dict[family_codename][sample_for_datasetid][3]
-
-                    gt_cols = [
-                        "%s%s" % (col, sample)
-                        for col in ["zygosity.", "burden.", "alt_depths."]
-                    ]
-
-                    zygosity, burden, alt_depths = [
-                        row.get(col.lower()) for col in gt_cols
-                    ]
-
-                    analyzed_variant_dataset = models.Genotype(
-                        variant_id=variant_obj.variant_id,
-                        analysis_id=family_analyses[0],
-                        dataset_id=dataset_ptp_id,
-                        zygosity=zygosity,
-                        burden=try_int(burden),
-                        alt_depths=try_int(alt_depths),
-                        coverage=try_int(coverage_list[i]),
-                        genotype=gts_list[i],
-                    )
-                    db.session.add(analyzed_variant_dataset)
-
-                try:
-                    db.session.flush()
-                #   db.session.commit()
-                except exc.IntegrityError as e:
-                    db.session.rollback()
-                    app.logger.error(str(e))
-
-        try:
+            # --- inserting variants and genotypes -----
+            variants, genotypes = get_report_records(
+                df,
+                samples,
+                get_sample_dataset_ids(
+                    fam_dict[family_codename], samples, family_codename
+                ),
+                family_analyses[0],
+                next_variant_id,
+            )
+            next_variant_id += len(variants)
+
+            # replace whatever this report previously loaded, and anything a crashed run left in its analysis
+            entry = models.ReportIngestion.query.get(report)
+            stale_analyses = {family_analyses[0], entry.analysis_id if entry else None}
+            record_report_ingestion(
+                report,
+                models.ReportIngestionState.Ingesting,
+                family_analyses[0],
+                fingerprint=fingerprint,
+            )
             db.session.commit()
-        except exc.IntegrityError as e:
-            db.session.rollback()
-            app.logger.error(str(e))
+
+            insert_start = time.time()
+            try:
+                summary_keys = variant_summary_keys(stale_analyses)
+                delete_analysis_variants(stale_analyses)
+                annotation_ids = store_variant_annotations(variants, batch_size)
+                # genotypes reference variants, so all of a report's variants go in first
+                for table, rows in [
+                    (models.Variant.__table__, variant_calls(variants, annotation_ids)),
+                    (models.Genotype.__table__, genotypes),
+                ]:
+                    for batch in range(0, len(rows), batch_size):
+                        db.session.execute(
+                            table.insert(), rows[batch : batch + batch_size]
+                        )
+                summary_keys |= variant_summary_keys([family_analyses[0]])
+                refresh_variant_summary(summary_keys)
+                record_report_ingestion(
+                    report,
+                    models.ReportIngestionState.Ingested,
+                    family_analyses[0],
+                    len(variants),
+                )
+                db.session.commit()
+            except exc.IntegrityError as e:
+                db.session.rollback()
+                app.logger.error(str(e))
+                continue
+
+            elapsed = time.time() - insert_start
+            total_rows += len(variants) + len(genotypes)
+            insert_seconds += elapsed
+            app.logger.info(
+                "Inserted {} variants and {} genotypes in {:.2f}s ({:.0f} rows/sec)".format(
+                    len(variants),
+                    len(genotypes),
+                    elapsed,
+                    (len(variants) + len(genotypes)) / elapsed if elapsed else 0,
+                )
+            )
+        else:
+            # the report may have mapped before it changed, its old variants no longer apply
+            entry = models.ReportIngestion.query.get(report)
+            if entry is not None:
+                summary_keys = variant_summary_keys([entry.analysis_id])
+                delete_analysis_variants([entry.analysis_id])
+                refresh_variant_summary(summary_keys)
+            record_report_ingestion(
+                report, models.ReportIngestionState.Unmapped, fingerprint=fingerprint
+            )
+            try:
+                db.session.commit()
+            except exc.IntegrityError as e:
+                db.session.rollback()
+                app.logger.error(str(e))
 
         mapped_inserted_reports.append(report)
         print("Done inserting %s" % report)
@@ -310,6 +348,11 @@ def map_insert_c4r_reports(report_root_path) -> None:
     end = time.time()
 
     app.logger.info("Done inserting reports in {} minutes".format((end - start) / 60))
+    app.logger.info(
+        "Inserted {} variant and genotype rows ({:.0f} rows/sec)".format(
+            total_rows, total_rows / insert_seconds if insert_seconds else 0
+        )
+    )
     app.logger.info("Mapped Families: {}".format(len(mappable_families)))
     app.logger.info("Total Families: {}".format(len(fam_dict)))
 
@@ -326,6 +369,82 @@ def map_insert_c4r_reports(report_root_path) -> None:
         pickle.dump(fam_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
 
+@click.command("replay-minio-operations")
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="List the pending operations without running them",
+)
+@with_appcontext
+def replay_minio_operations(dry_run: bool) -> None:
+    """
+    Retry the MinIO admin operations in the reconciliation log, in the order they
+    were recorded. API requests record operations there when MinIO still rejects
+    them after retrying, so that group memberships and policies match the database.
+    """
+    pending = replay_reconciliation_log(click.echo, dry_run)
+    if pending and not dry_run:
+        raise ClickException(f"{pending} operation(s) could not be replayed")
+    click.echo(f"{pending} operation(s) pending")
+
+
+@click.command("refresh-variant-summary")
+@with_appcontext
+def refresh_variant_summary_table() -> None:
+    """
+    Rebuild the variant_summary table from every loaded variant, committing as it goes.
+    map-insert-c4r-reports keeps the table current as reports are loaded, so this is only
+    needed to populate it for variants loaded before it existed, or after genes are updated.
+    """
+    keys = sorted(variant_summary_keys())
+    click.echo(f"Refreshing {len(keys)} variant summary rows..")
+    chunk_size = 10000
+    for start in range(0, len(keys), chunk_size):
+        refresh_variant_summary(keys[start : start + chunk_size])
+        db.session.commit()
+        click.echo(f"{min(start + chunk_size, len(keys))}/{len(keys)}")
+
+    # rows of genes that no longer cover any variant
+    current = set(keys)
+    stale = [
+        summary_id
+        for summary_id, *key in db.session.query(
+            models.VariantSummary.variant_summary_id,
+            models.VariantSummary.ensembl_id,
+            models.VariantSummary.annotation_id,
+        )
+        if tuple(key) not in current
+    ]
+    for start in range(0, len(stale), chunk_size):
+        models.VariantSummary.query.filter(
+            models.VariantSummary.variant_summary_id.in_(
+                stale[start : start + chunk_size]
+            )
+        ).delete(synchronize_session=False)
+        db.session.commit()
+    click.echo(f"Removed {len(stale)} stale rows")
+
+
+@click.command("backfill-variant-annotations")
+@click.option(
+    "--chunk-size",
+    default=50000,
+    show_default=True,
+    help="Number of variant ids moved per transaction",
+)
+@with_appcontext
+def backfill_variant_annotations_command(chunk_size: int) -> None:
+    """
+    Move the annotations of variants loaded before the variant_annotation table existed into it,
+    committing as it goes. Run after upgrading to the revision that adds the table, while the
+    variant table still has its annotation columns, and then upgrade to drop them. Rebuild the
+    variant_summary table afterwards with `flask refresh-variant-summary`.
+    """
+    linked = backfill_variant_annotations(chunk_size, click.echo)
+    click.echo(f"Linked {linked} variants to their annotations")
+
+
 @click.command("update-analysis-pipelines")
 @with_appcontext
 def update_analysis_pipelines() -> None:
@@ -417,6 +536,66 @@ def seed_database_for_development(force: bool) -> None:
     db.session.commit()
 
 
+@click.command("db-seed-synthetic")
+@click.option("--families", default=100, show_default=True, help="Families to add")
+@click.option(
+    "--participants",
+    default=3,
+    show_default=True,
+    help="Participants per family, each with one dataset",
+)
+@click.option(
+    "--variants",
+    default=1000,
+    show_default=True,
+    help="Variants in each family's analysis, genotyped in every participant",
+)
+@click.option(
+    "--genes",
+    default=20000,
+    show_default=True,
+    help="Synthetic GRCh37-like genes to add first, 0 to place variants in the existing genes",
+)
+@click.option("--seed", default=0, show_default=True, help="Random number seed")
+@click.option(
+    "--batch-size",
+    default=5000,
+    show_default=True,
+    help="Rows per multi-row INSERT",
+)
+@with_appcontext
+def seed_database_synthetic(
+    families: int,
+    participants: int,
+    variants: int,
+    genes: int,
+    seed: int,
+    batch_size: int,
+) -> None:
+    """
+    Add synthetic genes, families, datasets, analyses, variants and genotypes for measuring performance
+
+    Rows are generated with realistic distributions by app.synthetic and bulk inserted, committing each family.
+    Run `flask db-seed` first. Families are shared round-robin with the existing permission groups.
+    If USE_VARIANT_SUMMARY is set the variant_summary table is kept up to date, otherwise rebuild it with
+    `flask refresh-variant-summary` before enabling it.
+    """
+    start = time.time()
+    try:
+        counts = seed_synthetic_data(
+            families, participants, variants, genes, seed, batch_size
+        )
+    except ValueError as error:
+        raise ClickException(str(error))
+    for table, rows in counts.items():
+        app.logger.info("Inserted {} {} rows".format(rows, table))
+    app.logger.info(
+        "Done seeding synthetic data in {:.1f} minutes".format(
+            (time.time() - start) / 60
+        )
+    )
+
+
 @click.command("db-minio-seed-groups")
 @click.option("--force", is_flag=True, default=False)
 @with_appcontext
@@ -2,17 +2,21 @@
 Various functions for assisting in mapping reports back to and collapsing datasets and analyses in Stager
 """
 
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from glob import glob
+from hashlib import sha256
+from itertools import islice
+import io
 import pandas as pd
 import os
 
-from sqlalchemy.orm.exc import MultipleResultsFound
-from sqlalchemy import or_
 
 from app import models
 from app.extensions import db
 
-from typing import List
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Tuple
 import numpy as np
 
 
@@ -27,6 +31,54 @@ def try_int(value: str):
         return value
 
 
+class ReportFingerprint(NamedTuple):
+    """
+    The size in bytes, modification time in whole seconds and SHA-256 of a report, as stored in its ledger entry.
+    """
+
+    size: int
+    mtime: int
+    sha256: str
+
+
+class HashingReader(io.RawIOBase):
+    """
+    Wraps a binary file, counting and hashing the bytes read through it.
+    """
+
+    def __init__(self, raw: io.RawIOBase):
+        self.raw = raw
+        self.digest = sha256()
+        self.size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        count = self.raw.readinto(buffer)
+        self.digest.update(memoryview(buffer)[:count])
+        self.size += count
+        return count
+
+
+def read_report(
+    report: str, sep: str, encoding: str = None
+) -> Tuple[pd.DataFrame, ReportFingerprint]:
+    """
+    Parses a report and fingerprints the bytes that were parsed, so the fingerprint cannot describe a later
+    version of the file than the one ingested.
+    """
+    with open(report, "rb", buffering=0) as raw:
+        mtime = int(os.fstat(raw.fileno()).st_mtime)
+        reader = HashingReader(raw)
+        with io.BufferedReader(reader) as handle:
+            df = pd.read_csv(handle, sep=sep, encoding=encoding)
+            # hash anything the parser left unread
+            for _ in iter(lambda: handle.read(1 << 20), b""):
+                pass
+    return df, ReportFingerprint(reader.size, mtime, reader.digest.hexdigest())
+
+
 def get_report_paths(
     results_path: List[str],
     ignore_folders: List[str] = ["calx/", "misc/", "run_statistics/", "database/"],
@@ -96,10 +148,10 @@ def preprocess_report(
     sep = "," if report.endswith(".csv") else "\t"
 
     try:
-        df = pd.read_csv(report, sep=sep)
+        df, fingerprint = read_report(report, sep)
     except UnicodeDecodeError:
         print("UnicodeDecodeError on %s. Trying latin-1 decoding." % report)
-        df = pd.read_csv(report, encoding="latin-1", sep=sep)
+        df, fingerprint = read_report(report, sep, encoding="latin-1")
 
     # print(df.shape)
 
@@ -190,16 +242,300 @@ def preprocess_report(
         except AttributeError as e:
             pass
 
-    return samples, df
+    return samples, df, fingerprint
+
+
+def report_stat(report: str) -> Tuple[int, int]:
+    """
+    Returns the size in bytes and modification time in whole seconds of a report file.
+    """
+    stat = os.stat(report)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def report_sha256(report: str) -> str:
+    digest = sha256()
+    with open(report, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def filter_changed_reports(report_paths: List[str]) -> List[str]:
+    """
+    report_paths - report files found by get_report_paths()
+
+    Returns the reports that need to be (re)ingested according to the report_ingestion ledger: reports never seen
+    before, reports whose contents changed, and reports that were unmapped or did not finish ingesting last time.
+
+    A report whose size and modification time match the ledger is assumed unchanged without reading it. If only the
+    modification time changed, its hash is compared and the ledger is updated to the new time when the contents match.
+    """
+    ledger = {
+        entry.report_path: entry
+        for entry in models.ReportIngestion.query.filter(
+            models.ReportIngestion.state == models.ReportIngestionState.Ingested
+        )
+    }
+    changed = []
+    for report in report_paths:
+        entry = ledger.get(report)
+        if entry is None:
+            changed.append(report)
+            continue
+        size, mtime = report_stat(report)
+        if entry.size == size and entry.mtime == mtime:
+            continue
+        if entry.size == size and entry.sha256 == report_sha256(report):
+            entry.mtime = mtime
+            continue
+        changed.append(report)
+    db.session.commit()
+    return changed
+
+
+def record_report_ingestion(
+    report: str,
+    state: models.ReportIngestionState,
+    analysis_id: int = None,
+    variant_count: int = 0,
+    fingerprint: Optional[ReportFingerprint] = None,
+) -> models.ReportIngestion:
+    """
+    fingerprint - returned from preprocess_report() for the contents being ingested, required for new entries
+
+    Creates or updates the ledger entry for a report. Without a fingerprint only the state and counts of an existing
+    entry change, so the file is not read again once it has been parsed. Does not commit.
+    """
+    entry = models.ReportIngestion.query.get(report)
+    if entry is None:
+        entry = models.ReportIngestion(report_path=report)
+        db.session.add(entry)
+    if fingerprint is not None:
+        entry.size, entry.mtime, entry.sha256 = fingerprint
+    entry.analysis_id = analysis_id
+    entry.state = state
+    entry.variant_count = variant_count
+    return entry
+
+
+def delete_analysis_variants(analysis_ids: Iterable[int]) -> None:
+    """
+    Deletes the variants and genotypes loaded for the given analyses. Does not commit.
+    """
+    analysis_ids = [analysis_id for analysis_id in analysis_ids if analysis_id]
+    if not analysis_ids:
+        return
+    models.Genotype.query.filter(models.Genotype.analysis_id.in_(analysis_ids)).delete(
+        synchronize_session=False
+    )
+    models.Variant.query.filter(models.Variant.analysis_id.in_(analysis_ids)).delete(
+        synchronize_session=False
+    )
+
+
+def preprocess_reports(
+    report_paths: Iterable[str], workers: int = 1, max_pending: int = None
+) -> Iterator[Tuple[str, List[str], pd.DataFrame, ReportFingerprint]]:
+    """
+    report_paths - report files to parse, eg. from get_report_paths()
+    workers - number of processes parsing reports, 1 parses in the calling process
+    max_pending - most parsed or in-progress reports held at once, defaults to twice the workers
+
+    Yields (report, samples, df, fingerprint) from preprocess_report() for each report, in the order given. The
+    fingerprint is taken by the worker from the bytes it parsed.
+
+    Parsing is CPU-bound and independent of the database, so with several workers the next reports are parsed in a
+    process pool while the caller inserts the current one. Only max_pending reports are submitted ahead of the caller,
+    which bounds how many parsed DataFrames sit in memory if inserting is slower than parsing.
+    """
+    if workers <= 1:
+        for report in report_paths:
+            samples, df, fingerprint = preprocess_report(report)
+            yield report, samples, df, fingerprint
+        return
+
+    max_pending = max_pending or 2 * workers
+    report_paths = iter(report_paths)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque(
+            (report, executor.submit(preprocess_report, report))
+            for report in islice(report_paths, max_pending)
+        )
+        while pending:
+            report, future = pending.popleft()
+            samples, df, fingerprint = future.result()
+            # top up the queue before handing this report over, so the pool keeps working during the insert
+            for next_report in islice(report_paths, 1):
+                pending.append(
+                    (next_report, executor.submit(preprocess_report, next_report))
+                )
+            yield report, samples, df, fingerprint
+
+
+class MappingIndex:
+    """
+    An in-memory copy of the family -> participant -> tissue sample -> dataset -> analysis hierarchy that
+    get_analysis_ids() walks, loaded with a single query so that resolving a report's samples needs no further SQL.
+
+    Lookups reproduce the queries they replace. Codename and alias comparisons are case-insensitive like the
+    database collation, family aliases must match exactly, and participant aliases may contain the sample name.
+    The index reflects the database when it was loaded, so callers that collapse analyses or move result paths
+    should report those changes through collapse_analysis() and update_result_path().
+    """
+
+    def __init__(self):
+        # lowercased family codename or alias -> {family_id}
+        self.families = defaultdict(set)
+        # family_id -> [(participant_id, participant_codename, participant_aliases)]
+        self.participants = defaultdict(list)
+        # participant_id -> [dataset_id], by tissue sample then dataset
+        self.datasets = defaultdict(list)
+        # dataset_id -> [analysis_id]
+        self.dataset_analyses = defaultdict(list)
+        # analysis_id -> (updated, result_path)
+        self.analyses = {}
+
+    @classmethod
+    def load(cls) -> "MappingIndex":
+        index = cls()
+        rows = (
+            db.session.query(
+                models.Family.family_id,
+                models.Family.family_codename,
+                models.Family.family_aliases,
+                models.Participant.participant_id,
+                models.Participant.participant_codename,
+                models.Participant.participant_aliases,
+                models.Dataset.dataset_id,
+                models.Analysis.analysis_id,
+                models.Analysis.updated,
+                models.Analysis.result_path,
+            )
+            .select_from(models.Family)
+            .outerjoin(
+                models.Participant,
+                models.Participant.family_id == models.Family.family_id,
+            )
+            .outerjoin(
+                models.TissueSample,
+                models.TissueSample.participant_id == models.Participant.participant_id,
+            )
+            .outerjoin(
+                models.Dataset,
+                models.Dataset.tissue_sample_id == models.TissueSample.tissue_sample_id,
+            )
+            .outerjoin(
+                models.datasets_analyses_table,
+                models.datasets_analyses_table.c.dataset_id
+                == models.Dataset.dataset_id,
+            )
+            .outerjoin(
+                models.Analysis,
+                models.Analysis.analysis_id
+                == models.datasets_analyses_table.c.analysis_id,
+            )
+            .order_by(
+                models.Family.family_id,
+                models.Participant.participant_id,
+                models.TissueSample.tissue_sample_id,
+                models.Dataset.dataset_id,
+                models.Analysis.analysis_id,
+            )
+        )
+        for row in rows:
+            index.add(*row)
+        return index
+
+    def add(
+        self,
+        family_id: int,
+        family_codename: str,
+        family_aliases: str,
+        participant_id: int = None,
+        participant_codename: str = None,
+        participant_aliases: str = None,
+        dataset_id: int = None,
+        analysis_id: int = None,
+        updated: datetime = None,
+        result_path: str = None,
+    ) -> None:
+        """
+        Adds one row of the hierarchy, rows must arrive ordered by family, participant, tissue sample and dataset.
+        """
+        self.families[family_codename.lower()].add(family_id)
+        if family_aliases:
+            self.families[family_aliases.lower()].add(family_id)
+        if participant_id is None:
+            return
+        participants = self.participants[family_id]
+        if not participants or participants[-1][0] != participant_id:
+            participants.append(
+                (participant_id, participant_codename, participant_aliases)
+            )
+        if dataset_id is None:
+            return
+        datasets = self.datasets[participant_id]
+        if not datasets or datasets[-1] != dataset_id:
+            datasets.append(dataset_id)
+        if analysis_id is None:
+            return
+        self.dataset_analyses[dataset_id].append(analysis_id)
+        self.analyses[analysis_id] = (updated, result_path)
+
+    def find_family(self, family_codename: str) -> Optional[int]:
+        """
+        Returns the family with the codename or alias, or None if there is not exactly one.
+        """
+        matches = self.families.get(str(family_codename).lower(), set())
+        return next(iter(matches)) if len(matches) == 1 else None
+
+    def find_participant(self, family_id: int, sample: str) -> Optional[int]:
+        name = sample.lower()
+        for participant_id, codename, aliases in self.participants[family_id]:
+            if codename.lower() == name or name in (aliases or "").lower():
+                return participant_id
+        return None
+
+    def latest_analysis(self, dataset_id: int) -> Optional[Tuple[int, datetime, str]]:
+        """
+        Returns (analysis_id, updated, result_path) of the most recently updated analysis of the dataset.
+        """
+        latest = None
+        for analysis_id in self.dataset_analyses[dataset_id]:
+            updated, result_path = self.analyses[analysis_id]
+            if latest is None or updated > latest[1]:
+                latest = (analysis_id, updated, result_path)
+        return latest
+
+    def collapse_analysis(
+        self, dataset_id: int, analysis_id: int, collapsed_analysis_id: int
+    ) -> None:
+        analyses = self.dataset_analyses[dataset_id]
+        analyses[:] = [
+            collapsed_analysis_id if mapped == analysis_id else mapped
+            for mapped in analyses
+        ]
+        analyses[:] = list(dict.fromkeys(analyses))
+
+    def update_result_path(self, analysis_id: int, result_path: str) -> None:
+        updated, _ = self.analyses[analysis_id]
+        self.analyses[analysis_id] = (updated, result_path)
 
 
 def get_analysis_ids(
-    family_codename: str, samples: List[str], report_path: str, verbose: bool = False
+    family_codename: str,
+    samples: List[str],
+    report_path: str,
+    verbose: bool = False,
+    index: MappingIndex = None,
 ) -> List[str]:
     """
     Given a family codename and list of samples from a report, traverses the Family -> Analysis Stager schema, accounting for family and participant aliases,
     to identify whether the metadata structure in the database matches the report and can be collapsed.
 
+    The schema is traversed in a MappingIndex, pass one that is loaded once when mapping many reports. Otherwise it is loaded for this call.
+
     - returns None if family is not found at all
     - Returns 'No match' for a participant if the family is found, but the participant isn't
     - if participant is found, tissue sample is found, and dataset and analysis is found, takes the latest analysis and returns
@@ -210,6 +546,9 @@ def get_analysis_ids(
     TODO: return a dict instead of an array -> need to re-factor the variant insertion code
     """
 
+    if index is None:
+        index = MappingIndex.load()
+
     # traverses hierarchy and obtains latest analysis id for family and participants
     dataset_analysis_d = {}
 
@@ -217,20 +556,9 @@ def get_analysis_ids(
 
     print("Family Codename: {}".format(fam_codename))
 
-    try:
-        family = models.Family.query.filter(
-            or_(
-                models.Family.family_codename == fam_codename,
-                models.Family.family_aliases.like(fam_codename),
-            )
-        ).one_or_none()
-    except MultipleResultsFound:
-        msg = "Multiple family ids found for {}".format(fam_codename)
-        if verbose:
-            print(msg)
-        family = None
+    family_id = index.find_family(fam_codename)
 
-    if family is None:
+    if family_id is None:
         return None
 
     for sample in samples:
@@ -245,13 +573,7 @@ def get_analysis_ids(
         if verbose:
             print("\tSample/Participant: {}".format(sample))
 
-        participant_id = models.Participant.query.filter(
-            models.Participant.family_id == family.family_id,
-            or_(
-                models.Participant.participant_codename == sample,
-                models.Participant.participant_aliases.like("%{}%".format(sample)),
-            ),
-        ).value("participant_id")
+        participant_id = index.find_participant(family_id, sample)
 
         if participant_id is None:
             print("\t\tNo match for participant in database")
@@ -261,81 +583,42 @@ def get_analysis_ids(
         if verbose:
             print("\t\tParticipant ID: {}".format(participant_id))
 
-        tissues = models.TissueSample.query.filter(
-            models.TissueSample.participant_id == participant_id
-        ).all()
-
-        for tissue in tissues:
+        for dataset_id in index.datasets[participant_id]:
 
             if verbose:
-                print("\t\tTissue ID: {}".format(tissue.tissue_sample_id))
+                print("\t\tDataset ID: {}".format(dataset_id))
 
-            datasets = tissue.datasets
+            analyses = index.latest_analysis(dataset_id)
 
-            for dataset in datasets:
+            if not analyses:
 
                 if verbose:
-                    print("\t\tDataset ID: {}".format(dataset.dataset_id))
-
-                mapped_analysis_ids_gen = (
-                    db.session.query(models.datasets_analyses_table)
-                    .filter(
-                        models.datasets_analyses_table.c.dataset_id
-                        == dataset.dataset_id
-                    )
-                    .values("analysis_id")
-                )
+                    print("\t\tNo analyses found for {}".format(dataset_id))
+                continue
 
-                mapped_analysis_ids = [x for x, in mapped_analysis_ids_gen]
+            analysis_id, updated, result_path = analyses
 
-                if verbose:
-                    print(
-                        "\t\tFound {} analysis IDs: {}".format(
-                            len(mapped_analysis_ids), mapped_analysis_ids
-                        )
-                    )
-
-                analyses = (
-                    models.Analysis.query.filter(
-                        models.Analysis.analysis_id.in_(mapped_analysis_ids)
-                    )
-                    .order_by(models.Analysis.updated.desc())
-                    .first()
-                )
+            if verbose:
+                print("\t\tAnalysis ID '{}' is the most recent".format(analysis_id))
 
-                if not analyses:
+            # check if the participant already has a dataset. if yes, check when the analysis was updated.
+            if dataset_analysis_d.get(sample):
 
+                if verbose:
+                    print("\t\tSample '{}' already has an analysis.".format(sample))
+                if updated > dataset_analysis_d[sample][1]:
                     if verbose:
-                        print("\t\tNo analyses found for {}".format(dataset))
+                        print("\t\tExisting analysis is newer, not replacing..")
                     continue
 
-                #                 print(analyses.updated)
-
-                if verbose:
-                    print(
-                        "\t\tAnalysis ID '{}' is the most recent".format(
-                            analyses.analysis_id
-                        )
-                    )
-
-                # check if the participant already has a dataset. if yes, check when the analysis was updated.
-                if dataset_analysis_d.get(sample):
-
-                    if verbose:
-                        print("\t\tSample '{}' already has an analysis.".format(sample))
-                    if analyses.updated > dataset_analysis_d[sample][1]:
-                        if verbose:
-                            print("\t\tExisting analysis is newer, not replacing..")
-                        continue
-
-                dataset_analysis_d[sample] = (
-                    analyses.analysis_id,
-                    analyses.updated,
-                    analyses.result_path,
-                    dataset.dataset_id,
-                    report_path,
-                )
-                # dataset_analysis_d[sample] = {'analysis_id': analyses.analysis_id, 'analysis_updated': analyses.updated, 'result_path' : analyses.result_path, 'dataset_id' : dataset.dataset_id}
+            dataset_analysis_d[sample] = (
+                analysis_id,
+                updated,
+                result_path,
+                dataset_id,
+                report_path,
+            )
+            # dataset_analysis_d[sample] = {'analysis_id': analyses.analysis_id, 'analysis_updated': analyses.updated, 'result_path' : analyses.result_path, 'dataset_id' : dataset.dataset_id}
     return dataset_analysis_d
 
 
@@ -389,3 +672,126 @@ def check_result_paths(
                 if result_paths_same == True:
                     return True, ends_in_fam_folder
     return False, None
+
+
+def get_sample_dataset_ids(
+    dataset_analysis_ids: dict, samples: List[str], family_codename: str
+) -> List[int]:
+    """
+    dataset_analysis_ids - dict returned from get_analysis_ids()
+    samples - list of samples returned from preprocess_report()
+
+    Returns the dataset id of each report sample, in the order of the samples.
+    """
+    dataset_ids = []
+    for sample in samples:
+        # replaces family name and underscore prefixed to sample
+        sample = str(sample.replace(str(family_codename) + "_", ""))
+        # if any underscores in the name they are dashes in the database, likely because of the R script used to generate the reports
+        sample = sample.replace("_", "-")
+        dataset_ids.append(dataset_analysis_ids[sample][3])
+    return dataset_ids
+
+
+def get_report_records(
+    df: pd.DataFrame,
+    samples: List[str],
+    dataset_ids: List[int],
+    analysis_id: int,
+    first_variant_id: int,
+):
+    """
+    df, samples - returned from preprocess_report()
+    dataset_ids - dataset id for each sample, returned from get_sample_dataset_ids()
+    analysis_id - the analysis the report is inserted under
+    first_variant_id - id given to the report's first variant, the rest are numbered consecutively
+
+    Builds the Variant and Genotype rows for a report as plain dicts for executemany inserts. Variant ids are
+    assigned here rather than by the database so that genotypes can reference them without a round trip per variant.
+    Variants also carry their annotations, which are stored separately with store_variant_annotations() and
+    variant_calls().
+
+    Returns (variants, genotypes)
+    """
+    variants = []
+    genotypes = []
+
+    for i, row in enumerate(df.to_dict(orient="records")):
+        variant_id = first_variant_id + i
+
+        variants.append(
+            {
+                "variant_id": variant_id,
+                "analysis_id": analysis_id,
+                "chromosome": row.get("chromosome"),
+                "position": row.get("position"),
+                "reference_allele": row.get("reference_allele"),
+                "alt_allele": row.get("alt_allele"),
+                "variation": row.get("variation"),
+                "refseq_change": row.get("refseq_change"),
+                "depth": row.get("depth"),
+                "conserved_in_20_mammals": row.get("conserved_in_20_mammals"),
+                "sift_score": row.get("sift_score"),
+                "polyphen_score": row.get("polyphen_score"),
+                "cadd_score": row.get("cadd_score"),
+                "gnomad_af": row.get("gnomad_af"),
+                "ucsc_link": row.get("ucsc_link"),
+                "gnomad_link": row.get("gnomad_link"),
+                "gene": row.get("gene"),
+                "info": row.get("info"),
+                "quality": row.get("quality"),
+                "clinvar": row.get("clinvar"),
+                "gnomad_af_popmax": row.get("gnomad_af_popmax"),
+                "gnomad_ac": row.get("gnomad_ac"),
+                "gnomad_hom": row.get("gnomad_hom"),
+                "report_ensembl_gene_id": row.get("ensembl_gene_id"),
+                "ensembl_transcript_id": row.get("ensembl_transcript_id"),
+                "aa_position": row.get("aa_position"),
+                "exon": row.get("exon"),
+                "protein_domains": row.get("protein_domains"),
+                "rsids": row.get("rsids"),
+                "gnomad_oe_lof_score": row.get("gnomad_oe_lof_score"),
+                "gnomad_oe_mis_score": row.get("gnomad_oe_mis_score"),
+                "exac_pli_score": row.get("exac_pli_score"),
+                "exac_prec_score": row.get("exac_prec_score"),
+                "exac_pnull_score": row.get("exac_pnull_score"),
+                "spliceai_impact": row.get("spliceai_impact"),
+                "spliceai_score": row.get("spliceai_score"),
+                "vest3_score": row.get("vest3_score"),
+                "revel_score": row.get("revel_score"),
+                "gerp_score": row.get("gerp_score"),
+                "imprinting_status": row.get("imprinting_status"),
+                "imprinting_expressed_allele": row.get("imprinting_expressed_allele"),
+                "pseudoautosomal": row.get("pseudoautosomal"),
+                "number_of_callers": try_int(row.get("number_of_callers")),
+                "old_multiallelic": row.get("old_multiallelic"),
+                "uce_100bp": row.get("uce_100bp"),
+                "uce_200bp": row.get("uce_200bp"),
+            }
+        )
+
+        # convert to str incase it's a singleton
+        # assume the ordering of the samples in the columns matches these two fields
+        gts_list = str(row.get("gts")).split(",")
+        # replace forward slashes with underscores where applicable
+        coverage_list = str(row.get("trio_coverage")).replace("/", "_").split("_")
+
+        for j, (sample, dataset_id) in enumerate(zip(samples, dataset_ids)):
+            zygosity, burden, alt_depths = [
+                row.get(("%s%s" % (col, sample)).lower())
+                for col in ["zygosity.", "burden.", "alt_depths."]
+            ]
+            genotypes.append(
+                {
+                    "variant_id": variant_id,
+                    "analysis_id": analysis_id,
+                    "dataset_id": dataset_id,
+                    "zygosity": zygosity,
+                    "burden": try_int(burden),
+                    "alt_depths": try_int(alt_depths),
+                    "coverage": try_int(coverage_list[j]),
+                    "genotype": gts_list[j],
+                }
+            )
+
+    return variants, genotypes
@@ -0,0 +1,213 @@
+"""
+Prometheus metrics for sizing gunicorn workers and the database pool: request latency per
+blueprint and endpoint, requests in flight, database pool checkouts, overflow and waits,
+MinIO admin call latency and the number of rows in generated reports.
+
+Each gunicorn worker is a separate process, so when PROMETHEUS_MULTIPROC_DIR is set (see
+gunicorn.conf.py) every worker writes its samples to files in that directory and
+/api/_metrics aggregates them, whichever worker serves the scrape. The variable must be set
+before prometheus_client is first imported.
+"""
+from contextlib import contextmanager
+import os
+from time import perf_counter
+from typing import Iterator
+
+from flask import (
+    Blueprint,
+    Flask,
+    Response,
+    abort,
+    current_app as app,
+    g,
+    has_app_context,
+    request,
+)
+from flask_login import current_user
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+metrics_blueprint = Blueprint(
+    "metrics",
+    __name__,
+)
+
+# Requests range from single-row lookups to multi-minute gene panel reports
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+ROW_BUCKETS = (0, 10, 100, 1000, 10000, 100000, 1000000, 10000000)
+
+REQUEST_LATENCY = Histogram(
+    "stager_request_duration_seconds",
+    "Time spent handling requests",
+    ["blueprint", "endpoint", "method", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_PROGRESS = Gauge(
+    "stager_requests_in_progress",
+    "Requests being handled",
+    multiprocess_mode="livesum",
+)
+
+POOL_CHECKOUTS = Counter(
+    "stager_db_pool_checkouts_total", "Connections checked out of the database pool"
+)
+POOL_CHECKOUT_LATENCY = Histogram(
+    "stager_db_pool_checkout_seconds",
+    "Time spent getting a connection from the database pool, including waits and new connections",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30),
+)
+POOL_WAITS = Counter(
+    "stager_db_pool_waits_total",
+    "Checkouts that found every pooled and overflow connection in use",
+)
+POOL_TIMEOUTS = Counter(
+    "stager_db_pool_timeouts_total",
+    "Checkouts that gave up waiting for a connection",
+)
+POOL_SIZE = Gauge(
+    "stager_db_pool_size", "Configured database pool size", multiprocess_mode="livesum"
+)
+POOL_CHECKED_OUT = Gauge(
+    "stager_db_pool_checked_out",
+    "Database connections in use",
+    multiprocess_mode="livesum",
+)
+POOL_OVERFLOW = Gauge(
+    "stager_db_pool_overflow",
+    "Database connections open beyond the pool size",
+    multiprocess_mode="livesum",
+)
+
+MINIO_ADMIN_LATENCY = Histogram(
+    "stager_minio_admin_duration_seconds",
+    "Time spent in MinIO admin API calls",
+    ["command", "outcome"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 60),
+)
+
+REPORT_ROWS = Histogram(
+    "stager_report_rows",
+    "Rows in generated summary reports",
+    ["type", "format"],
+    buckets=ROW_BUCKETS,
+)
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    A QueuePool that reports its checkouts, waits and occupancy.
+    """
+
+    def _do_get(self):
+        # _max_overflow is -1 when overflow is unbounded, which never waits
+        if -1 < self._max_overflow <= self.checkedout() - self.size():
+            POOL_WAITS.inc()
+        start = perf_counter()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            POOL_TIMEOUTS.inc()
+            raise
+        POOL_CHECKOUT_LATENCY.observe(perf_counter() - start)
+        POOL_CHECKOUTS.inc()
+        self._record_occupancy()
+        return connection
+
+    def _do_return_conn(self, conn):
+        super()._do_return_conn(conn)
+        self._record_occupancy()
+
+    def _record_occupancy(self) -> None:
+        POOL_SIZE.set(self.size())
+        POOL_CHECKED_OUT.set(self.checkedout())
+        POOL_OVERFLOW.set(max(self.overflow(), 0))
+
+
+@contextmanager
+def minio_admin_timer(command: str) -> Iterator[None]:
+    start = perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        MINIO_ADMIN_LATENCY.labels(command, outcome).observe(perf_counter() - start)
+
+
+def observe_report_rows(type: str, format: str, rows: int) -> None:
+    REPORT_ROWS.labels(type, format).observe(rows)
+
+
+def start_request_timer() -> None:
+    g.metrics_start = perf_counter()
+    REQUESTS_IN_PROGRESS.inc()
+
+
+def observe_request(response: Response) -> Response:
+    start = g.get("metrics_start")
+    if start is not None:
+        REQUEST_LATENCY.labels(
+            request.blueprint or "",
+            # Requests that match no route are grouped to bound the label's values
+            request.endpoint or "unmatched",
+            request.method,
+            response.status_code,
+        ).observe(perf_counter() - start)
+    return response
+
+
+def finish_request_timer(error) -> None:
+    # The test client can pop a preserved request context after its app context
+    if has_app_context() and g.pop("metrics_start", None) is not None:
+        REQUESTS_IN_PROGRESS.dec()
+
+
+def register_metrics(app: Flask) -> None:
+    if not app.config["ENABLE_METRICS"]:
+        return
+    # The engine is created on first use, so this takes effect as long as nothing has
+    # queried the database yet. SQLite in-memory databases need their own pool class.
+    if make_url(app.config["SQLALCHEMY_DATABASE_URI"]).get_backend_name() != "sqlite":
+        options = app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", {})
+        options.setdefault("poolclass", InstrumentedQueuePool)
+    app.before_request(start_request_timer)
+    app.after_request(observe_request)
+    app.teardown_request(finish_request_timer)
+
+
+@metrics_blueprint.route("/api/_metrics", methods=["GET"])
+def metrics():
+    """
+    The metrics of every worker in the Prometheus text format. Scrapers authenticate with
+    the METRICS_TOKEN as a bearer token, otherwise an admin must be logged in.
+    """
+    if not app.config["ENABLE_METRICS"]:
+        abort(404)
+    token = app.config["METRICS_TOKEN"]
+    if not (
+        (token and request.headers.get("Authorization") == f"Bearer {token}")
+        or app.config.get("LOGIN_DISABLED")
+        or (current_user.is_authenticated and current_user.is_admin)
+    ):
+        abort(401, description="Unauthorized")
+
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(
+        generate_latest(registry), headers={"Content-Type": CONTENT_TYPE_LATEST}
+    )
@@ -0,0 +1,177 @@
+"""
+Fans out the MinIO admin operations behind a single request over a bounded
+thread pool, retrying transient failures. Operations that still fail are
+recorded in the minio_reconciliation table so that MinIO can be brought back
+in line with the database by `flask replay-minio-operations`.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+import json
+from time import sleep
+from typing import Any, Callable, Dict, List, Optional
+
+from flask import current_app as app
+import urllib3
+
+from . import models
+from .extensions import db
+from .madmin import MinioAdmin, MinioAdminError
+from .utils import get_minio_admin
+
+
+@dataclass
+class AdminCall:
+    """
+    One MinioAdmin method call, kept as plain data so it can be logged and replayed.
+    """
+
+    method: str
+    args: List[str]
+    kwargs: Dict[str, str] = field(default_factory=dict)
+
+    def __call__(self, admin: MinioAdmin) -> Any:
+        return getattr(admin, self.method)(*self.args, **self.kwargs)
+
+    def __str__(self) -> str:
+        arguments = [repr(arg) for arg in self.args]
+        arguments += [f"{key}={value!r}" for key, value in self.kwargs.items()]
+        return f"{self.method}({', '.join(arguments)})"
+
+
+def admin_call(method: str, *args: str, **kwargs: str) -> AdminCall:
+    return AdminCall(method, list(args), kwargs)
+
+
+@dataclass
+class FailedTask:
+    # The call that failed followed by the calls after it that were not attempted
+    calls: List[AdminCall]
+    error: str
+
+
+def is_transient(error: Exception) -> bool:
+    if isinstance(error, MinioAdminError):
+        return error.status >= 500
+    return isinstance(error, urllib3.exceptions.HTTPError)
+
+
+def run_task(
+    admin: MinioAdmin, calls: List[AdminCall], retries: int, backoff: float
+) -> Optional[FailedTask]:
+    """
+    Runs the calls in order, retrying each transient failure up to retries times
+    with exponential backoff. Stops at the first call that cannot be completed.
+    """
+    for i, call in enumerate(calls):
+        attempt = 0
+        while True:
+            try:
+                call(admin)
+                break
+            except (RuntimeError, urllib3.exceptions.HTTPError) as error:
+                if attempt < retries and is_transient(error):
+                    sleep(backoff * 2 ** attempt)
+                    attempt += 1
+                    continue
+                return FailedTask(calls[i:], str(error))
+    return None
+
+
+def run_admin_tasks(
+    admin: MinioAdmin,
+    tasks: List[List[AdminCall]],
+    workers: int,
+    retries: int = 0,
+    backoff: float = 0,
+) -> List[FailedTask]:
+    """
+    Runs each task, a list of calls that must happen in order, concurrently with
+    the others on at most workers threads. Tasks must not depend on each other.
+    Returns the tasks that could not be completed; the rest are not affected.
+    """
+    tasks = [calls for calls in tasks if calls]
+
+    def run(calls: List[AdminCall]) -> Optional[FailedTask]:
+        return run_task(admin, calls, retries, backoff)
+
+    if workers <= 1 or len(tasks) <= 1:
+        results = [run(calls) for calls in tasks]
+    else:
+        with ThreadPoolExecutor(
+            max_workers=min(workers, len(tasks)), thread_name_prefix="minio-admin"
+        ) as executor:
+            results = list(executor.map(run, tasks))
+    return [failure for failure in results if failure is not None]
+
+
+def sync_minio(tasks: List[List[AdminCall]], context: str) -> List[FailedTask]:
+    """
+    Runs the tasks against the app's MinIO admin client with the configured
+    concurrency and retries. Each task that fails is logged and added to the
+    reconciliation log in the current session, to be committed with the
+    database changes it belongs to.
+    """
+    failures = run_admin_tasks(
+        get_minio_admin(),
+        tasks,
+        app.config["MINIO_ADMIN_WORKERS"],
+        app.config["MINIO_ADMIN_RETRIES"],
+        app.config["MINIO_ADMIN_BACKOFF"],
+    )
+    for failure in failures:
+        app.logger.warning(
+            "MinIO operation %s for %s failed, recording for replay: %s",
+            failure.calls[0],
+            context,
+            failure.error,
+        )
+        db.session.add(
+            models.MinioReconciliation(
+                context=context,
+                calls=json.dumps([asdict(call) for call in failure.calls]),
+                error=failure.error,
+            )
+        )
+    return failures
+
+
+def replay_reconciliation_log(echo: Callable[[str], Any], dry_run: bool = False) -> int:
+    """
+    Replays pending entries of the reconciliation log one at a time in the
+    order they were recorded, since a later entry may depend on an earlier one.
+    Entries that fail again keep their remaining calls for the next replay.
+    Returns the number of entries still pending.
+    """
+    admin = get_minio_admin()
+    entries = (
+        models.MinioReconciliation.query.filter_by(
+            state=models.ReconciliationState.Pending
+        )
+        .order_by(models.MinioReconciliation.reconciliation_id)
+        .all()
+    )
+    pending = 0
+    for entry in entries:
+        calls = [AdminCall(**call) for call in json.loads(entry.calls)]
+        echo(
+            f"{entry.reconciliation_id} ({entry.context}): {'; '.join(map(str, calls))}"
+        )
+        if dry_run:
+            pending += 1
+            continue
+        failure = run_task(
+            admin,
+            calls,
+            app.config["MINIO_ADMIN_RETRIES"],
+            app.config["MINIO_ADMIN_BACKOFF"],
+        )
+        entry.attempts += 1
+        if failure is None:
+            entry.state = models.ReconciliationState.Resolved
+        else:
+            echo(f"  failed: {failure.error}")
+            entry.calls = json.dumps([asdict(call) for call in failure.calls])
+            entry.error = failure.error
+            pending += 1
+        db.session.commit()
+    return pending
@@ -7,6 +7,7 @@ from flask_login import UserMixin
 from sqlalchemy import CheckConstraint
 from werkzeug.security import check_password_hash, generate_password_hash
 
+from .binning import bin_sql
 from .extensions import db, login
 
 users_groups_table = db.Table(
@@ -388,6 +389,148 @@ class Analysis(db.Model):
     priority: PriorityType = db.Column(db.Enum(PriorityType))
 
 
+class ReportIngestionState(str, Enum):
+    Ingesting = "Ingesting"
+    Ingested = "Ingested"
+    Unmapped = "Unmapped"
+
+
+@dataclass
+class ReportIngestion(db.Model):
+    # Ledger of C4R reports seen by map-insert-c4r-reports, so unchanged reports are skipped on later runs
+    report_path: str = db.Column(db.String(500), primary_key=True)
+    size: int = db.Column(db.BigInteger, nullable=False)
+    # seconds since the epoch, as reported by the filesystem
+    mtime: int = db.Column(db.BigInteger, nullable=False)
+    sha256: str = db.Column(db.String(64), nullable=False)
+    # the analysis whose variants were loaded from this report
+    analysis_id: int = db.Column(
+        db.Integer,
+        db.ForeignKey("analysis.analysis_id", onupdate="cascade", ondelete="set null"),
+    )
+    state: ReportIngestionState = db.Column(
+        db.Enum(ReportIngestionState), nullable=False
+    )
+    variant_count: int = db.Column(db.Integer, nullable=False, default=0)
+    updated: datetime = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+
+
+@dataclass
+class VariantSummary(db.Model):
+    # One variant-wise report row per gene and variant annotation,
+    # kept up to date by refresh_variant_summary as variants are loaded and removed
+    variant_summary_id = db.Column(db.Integer, primary_key=True)
+    ensembl_id: int = db.Column(
+        db.Integer,
+        db.ForeignKey("gene.ensembl_id", onupdate="cascade", ondelete="cascade"),
+        nullable=False,
+    )
+    annotation_id: int = db.Column(
+        db.Integer,
+        db.ForeignKey(
+            "variant_annotation.annotation_id", onupdate="cascade", ondelete="cascade"
+        ),
+        nullable=False,
+    )
+    frequency: int = db.Column(db.Integer, nullable=False)
+    # '; ' delimited, as in the report
+    participant_codenames: str = db.Column(db.Text, nullable=False)
+    family_codenames: str = db.Column(db.Text, nullable=False)
+    zygosities: str = db.Column(db.Text, nullable=False)
+    # distinct datasets whose genotypes are aggregated here, for permission checks
+    dataset_ids: str = db.Column(db.Text, nullable=False)
+    # JSON object of the whole report row, every cell formatted as in the CSV
+    report = db.Column(db.Text(16777215), nullable=False)
+
+    __table_args__ = (
+        db.Index(
+            "ix_variant_summary_ensembl_id_annotation_id",
+            "ensembl_id",
+            "annotation_id",
+            unique=True,
+        ),
+    )
+
+
+@dataclass
+class DataVersion(db.Model):
+    # A single row counting the commits that changed report data, which versions the
+    # report cache. Bumped by app.data_version whenever a watched table is written.
+    data_version_id: int = db.Column(db.Integer, primary_key=True)
+    version: int = db.Column(db.BigInteger, nullable=False, default=0)
+    # commits that changed group memberships or the datasets shared with groups
+    permission_version: int = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class ReconciliationState(str, Enum):
+    Pending = "Pending"
+    Resolved = "Resolved"
+
+
+@dataclass
+class MinioReconciliation(db.Model):
+    # MinIO admin operations that failed after their database changes were made,
+    # replayed in order by replay-minio-operations
+    reconciliation_id: int = db.Column(db.Integer, primary_key=True)
+    # the request or command that scheduled the operations
+    context: str = db.Column(db.String(200), nullable=False)
+    # JSON list of the remaining MinioAdmin calls, in the order they must run
+    calls: str = db.Column(db.Text, nullable=False)
+    error: str = db.Column(db.Text)
+    attempts: int = db.Column(db.Integer, nullable=False, default=1)
+    state: ReconciliationState = db.Column(
+        db.Enum(ReconciliationState),
+        nullable=False,
+        default=ReconciliationState.Pending,
+    )
+    created: datetime = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated: datetime = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+
+
+class ExportState(str, Enum):
+    Pending = "Pending"
+    Running = "Running"
+    Done = "Done"
+    Failed = "Failed"
+    Cancelled = "Cancelled"
+
+
+@dataclass
+class ExportJob(db.Model):
+    # CSV downloads computed in the background by app.exports
+    export_id: int = db.Column(db.Integer, primary_key=True)
+    # datasets, analyses, variants or participants
+    kind: str = db.Column(db.String(20), nullable=False)
+    # JSON object of the query string parameters of the equivalent GET request
+    params: str = db.Column(db.Text, nullable=False)
+    state: ExportState = db.Column(
+        db.Enum(ExportState), nullable=False, default=ExportState.Pending
+    )
+    # null when submitted with LOGIN_DISABLED
+    requester_id: int = db.Column(
+        db.Integer,
+        db.ForeignKey("user.user_id", onupdate="cascade", ondelete="cascade"),
+    )
+    # the MinIO bucket the file is written to, or null for the worker's EXPORT_DIR
+    group_code: str = db.Column(db.String(50))
+    # object name or file path of the gzipped CSV once finished
+    path = db.Column(db.String(500))
+    rows: int = db.Column(db.BigInteger, nullable=False, default=0)
+    size: int = db.Column(db.BigInteger)
+    error: str = db.Column(db.Text)
+    created: datetime = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    started: datetime = db.Column(db.DateTime)
+    finished: datetime = db.Column(db.DateTime)
+    # bumped by a heartbeat while running, so interrupted jobs can be told apart
+    updated: datetime = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow
+    )
+
+
 @dataclass
 class Pipeline(db.Model):
     pipeline_id: int = db.Column(db.Integer, primary_key=True)
@@ -449,22 +592,24 @@ class GeneAlias(db.Model):
 
 
 @dataclass
-class Variant(db.Model):
-    # table contains both variant-annotation (external, versioned annotation information) and variant-analysis (vcf) information.
-    # in the future, the variant-analysis information could be stored in the database and
-    # variant-annotations would be performed on the fly potentially through click commands or additional tables
-    variant_id: int = db.Column(db.Integer, primary_key=True)
-    analysis_id: int = db.Column(
-        db.Integer, db.ForeignKey("analysis.analysis_id"), nullable=False
-    )
+class VariantAnnotation(db.Model):
+    # External, versioned annotations of a variant, stored once per locus and allele and shared by
+    # every analysis that called it. Reports loaded later overwrite the annotations of earlier ones.
+    annotation_id: int = db.Column(db.Integer, primary_key=True)
     chromosome: str = db.Column(db.String(2), nullable=False)
     # GRCh37 coordinates, incompatible with others
     position: int = db.Column(db.Integer, nullable=False)
+    # UCSC bin of the position, lets gene panels be resolved to a few index ranges.
+    # Generated by the database so that rows inserted outside of the ORM are binned too.
+    bin = db.Column(
+        db.Integer,
+        db.Computed(bin_sql("position - 1", "position"), persisted=True),
+        nullable=False,
+    )
     reference_allele: str = db.Column(db.String(300), nullable=False)
     alt_allele: str = db.Column(db.String(300), nullable=False)
     variation: str = db.Column(db.String(50), nullable=False)
     refseq_change = db.Column(db.String(500), nullable=True)
-    depth: int = db.Column(db.Integer, nullable=False)
     conserved_in_20_mammals: int = db.Column(db.Float, nullable=True)
     sift_score: int = db.Column(db.Float, nullable=True)
     polyphen_score: int = db.Column(db.Float, nullable=True)
@@ -473,22 +618,13 @@ class Variant(db.Model):
 
     ucsc_link: str = db.Column(db.String(300), nullable=True)
     gnomad_link: str = db.Column(db.String(500), nullable=True)
-    # can be hgnc, ensembl or null depending on age of report. reports from 2020-08 onwards are guaranteed to have either hgnc or ensembl id in this, exists to facilitate comparison
-    gene: str = db.Column(db.String(50), nullable=True)
-    info: str = db.Column(db.Text(15000), nullable=True)
-    quality: int = db.Column(db.Integer, nullable=True)
     clinvar: str = db.Column(db.String(200), nullable=True)
     gnomad_af_popmax: int = db.Column(db.Float, nullable=True)
     gnomad_ac: int = db.Column(db.Integer, nullable=True)
     gnomad_hom: int = db.Column(db.Integer, nullable=True)
-    # unfortunately, not always an ensembl gene id
-    report_ensembl_gene_id: str = db.Column(db.String(50), nullable=True)
-    # unfortunately, not always an ensembl transcript id
-    ensembl_transcript_id: str = db.Column(db.String(50), nullable=True)
     aa_position: str = db.Column(db.String(50), nullable=True)
     exon: str = db.Column(db.String(50), nullable=True)
     protein_domains: str = db.Column(db.String(750), nullable=True)
-    rsids: str = db.Column(db.String(500), nullable=True)  # comma delimited
     gnomad_oe_lof_score: int = db.Column(db.Float, nullable=True)
     gnomad_oe_mis_score: int = db.Column(db.Float, nullable=True)
     exac_pli_score: int = db.Column(db.Float, nullable=True)
@@ -502,11 +638,56 @@ class Variant(db.Model):
     imprinting_status: str = db.Column(db.String(50), nullable=True)
     imprinting_expressed_allele: str = db.Column(db.String(50), nullable=True)
     pseudoautosomal: str = db.Column(db.Boolean, nullable=True)  # 'Nan'/Yes/Na
-    number_of_callers: int = db.Column(db.Integer, nullable=True)
-    old_multiallelic: str = db.Column(db.String(500), nullable=True)
     uce_100bp: bool = db.Column(db.Boolean, nullable=True)
     uce_200bp: bool = db.Column(db.Boolean, nullable=True)
 
+    __table_args__ = (
+        db.Index(
+            "ix_variant_annotation_locus",
+            "chromosome",
+            "position",
+            "reference_allele",
+            "alt_allele",
+            unique=True,
+        ),
+        db.Index(
+            "ix_variant_annotation_chromosome_bin_position",
+            "chromosome",
+            "bin",
+            "position",
+        ),
+    )
+
+
+@dataclass
+class Variant(db.Model):
+    # A variant as called in one analysis (vcf), with the values that differ between reports,
+    # such as depth and quality. Annotations of the locus are shared in VariantAnnotation.
+    variant_id: int = db.Column(db.Integer, primary_key=True)
+    analysis_id: int = db.Column(
+        db.Integer, db.ForeignKey("analysis.analysis_id"), nullable=False
+    )
+    annotation_id: int = db.Column(
+        db.Integer,
+        db.ForeignKey("variant_annotation.annotation_id"),
+        nullable=False,
+        index=True,
+    )
+    depth: int = db.Column(db.Integer, nullable=False)
+    # can be hgnc, ensembl or null depending on age of report. reports from 2020-08 onwards are guaranteed to have either hgnc or ensembl id in this, exists to facilitate comparison
+    gene: str = db.Column(db.String(50), nullable=True)
+    info: str = db.Column(db.Text(15000), nullable=True)
+    quality: int = db.Column(db.Integer, nullable=True)
+    # unfortunately, not always an ensembl gene id
+    report_ensembl_gene_id: str = db.Column(db.String(50), nullable=True)
+    # unfortunately, not always an ensembl transcript id
+    ensembl_transcript_id: str = db.Column(db.String(50), nullable=True)
+    rsids: str = db.Column(db.String(500), nullable=True)  # comma delimited
+    number_of_callers: int = db.Column(db.Integer, nullable=True)
+    old_multiallelic: str = db.Column(db.String(500), nullable=True)
+
+    annotation = db.relationship("VariantAnnotation")
+
 
 @dataclass
 class Genotype(db.Model):
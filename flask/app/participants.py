@@ -2,11 +2,12 @@ from dataclasses import asdict
 
 from flask import Blueprint, Response, abort, current_app as app, jsonify, request
 from flask_login import current_user, login_required
-from sqlalchemy import distinct, func
+from sqlalchemy import func
 from sqlalchemy.orm import contains_eager, joinedload
 
 from . import models
 from .extensions import db
+from .permissions import permission_filter
 from .utils import (
     check_admin,
     csv_response,
@@ -18,10 +19,16 @@ from .utils import (
     filter_updated_or_abort,
     mixin,
     paged,
+    paginate_query,
     paginated_response,
     transaction_or_abort,
     validate_json,
 )
+from .variants import (
+    participant_analyses,
+    refresh_variant_summary,
+    variant_summary_keys,
+)
 
 editable_columns = [
     "participant_codename",
@@ -74,10 +81,6 @@ def list_participants(page: int, limit: int) -> Response:
     if order_dir and order_dir not in ["desc", "asc"]:
         abort(400, description="order_dir must be either 'asc' or 'desc'")
 
-    if order:
-        if order_dir == "desc":
-            order = order.desc()
-
     filters = []
     family_codename = request.args.get("family_codename", type=str)
     if family_codename:
@@ -122,6 +125,8 @@ def list_participants(page: int, limit: int) -> Response:
         query = (
             models.Participant.query.options(
                 joinedload(models.Participant.institution),
+                joinedload(models.Participant.created_by),
+                joinedload(models.Participant.updated_by),
                 contains_eager(models.Participant.family),
                 contains_eager(models.Participant.tissue_samples).contains_eager(
                     models.TissueSample.datasets
@@ -130,22 +135,14 @@ def list_participants(page: int, limit: int) -> Response:
             .join(models.Participant.family)
             .outerjoin(models.Participant.tissue_samples)
             .outerjoin(models.TissueSample.datasets)
-            .join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id, *filters)
+            .filter(permission_filter(models.Dataset, user_id), *filters)
         )
     else:  # Admin or LOGIN_DISABLED, authorized to query all participants
         query = (
             models.Participant.query.options(
                 joinedload(models.Participant.institution),
+                joinedload(models.Participant.created_by),
+                joinedload(models.Participant.updated_by),
                 contains_eager(models.Participant.family),
                 joinedload(models.Participant.tissue_samples).joinedload(
                     models.TissueSample.datasets
@@ -172,10 +169,15 @@ def list_participants(page: int, limit: int) -> Response:
     # mapped objects. In addition, .count() just wraps the main query in a subquery, so it can be
     # inefficient. Luckily, we can sidestep this whole problem efficiently by having the database
     # count the number of distinct parent primary keys returned. https://gist.github.com/hest/8798884
-    total_count = query.with_entities(
-        func.count(distinct(models.Participant.participant_id))
-    ).scalar()
-    participants = query.order_by(order).limit(limit).offset(page * (limit or 0)).all()
+    participants, total_count, page, next_cursor = paginate_query(
+        query,
+        request.args,
+        models.Participant.participant_id,
+        page,
+        limit,
+        order_column=order,
+        descending=order is not None and order_dir == "desc",
+    )
 
     results = [
         {
@@ -196,7 +198,7 @@ def list_participants(page: int, limit: int) -> Response:
     ]
 
     if expects_json(request):
-        return paginated_response(results, page, total_count, limit)
+        return paginated_response(results, page, total_count, limit, next_cursor)
     elif expects_csv(request):
         return csv_response(
             results,
@@ -248,28 +250,10 @@ def update_participant(id: int):
     else:
         user_id = current_user.user_id
 
-    if user_id:
-        participant = (
-            models.Participant.query.filter(models.Participant.participant_id == id)
-            .join(models.TissueSample)
-            .join(models.Dataset)
-            .join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
-            .first_or_404()
-        )
-    else:
-        participant = models.Participant.query.filter(
-            models.Participant.participant_id == id
-        ).first_or_404()
+    participant = models.Participant.query.filter(
+        models.Participant.participant_id == id,
+        permission_filter(models.Participant, user_id),
+    ).first_or_404()
 
     enum_error = mixin(participant, request.json, editable_columns)
 
@@ -279,6 +263,14 @@ def update_participant(id: int):
     if user_id:
         participant.updated_by_id = user_id
 
+    if "participant_codename" in request.json:
+        app.logger.debug("Refreshing variant summaries with the participant codename..")
+        refresh_variant_summary(
+            variant_summary_keys(
+                participant_analyses(models.Participant.participant_id == id)
+            )
+        )
+
     transaction_or_abort(db.session.commit)
 
     return jsonify(
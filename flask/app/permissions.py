@@ -0,0 +1,127 @@
+"""
+Which datasets each user can see, through the groups they belong to. Each user's
+set of dataset ids is computed once per worker and reused until group memberships
+or the datasets shared with groups change, as counted by the permission_version
+in the data_version table. Group-scoped queries apply it as a single IN filter or
+semi-join instead of joining groups_datasets and users_groups into every query.
+"""
+from typing import Any, Dict, FrozenSet, Optional
+
+from flask import current_app as app
+from sqlalchemy import false, true
+
+from . import models
+from .data_version import data_version
+from .extensions import db
+
+
+class DatasetPermissions:
+    """
+    The permitted dataset ids of each user seen so far at one permission_version.
+    """
+
+    def __init__(self, version: int):
+        self.version = version
+        self.datasets: Dict[str, FrozenSet[int]] = {}
+
+
+def load_permitted_dataset_ids(user_id: Any) -> FrozenSet[int]:
+    return frozenset(
+        dataset_id
+        for dataset_id, in db.session.query(
+            models.groups_datasets_table.columns.dataset_id
+        )
+        .join(
+            models.users_groups_table,
+            models.groups_datasets_table.columns.group_id
+            == models.users_groups_table.columns.group_id,
+        )
+        .filter(models.users_groups_table.columns.user_id == user_id)
+        .distinct()
+    )
+
+
+def load_group_dataset_ids(group_code: str) -> FrozenSet[int]:
+    return frozenset(
+        dataset_id
+        for dataset_id, in db.session.query(
+            models.groups_datasets_table.columns.dataset_id
+        )
+        .join(
+            models.Group,
+            models.groups_datasets_table.columns.group_id == models.Group.group_id,
+        )
+        .filter(models.Group.group_code == group_code)
+    )
+
+
+def permitted_dataset_ids(
+    user_id: Any, shared_with: Optional[str] = None
+) -> Optional[FrozenSet[int]]:
+    """
+    Returns the ids of the datasets shared with the user's groups, or None if no
+    user_id is given and every dataset is visible. If the group_code shared_with is
+    given, only those of the datasets that are also shared with that group.
+    """
+    if shared_with:
+        group_datasets = load_group_dataset_ids(shared_with)
+        datasets = permitted_dataset_ids(user_id)
+        return group_datasets if datasets is None else group_datasets & datasets
+    if not user_id:
+        return None
+    version = data_version("permission_version")
+    permissions = app.extensions.get("dataset_permissions")
+    if permissions is None or permissions.version != version:
+        permissions = app.extensions["dataset_permissions"] = DatasetPermissions(
+            version
+        )
+    key = str(user_id)
+    datasets = permissions.datasets.get(key)
+    if datasets is None:
+        app.logger.debug("Loading the datasets permitted to user '%s'..", user_id)
+        datasets = permissions.datasets[key] = load_permitted_dataset_ids(user_id)
+    return datasets
+
+
+def permission_filter(
+    model: Any, user_id: Any, shared_with: Optional[str] = None
+) -> Any:
+    """
+    Returns a filter keeping the rows of model that the user can see: datasets shared
+    with their groups, genotypes of those datasets, or the tissue samples, participants,
+    families and analyses with at least one of them. Keeps every row if no user_id is given.
+    If the group_code shared_with is given, only datasets also shared with that group count.
+    """
+    datasets = permitted_dataset_ids(user_id, shared_with)
+    if datasets is None:
+        return true()
+    if not datasets:
+        return false()
+    datasets = sorted(datasets)
+
+    if model is models.Dataset or model is models.Genotype:
+        return model.dataset_id.in_(datasets)
+    if model is models.Analysis:
+        return models.Analysis.analysis_id.in_(
+            db.session.query(models.datasets_analyses_table.columns.analysis_id)
+            .filter(models.datasets_analyses_table.columns.dataset_id.in_(datasets))
+            .subquery()
+        )
+
+    tissue_samples = db.session.query(models.Dataset.tissue_sample_id).filter(
+        models.Dataset.dataset_id.in_(datasets)
+    )
+    if model is models.TissueSample:
+        return models.TissueSample.tissue_sample_id.in_(tissue_samples.subquery())
+    participants = db.session.query(models.TissueSample.participant_id).filter(
+        models.TissueSample.tissue_sample_id.in_(tissue_samples.subquery())
+    )
+    if model is models.Participant:
+        return models.Participant.participant_id.in_(participants.subquery())
+    if model is models.Family:
+        return models.Family.family_id.in_(
+            db.session.query(models.Participant.family_id)
+            .filter(models.Participant.participant_id.in_(participants.subquery()))
+            .subquery()
+        )
+    raise ValueError(f"No permission filter for {model}")
@@ -0,0 +1,269 @@
+"""
+Caches rendered gene panel reports. Entries are keyed on the report, the panel,
+the datasets visible to the caller and the data version (see app.data_version),
+so entries are never invalidated and stale ones simply fall out of the LRU.
+
+Two backends are available: "memory" keeps entries in each worker, and "shared"
+keeps them in a local SQLite file used by every worker on the host.
+"""
+from collections import OrderedDict
+from hashlib import sha256
+import json
+import os
+import sqlite3
+from threading import Lock, local
+from time import time
+from typing import Any, Dict, Iterable, Optional
+
+from flask import current_app as app
+
+
+class MemoryReportCache:
+    """
+    A size-bounded LRU of report bodies in this worker's memory.
+    """
+
+    backend = "memory"
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: bytes) -> None:
+        # reports larger than the whole cache are not kept
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous)
+            self.entries[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                "backend": self.backend,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class SharedReportCache:
+    """
+    A size-bounded LRU of report bodies in a SQLite database, shared by the
+    processes on this host, along with their combined statistics.
+
+    Lookups only read the database. Hits and misses are counted in this process
+    and added to the shared counters every flush_every lookups, on each set() and
+    when stats() is read, and an entry's last use is only rewritten once it is
+    more than used_resolution seconds old, which is as precise as the LRU gets.
+    """
+
+    backend = "shared"
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int,
+        used_resolution: float = 60,
+        flush_every: int = 100,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.used_resolution = used_resolution
+        self.flush_every = flush_every
+        self.local = local()
+        self.lock = Lock()
+        self.pending = {"hits": 0, "misses": 0}
+        self.pending_pid = os.getpid()
+        with self.connect() as connection:
+            connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS entry (
+                    key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS entry_used ON entry (used);
+                CREATE TABLE IF NOT EXISTS counter (name TEXT PRIMARY KEY, count INTEGER NOT NULL);
+                """
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        # one connection per thread, and never one inherited from a parent process
+        if getattr(self.local, "pid", None) != os.getpid():
+            self.local.connection = sqlite3.connect(
+                self.path, timeout=30, isolation_level=None
+            )
+            self.local.connection.execute("PRAGMA journal_mode=WAL")
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    @staticmethod
+    def count(connection: sqlite3.Connection, name: str, count: int = 1) -> None:
+        connection.execute(
+            "INSERT INTO counter VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET count = count + excluded.count",
+            (name, count),
+        )
+
+    def take_pending(self, name: str = None) -> Dict[str, int]:
+        """
+        Counts a lookup if name is given, and returns and resets this process's
+        uncounted lookups once there are flush_every of them, or always if name is None.
+        """
+        with self.lock:
+            # counts inherited from a parent process are the parent's to flush
+            if self.pending_pid != os.getpid():
+                self.pending = {"hits": 0, "misses": 0}
+                self.pending_pid = os.getpid()
+            if name is not None:
+                self.pending[name] += 1
+                if sum(self.pending.values()) < self.flush_every:
+                    return {}
+            pending, self.pending = self.pending, {"hits": 0, "misses": 0}
+        return {name: count for name, count in pending.items() if count}
+
+    def flush(self, connection: sqlite3.Connection = None) -> None:
+        """
+        Adds this process's uncounted hits and misses to the shared counters.
+        """
+        pending = self.take_pending()
+        if pending:
+            connection = connection or self.connect()
+            for name, count in pending.items():
+                self.count(connection, name, count)
+
+    def get(self, key: str) -> Optional[bytes]:
+        connection = self.connect()
+        row = connection.execute(
+            "SELECT value, used FROM entry WHERE key = ?", (key,)
+        ).fetchone()
+        pending = self.take_pending("misses" if row is None else "hits")
+        for name, count in pending.items():
+            self.count(connection, name, count)
+        if row is None:
+            return None
+        value, used = row
+        now = time()
+        if now - used > self.used_resolution:
+            connection.execute("UPDATE entry SET used = ? WHERE key = ?", (now, key))
+        return value
+
+    def set(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.execute(
+                "INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?)",
+                (key, value, len(value), time()),
+            )
+            (size,) = connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM entry"
+            ).fetchone()
+            evicted = []
+            if size > self.max_bytes:
+                for old_key, old_size in connection.execute(
+                    "SELECT key, size FROM entry ORDER BY used"
+                ):
+                    if size <= self.max_bytes:
+                        break
+                    evicted.append((old_key,))
+                    size -= old_size
+                connection.executemany("DELETE FROM entry WHERE key = ?", evicted)
+                self.count(connection, "evictions", len(evicted))
+            self.flush(connection)
+            connection.execute("COMMIT")
+        except:
+            connection.execute("ROLLBACK")
+            raise
+
+    def clear(self) -> None:
+        self.connect().execute("DELETE FROM entry")
+
+    def stats(self) -> Dict[str, Any]:
+        connection = self.connect()
+        self.flush(connection)
+        counters = dict(connection.execute("SELECT name, count FROM counter"))
+        entries, size = connection.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entry"
+        ).fetchone()
+        return {
+            "backend": self.backend,
+            "hits": counters.get("hits", 0),
+            "misses": counters.get("misses", 0),
+            "evictions": counters.get("evictions", 0),
+            "entries": entries,
+            "bytes": size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def get_report_cache():
+    """
+    Returns the app's report cache as configured by REPORT_CACHE_BACKEND, or None if
+    caching is disabled.
+    """
+    if "report_cache" not in app.extensions:
+        backend = app.config["REPORT_CACHE_BACKEND"]
+        max_bytes = app.config["REPORT_CACHE_MAX_MB"] * 1024 * 1024
+        if backend == "memory":
+            cache = MemoryReportCache(max_bytes)
+        elif backend == "shared":
+            cache = SharedReportCache(app.config["REPORT_CACHE_PATH"], max_bytes)
+        elif backend in ("", "none"):
+            cache = None
+        else:
+            raise ValueError(f"Unknown REPORT_CACHE_BACKEND '{backend}'")
+        app.extensions["report_cache"] = cache
+    return app.extensions["report_cache"]
+
+
+def report_cache_key(
+    type: str,
+    format: str,
+    ensgs: Iterable[int],
+    datasets: Optional[Iterable[int]],
+    version: int,
+) -> str:
+    """
+    Identifies a rendered report. datasets are the ids visible to the caller, or None
+    if they can see every dataset.
+    """
+    return sha256(
+        json.dumps(
+            [
+                type,
+                format,
+                sorted(set(ensgs)),
+                None if datasets is None else sorted(datasets),
+                version,
+            ]
+        ).encode()
+    ).hexdigest()
@@ -3,6 +3,7 @@ from datetime import datetime
 from enum import Enum
 import inspect
 from io import StringIO
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 from flask import (
     Blueprint,
@@ -219,13 +220,17 @@ def get_metadataset_types():
     return jsonify(d)
 
 
+# States of background bookkeeping tables, which are not values users pick from
+internal_enums = {"ExportState", "ReconciliationState", "ReportIngestionState"}
+
+
 @routes.route("/api/enums", methods=["GET"])
 @login_required
 def get_enums():
     enums = {}
     app.logger.info("Retrieving all enums..")
     for name, obj in inspect.getmembers(models, inspect.isclass):
-        if issubclass(obj, Enum) and name != "Enum":
+        if issubclass(obj, Enum) and name != "Enum" and name not in internal_enums:
             app.logger.debug("'%s' is an enum", name)
             enums[name] = [e.value for e in getattr(models, name)]
         else:
@@ -244,6 +249,66 @@ def get_enums():
     return jsonify(enums)
 
 
+def codename_key(value: Any) -> Optional[str]:
+    """
+    Normalizes a codename for matching the way MySQL's default collation compares them.
+    """
+    return None if value is None else str(value).lower()
+
+
+def bulk_get_or_create(
+    column: db.Column, values: Iterable[Any], defaults: Optional[Dict[str, Any]] = None
+) -> Dict[Optional[str], int]:
+    """
+    Maps each distinct value of a unique column to the primary key of its row,
+    inserting all the missing ones in one statement. Keys are normalized with codename_key.
+    """
+    model = column.class_
+    primary_key = model.__mapper__.primary_key[0]
+    wanted = {}
+    for value in values:
+        wanted.setdefault(codename_key(value), None if value is None else str(value))
+    if not wanted:
+        return {}
+
+    def lookup(names: Iterable[str]) -> Dict[str, int]:
+        return {
+            codename_key(name): id
+            for id, name in db.session.query(primary_key, column).filter(
+                column.in_(names)
+            )
+        }
+
+    ids = lookup([value for value in wanted.values() if value is not None])
+    missing = [value for key, value in wanted.items() if key not in ids]
+    if missing:
+        app.logger.debug("Creating %s %s entries", len(missing), model.__name__)
+        db.session.execute(
+            model.__table__.insert(),
+            [{column.key: value, **(defaults or {})} for value in missing],
+        )
+        ids.update(lookup(missing))
+    return ids
+
+
+def find_participants(codenames: Iterable[Any]) -> Dict[Tuple[int, str], int]:
+    """
+    Maps (family_id, codename_key(participant_codename)) to participant_id for the given codenames.
+    """
+    return {
+        (family_id, codename_key(codename)): participant_id
+        for participant_id, family_id, codename in db.session.query(
+            models.Participant.participant_id,
+            models.Participant.family_id,
+            models.Participant.participant_codename,
+        ).filter(
+            models.Participant.participant_codename.in_(
+                {str(codename) for codename in codenames if codename is not None}
+            )
+        )
+    }
+
+
 @routes.route("/api/_bulk", methods=["POST"])
 @login_required
 def bulk_update():
@@ -383,190 +448,166 @@ def bulk_update():
             )
             abort(403, description="User does not belong to any permission groups")
 
-    app.logger.info("Begin processing and inserting records into the database..")
+    # Validate every row up front so a bad row late in the upload is rejected
+    # before anything is written, reporting the same line numbers as before
+    app.logger.info("Validating %s records..", len(dat))
     for i, row in enumerate(dat):
-        app.logger.info("Start Record: %s", i)
-        app.logger.debug("\tChecking sequencing date is provided")
-        sequencing_date = row.get("sequencing_date")
-        if not sequencing_date:
+        app.logger.debug("\tChecking sequencing date is provided for record %s", i)
+        if not row.get("sequencing_date"):
             app.logger.error("\tNo sequencing date provided.")
             abort(400, description="A sequencing date must be provided")
-        else:
-            app.logger.debug("\tSequencing date provided: '%s'", sequencing_date)
-
-        # Find the family by codename or create it if it doesn't exist
-
-        app.logger.debug(
-            "\tChecking whether family already exists through codename '%s'..",
-            row.get("family_codename"),
-        )
-        family_id = models.Family.query.filter(
-            models.Family.family_codename == row.get("family_codename")
-        ).value("family_id")
-        if not family_id:
-            app.logger.debug(
-                "\tFamily '%s' does not yet exist.., creating",
-                row.get("family_codename"),
-            )
-            family = models.Family(
-                family_codename=row.get("family_codename"),
-                created_by_id=created_by_id,
-                updated_by_id=updated_by_id,
-            )
-            db.session.add(family)
-            app.logger.debug("\tInserting instance into database..")
-            transaction_or_abort(db.session.flush)
-            family_id = family.family_id
-        else:
-            app.logger.debug(
-                "\tFamily ID '%s' already exists and won't be created.", family_id
-            )
 
-        # Fail if we have any invalid values
         app.logger.debug("\tValidating enums for participants..")
         enum_error = enum_validate(
             models.Participant, row, editable_dict["participant"]
         )
         if enum_error:
             app.logger.error("\tEnum invalid: " + enum_error)
-            db.session.rollback()
             abort(400, description=f"Error on line {str(i + 1)} - " + enum_error)
-        else:
-            app.logger.debug("\tAll enums supplied are valid.")
-
-        # get institution id
-        app.logger.debug("\tRetrieving institution")
-        institution = row.get("institution")
-        if institution:
-            app.logger.debug(
-                "\tChecking supplied institution name, '%s', exists..", institution
-            )
-            institution_obj = models.Institution.query.filter(
-                models.Institution.institution == institution
-            ).one_or_none()
-            if institution_obj:
-                app.logger.debug("\tInstitution name exists, assigning its id")
-                institution_id = institution_obj.institution_id
-            else:
-                app.logger.debug(
-                    "\tInstitution name does not exist, creating a new entry in the database"
-                )
-                institution_obj = models.Institution(institution=institution)
-                db.session.add(institution_obj)
-                transaction_or_abort(db.session.commit)
-                institution_id = institution_obj.institution_id
-        else:
-            app.logger.debug("\tNo institution supplied")
-
-        # Find the participant by codename or create it if it doesn't exist
-        app.logger.debug(
-            "\tChecking participant exists through codename '%s'",
-            row.get("participant_codename"),
-        )
-        participant_id = models.Participant.query.filter(
-            models.Participant.family_id == family_id,
-            models.Participant.participant_codename == row.get("participant_codename"),
-        ).value("participant_id")
-        if not participant_id:
-            app.logger.debug("\tParticipant does not exist, creating")
-            participant = models.Participant(
-                family_id=family_id,
-                participant_codename=row.get("participant_codename"),
-                sex=row.get("sex"),
-                affected=row.get("affected"),
-                solved=row.get("solved"),
-                participant_type=row.get("participant_type"),
-                institution_id=institution_id if institution else None,
-                month_of_birth=row.get("month_of_birth"),
-                created_by_id=created_by_id,
-                updated_by_id=updated_by_id,
-            )
-            app.logger.debug("\tCreating entry in the database..")
-            db.session.add(participant)
-            transaction_or_abort(db.session.flush)
-            participant_id = participant.participant_id
-        else:
-            app.logger.debug(
-                "\tParticipant already exists and will not be added to the database"
-            )
 
-        # Fail if we have any invalid values
         app.logger.debug("\tValidating enums for tissue samples..")
         enum_error = enum_validate(
             models.TissueSample, row, editable_dict["tissue_sample"]
         )
         if enum_error:
-            db.session.rollback()
+            app.logger.error("\tEnum invalid: " + enum_error)
             abort(400, description=f"Error on line {str(i + 1)}: " + enum_error)
-        else:
-            app.logger.debug("\tAll enums supplied are valid.")
 
-        # Create a new tissue sample under this participant
-        app.logger.debug("\tCreating a new tissue sample..")
-        tissue_sample = models.TissueSample(
-            participant_id=participant_id,
-            tissue_sample_type=row.get("tissue_sample_type"),
-            notes=row.get("notes"),
-            created_by_id=created_by_id,
-            updated_by_id=updated_by_id,
-        )
-        app.logger.debug("\tCreating tissue sample entry in the database..")
-        db.session.add(tissue_sample)
-        transaction_or_abort(db.session.flush)
-        app.logger.debug("\tDone")
-        # Fail if we have any invalid values
         app.logger.debug("\tValidating enums for datasets..")
         enum_error = enum_validate(models.Dataset, row, editable_dict["dataset"])
         if enum_error:
             app.logger.error("\tEnum invalid: " + enum_error)
-            db.session.rollback()
             abort(400, description=f"Error on line {str(i + 1)} - " + enum_error)
-        else:
-            app.logger.debug("\tAll enums supplied are valid.")
-
-        # Create a new dataset under the new tissue sample
-        app.logger.debug("\tCreating a new dataset..")
-        dataset = models.Dataset(
-            tissue_sample_id=tissue_sample.tissue_sample_id,
-            dataset_type=row.get("dataset_type"),
-            created_by_id=created_by_id,
-            updated_by_id=updated_by_id,
-            condition=row.get("condition"),
-            extraction_protocol=row.get("extraction_protocol"),
-            capture_kit=row.get("capture_kit"),
-            library_prep_method=row.get("library_prep_method"),
+    app.logger.debug("All records are valid.")
+
+    app.logger.info("Begin processing and inserting records into the database..")
+    audit = {"created_by_id": created_by_id, "updated_by_id": updated_by_id}
+
+    app.logger.debug("Finding or creating families..")
+    family_ids = transaction_or_abort(
+        lambda: bulk_get_or_create(
+            models.Family.family_codename,
+            [row.get("family_codename") for row in dat],
+            audit,
+        )
+    )
+    app.logger.debug("Finding or creating institutions..")
+    institution_ids = transaction_or_abort(
+        lambda: bulk_get_or_create(
+            models.Institution.institution,
+            [row.get("institution") for row in dat if row.get("institution")],
+        )
+    )
+
+    # Participant codenames are unique on their own, but a participant is only
+    # reused if it belongs to the requested family, otherwise the insert below
+    # fails on the unique constraint as it always has
+    app.logger.debug("Finding or creating participants..")
+
+    def participant_key(row: Dict[str, Any]) -> Tuple[int, Optional[str]]:
+        return (
+            family_ids[codename_key(row.get("family_codename"))],
+            codename_key(row.get("participant_codename")),
+        )
+
+    participant_ids = find_participants(row.get("participant_codename") for row in dat)
+    new_participants = []
+    for row in dat:
+        key = participant_key(row)
+        if key not in participant_ids:
+            # Later rows for the same participant reuse the one inserted here
+            participant_ids[key] = None
+            institution = row.get("institution")
+            new_participants.append(
+                {
+                    "family_id": key[0],
+                    "participant_codename": row.get("participant_codename"),
+                    "sex": row.get("sex"),
+                    "affected": row.get("affected"),
+                    "solved": row.get("solved"),
+                    "participant_type": row.get("participant_type"),
+                    "institution_id": institution_ids[codename_key(institution)]
+                    if institution
+                    else None,
+                    "month_of_birth": row.get("month_of_birth"),
+                    **audit,
+                }
+            )
+    if new_participants:
+        app.logger.debug("Creating %s participants..", len(new_participants))
+        transaction_or_abort(
+            lambda: db.session.execute(
+                models.Participant.__table__.insert(), new_participants
+            )
+        )
+        participant_ids.update(
+            find_participants(p["participant_codename"] for p in new_participants)
+        )
+
+    # Tissue samples and datasets have no natural key to read their ids back by,
+    # so they go through the ORM which batches them into one flush
+    app.logger.debug("Creating %s tissue samples and datasets..", len(dat))
+    datasets = []
+    for row in dat:
+        tissue_sample = models.TissueSample(
+            participant_id=participant_ids[participant_key(row)],
+            tissue_sample_type=row.get("tissue_sample_type"),
             notes=row.get("notes"),
-            read_length=row.get("read_length"),
-            read_type=row.get("read_type"),
-            sequencing_centre=row.get("sequencing_centre"),
-            sequencing_date=row.get("sequencing_date"),
-            batch_id=row.get("batch_id"),
+            **audit,
         )
-        app.logger.debug("\tLinking files to dataset..")
-        if request.content_type == "text/csv":
-            app.logger.debug(
-                "\tContent type is `text/csv` and linked files are expected to be | separated: '%s'",
-                row.get("linked_files", "").split("|"),
+        datasets.append(
+            models.Dataset(
+                tissue_sample=tissue_sample,
+                dataset_type=row.get("dataset_type"),
+                condition=row.get("condition"),
+                extraction_protocol=row.get("extraction_protocol"),
+                capture_kit=row.get("capture_kit"),
+                library_prep_method=row.get("library_prep_method"),
+                notes=row.get("notes"),
+                read_length=row.get("read_length"),
+                read_type=row.get("read_type"),
+                sequencing_centre=row.get("sequencing_centre"),
+                sequencing_date=row.get("sequencing_date"),
+                batch_id=row.get("batch_id"),
+                **audit,
             )
-            files = row.get("linked_files", "").split("|")
-        else:
-            app.logger.debug(
-                "\tContent type is NOT `test/csv` and linked files are expected to be in a list: '%s'",
-                row.get("linked_files", []),
+        )
+    db.session.add_all(datasets)
+    transaction_or_abort(db.session.flush)
+    dataset_ids = [dataset.dataset_id for dataset in datasets]
+
+    app.logger.debug("Linking files to datasets..")
+    if request.content_type == "text/csv":
+        app.logger.debug("\tLinked files are expected to be | separated")
+        files = [(row.get("linked_files") or "").split("|") for row in dat]
+    else:
+        app.logger.debug("\tLinked files are expected to be in a list")
+        files = [row.get("linked_files", []) for row in dat]
+    dataset_files = [
+        {"dataset_id": dataset_id, "path": path}
+        for dataset_id, paths in zip(dataset_ids, files)
+        for path in paths
+        if path
+    ]
+    if dataset_files:
+        transaction_or_abort(
+            lambda: db.session.execute(
+                models.DatasetFile.__table__.insert(), dataset_files
             )
-            files = row.get("linked_files", [])
-        dataset.files += [models.DatasetFile(path=path) for path in files if path]
-
-        app.logger.debug("\tAdding users groups to the dataset")
-        dataset.groups += groups
-        app.logger.debug("\tCreating dataset entry in the database..")
-        app.logger.debug(dataset.__dict__)
-        db.session.add(dataset)
-        transaction_or_abort(db.session.flush)
-        app.logger.debug("\tDone")
-        dataset_ids.append(dataset.dataset_id)
-
-        app.logger.info("End Record: %s", i)
+        )
+
+    app.logger.debug("Adding users groups to the datasets..")
+    if dataset_ids:
+        transaction_or_abort(
+            lambda: db.session.execute(
+                models.groups_datasets_table.insert(),
+                [
+                    {"group_id": group.group_id, "dataset_id": dataset_id}
+                    for dataset_id in dataset_ids
+                    for group in groups
+                ],
+            )
+        )
 
     transaction_or_abort(db.session.commit)
     app.logger.debug("%s datasets added", len(dataset_ids))
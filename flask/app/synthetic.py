@@ -0,0 +1,503 @@
+"""
+Generates synthetic genes, families, participants, datasets, analyses, variants and genotypes
+in bulk, so that endpoints and report ingestion can be measured at production-like volumes.
+Used by `flask db-seed-synthetic` and benchmarks.endpoints.
+
+Values are drawn from a seeded NumPy generator, so the same arguments on the same database
+produce the same data. Distributions roughly follow exome reports: most variants fall in genes,
+a shared pool of common variants recurs across families, and a share of genotypes lack the
+depth to call a zygosity.
+"""
+from datetime import date, datetime, timedelta
+from itertools import cycle
+from typing import Any, Dict, List, Optional, Tuple
+
+from flask import current_app as app
+import numpy as np
+from sqlalchemy import func
+
+from . import models
+from .annotations import store_variant_annotations, variant_calls
+from .extensions import db
+from .variants import refresh_variant_summary, variant_summary_keys
+
+# GRCh37 chromosome lengths
+GRCH37_CHROMOSOME_LENGTHS = {
+    "1": 249250621,
+    "2": 243199373,
+    "3": 198022430,
+    "4": 191154276,
+    "5": 180915260,
+    "6": 171115067,
+    "7": 159138663,
+    "8": 146364022,
+    "9": 141213431,
+    "10": 135534747,
+    "11": 135006516,
+    "12": 133851895,
+    "13": 115169878,
+    "14": 107349540,
+    "15": 102531392,
+    "16": 90354753,
+    "17": 81195210,
+    "18": 78077248,
+    "19": 59128983,
+    "20": 63025520,
+    "21": 48129895,
+    "22": 51304566,
+    "X": 155270560,
+    "Y": 59373566,
+}
+
+# relative frequencies of annotations in exome reports
+VARIATIONS = {
+    "missense_variant": 0.42,
+    "synonymous_variant": 0.22,
+    "intron_variant": 0.12,
+    "splice_region_variant": 0.07,
+    "frameshift_variant": 0.05,
+    "5_prime_utr_variant": 0.04,
+    "inframe_deletion": 0.04,
+    "stop_gained": 0.04,
+}
+CLINVAR = {
+    None: 0.85,
+    "benign": 0.05,
+    "likely-benign": 0.03,
+    "uncertain": 0.04,
+    "likely-pathogenic": 0.015,
+    "pathogenic": 0.015,
+}
+ZYGOSITIES = {"Het": 0.55, "Hom": 0.12, "-": 0.28, "Insufficient coverage": 0.05}
+
+# share of each analysis' variants drawn from the pool shared by every family
+COMMON_VARIANT_SHARE = 0.3
+# share of variants placed in a gene rather than anywhere on a chromosome
+GENIC_VARIANT_SHARE = 0.85
+# dataset types given to synthetic datasets, where they exist
+SYNTHETIC_DATASET_TYPES = ["WES", "RES", "WGS", "RGS"]
+SYNTHETIC_GROUP_CODE = "synthetic"
+# prefix of synthetic family codenames, and of participant codenames after them
+SYNTHETIC_PREFIX = "SYN"
+
+NUCLEOTIDES = np.array(["A", "C", "G", "T"])
+
+
+def choose(rng: np.random.Generator, weights: Dict[Any, float], size: int) -> List:
+    values = list(weights)
+    probabilities = np.array(list(weights.values()))
+    picks = rng.choice(len(values), size=size, p=probabilities / probabilities.sum())
+    return [values[pick] for pick in picks]
+
+
+def next_id(column: Any) -> int:
+    return (db.session.query(func.max(column)).scalar() or 0) + 1
+
+
+def insert_rows(table: Any, rows: List[Dict[str, Any]], batch_size: int) -> None:
+    for batch in range(0, len(rows), batch_size):
+        db.session.execute(table.insert(), rows[batch : batch + batch_size])
+
+
+def synthetic_genes(
+    rng: np.random.Generator, count: int, first_ensembl_id: int
+) -> List[Dict[str, Any]]:
+    """
+    Returns gene rows spread over the chromosomes in proportion to their length, with
+    log-normal lengths around the human median of about 24 kb.
+    """
+    chromosomes = list(GRCH37_CHROMOSOME_LENGTHS)
+    lengths = np.array(list(GRCH37_CHROMOSOME_LENGTHS.values()))
+    on = rng.choice(len(chromosomes), size=count, p=lengths / lengths.sum())
+    spans = np.clip(rng.lognormal(np.log(24000), 1.2, count), 500, 2_000_000)
+    starts = (rng.random(count) * (lengths[on] - spans)).astype(np.int64) + 1
+    return [
+        {
+            "ensembl_id": first_ensembl_id + i,
+            "chromosome": chromosomes[on[i]],
+            "source": "synthetic",
+            "start": int(starts[i]),
+            "end": int(starts[i] + spans[i]),
+        }
+        for i in range(count)
+    ]
+
+
+def gene_spans() -> List[Tuple[int, str, int, int, Optional[str]]]:
+    """
+    Returns (ensembl_id, chromosome, start, end, name) of every gene, naming each by one alias.
+    """
+    names = dict(db.session.query(models.GeneAlias.ensembl_id, models.GeneAlias.name))
+    return [
+        (ensembl_id, chromosome, start, end, names.get(ensembl_id))
+        for ensembl_id, chromosome, start, end in db.session.query(
+            models.Gene.ensembl_id,
+            models.Gene.chromosome,
+            models.Gene.start,
+            models.Gene.end,
+        )
+    ]
+
+
+def synthetic_variants(
+    rng: np.random.Generator,
+    count: int,
+    genes: List[Tuple[int, str, int, int, Optional[str]]],
+    common: bool = False,
+) -> List[Dict[str, Any]]:
+    """
+    Returns variant annotations, without ids, placed in the given gene_spans() or anywhere on
+    a chromosome. Common variants have a population frequency of at least 1%.
+    """
+    chromosomes = list(GRCH37_CHROMOSOME_LENGTHS)
+    lengths = np.array(list(GRCH37_CHROMOSOME_LENGTHS.values()))
+    genic = rng.random(count) < (GENIC_VARIANT_SHARE if genes else 0)
+    picks = rng.integers(0, max(len(genes), 1), count)
+    anywhere = rng.choice(len(chromosomes), size=count, p=lengths / lengths.sum())
+    offsets = rng.random(count)
+    snv = rng.random(count) < 0.88
+    variations = choose(rng, VARIATIONS, count)
+    clinvar = choose(rng, CLINVAR, count)
+    depths = rng.negative_binomial(8, 0.12, count) + 5
+    if common:
+        frequencies = 10 ** rng.uniform(-2, np.log10(0.5), count)
+    else:
+        frequencies = 10 ** rng.uniform(-6, -2, count)
+    # a third of rare variants are absent from gnomAD
+    absent = (rng.random(count) < 0.35) & (not common)
+    cadd = rng.gamma(2.0, 6.0, count)
+    sift = rng.random(count)
+    polyphen = rng.random(count)
+    rsid = rng.random(count) < (0.95 if common else 0.4)
+
+    variants = []
+    for i in range(count):
+        gene = None
+        if genic[i]:
+            ensembl_id, chromosome, start, end, name = genes[picks[i]]
+            position = start + int(offsets[i] * (end - start))
+            gene = (ensembl_id, name or f"ENSG{ensembl_id:011d}")
+        else:
+            chromosome = chromosomes[anywhere[i]]
+            position = 1 + int(offsets[i] * (lengths[anywhere[i]] - 1))
+        base = rng.integers(4)
+        reference = str(NUCLEOTIDES[base])
+        alt = str(NUCLEOTIDES[(base + rng.integers(1, 4)) % 4])
+        if not snv[i]:
+            # short insertions and deletions
+            indel = "".join(rng.choice(NUCLEOTIDES, rng.integers(1, 6)))
+            if rng.random() < 0.5:
+                reference, alt = reference + indel, reference
+            else:
+                alt = reference + indel
+        missing = absent[i]
+        variants.append(
+            {
+                "chromosome": chromosome,
+                "position": position,
+                "reference_allele": reference,
+                "alt_allele": alt,
+                "variation": variations[i],
+                "depth": int(depths[i]),
+                "conserved_in_20_mammals": round(float(offsets[i]), 3),
+                "sift_score": round(float(sift[i]), 3),
+                "polyphen_score": round(float(polyphen[i]), 3),
+                "cadd_score": round(float(cadd[i]), 2),
+                "gnomad_af": None if missing else float(frequencies[i]),
+                "gnomad_af_popmax": None
+                if missing
+                else float(min(frequencies[i] * 1.8, 1)),
+                "gnomad_ac": None if missing else int(frequencies[i] * 250000) + 1,
+                "gnomad_hom": None if missing else int(frequencies[i] ** 2 * 125000),
+                "clinvar": clinvar[i],
+                "gene": gene[1] if gene else None,
+                "report_ensembl_gene_id": f"ENSG{gene[0]:011d}" if gene else None,
+                "rsids": f"rs{rng.integers(1, 800_000_000)}" if rsid[i] else None,
+                "quality": int(rng.integers(30, 5000)),
+                "ucsc_link": f"http://genome.ucsc.edu/cgi-bin/hgTracks?db=hg19&position=chr{chromosome}:{position}",
+                "gnomad_link": f"http://gnomad.broadinstitute.org/variant/{chromosome}-{position}-{reference}-{alt}",
+                "uce_100bp": False,
+                "uce_200bp": False,
+            }
+        )
+    return variants
+
+
+def synthetic_genotypes(
+    rng: np.random.Generator, variants: List[Dict[str, Any]], samples: int
+) -> List[List[Dict[str, Any]]]:
+    """
+    Returns the genotypes of samples participants for each variant, without ids.
+    """
+    zygosities = choose(rng, ZYGOSITIES, len(variants) * samples)
+    genotypes = []
+    for i, variant in enumerate(variants):
+        reference, alt = variant["reference_allele"], variant["alt_allele"]
+        calls = []
+        for j in range(samples):
+            zygosity = zygosities[i * samples + j]
+            coverage = max(int(variant["depth"] * rng.uniform(0.6, 1.4)), 1)
+            if zygosity == "Insufficient coverage":
+                coverage = int(rng.integers(0, 5))
+            alt_depths = {
+                "Het": int(coverage * rng.uniform(0.3, 0.7)),
+                "Hom": int(coverage * rng.uniform(0.9, 1)),
+            }.get(zygosity, 0)
+            calls.append(
+                {
+                    "zygosity": zygosity,
+                    "burden": int(zygosity in ("Het", "Hom")),
+                    "alt_depths": alt_depths,
+                    "coverage": coverage,
+                    "genotype": {
+                        "Het": f"{reference}/{alt}",
+                        "Hom": f"{alt}/{alt}",
+                        "-": f"{reference}/{reference}",
+                    }.get(zygosity, "./."),
+                }
+            )
+        genotypes.append(calls)
+    return genotypes
+
+
+def seed_synthetic_genes(rng: np.random.Generator, count: int, batch_size: int) -> None:
+    first_ensembl_id = next_id(models.Gene.ensembl_id)
+    genes = synthetic_genes(rng, count, first_ensembl_id)
+    insert_rows(models.Gene.__table__, genes, batch_size)
+    insert_rows(
+        models.GeneAlias.__table__,
+        [
+            {
+                "ensembl_id": gene["ensembl_id"],
+                "name": f"{SYNTHETIC_PREFIX}{gene['ensembl_id']}",
+            }
+            for gene in genes
+        ],
+        batch_size,
+    )
+    db.session.commit()
+    app.logger.info("Inserted %s synthetic genes", count)
+
+
+def seed_synthetic_data(
+    families: int,
+    participants: int,
+    variants: int,
+    genes: int,
+    seed: int = 0,
+    batch_size: int = 5000,
+) -> Dict[str, int]:
+    """
+    Inserts synthetic genes, then families of participants, each with one tissue sample and dataset,
+    shared with one group, and one analysis of the family's datasets with variants genotyped in
+    every participant. Ids are allocated up front from the current maximum and rows go in as
+    multi-row INSERTs, committing each family. Requires the users, institutions, dataset types and
+    pipelines that `flask db-seed` creates. Each row is created and updated by the next of the
+    existing users in turn, so that serializing rows touches many users. Families are shared
+    round-robin with the existing groups, or a new "synthetic" group if there are none.
+
+    Returns the number of rows inserted per table.
+    """
+    rng = np.random.default_rng(seed)
+    user_ids = [
+        user_id
+        for (user_id,) in db.session.query(models.User.user_id).order_by(
+            models.User.user_id
+        )
+    ]
+    pipeline = models.Pipeline.query.order_by(models.Pipeline.pipeline_id).first()
+    dataset_types = [
+        dataset_type
+        for (dataset_type,) in db.session.query(models.DatasetType.dataset_type)
+        if dataset_type in SYNTHETIC_DATASET_TYPES
+    ]
+    if not user_ids or pipeline is None or not dataset_types:
+        raise ValueError(
+            "Users, pipelines and dataset types are missing, run `flask db-seed` first"
+        )
+    institution_ids = [
+        institution_id
+        for (institution_id,) in db.session.query(models.Institution.institution_id)
+    ]
+    group_ids = [group_id for (group_id,) in db.session.query(models.Group.group_id)]
+    if not group_ids:
+        group = models.Group(
+            group_code=SYNTHETIC_GROUP_CODE, group_name="Synthetic data"
+        )
+        db.session.add(group)
+        db.session.commit()
+        group_ids = [group.group_id]
+
+    if genes:
+        seed_synthetic_genes(rng, genes, batch_size)
+    spans = gene_spans()
+    common = synthetic_variants(rng, max(variants * 2, 1), spans, common=True)
+
+    now = datetime.utcnow()
+    users = cycle(user_ids)
+
+    def audit() -> Dict[str, Any]:
+        user_id = next(users)
+        return {
+            "created_by_id": user_id,
+            "updated_by_id": user_id,
+            "created": now,
+            "updated": now,
+        }
+
+    family_id = next_id(models.Family.family_id)
+    participant_id = next_id(models.Participant.participant_id)
+    tissue_sample_id = next_id(models.TissueSample.tissue_sample_id)
+    dataset_id = next_id(models.Dataset.dataset_id)
+    analysis_id = next_id(models.Analysis.analysis_id)
+    variant_id = next_id(models.Variant.variant_id)
+    counts = {"gene": genes}
+
+    def count(table: str, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        counts[table] = counts.get(table, 0) + len(rows)
+        return rows
+
+    for f in range(families):
+        family_codename = f"{SYNTHETIC_PREFIX}{family_id:06}"
+        db.session.execute(
+            models.Family.__table__.insert(),
+            count(
+                "family",
+                [
+                    {
+                        "family_id": family_id,
+                        "family_codename": family_codename,
+                        **audit(),
+                    }
+                ],
+            ),
+        )
+        participant_rows, tissue_sample_rows, dataset_rows = [], [], []
+        for p in range(participants):
+            participant_rows.append(
+                {
+                    "participant_id": participant_id + p,
+                    "family_id": family_id,
+                    "participant_codename": f"{family_codename}-{p + 1}",
+                    "sex": str(
+                        rng.choice([models.Sex.Female.value, models.Sex.Male.value])
+                    ),
+                    "participant_type": (
+                        models.ParticipantType.Proband
+                        if p == 0
+                        else models.ParticipantType.Parent
+                        if p < 3
+                        else models.ParticipantType.Sibling
+                    ).value,
+                    "affected": p == 0,
+                    "solved": False,
+                    "month_of_birth": date(
+                        int(rng.integers(1950, 2020)), int(rng.integers(1, 13)), 1
+                    ),
+                    "institution_id": int(rng.choice(institution_ids))
+                    if institution_ids
+                    else None,
+                    **audit(),
+                }
+            )
+            tissue_sample_rows.append(
+                {
+                    "tissue_sample_id": tissue_sample_id + p,
+                    "participant_id": participant_id + p,
+                    "tissue_sample_type": models.TissueSampleType.Blood.value,
+                    **audit(),
+                }
+            )
+            dataset_rows.append(
+                {
+                    "dataset_id": dataset_id + p,
+                    "tissue_sample_id": tissue_sample_id + p,
+                    "dataset_type": str(rng.choice(dataset_types)),
+                    "condition": models.DatasetCondition.GermLine.value,
+                    "sequencing_date": (
+                        now - timedelta(days=int(rng.integers(0, 2000)))
+                    ).date(),
+                    "discriminator": "dataset",
+                    **audit(),
+                }
+            )
+        dataset_ids = [row["dataset_id"] for row in dataset_rows]
+        for table, rows, name in [
+            (models.Participant.__table__, participant_rows, "participant"),
+            (models.TissueSample.__table__, tissue_sample_rows, "tissue_sample"),
+            (models.Dataset.__table__, dataset_rows, "dataset"),
+        ]:
+            db.session.execute(table.insert(), count(name, rows))
+        db.session.execute(
+            models.groups_datasets_table.insert(),
+            [
+                {"group_id": group_ids[f % len(group_ids)], "dataset_id": id}
+                for id in dataset_ids
+            ],
+        )
+        db.session.execute(
+            models.Analysis.__table__.insert(),
+            count(
+                "analysis",
+                [
+                    {
+                        "analysis_id": analysis_id,
+                        "analysis_state": models.AnalysisState.Done.value,
+                        "pipeline_id": pipeline.pipeline_id,
+                        "requester_id": next(users),
+                        "requested": now,
+                        "finished": now,
+                        "updated": now,
+                        "updated_by_id": next(users),
+                    }
+                ],
+            ),
+        )
+        db.session.execute(
+            models.datasets_analyses_table.insert(),
+            [{"dataset_id": id, "analysis_id": analysis_id} for id in dataset_ids],
+        )
+
+        shared = int(variants * COMMON_VARIANT_SHARE)
+        family_variants = [
+            common[i] for i in rng.choice(len(common), shared, replace=False)
+        ] + synthetic_variants(rng, variants - shared, spans)
+        variant_rows, genotype_rows = [], []
+        for variant, calls in zip(
+            family_variants, synthetic_genotypes(rng, family_variants, participants)
+        ):
+            variant_rows.append(
+                {**variant, "variant_id": variant_id, "analysis_id": analysis_id}
+            )
+            for id, call in zip(dataset_ids, calls):
+                genotype_rows.append(
+                    {
+                        **call,
+                        "variant_id": variant_id,
+                        "analysis_id": analysis_id,
+                        "dataset_id": id,
+                    }
+                )
+            variant_id += 1
+        annotation_ids = store_variant_annotations(variant_rows, batch_size)
+        insert_rows(
+            models.Variant.__table__,
+            count("variant", variant_calls(variant_rows, annotation_ids)),
+            batch_size,
+        )
+        insert_rows(
+            models.Genotype.__table__, count("genotype", genotype_rows), batch_size
+        )
+        if app.config["USE_VARIANT_SUMMARY"]:
+            refresh_variant_summary(variant_summary_keys([analysis_id]))
+        db.session.commit()
+
+        if (f + 1) % 100 == 0:
+            app.logger.info("Inserted %s of %s synthetic families", f + 1, families)
+        family_id += 1
+        participant_id += participants
+        tissue_sample_id += participants
+        dataset_id += participants
+        analysis_id += 1
+
+    return counts
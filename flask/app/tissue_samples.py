@@ -5,6 +5,7 @@ from flask_login import login_user, logout_user, current_user, login_required
 from .extensions import db, login
 from . import models
 from sqlalchemy.orm import contains_eager, joinedload
+from .permissions import permission_filter
 from .utils import (
     check_admin,
     transaction_or_abort,
@@ -50,17 +51,7 @@ def get_tissue_sample(id: int):
                 joinedload(models.TissueSample.updated_by),
             )
             .join(models.Dataset)
-            .join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
+            .filter(permission_filter(models.Dataset, user_id))
             .one_or_none()
         )
     else:
@@ -232,17 +223,7 @@ def update_tissue_sample(id: int):
                 # contains_eager(models.TissueSample.updated_by),
             )
             .join(models.Dataset)
-            .join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
-            )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
-            )
-            .filter(models.users_groups_table.columns.user_id == user_id)
+            .filter(permission_filter(models.Dataset, user_id))
             .one_or_none()
         )
     else:
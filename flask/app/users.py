@@ -9,6 +9,7 @@ from sqlalchemy.orm import joinedload
 from . import models
 from .extensions import db
 from .madmin import MinioAdmin
+from .minio_sync import admin_call, sync_minio
 from .utils import check_admin, get_minio_admin, transaction_or_abort, validate_json
 
 
@@ -118,14 +119,19 @@ def reset_minio_credentials(user: models.User) -> None:
         the explicit denies in the group policy will override the allows in the individual policy
         https://docs.aws.amazon.com/IAM/latest/UserGuide/reference_policies_evaluation-logic.html
         """
-        minio_admin.set_policy("readwrite", user=access_key)
+        tasks = [[admin_call("set_policy", "readwrite", user=access_key)]]
     else:
-        for group in user.groups:
-            # MinIO requires a user to exist to create the group so the access policy
-            # might not be set on a group if this is the first user to be added, however
-            # we can guarantee from POST /api/groups that the policy exists in MinIO
-            minio_admin.group_add(group.group_code, access_key)
-            minio_admin.set_policy(group.group_code, group=group.group_code)
+        # MinIO requires a user to exist to create the group so the access policy
+        # might not be set on a group if this is the first user to be added, however
+        # we can guarantee from POST /api/groups that the policy exists in MinIO
+        tasks = [
+            [
+                admin_call("group_add", group.group_code, access_key),
+                admin_call("set_policy", group.group_code, group=group.group_code),
+            ]
+            for group in user.groups
+        ]
+    sync_minio(tasks, f"reset MinIO credentials for {user.username}")
 
     user.minio_access_key = access_key
     user.minio_secret_key = secret_key
@@ -367,17 +373,26 @@ def update_user(username: str) -> Response:
                 app.logger.error("The requested groups are invalid.")
                 abort(404, description="Invalid group code provided")
             if user.minio_access_key:
-                for group in user.groups:
-                    app.logger.debug("Reset current group memberships")
-                    # Reset existing group memberships
-                    minio_admin.group_remove(group.group_code, user.minio_access_key)
-
+                app.logger.debug("Updating MinIO group memberships..")
+                # Each task touches a different group, so they run concurrently
+                tasks = [
+                    [
+                        admin_call(
+                            "group_remove", group.group_code, user.minio_access_key
+                        )
+                    ]
+                    for group in user.groups
+                    if group.group_code not in requested_groups
+                ]
                 for group_code in requested_groups:
-                    app.logger.debug("Adding membership to requested groups")
-                    # Add to group
-                    minio_admin.group_add(group_code, user.minio_access_key)
-                    # Reset policy for group in case the group did not exist
-                    minio_admin.set_policy(group_code, group=group_code)
+                    tasks.append(
+                        [
+                            admin_call("group_add", group_code, user.minio_access_key),
+                            # Reset policy for group in case the group did not exist
+                            admin_call("set_policy", group_code, group=group_code),
+                        ]
+                    )
+                sync_minio(tasks, f"PATCH /api/users/{old_username}")
             user.groups = groups
 
         app.logger.debug(
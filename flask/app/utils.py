@@ -1,11 +1,14 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from csv import DictWriter, QUOTE_MINIMAL
 from dataclasses import asdict, dataclass
 from datetime import date, datetime, time
 from enum import Enum
 from functools import wraps
+from hashlib import sha1
 from io import BytesIO, StringIO
+import json
 from os import getenv
-from typing import Any, Callable, Dict, List, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 from flask import (
     abort,
     current_app as app,
@@ -17,10 +20,16 @@ from flask import (
 from flask.json import JSONEncoder
 from flask_login import current_user
 from flask_sqlalchemy import Model
-from sqlalchemy import exc
+from minio import Minio
+from sqlalchemy import and_, case, distinct, exc, func, or_, types
+from sqlalchemy.orm import Query
+import urllib3
+from werkzeug.datastructures import MultiDict
 from werkzeug.exceptions import HTTPException
 
+from .columnar import ARROW_STREAM_MIMETYPE, PARQUET_MIMETYPE
 from .extensions import db
+from .instrumentation import timed
 from .madmin import MinioAdmin
 from .models import User
 
@@ -96,9 +105,9 @@ def paged(handler):
     return decorated_handler
 
 
-def transaction_or_abort(callback: Callable) -> None:
+def transaction_or_abort(callback: Callable) -> Any:
     try:
-        callback()
+        return callback()
     except exc.DataError as err:
         db.session.rollback()
         abort(400, description=err.orig.args[1])
@@ -159,11 +168,43 @@ def filter_updated_or_abort(column: db.Column, value: str):
 
 
 def get_minio_admin() -> MinioAdmin:
-    return MinioAdmin(
-        endpoint=app.config["MINIO_ENDPOINT"],
-        access_key=app.config["MINIO_ACCESS_KEY"],
-        secret_key=app.config["MINIO_SECRET_KEY"],
-    )
+    """
+    Returns the app's MinIO admin client, which like get_minio_client keeps
+    its connection pool across requests.
+    """
+    admin = app.extensions.get("minio_admin")
+    if admin is None:
+        admin = app.extensions["minio_admin"] = MinioAdmin(
+            endpoint=app.config["MINIO_ENDPOINT"],
+            access_key=app.config["MINIO_ACCESS_KEY"],
+            secret_key=app.config["MINIO_SECRET_KEY"],
+        )
+    return admin
+
+
+def get_minio_client() -> Minio:
+    """
+    Returns the app's MinIO client, created on first use so that every request
+    shares its connection pool instead of opening new connections each time.
+    """
+    client = app.extensions.get("minio")
+    if client is None:
+        client = app.extensions["minio"] = Minio(
+            app.config["MINIO_ENDPOINT"],
+            access_key=app.config["MINIO_ACCESS_KEY"],
+            secret_key=app.config["MINIO_SECRET_KEY"],
+            secure=False,
+            http_client=urllib3.PoolManager(
+                maxsize=app.config["MINIO_POOL_SIZE"],
+                timeout=urllib3.Timeout(connect=5, read=300),
+                retries=urllib3.Retry(
+                    total=5,
+                    backoff_factor=0.2,
+                    status_forcelist=[500, 502, 503, 504],
+                ),
+            ),
+        )
+    return client
 
 
 def query_results_to_csv(results: List[dict or dataclass]):
@@ -190,14 +231,166 @@ def query_results_to_csv(results: List[dict or dataclass]):
     return csv_data.getvalue()
 
 
-def paginated_response(results: List[Any], page: int, total: int, limit: int = None):
-    return jsonify(
-        {
-            "data": results,
-            "page": page if limit else 0,
-            "total_count": total,
-        }
+def paginated_response(
+    results: List[Any],
+    page: int,
+    total: int,
+    limit: int = None,
+    next_cursor: Optional[str] = None,
+):
+    response = {
+        "data": results,
+        "page": page if limit else 0,
+        "total_count": total,
+    }
+    if limit:
+        # null once the last page has been reached
+        response["next_cursor"] = next_cursor
+    return jsonify(response)
+
+
+def encode_cursor_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {"datetime": value.isoformat()}
+    if isinstance(value, date):
+        return {"date": value.isoformat()}
+    return value
+
+
+def decode_cursor_value(value: Any) -> Any:
+    if isinstance(value, dict) and "datetime" in value:
+        return datetime.fromisoformat(value["datetime"])
+    if isinstance(value, dict) and "date" in value:
+        return date.fromisoformat(value["date"])
+    return value
+
+
+def query_fingerprint(args: MultiDict) -> str:
+    """
+    Identifies the filters and ordering of a listing's query string parameters
+    so a cursor cannot be replayed against a different listing.
+    """
+    filters = sorted(
+        (key, value)
+        for key, value in args.items(multi=True)
+        if key not in ("cursor", "page", "limit")
+    )
+    return sha1(json.dumps(filters).encode()).hexdigest()[:16]
+
+
+def keyset_filter(
+    column: Optional[db.Column],
+    primary_key: db.Column,
+    descending: bool,
+    value: Any,
+    key: Any,
+):
+    """
+    Matches the rows strictly after (value, key) when ordering by column, then
+    primary_key, in the given direction. MySQL sorts NULLs first when ascending
+    and last when descending, so nullable columns need their own branches.
+    """
+    after_key = primary_key < key if descending else primary_key > key
+    if column is None:
+        return after_key
+    if value is None:
+        if descending:
+            return and_(column.is_(None), after_key)
+        return or_(column.isnot(None), and_(column.is_(None), after_key))
+    if descending:
+        return or_(column < value, column.is_(None), and_(column == value, after_key))
+    return or_(column > value, and_(column == value, after_key))
+
+
+def enum_position(column: db.Column) -> Any:
+    """
+    MySQL sorts ENUM columns by their position in the definition but compares them
+    to strings as strings, so a cursor on the value could skip or repeat rows.
+    Returns the position to order and seek on instead, other columns as they are.
+    """
+    if not isinstance(column.type, types.Enum):
+        return column
+    return case(
+        {value: position for position, value in enumerate(column.type.enums)},
+        value=column,
+    )
+
+
+def paginate_query(
+    query: Query,
+    args: MultiDict,
+    primary_key: db.Column,
+    page: int,
+    limit: Optional[int],
+    order_column: Optional[db.Column] = None,
+    descending: bool = False,
+) -> Tuple[List[Any], int, int, Optional[str]]:
+    """
+    Orders and pages a list query, returning its rows, the total number of
+    distinct rows, the page number and a cursor for the following page. args
+    are the query string parameters of the listing, including any cursor.
+
+    Passing the returned cursor back as ?cursor= seeks past the last row of the
+    previous page instead of using OFFSET, so every page costs the same as the
+    first. The total count is computed once and carried along in the cursor.
+    """
+    direction = "desc" if descending else "asc"
+    order = [getattr(primary_key, direction)()]
+    if order_column is not None:
+        order_column = enum_position(order_column)
+        order.insert(0, getattr(order_column, direction)())
+    fingerprint = query_fingerprint(args)
+
+    cursor = args.get("cursor")
+    if cursor:
+        if not limit:
+            abort(400, description="cursor requires a limit")
+        try:
+            state = json.loads(urlsafe_b64decode(cursor.encode()))
+            value, key = (decode_cursor_value(v) for v in state["after"])
+            total, page = int(state["total"]), int(state["page"])
+        except (ValueError, KeyError, TypeError):
+            abort(400, description="Invalid cursor")
+        if state.get("query") != fingerprint:
+            abort(400, description="cursor does not match the requested filters")
+        query = query.filter(
+            keyset_filter(order_column, primary_key, descending, value, key)
+        )
+        offset = 0
+    else:
+        total = query.with_entities(func.count(distinct(primary_key))).scalar()
+        offset = page * (limit or 0)
+
+    if not limit:
+        return query.order_by(*order).offset(offset).all(), total, page, None
+
+    # Fetch one row past the page to know whether there is a next page, along
+    # with the values the cursor needs to resume from
+    cursor_columns = [primary_key.label("cursor_key")]
+    if order_column is not None:
+        cursor_columns.append(order_column.label("cursor_value"))
+    rows = (
+        query.add_columns(*cursor_columns)
+        .order_by(*order)
+        .limit(limit + 1)
+        .offset(offset)
+        .all()
     )
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        state = {
+            "after": [
+                encode_cursor_value(getattr(last, "cursor_value", None)),
+                encode_cursor_value(last.cursor_key),
+            ],
+            "total": total,
+            "page": page + 1,
+            "query": fingerprint,
+        }
+        next_cursor = urlsafe_b64encode(json.dumps(state).encode()).decode()
+    return [row[0] for row in rows], total, page, next_cursor
 
 
 def update_last_login(user: User = None):
@@ -237,7 +430,8 @@ def csv_response(
     if colnames:
         results = filter_keys_and_reorder(results, colnames)
 
-    csv = query_results_to_csv(results)
+    with timed("serialize"):
+        csv = query_results_to_csv(results)
 
     return send_file(
         BytesIO(csv.encode("utf-8")),
@@ -260,6 +454,23 @@ def expects_csv(req: Request):
     return "text/csv" in req.accept_mimetypes
 
 
+def accepts_explicitly(req: Request, mimetype: str):
+    """
+    Whether mimetype itself, rather than only a wildcard matching it, is acceptable.
+    """
+    return any(
+        value == mimetype and quality > 0 for value, quality in req.accept_mimetypes
+    )
+
+
+def expects_parquet(req: Request):
+    return accepts_explicitly(req, PARQUET_MIMETYPE)
+
+
+def expects_arrow(req: Request):
+    return accepts_explicitly(req, ARROW_STREAM_MIMETYPE)
+
+
 # https://stackoverflow.com/a/55991358
 def clone_entity(model_object, **kwargs):
     """
@@ -1,17 +1,48 @@
-from dataclasses import asdict
-from typing import Any, List
+from dataclasses import fields
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
-from flask import Blueprint, Response, abort, current_app as app, jsonify, request
+from flask import (
+    Blueprint,
+    Response,
+    abort,
+    current_app as app,
+    jsonify,
+    request,
+    stream_with_context,
+)
 from flask_login import current_user, login_required
-from sqlalchemy import distinct, func
 from sqlalchemy.orm import contains_eager
-from sqlalchemy.sql import and_, or_
+from sqlalchemy.sql import and_, or_, tuple_
 
+import numpy as np
+import orjson
 import pandas as pd
+import pyarrow as pa
 from . import models
+from .binning import overlapping_bins
+from .columnar import (
+    ARROW_STREAM_MIMETYPE,
+    PARQUET_MIMETYPE,
+    arrow_type,
+    runs_to_lists,
+    to_arrow,
+    write_table,
+)
 from .extensions import db
-
-from .utils import expects_csv, expects_json
+from .genes import get_gene_index
+from .instrumentation import timed
+from .metrics import observe_report_rows
+from .permissions import permission_filter, permitted_dataset_ids
+from .data_version import data_version
+from .report_cache import get_report_cache, report_cache_key
+from .utils import (
+    check_admin,
+    expects_arrow,
+    expects_csv,
+    expects_json,
+    expects_parquet,
+)
 
 
 variants_blueprint = Blueprint(
@@ -76,6 +107,184 @@ relevant_cols = [
 ]
 
 
+# The variant-wise report has one row per variant annotation, which identifies the locus and allele
+variant_key = "annotation_id"
+
+# Variants are ordered by these report strings, as before they were grouped by annotation
+variant_order = ["position", "reference_allele", "alt_allele"]
+
+# How each column is collapsed in the variant-wise report. "list" keeps one value per genotype,
+# "set" keeps each distinct value once in order of appearance, and "first" takes the first value.
+variant_aggregations = {
+    "ensembl_id": "set",
+    "chromosome": "first",
+    "position": "first",
+    "reference_allele": "first",
+    "alt_allele": "first",
+    "ucsc_link": "first",
+    "gnomad_link": "first",
+    "clinvar": "first",
+    "gnomad_af_popmax": "first",
+    "gnomad_ac": "first",
+    "gnomad_hom": "first",
+    "report_ensembl_gene_id": "set",
+    "ensembl_transcript_id": "set",
+    "aa_position": "first",
+    "exon": "first",
+    "protein_domains": "first",
+    "rsids": "set",
+    "gnomad_oe_lof_score": "first",
+    "gnomad_oe_mis_score": "first",
+    "exac_pli_score": "first",
+    "exac_prec_score": "first",
+    "exac_pnull_score": "first",
+    "spliceai_impact": "first",
+    "spliceai_score": "first",
+    "vest3_score": "first",
+    "revel_score": "first",
+    "gerp_score": "first",
+    "imprinting_status": "first",
+    "imprinting_expressed_allele": "first",
+    "pseudoautosomal": "first",
+    # "number_of_callers"
+    # "old_multiallelic": "list",
+    "uce_100bp": "first",
+    "uce_200bp": "first",
+    "genotype": "list",
+    "coverage": "list",
+    "info": "list",
+    "quality": "list",
+    "gene": "list",
+    "variation": "first",
+    "refseq_change": "first",
+    "depth": "list",
+    "conserved_in_20_mammals": "first",
+    "sift_score": "first",
+    "polyphen_score": "first",
+    "cadd_score": "first",
+    "gnomad_af": "first",
+    "zygosity": "list",
+    "burden": "list",
+    "alt_depths": "list",
+    "dataset_id": "list",
+    "participant_codename": "list",
+    "family_codename": "set",
+}
+
+
+def to_report_str(column: pd.Series) -> np.ndarray:
+    """
+    Formats a column the way report cells are written: missing values are blank and everything else is a string,
+    the same as the participant-wise report's fillna("").astype(str).
+    """
+    # Stringify each distinct value once, missing values (code -1) pick up the trailing blank
+    codes, uniques = pd.factorize(column)
+    strings = np.append(
+        pd.Series(np.asarray(uniques)).astype(str).to_numpy(dtype=object), ""
+    )
+    return strings[codes]
+
+
+def format_ensembl_ids(ids: np.ndarray) -> np.ndarray:
+    return ("ENSG" + pd.Series(ids, dtype=object).str.pad(11, fillchar="0")).to_numpy(
+        dtype=object
+    )
+
+
+def join_groups(values: np.ndarray, starts: np.ndarray, sep: str = "; ") -> List[str]:
+    """
+    Joins each run values[starts[i]:starts[i + 1]] with sep. Rather than joining each group separately,
+    every value but the last of its group gets the separator appended, the whole array is joined once,
+    and the groups are sliced back out of that string by their cumulative lengths.
+    """
+    ends = np.append(starts[1:], len(values))
+    pieces = values.copy()
+    inner = np.ones(len(values), dtype=bool)
+    inner[ends - 1] = False
+    pieces[inner] = pieces[inner] + sep
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, pieces), np.int64, len(pieces)), out=offsets[1:])
+    joined = "".join(pieces)
+    return [joined[begin:end] for begin, end in zip(offsets[starts], offsets[ends])]
+
+
+def variant_runs(df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Groups the rows of a participant-wise report by their integer variant_key. Rows are stably sorted
+    by variant, so each variant is a contiguous run that keeps the original genotype order. Variants
+    are ordered by the report strings of their first row's variant_order columns, as the report has
+    always ordered them, which only takes formatting one row per variant.
+
+    Returns the sorting order of the rows, the sorted variant code of each row, and where each
+    variant's run starts in the sorted rows.
+    """
+    codes, annotation_ids = pd.factorize(df[variant_key], sort=True)
+    _, firsts = np.unique(codes, return_index=True)
+    ranks = np.empty(len(annotation_ids), dtype=np.int64)
+    ranks[
+        pd.DataFrame(
+            {
+                **{key: to_report_str(df[key].iloc[firsts]) for key in variant_order},
+                variant_key: np.asarray(annotation_ids),
+            }
+        )
+        .sort_values(variant_order + [variant_key])
+        .index.to_numpy()
+    ] = np.arange(len(annotation_ids))
+    codes = ranks[codes]
+    order = np.argsort(codes, kind="stable")
+    codes = codes[order]
+    starts = np.flatnonzero(np.append(True, codes[1:] != codes[:-1]))
+    return order, codes, starts
+
+
+def distinct_runs(codes: np.ndarray, values: Any) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns a mask keeping the first of each value within its run of codes, and where each run
+    starts once masked.
+    """
+    distinct = ~pd.DataFrame({"code": codes, "value": values}).duplicated().to_numpy()
+    distinct_codes = codes[distinct]
+    return distinct, np.flatnonzero(
+        np.append(True, distinct_codes[1:] != distinct_codes[:-1])
+    )
+
+
+def aggregate_variants(df: pd.DataFrame, relevant_cols=relevant_cols) -> pd.DataFrame:
+    """
+    Collapses a participant-wise report into one row per variant in a single sort-and-split pass,
+    reducing every column per variant run with array operations instead of Python aggregators.
+    """
+    columns = relevant_cols + ["frequency"]
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+
+    order, codes, starts = variant_runs(df)
+    aggregated = {variant_key: df[variant_key].to_numpy()[order[starts]]}
+    for column, how in variant_aggregations.items():
+        if how == "first":
+            values = to_report_str(df[column].iloc[order[starts]])
+        else:
+            values = to_report_str(df[column].iloc[order])
+            if column == "ensembl_id":
+                values = format_ensembl_ids(values)
+            if how == "list":
+                values = join_groups(values, starts)
+            else:
+                distinct, distinct_starts = distinct_runs(codes, values)
+                values = join_groups(values[distinct], distinct_starts)
+        aggregated[column] = values
+    aggregated["frequency"] = np.diff(np.append(starts, len(codes)))
+    return pd.DataFrame(aggregated, columns=columns)
+
+
+def sufficient_genotypes(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Retains the genotypes with sufficient depth to annotate zygosity.
+    """
+    return df[~df["zygosity"].str.contains("-|Insufficient")]
+
+
 def get_report_df(df: pd.DataFrame, type: str, relevant_cols=relevant_cols):
     """
     The expected input is a de-normalized ('tidy') dataframe returned by pd.read_sql. This function subsets relevant columns and retains variants with sufficient depth to annotate zygosity.
@@ -88,112 +297,157 @@ def get_report_df(df: pd.DataFrame, type: str, relevant_cols=relevant_cols):
     # subsetting by a list of col names ensures ordering is consistent between the two report types
 
     df = df.loc[:, ~df.columns.duplicated()]
-    df = df[relevant_cols]
 
     # some columns are duplicated eg. dataset_id, is there a way to query so that this doesn't happen?
 
-    df = df[~df["zygosity"].str.contains("-|Insufficient")]
-    df = df.fillna("")
-    df = df.astype(str)
-    df["ensembl_id"] = df["ensembl_id"].apply(lambda x: "ENSG" + x.rjust(11, "0"))
+    df = sufficient_genotypes(df)
 
     if type == "participants":
+        df = df[relevant_cols]
+        df = df.fillna("")
+        df = df.astype(str)
+        df["ensembl_id"] = "ENSG" + df["ensembl_id"].str.pad(11, fillchar="0")
         return df
 
     elif type == "variants":
-        df = (
-            df.groupby(["position", "reference_allele", "alt_allele"])
-            .agg(
-                {
-                    "ensembl_id": set,
-                    "chromosome": "first",
-                    "ucsc_link": "first",
-                    "gnomad_link": "first",
-                    "clinvar": "first",
-                    "gnomad_af_popmax": "first",
-                    "gnomad_ac": "first",
-                    "gnomad_hom": "first",
-                    "report_ensembl_gene_id": set,
-                    "ensembl_transcript_id": set,
-                    "aa_position": "first",
-                    "exon": "first",
-                    "protein_domains": "first",
-                    "rsids": set,
-                    "gnomad_oe_lof_score": "first",
-                    "gnomad_oe_mis_score": "first",
-                    "exac_pli_score": "first",
-                    "exac_prec_score": "first",
-                    "exac_pnull_score": "first",
-                    "spliceai_impact": "first",
-                    "spliceai_score": "first",
-                    "vest3_score": "first",
-                    "revel_score": "first",
-                    "gerp_score": "first",
-                    "imprinting_status": "first",
-                    "imprinting_expressed_allele": "first",
-                    "pseudoautosomal": "first",
-                    # "number_of_callers"
-                    # "old_multiallelic": list,
-                    "uce_100bp": "first",
-                    "uce_200bp": "first",
-                    "genotype": list,
-                    "coverage": list,
-                    "info": list,
-                    "quality": list,
-                    "gene": list,
-                    "variation": "first",
-                    "refseq_change": "first",
-                    "depth": list,
-                    "conserved_in_20_mammals": "first",
-                    "sift_score": "first",
-                    "polyphen_score": "first",
-                    "cadd_score": "first",
-                    "gnomad_af": "first",
-                    "zygosity": list,
-                    "burden": list,
-                    "alt_depths": list,
-                    "dataset_id": list,
-                    "participant_codename": list,
-                    "family_codename": set,
-                },
-                axis="columns",
+        # Cells are only stringified as they are aggregated, so the "first" columns are converted once per variant
+        return aggregate_variants(df, relevant_cols)
+
+
+# Columns of columnar reports with few distinct values, which are dictionary encoded
+dictionary_cols = {
+    "ensembl_id",
+    "chromosome",
+    "gene",
+    "report_ensembl_gene_id",
+    "zygosity",
+    "participant_codename",
+    "family_codename",
+}
+
+
+def report_table(df: pd.DataFrame, type: str, types: Dict[str, Any]) -> pa.Table:
+    """
+    Builds the participant-wise or variant-wise report from the same de-normalized dataframe as
+    get_report_df, as an Arrow table whose cells keep the type of their column in types, which maps
+    column names to SQLAlchemy types. Ensembl ids are formatted as in the other reports. In the
+    variant-wise report, "list" and "set" columns hold lists of values instead of delimited strings.
+    """
+    df = sufficient_genotypes(df.loc[:, ~df.columns.duplicated()])
+
+    def column(name: str, values: pd.Series) -> pa.Array:
+        if name == "ensembl_id":
+            return to_arrow(
+                format_ensembl_ids(to_report_str(values)), pa.string(), True
             )
-            .reset_index()
+        return to_arrow(values, arrow_type(types[name]), name in dictionary_cols)
+
+    if type == "participants":
+        return pa.table({name: column(name, df[name]) for name in relevant_cols})
+
+    order, codes, starts = variant_runs(df)
+    if df.empty:
+        starts = starts[:0]
+    arrays = {}
+    for name, how in variant_aggregations.items():
+        if how == "first":
+            arrays[name] = column(name, df[name].iloc[order[starts]])
+            continue
+        values = df[name].iloc[order]
+        runs = starts
+        if how == "set":
+            distinct, runs = distinct_runs(codes, values.to_numpy())
+            values = values[distinct]
+            if values.empty:
+                runs = runs[:0]
+        arrays[name] = runs_to_lists(column(name, values), runs)
+    arrays["frequency"] = pa.array(np.diff(np.append(starts, len(codes))), pa.int64())
+    return pa.table({name: arrays[name] for name in relevant_cols + ["frequency"]})
+
+
+def report_frames(query: Any, type: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Generates the report for the query chunk_size rows at a time. Rows are fetched with a
+    server-side cursor, so memory use is bounded by the chunk size rather than the size of the panel.
+
+    The variant-wise report is aggregated chunk by chunk, so the query must keep the rows of each
+    variant together, see chunked_report_order. The rows of the last variant in each chunk are
+    held back and prepended to the next chunk, since that variant's genotypes may continue there.
+    """
+    result = (
+        db.session.connection()
+        .execution_options(stream_results=True)
+        .execute(query.statement)
+    )
+    keys = result.keys()
+    carry = None
+    try:
+        while True:
+            rows = result.fetchmany(chunk_size)
+            df = pd.DataFrame.from_records(rows, columns=keys)
+            df = df.loc[:, ~df.columns.duplicated()]
+            if carry is not None:
+                df = pd.concat([carry, df], ignore_index=True)
+                carry = None
+
+            if type == "variants" and len(rows):
+                held = df[variant_key] == df[variant_key].iloc[-1]
+                carry = df[held]
+                df = df[~held]
+
+            if len(df):
+                yield get_report_df(df, type=type)
+
+            if not len(rows):
+                break
+    finally:
+        result.close()
+
+
+def chunked_report_order(query: Any, type: str) -> Any:
+    """
+    Orders the summary query as report_frames requires for the report type.
+    """
+    if type == "variants":
+        return query.order_by(
+            models.VariantAnnotation.position, models.Variant.annotation_id
         )
-        df = df[relevant_cols]
+    return query
 
-        df["frequency"] = df["participant_codename"].str.len()
-        for col in [
-            "ensembl_id",
-            "zygosity",
-            "burden",
-            "alt_depths",
-            "depth",
-            "genotype",
-            "coverage",
-            "info",
-            "quality",
-            "gene",
-            "rsids",
-            "report_ensembl_gene_id",
-            "ensembl_transcript_id",
-            "participant_codename",
-            "family_codename",
-            "dataset_id",
-        ]:
-            df[col] = df[col].apply(lambda g: "; ".join(g))
-        return df
+
+def report_csv_columns(type: str) -> List[str]:
+    return relevant_cols if type == "participants" else relevant_cols + ["frequency"]
 
 
-def parse_gene_panel() -> List[Any]:
+def stream_report_csv(query: Any, type: str, chunk_size: int) -> Iterator[str]:
     """
-    Parses query string parameter ?panel=ENSGXXXXXXXX,ENSGXXXXXXX for the current request.
+    Generates the CSV report for the query chunk by chunk, see report_frames.
+    """
+    yield pd.DataFrame(columns=report_csv_columns(type)).to_csv(index=False)
+
+    written = 0
+    try:
+        for report_df in report_frames(query, type, chunk_size):
+            written += len(report_df)
+            yield report_df.to_csv(encoding="utf-8", index=False, header=False)
+    except:
+        app.logger.error(
+            "Unexpected error while streaming the %s report", type, exc_info=True
+        )
+        raise
+    observe_report_rows(type, "csv", written)
+
+
+def parse_gene_panel(genes: Optional[str] = None) -> List[int]:
+    """
+    Parses query string parameter ?panel=ENSGXXXXXXXX,ENSGXXXXXXX for the current request,
+    or the given panel in the same format.
     We abort if the panel parameter is missing or malformed. If any specified gene isn't
     in our database, we also abort.
-    Returns a list of filters for use against the variant table to find corresponding variants
-    based on gene start and end positions.
+    Returns the requested ensembl_ids, which are checked against the in-memory gene index.
     """
-    genes = request.args.get("panel", type=str)
+    if genes is None:
+        genes = request.args.get("panel", type=str)
     if genes is None or len(genes) == 0:
         app.logger.error("No gene(s) provided in the request body")
         abort(400, description="No gene(s) provided")
@@ -213,142 +467,505 @@ def parse_gene_panel() -> List[Any]:
         app.logger.error(f"Bad gene panel: {errors}")
         abort(400, description=f"Bad gene panel: {','.join(errors)}")
 
-    # we can't validate whether the requested genes are found in the results (if that is still desired), since gene is no longer a property like in the variant endpoint
     # this may not play well if we decide to pre-populate the entire gene table though since in that case, a gene can be found in the database but not have variants
-    # Again, we customize the count query for efficiency
-    query = models.Gene.query.filter(models.Gene.ensembl_id.in_(ensgs))
-    found_genes = query.with_entities(
-        func.count(distinct(models.Gene.ensembl_id))
-    ).scalar()
-    if found_genes == 0:
+    missing = get_gene_index().missing(ensgs)
+    if len(missing) == len(ensgs):
         app.logger.error("No requested genes were found.")
         abort(400, description="No requested genes were found.")
-    elif found_genes < len(ensgs):
-        app.logger.error("Not all requested genes were found.")
+    elif len(missing):
+        app.logger.error("Not all requested genes were found: %s", missing)
         abort(400, description="Not all requested genes were found.")
 
-    genes = query.all()
-
-    return ensgs
+    return sorted(ensgs)
 
 
-@variants_blueprint.route("/api/summary/<string:type>", methods=["GET"])
-@login_required
-def summary(type: str):
+def panel_variant_filter(regions: List[Tuple[str, int, int]]) -> Any:
     """
-    GET /api/summary/participants\?panel=ENSG00000138131
-    GET /api/summary/variants\?panel=ENSG00000138131
-
-    The same sqlalchemy query is used for both endpoints as the participant-wise report is the precursor to the variant-wise report.
-
-    The JSON response for participants is de-normalized such that each object is a participant and a variant,
-    whereas for the variant JSON response, each object is a variant, the annotations, and an array of genotypes for the involved participants.
-
-    Similarly, the csv output for the participants is de-normalized such that each row is a participant's variant. If the requested genes span similar coordinates duplicated variants will be returned, for each gene.
-    The variant csv output is a summary - each row is a unique variant with various columns collapsed and ';' delimited indicating for example, all participants that had such a variant.
+    Returns a filter restricting the variant_annotation table to the given 1-based, closed
+    (chromosome, start, end) regions.
 
+    Each region becomes an equality on chromosome, a short list of UCSC bins, and a position range,
+    which the (chromosome, bin, position) index resolves as a handful of index range scans.
+    Without it, the range join against the gene table has to examine every variant.
     """
+    return or_(
+        *[
+            and_(
+                models.VariantAnnotation.chromosome == chromosome,
+                # regions are 1-based and closed, bins are 0-based and half-open
+                models.VariantAnnotation.bin.in_(overlapping_bins(start - 1, end)),
+                models.VariantAnnotation.position.between(start, end),
+            )
+            for chromosome, start, end in regions
+        ]
+    )
 
-    if type not in ["variants", "participants"]:
-        abort(404)
 
-    if app.config.get("LOGIN_DISABLED") or current_user.is_admin:
-        user_id = request.args.get("user")
-        app.logger.debug("User is admin with ID '%s'", user_id)
-    else:
-        user_id = current_user.user_id
-        app.logger.debug("User is regular with ID '%s'", user_id)
-
-    ensgs = parse_gene_panel()
+def summary_query(
+    ensgs: List[int], user_id: Any = None, shared_with: Optional[str] = None
+) -> Any:
+    """
+    Returns the (Gene, Variant) query behind the variant and participant summaries for the
+    gene panel, with each variant's annotation, genotypes and their datasets, tissue samples,
+    participants and families eagerly loaded from the same rows. If user_id is given, only
+    genotypes of datasets shared with the user's groups are included, and if the group_code
+    shared_with is given, only those of datasets shared with that group.
 
-    # app.logger.debug(ensgs)
+    Annotations are looked up once per region of the panel, merging genes that overlap, and
+    then the variants called at them.
+    """
 
     # returns a tuple (Genes, Variants)
     query = (
         db.session.query(models.Gene, models.Variant)
         .options(
+            contains_eager(models.Variant.annotation),
             contains_eager(models.Variant.genotype)
             .contains_eager(models.Genotype.analysis)
             .contains_eager(models.Analysis.datasets)
             .contains_eager(models.Dataset.tissue_sample)
             .contains_eager(models.TissueSample.participant)
-            .contains_eager(models.Participant.family)
+            .contains_eager(models.Participant.family),
         )
         .join(
-            models.Variant,
+            models.VariantAnnotation,
             and_(
-                models.Gene.chromosome == models.Variant.chromosome,
-                models.Gene.start <= models.Variant.position,
-                models.Variant.position <= models.Gene.end,
+                models.Gene.chromosome == models.VariantAnnotation.chromosome,
+                models.Gene.start <= models.VariantAnnotation.position,
+                models.VariantAnnotation.position <= models.Gene.end,
             ),
         )
+        .join(
+            models.Variant,
+            models.Variant.annotation_id == models.VariantAnnotation.annotation_id,
+        )
         .join(models.Variant.genotype)
         .join(models.Genotype.analysis, models.Genotype.dataset)
         .join(models.Dataset.tissue_sample)
         .join(models.TissueSample.participant)
         .join(models.Participant.family)
-        .filter(models.Gene.ensembl_id.in_(ensgs))
+        .filter(
+            models.Gene.ensembl_id.in_(ensgs),
+            panel_variant_filter(get_gene_index().regions(ensgs)),
+        )
     )
 
-    if user_id:
+    if user_id or shared_with:
         app.logger.debug("Processing query - restricted based on user id.")
-        query = (
-            query.join(
-                models.groups_datasets_table,
-                models.Dataset.dataset_id
-                == models.groups_datasets_table.columns.dataset_id,
+        query = query.filter(permission_filter(models.Genotype, user_id, shared_with))
+    else:
+        app.logger.debug("Processing query - unrestricted based on user id.")
+
+    return query
+
+
+gene_fields = [field.name for field in fields(models.Gene)]
+variant_fields = [field.name for field in fields(models.Variant)]
+# serialized with the variant, as before annotations were shared
+annotation_fields = [
+    field.name
+    for field in fields(models.VariantAnnotation)
+    if field.name != "annotation_id"
+]
+genotype_fields = [field.name for field in fields(models.Genotype)]
+
+
+def variant_summary_records(query: Any) -> List[Dict[str, Any]]:
+    """
+    Builds the variant-wise JSON summary from the (Gene, Variant) summary query.
+
+    Rather than loading and serializing ORM objects, only the serialized columns are selected
+    and the rows are grouped in one pass: one object per distinct gene and variant in order of
+    first appearance, each with every distinct genotype of its variant, as the ORM query returned.
+    Each variant's annotation fields are included in the variant's object.
+    """
+    columns = (
+        [getattr(models.Gene, name) for name in gene_fields]
+        + [getattr(models.Variant, name) for name in variant_fields]
+        + [getattr(models.VariantAnnotation, name) for name in annotation_fields]
+        + [getattr(models.Genotype, name) for name in genotype_fields]
+        + [models.Participant.participant_codename]
+    )
+    result = db.session.execute(
+        query.with_entities(
+            *[column.label(f"c{i}") for i, column in enumerate(columns)]
+        ).statement
+    )
+    variant_start = len(gene_fields)
+    genotype_start = variant_start + len(variant_fields) + len(annotation_fields)
+    variant_id_index = variant_start + variant_fields.index("variant_id")
+    # variant_id, analysis_id and dataset_id, the genotype's primary key
+    genotype_key = slice(genotype_start, genotype_start + 3)
+
+    records = {}
+    # genotypes by variant, shared by every gene overlapping the variant
+    genotypes = {}
+    for row in result:
+        variant_id = row[variant_id_index]
+        key = (row[0], variant_id)
+        if key not in records:
+            record = dict(zip(gene_fields, row[:variant_start]))
+            record.update(
+                zip(
+                    variant_fields + annotation_fields,
+                    row[variant_start:genotype_start],
+                )
             )
-            .join(
-                models.users_groups_table,
-                models.groups_datasets_table.columns.group_id
-                == models.users_groups_table.columns.group_id,
+            records[key] = record
+            if variant_id not in genotypes:
+                genotypes[variant_id] = {}
+        variant_genotypes = genotypes[variant_id]
+        genotype_id = tuple(row[genotype_key])
+        if genotype_id not in variant_genotypes:
+            genotype = dict(zip(genotype_fields, row[genotype_start:-1]))
+            genotype["participant_codename"] = row[-1]
+            variant_genotypes[genotype_id] = genotype
+
+    for (_, variant_id), record in records.items():
+        record["genotype"] = list(genotypes[variant_id].values())
+    return list(records.values())
+
+
+# (ensembl_id, annotation_id), identifying a variant_summary row
+VariantSummaryKey = Tuple[int, int]
+
+# variant_summary rows recomputed per query when refreshing
+SUMMARY_REFRESH_CHUNK_SIZE = 500
+
+
+def variant_summary_keys(
+    analysis_ids: Optional[Iterable[int]] = None,
+) -> Set[VariantSummaryKey]:
+    """
+    Returns the variant_summary rows that the variants of the given analyses, or of all analyses,
+    contribute to: every distinct variant paired with each gene that covers it. As removed variants
+    affect the rows too, this is called before variants are deleted as well as after they are inserted.
+    """
+    query = (
+        db.session.query(
+            models.VariantAnnotation.chromosome,
+            models.VariantAnnotation.position,
+            models.VariantAnnotation.annotation_id,
+        )
+        .join(
+            models.Variant,
+            models.Variant.annotation_id == models.VariantAnnotation.annotation_id,
+        )
+        .distinct()
+    )
+    if analysis_ids is not None:
+        analysis_ids = [analysis_id for analysis_id in analysis_ids if analysis_id]
+        if not analysis_ids:
+            return set()
+        query = query.filter(models.Variant.analysis_id.in_(analysis_ids))
+
+    by_chromosome = {}
+    for chromosome, position, annotation_id in query:
+        by_chromosome.setdefault(chromosome, []).append((position, annotation_id))
+
+    index = get_gene_index()
+    keys = set()
+    for chromosome, variants in by_chromosome.items():
+        genes = index.overlapping(chromosome, [position for position, _ in variants])
+        for (_, annotation_id), ensgs in zip(variants, genes):
+            keys.update((ensembl_id, annotation_id) for ensembl_id in ensgs)
+    return keys
+
+
+def gene_variant_reports(
+    keys: List[VariantSummaryKey], user_id: Any = None
+) -> List[Tuple[VariantSummaryKey, Dict[str, Any]]]:
+    """
+    Aggregates the variant-wise report row of each key from the current genotypes, separately for
+    each gene. If user_id is given, only genotypes of datasets shared with the user are included.
+    Reads through the session's connection, so uncommitted changes are seen.
+    """
+    query = summary_query(sorted({key[0] for key in keys}), user_id).filter(
+        tuple_(models.Gene.ensembl_id, models.Variant.annotation_id).in_(keys)
+    )
+    df = pd.read_sql(query.statement, db.session.connection())
+    df = df.loc[:, ~df.columns.duplicated()]
+
+    reports = []
+    for ensembl_id, gene_df in df.groupby("ensembl_id", sort=False):
+        for record in get_report_df(
+            gene_df, type="variants", relevant_cols=relevant_cols + [variant_key]
+        ).to_dict(orient="records"):
+            record["frequency"] = int(record["frequency"])
+            key = (int(ensembl_id), int(record.pop(variant_key)))
+            reports.append((key, record))
+    return reports
+
+
+def refresh_variant_summary(keys: Iterable[VariantSummaryKey]) -> int:
+    """
+    Recomputes the variant_summary rows for the keys from the current genotypes, dropping rows
+    whose variants no longer exist. Changes are left for the caller to commit.
+    Returns the number of rows written.
+    """
+    keys = sorted(keys)
+    # the reports are read through the connection, which does not autoflush
+    db.session.flush()
+    table = models.VariantSummary.__table__
+    key_columns = tuple_(table.c.ensembl_id, table.c.annotation_id)
+    written = 0
+    for start in range(0, len(keys), SUMMARY_REFRESH_CHUNK_SIZE):
+        chunk = keys[start : start + SUMMARY_REFRESH_CHUNK_SIZE]
+        db.session.execute(table.delete().where(key_columns.in_(chunk)))
+        rows = [
+            {
+                "ensembl_id": ensembl_id,
+                "annotation_id": annotation_id,
+                "frequency": record["frequency"],
+                "participant_codenames": record["participant_codename"],
+                "family_codenames": record["family_codename"],
+                "zygosities": record["zygosity"],
+                "dataset_ids": "; ".join(
+                    dict.fromkeys(record["dataset_id"].split("; "))
+                ),
+                "report": json.dumps(record),
+            }
+            for (ensembl_id, annotation_id), record in gene_variant_reports(chunk)
+        ]
+        if rows:
+            db.session.execute(table.insert(), rows)
+        written += len(rows)
+    app.logger.debug(
+        "Refreshed %d variant summary rows for %d keys", written, len(keys)
+    )
+    return written
+
+
+def participant_analyses(*criteria: Any) -> List[int]:
+    """
+    Returns the analyses with genotypes of participants matching the criteria, whose
+    variant_summary rows need refreshing when those participants' codenames change.
+    """
+    return [
+        analysis_id
+        for analysis_id, in db.session.query(models.Genotype.analysis_id)
+        .join(models.Genotype.dataset)
+        .join(models.Dataset.tissue_sample)
+        .join(models.TissueSample.participant)
+        .filter(*criteria)
+        .distinct()
+    ]
+
+
+def merge_report_rows(first: Dict[str, Any], second: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Combines the variant-wise report rows of one variant for two genes, as the report
+    would have collapsed their genotypes together.
+    """
+    merged = dict(first)
+    for column, how in variant_aggregations.items():
+        if how == "list":
+            merged[column] = f"{first[column]}; {second[column]}"
+        elif how == "set":
+            merged[column] = "; ".join(
+                dict.fromkeys(first[column].split("; ") + second[column].split("; "))
             )
-            .filter(models.users_groups_table.columns.user_id == user_id)
+    merged["frequency"] = first["frequency"] + second["frequency"]
+    return merged
+
+
+def materialized_variant_report(ensgs: List[int], user_id: Any = None) -> pd.DataFrame:
+    """
+    Builds the variant-wise report for the gene panel from the variant_summary table.
+
+    Rows are stored per gene with every genotype, so for a user, rows from datasets they cannot
+    see are skipped and rows they can only partly see are aggregated again from the visible
+    genotypes. Variants covered by several genes of the panel are then merged into one row.
+    """
+    permitted = permitted_dataset_ids(user_id)
+
+    summary = db.session.query(
+        models.VariantSummary.ensembl_id,
+        models.VariantSummary.annotation_id,
+        models.VariantSummary.dataset_ids,
+        models.VariantSummary.report,
+    ).filter(models.VariantSummary.ensembl_id.in_(ensgs))
+
+    records = []
+    partial = []
+    for ensembl_id, annotation_id, dataset_ids, report in summary:
+        if permitted is not None:
+            datasets = {int(dataset_id) for dataset_id in dataset_ids.split("; ")}
+            if not datasets <= permitted:
+                if datasets & permitted:
+                    partial.append((ensembl_id, annotation_id))
+                continue
+        records.append((annotation_id, json.loads(report)))
+    if partial:
+        app.logger.debug("Aggregating %d partly visible variants", len(partial))
+        records += [
+            (annotation_id, record)
+            for (_, annotation_id), record in gene_variant_reports(partial, user_id)
+        ]
+
+    variants = {}
+    for annotation_id, record in records:
+        variants[annotation_id] = (
+            merge_report_rows(variants[annotation_id], record)
+            if annotation_id in variants
+            else record
         )
+    # ordered as aggregate_variants orders variants, by their report strings
+    order = sorted(
+        variants,
+        key=lambda annotation_id: (
+            [variants[annotation_id][column] for column in variant_order],
+            annotation_id,
+        ),
+    )
+    return pd.DataFrame(
+        [variants[annotation_id] for annotation_id in order],
+        columns=relevant_cols + ["frequency"],
+    )
+
+
+@variants_blueprint.route("/api/summary/<string:type>", methods=["GET"])
+@login_required
+def summary(type: str):
+    """
+    GET /api/summary/participants\?panel=ENSG00000138131
+    GET /api/summary/variants\?panel=ENSG00000138131
+
+    The same sqlalchemy query is used for both endpoints as the participant-wise report is the precursor to the variant-wise report.
+
+    The JSON response for participants is de-normalized such that each object is a participant and a variant,
+    whereas for the variant JSON response, each object is a variant, the annotations, and an array of genotypes for the involved participants.
+
+    Similarly, the csv output for the participants is de-normalized such that each row is a participant's variant. If the requested genes span similar coordinates duplicated variants will be returned, for each gene.
+    The variant csv output is a summary - each row is a unique variant with various columns collapsed and ';' delimited indicating for example, all participants that had such a variant.
+
+    For large panels, pass ?stream=true with a text/csv Accept header to have the csv generated and sent
+    in chunks of REPORT_CHUNK_SIZE rows instead of being built in memory. Streamed variant rows are ordered by position.
+
+    With USE_VARIANT_SUMMARY set, the variant-wise csv is read from the precomputed variant_summary table instead.
+
+    Pass an application/vnd.apache.parquet or application/vnd.apache.arrow.stream Accept header for the report as a
+    Parquet file or Arrow IPC stream, in which columns keep their database types and the variant-wise collapsed columns are lists.
+
+    Reports that are not streamed are cached per panel, format and visible datasets until the data they are built from changes.
+
+    """
+
+    if type not in ["variants", "participants"]:
+        abort(404)
+
+    if app.config.get("LOGIN_DISABLED") or current_user.is_admin:
+        user_id = request.args.get("user")
+        app.logger.debug("User is admin with ID '%s'", user_id)
     else:
-        app.logger.debug("Processing query - unrestricted based on user id.")
+        user_id = current_user.user_id
+        app.logger.debug("User is regular with ID '%s'", user_id)
+
+    genes = parse_gene_panel()
 
     # defaults to json unless otherwise specified
     app.logger.info(request.accept_mimetypes)
 
-    if expects_json(request):
+    # columnar formats are only served when named, as wildcards match them too
+    if expects_parquet(request):
+        app.logger.info("%s Accept header requested", PARQUET_MIMETYPE)
+        format = "parquet"
+    elif expects_arrow(request):
+        app.logger.info("%s Accept header requested", ARROW_STREAM_MIMETYPE)
+        format = "arrow"
+    elif expects_json(request):
         app.logger.info("Defaulting to json response")
+        format = "json"
+    elif expects_csv(request):
+        app.logger.info("text/csv Accept header requested")
+        format = "csv"
+    else:
+        message = f"Only 'text/csv', 'application/json', '{PARQUET_MIMETYPE}' and '{ARROW_STREAM_MIMETYPE}' HTTP accept headers supported"
+        app.logger.error(message)
+        abort(406, message)
 
-        if type == "variants":
+    stream = format == "csv" and request.args.get("stream", type=str) in ["true", "1"]
+    cache = None if stream else get_report_cache()
+    if cache is not None:
+        # versioned before the report is read, so a concurrent change cannot be cached as current
+        key = report_cache_key(
+            type, format, genes, permitted_dataset_ids(user_id), data_version()
+        )
+        body = cache.get(key)
+        if body is not None:
+            app.logger.debug("Serving the report from the cache")
+            return report_response(type, format, body)
 
-            return jsonify(
-                [
-                    {
-                        **asdict(tup[0]),  # gene
-                        **asdict(tup[1]),  # variants
-                        "genotype": [
-                            {
-                                **asdict(genotype),
-                                "participant_codename": genotype.dataset.tissue_sample.participant.participant_codename,
-                            }
-                            for genotype in tup[1].genotype
-                        ],
-                    }
-                    for tup in query.all()
-                ]
-            )
+    response = render_report(type, format, genes, user_id, stream)
+    if cache is not None:
+        cache.set(key, response.get_data())
+    return response
 
-        elif type == "participants":
-            try:
-                sql_df = pd.read_sql(query.statement, query.session.bind)
-            except:
-                app.logger.error(
-                    "Unexpected error resulting from sqlalchemy query", exc_info=True
+
+# mimetype and attachment file extension of each report format
+report_formats = {
+    "json": ("application/json", None),
+    "csv": ("text/csv", "csv"),
+    "parquet": (PARQUET_MIMETYPE, "parquet"),
+    "arrow": (ARROW_STREAM_MIMETYPE, "arrows"),
+}
+
+
+def report_response(type: str, format: str, body: Any) -> Response:
+    mimetype, extension = report_formats[format]
+    response = Response(body, mimetype=mimetype)
+    if extension:
+        response.headers.set(
+            "Content-Disposition",
+            "attachment",
+            filename="{}_wise_report.{}".format(type[:-1], extension),
+        )
+    return response
+
+
+def report_column_types(query: Any) -> Dict[str, Any]:
+    """
+    Maps the columns read from the summary query to their SQLAlchemy types, keeping the first of
+    duplicated names as the reports do.
+    """
+    types = {}
+    for column in query.statement.inner_columns:
+        types.setdefault(column.name, column.type)
+    return types
+
+
+def render_report(
+    type: str, format: str, genes: List[int], user_id: Any, stream: bool
+) -> Response:
+    query = summary_query(genes, user_id)
+
+    if format == "json":
+        if type == "variants":
+            records = variant_summary_records(query)
+            observe_report_rows(type, format, len(records))
+            with timed("serialize"):
+                body = orjson.dumps(
+                    records,
+                    option=orjson.OPT_SORT_KEYS if app.config["JSON_SORT_KEYS"] else 0,
                 )
-                abort(500, "Unexpected error")
+            return report_response(type, format, body)
+
+        try:
+            sql_df = pd.read_sql(query.statement, query.session.bind)
+        except:
+            app.logger.error(
+                "Unexpected error resulting from sqlalchemy query", exc_info=True
+            )
+            abort(500, "Unexpected error")
 
+        with timed("pandas"):
             ptp_dict = sql_df.loc[:, ~sql_df.columns.duplicated()][
                 relevant_cols
             ].to_dict(orient="records")
-            return jsonify(ptp_dict)
+        observe_report_rows(type, format, len(ptp_dict))
+        return jsonify(ptp_dict)
 
-    elif expects_csv(request):
-        app.logger.info("text/csv Accept header requested")
+    if format in ("parquet", "arrow"):
         try:
             sql_df = pd.read_sql(query.statement, query.session.bind)
         except:
@@ -357,20 +974,57 @@ def summary(type: str):
             )
             abort(500, "Unexpected error")
 
-        agg_df = get_report_df(sql_df, type=type)
-        csv_data = agg_df.to_csv(encoding="utf-8", index=False)
+        with timed("pandas"):
+            table = report_table(sql_df, type, report_column_types(query))
+        observe_report_rows(type, format, table.num_rows)
+        with timed("serialize"):
+            body = write_table(table, format)
+        return report_response(type, format, body)
 
-        response = Response(csv_data, mimetype="text/csv")
-        response.headers.set(
-            "Content-Disposition",
-            "attachment",
-            filename="{}_wise_report.csv".format(type[:-1]),
+    if stream:
+        app.logger.info("Streaming the CSV report")
+        return report_response(
+            type,
+            format,
+            stream_with_context(
+                stream_report_csv(
+                    chunked_report_order(query, type),
+                    type,
+                    app.config["REPORT_CHUNK_SIZE"],
+                )
+            ),
         )
-        return response
+
+    if type == "variants" and app.config["USE_VARIANT_SUMMARY"]:
+        app.logger.info("Building the report from the variant summary table")
+        agg_df = materialized_variant_report(genes, user_id)
     else:
-        app.logger.error(
-            "Only 'text/csv' and 'application/json' HTTP accept headers supported"
-        )
-        abort(
-            406, "Only 'text/csv' and 'application/json' HTTP accept headers supported"
-        )
+        try:
+            sql_df = pd.read_sql(query.statement, query.session.bind)
+        except:
+            app.logger.error(
+                "Unexpected error resulting from sqlalchemy query", exc_info=True
+            )
+            abort(500, "Unexpected error")
+
+        with timed("pandas"):
+            agg_df = get_report_df(sql_df, type=type)
+    observe_report_rows(type, format, len(agg_df))
+    with timed("serialize"):
+        csv_data = agg_df.to_csv(encoding="utf-8", index=False)
+
+    return report_response(type, format, csv_data)
+
+
+@variants_blueprint.route("/api/summary/cache", methods=["GET"])
+@login_required
+@check_admin
+def report_cache_stats():
+    """
+    Hit, miss and eviction counts and the size of the report cache. Administrator-only.
+    With the shared backend, the counts are for every worker on the host.
+    """
+    cache = get_report_cache()
+    if cache is None:
+        return jsonify({"backend": "none"})
+    return jsonify(cache.stats())
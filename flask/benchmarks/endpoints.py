@@ -0,0 +1,371 @@
+"""
+Records latency percentiles, SQL query counts and peak memory of the core endpoints and of
+map-insert-c4r-reports as a JSON baseline, and compares them against an earlier baseline.
+
+    python -m benchmarks.endpoints [--seed] [--families 100] [--variants 1000] [--repeat 20]
+        [--output endpoints.json] [--compare baseline.json]
+
+Run from the flask directory against the database configured for the app, as the queries
+and their plans are MySQL's. With --seed, the `flask db-seed` data and `flask db-seed-synthetic`
+data of the given volume are added first. Runs write to the database: /api/_bulk adds
+participants and the ingestion benchmark replaces the variants of --reports synthetic families,
+so only point it at a development database.
+
+Requests are made through the test client with LOGIN_DISABLED, so every dataset is visible,
+and with the report cache disabled so reports are rendered each time. Each request runs once
+to warm up before --repeat timed runs. Ingestion runs --ingest-repeat times, with the reports
+rewritten with new variants before each run so every run replaces them. Peak memory is the
+tracemalloc peak of Python allocations during one further run.
+"""
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import tempfile
+from time import perf_counter
+import tracemalloc
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import event, func
+
+from app import create_app, db, models
+from app.config import Config
+from app.manage import (
+    map_insert_c4r_reports,
+    seed_dataset_types,
+    seed_default_admin,
+    seed_institutions,
+    seed_pipelines,
+)
+from app.synthetic import (
+    SYNTHETIC_PREFIX,
+    seed_synthetic_data,
+    synthetic_genotypes,
+    synthetic_variants,
+    gene_spans,
+)
+
+
+class BenchmarkConfig(Config):
+    LOGIN_DISABLED = True
+    SQLALCHEMY_LOG = False
+    REPORT_CACHE_BACKEND = "none"
+
+
+class QueryCounter:
+    def __init__(self, engine: Any):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self.increment)
+
+    def increment(self, *args) -> None:
+        self.count += 1
+
+
+def measure(
+    counter: QueryCounter,
+    repeat: int,
+    run: Callable[[], None],
+    setup: Callable[[], None] = lambda: None,
+) -> Dict[str, float]:
+    """
+    Times repeat runs, each after an untimed setup, and a further run for peak memory.
+    """
+    times, queries = [], []
+    for _ in range(repeat):
+        setup()
+        db.session.remove()
+        counter.count = 0
+        start = perf_counter()
+        run()
+        times.append(perf_counter() - start)
+        queries.append(counter.count)
+    setup()
+    db.session.remove()
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    p50, p90, p99 = np.percentile(times, [50, 90, 99]) * 1000
+    return {
+        "runs": repeat,
+        "p50_ms": round(p50, 2),
+        "p90_ms": round(p90, 2),
+        "p99_ms": round(p99, 2),
+        "max_ms": round(max(times) * 1000, 2),
+        "queries": int(np.median(queries)),
+        "peak_mib": round(peak / 2 ** 20, 2),
+    }
+
+
+def write_reports(root: str, families: List[str], variants: int, seed: int) -> None:
+    """
+    Writes a C4R WES report of synthetic variants for each family, as map-insert-c4r-reports reads them.
+    """
+    rng = np.random.default_rng(seed)
+    spans = gene_spans()
+    for family in families:
+        samples = [
+            codename
+            for (codename,) in db.session.query(models.Participant.participant_codename)
+            .join(models.Family)
+            .filter(models.Family.family_codename == family)
+            .order_by(models.Participant.participant_id)
+        ]
+        rows = synthetic_variants(rng, variants, spans)
+        calls = synthetic_genotypes(rng, rows, len(samples))
+        report = pd.DataFrame(
+            {
+                "Position": [f"{row['chromosome']}:{row['position']}" for row in rows],
+                "Ref": [row["reference_allele"] for row in rows],
+                "Alt": [row["alt_allele"] for row in rows],
+                "Variation": [row["variation"] for row in rows],
+                "Depth": [row["depth"] for row in rows],
+                "Gene": [row["gene"] for row in rows],
+                "Ensembl_gene_id": [row["report_ensembl_gene_id"] for row in rows],
+                "Conserved_in_20_mammals": [
+                    row["conserved_in_20_mammals"] for row in rows
+                ],
+                "Sift_score": [row["sift_score"] for row in rows],
+                "Polyphen_score": [row["polyphen_score"] for row in rows],
+                "Cadd_score": [row["cadd_score"] for row in rows],
+                "Gnomad_af": [row["gnomad_af"] for row in rows],
+                "Gnomad_af_popmax": [row["gnomad_af_popmax"] for row in rows],
+                "Gnomad_ac": [row["gnomad_ac"] for row in rows],
+                "Gnomad_hom": [row["gnomad_hom"] for row in rows],
+                "Clinvar": [row["clinvar"] for row in rows],
+                "Rsids": [row["rsids"] for row in rows],
+                "Quality": [row["quality"] for row in rows],
+                "Ucsc_link": [
+                    f'=HYPERLINK("{row["ucsc_link"]}","UCSC")' for row in rows
+                ],
+                "Gnomad_link": [
+                    f'=HYPERLINK("{row["gnomad_link"]}","gnomAD")' for row in rows
+                ],
+                "Gts": [
+                    ",".join(call["genotype"] for call in call_row)
+                    for call_row in calls
+                ],
+                "Trio_coverage": [
+                    "_".join(str(call["coverage"]) for call in call_row)
+                    for call_row in calls
+                ],
+            }
+        )
+        for i, sample in enumerate(samples):
+            for column in ["zygosity", "burden", "alt_depths"]:
+                report[f"{column.capitalize()}.{sample}"] = [
+                    call_row[i][column] for call_row in calls
+                ]
+        directory = os.path.join(root, "synx", family)
+        os.makedirs(directory, exist_ok=True)
+        report.to_csv(
+            os.path.join(directory, f"{family}.wes.2021-07-01.csv"), index=False
+        )
+
+
+def endpoint_benchmarks(client: Any, repeat: int) -> Dict[str, Callable[[], None]]:
+    """
+    Returns a run function for each endpoint benchmark, each checking the response succeeded.
+    """
+    panel = ",".join(
+        gene
+        for (gene,) in db.session.query(models.Variant.report_ensembl_gene_id)
+        .filter(models.Variant.report_ensembl_gene_id.isnot(None))
+        .group_by(models.Variant.report_ensembl_gene_id)
+        .order_by(func.count().desc())
+        .limit(10)
+    )
+    if not panel:
+        raise SystemExit("There are no variants in genes to report, run with --seed")
+
+    # _bulk adds datasets to the groups of the requesting user, the first user joins a group if none has
+    membership = (
+        db.session.query(models.users_groups_table.c.user_id, models.Group.group_code)
+        .join(models.Group)
+        .first()
+    )
+    if membership is None:
+        user = models.User.query.order_by(models.User.user_id).first()
+        group = models.Group.query.order_by(models.Group.group_id).first()
+        user.groups.append(group)
+        db.session.commit()
+        membership = (user.user_id, group.group_code)
+    user_id, group_code = membership
+    family = (
+        db.session.query(models.Family.family_codename)
+        .order_by(models.Family.family_id)
+        .limit(1)
+        .scalar()
+    )
+    bulk_runs = iter(range(repeat + 2))
+    stamp = datetime.now().strftime("%Y%m%d%H%M%S")
+
+    def get(url: str, accept: str = "application/json") -> Callable[[], None]:
+        def run():
+            response = client.get(url, headers={"Accept": accept})
+            assert response.status_code == 200, (url, response.status_code)
+            response.get_data()
+
+        return run
+
+    def bulk():
+        run = next(bulk_runs)
+        response = client.post(
+            f"/api/_bulk?groups={group_code}&user={user_id}",
+            json=[
+                {
+                    "family_codename": family,
+                    "participant_codename": f"BENCH{stamp}-{run}-{i}",
+                    "tissue_sample_type": "Blood",
+                    "dataset_type": "WES",
+                    "condition": "GermLine",
+                    "sequencing_date": "2021-07-01",
+                }
+                for i in range(10)
+            ],
+        )
+        assert response.status_code == 200, ("/api/_bulk", response.get_data())
+
+    summary = "/api/summary/{}?panel=" + panel
+    return {
+        "summary_variants_json": get(summary.format("variants")),
+        "summary_variants_csv": get(summary.format("variants"), "text/csv"),
+        "summary_variants_parquet": get(
+            summary.format("variants"), "application/vnd.apache.parquet"
+        ),
+        "summary_participants_json": get(summary.format("participants")),
+        "summary_participants_csv": get(summary.format("participants"), "text/csv"),
+        "datasets_page": get("/api/datasets?limit=50"),
+        "datasets_all": get("/api/datasets"),
+        "analyses_page": get("/api/analyses?limit=50"),
+        "participants_page": get("/api/participants?limit=50"),
+        "bulk_10_rows": bulk,
+    }
+
+
+def volume() -> Dict[str, int]:
+    return {
+        model.__tablename__: db.session.query(func.count()).select_from(model).scalar()
+        for model in (
+            models.Gene,
+            models.Family,
+            models.Participant,
+            models.Dataset,
+            models.Analysis,
+            models.VariantAnnotation,
+            models.Variant,
+            models.Genotype,
+        )
+    }
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> None:
+    print(
+        f"{'benchmark':<28} {'p50 (ms)':>20} {'p90 (ms)':>20} {'queries':>12} {'peak (MiB)':>20}"
+    )
+    for name, result in current["results"].items():
+        before = baseline["results"].get(name)
+        if before is None:
+            print(f"{name:<28} (not in baseline)")
+            continue
+
+        def cell(key: str) -> str:
+            ratio = result[key] / before[key] if before[key] else float("nan")
+            return f"{before[key]:g} -> {result[key]:g} ({ratio:.2f}x)"
+
+        print(
+            f"{name:<28} {cell('p50_ms'):>20} {cell('p90_ms'):>20}"
+            f" {before['queries']:>5} -> {result['queries']:<3} {cell('peak_mib'):>20}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--seed", action="store_true", help="add db-seed and synthetic data first"
+    )
+    parser.add_argument("--families", type=int, default=100)
+    parser.add_argument("--participants", type=int, default=3)
+    parser.add_argument("--variants", type=int, default=1000)
+    parser.add_argument("--genes", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--reports", type=int, default=5)
+    parser.add_argument("--ingest-repeat", type=int, default=3)
+    parser.add_argument("--output", default="endpoints.json")
+    parser.add_argument("--compare", help="an earlier --output to compare against")
+    args = parser.parse_args()
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        if args.seed:
+            seed_default_admin(False)
+            seed_institutions(False)
+            seed_dataset_types(False)
+            seed_pipelines(False)
+            db.session.commit()
+            seed_synthetic_data(
+                args.families, args.participants, args.variants, args.genes
+            )
+
+        counter = QueryCounter(db.engine)
+        client = app.test_client()
+        results = {}
+        for name, run in endpoint_benchmarks(client, args.repeat).items():
+            run()
+            results[name] = measure(counter, args.repeat, run)
+            print(name, results[name])
+
+        families = [
+            codename
+            for (codename,) in db.session.query(models.Family.family_codename)
+            .filter(models.Family.family_codename.like(f"{SYNTHETIC_PREFIX}%"))
+            .order_by(models.Family.family_id)
+            .limit(args.reports)
+        ]
+        if families:
+            runner = app.test_cli_runner()
+            cwd = os.getcwd()
+            with tempfile.TemporaryDirectory() as root:
+                # the command saves its mapping results to the working directory
+                os.chdir(root)
+                seeds = iter(range(args.ingest_repeat + 1))
+                try:
+
+                    def ingest():
+                        result = runner.invoke(map_insert_c4r_reports, [root])
+                        assert result.exit_code == 0, result.output
+
+                    name = f"map_insert_c4r_reports_{len(families)}"
+                    results[name] = measure(
+                        counter,
+                        args.ingest_repeat,
+                        ingest,
+                        lambda: write_reports(
+                            root, families, args.variants, next(seeds)
+                        ),
+                    )
+                    print(name, results[name])
+                finally:
+                    os.chdir(cwd)
+
+        baseline = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "database": db.engine.dialect.name,
+            "python": platform.python_version(),
+            "volume": volume(),
+            "results": results,
+        }
+
+    with open(args.output, "w") as handle:
+        json.dump(baseline, handle, indent=2)
+    print(f"Wrote {args.output}")
+    if args.compare:
+        with open(args.compare) as handle:
+            compare(json.load(handle), baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Benchmarks the variant-wise report aggregation in app.variants.get_report_df against the
+groupby/agg implementation it replaced, on synthetic participant-wise frames.
+
+    python -m benchmarks.report_df [--rows 10000 100000 1000000] [--repeat 3]
+
+Run from the flask directory. Before timing, each size is checked to produce the same CSV
+as the legacy implementation. Set-valued cells are compared as sets because the legacy
+output ordered them by string hash, which changes from one interpreter run to the next.
+"""
+import argparse
+from io import StringIO
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+from flask import Flask
+
+from app.variants import (
+    get_report_df,
+    relevant_cols,
+    variant_aggregations,
+    variant_key,
+    variant_order,
+)
+
+
+def legacy_get_report_df(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.loc[:, ~df.columns.duplicated()]
+    df = df[relevant_cols + [variant_key]]
+    df = df[~df["zygosity"].str.contains("-|Insufficient")]
+    df = df.fillna("")
+    df = df.astype(str)
+    df["ensembl_id"] = df["ensembl_id"].apply(lambda x: "ENSG" + x.rjust(11, "0"))
+    # Variants are keyed by annotation as they are now, and sorted by locus as they were
+    df = (
+        df.groupby(variant_key)
+        .agg(
+            {
+                column: {"first": "first", "list": list, "set": set}[how]
+                for column, how in variant_aggregations.items()
+            },
+            axis="columns",
+        )
+        .sort_values(variant_order)
+        .reset_index(drop=True)
+    )
+    df = df[relevant_cols]
+    df["frequency"] = df["participant_codename"].str.len()
+    for column, how in variant_aggregations.items():
+        if how != "first":
+            df[column] = df[column].apply(lambda g: "; ".join(g))
+    return df
+
+
+def synthetic_report(rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    A participant-wise frame shaped like the summary query: about four genotypes per variant,
+    a mix of numeric, nullable and string annotations, and some insufficient-depth genotypes.
+    """
+    rng = np.random.default_rng(seed)
+    variants = max(rows // 4, 1)
+    variant = rng.integers(0, variants, rows)
+    positions = rng.integers(1, 250_000_000, variants)
+    alleles = np.array(["A", "C", "G", "T", "AT", "GCC"])
+    df = pd.DataFrame(
+        {
+            column: rng.choice(np.array([f"{column}_{i}" for i in range(20)]), rows)
+            for column in relevant_cols
+        }
+    )
+    df["position"] = positions[variant]
+    df["reference_allele"] = alleles[variant % 4]
+    df["alt_allele"] = alleles[(variant // 4) % 6]
+    # One annotation per locus, as stored in variant_annotation
+    df["annotation_id"] = (
+        df.groupby(["position", "reference_allele", "alt_allele"]).ngroup() + 1
+    )
+    df["chromosome"] = (variant % 22 + 1).astype(str)
+    df["ensembl_id"] = rng.integers(1, 300_000, variants)[variant]
+    df["depth"] = rng.integers(0, 500, rows)
+    df["cadd_score"] = np.where(rng.random(rows) < 0.2, np.nan, rng.random(rows) * 40)
+    df["gnomad_af"] = rng.random(variants)[variant]
+    df["clinvar"] = np.where(variant % 7 == 0, None, "Pathogenic")
+    df["zygosity"] = rng.choice(
+        np.array(["Het", "Hom", "Insufficient coverage", "-"]),
+        rows,
+        p=[0.6, 0.3, 0.05, 0.05],
+    )
+    df["participant_codename"] = "P" + pd.Series(rng.integers(0, 5000, rows)).astype(
+        str
+    )
+    df["family_codename"] = "F" + pd.Series(rng.integers(0, 1000, rows)).astype(str)
+    df["dataset_id"] = rng.integers(1, 10_000, rows)
+    return df
+
+
+def check_equivalent(df: pd.DataFrame) -> None:
+    expected = pd.read_csv(
+        StringIO(legacy_get_report_df(df).to_csv(index=False)), dtype=str
+    )
+    actual = pd.read_csv(
+        StringIO(get_report_df(df, type="variants").to_csv(index=False)), dtype=str
+    )
+    for column, how in variant_aggregations.items():
+        if how == "set":
+            expected[column] = expected[column].str.split("; ").map(frozenset)
+            actual[column] = actual[column].str.split("; ").map(frozenset)
+    pd.testing.assert_frame_equal(expected, actual)
+
+
+def best_of(repeat: int, fn, *args, **kwargs) -> float:
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        fn(*args, **kwargs)
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # get_report_df logs through current_app
+    with Flask(__name__).app_context():
+        print(f"{'rows':>10} {'legacy (s)':>12} {'current (s)':>12} {'speedup':>8}")
+        for rows in args.rows:
+            df = synthetic_report(rows)
+            check_equivalent(df)
+            legacy = best_of(args.repeat, legacy_get_report_df, df)
+            current = best_of(args.repeat, get_report_df, df, type="variants")
+            print(
+                f"{rows:>10} {legacy:>12.3f} {current:>12.3f} {legacy / current:>7.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+"""
+Benchmarks the variant-wise JSON summary in app.variants.variant_summary_records against the
+ORM implementation it replaced, on a synthetic in-memory SQLite database.
+
+    python -m benchmarks.variant_summary [--genes 10 100 1000] [--variants 20] [--genotypes 3]
+
+Run from the flask directory. Each panel has --variants variants per gene and --genotypes
+genotypes per variant. Before timing, each panel is checked to produce the same JSON as the
+legacy implementation. Times include serialization; peak memory is measured with tracemalloc.
+Most of the current implementation's time is SQLite evaluating the range join, which MySQL
+resolves with the variant bin index.
+"""
+import argparse
+from dataclasses import asdict
+from datetime import datetime
+import json
+from time import perf_counter
+import tracemalloc
+
+from flask import json as flask_json
+import orjson
+from sqlalchemy import event, true
+
+from app import create_app, db, models
+from app.config import Config
+from app import variants
+from app.variants import summary_query, variant_summary_records
+
+
+class BenchmarkConfig(Config):
+    SQLALCHEMY_DATABASE_URI = "sqlite://"
+    SQLALCHEMY_LOG = False
+
+
+def legacy_variant_summary(query) -> str:
+    return flask_json.dumps(
+        [
+            {
+                **asdict(tup[0]),  # gene
+                **asdict(tup[1]),  # variants
+                **{
+                    key: value
+                    for key, value in asdict(tup[1].annotation).items()
+                    if key != "annotation_id"
+                },
+                "genotype": [
+                    {
+                        **asdict(genotype),
+                        "participant_codename": genotype.dataset.tissue_sample.participant.participant_codename,
+                    }
+                    for genotype in tup[1].genotype
+                ],
+            }
+            for tup in query.all()
+        ]
+    )
+
+
+def variant_summary(query) -> bytes:
+    return orjson.dumps(variant_summary_records(query), option=orjson.OPT_SORT_KEYS)
+
+
+def seed(genes: int, variants: int, genotypes: int) -> None:
+    """
+    Inserts genes spaced along chromosome 1, each with its variants, and one family whose
+    participants each have a dataset. Every variant has a genotype in the first genotypes datasets.
+    """
+    now = datetime.utcnow()
+    audit = {"created_by_id": 1, "updated_by_id": 1, "created": now, "updated": now}
+    db.session.execute(
+        models.User.__table__.insert(),
+        {"user_id": 1, "username": "admin", "email": "admin", "password_hash": ""},
+    )
+    db.session.execute(
+        models.Family.__table__.insert(),
+        {"family_id": 1, "family_codename": "F1", **audit},
+    )
+    db.session.execute(
+        models.Participant.__table__.insert(),
+        [
+            {
+                "participant_id": i,
+                "family_id": 1,
+                "participant_codename": f"P{i}",
+                **audit,
+            }
+            for i in range(1, genotypes + 1)
+        ],
+    )
+    db.session.execute(
+        models.TissueSample.__table__.insert(),
+        [
+            {
+                "tissue_sample_id": i,
+                "participant_id": i,
+                "tissue_sample_type": "Blood",
+                **audit,
+            }
+            for i in range(1, genotypes + 1)
+        ],
+    )
+    db.session.execute(
+        models.Dataset.__table__.insert(),
+        [
+            {
+                "dataset_id": i,
+                "tissue_sample_id": i,
+                "dataset_type": "WES",
+                "condition": "GermLine",
+                **audit,
+            }
+            for i in range(1, genotypes + 1)
+        ],
+    )
+    db.session.execute(
+        models.Analysis.__table__.insert(),
+        {
+            "analysis_id": 1,
+            "analysis_state": "Done",
+            "pipeline_id": 1,
+            "requester_id": 1,
+            "requested": now,
+            "updated": now,
+            "updated_by_id": 1,
+        },
+    )
+    db.session.execute(
+        models.datasets_analyses_table.insert(),
+        [{"dataset_id": i, "analysis_id": 1} for i in range(1, genotypes + 1)],
+    )
+    db.session.execute(
+        models.Gene.__table__.insert(),
+        [
+            {
+                "ensembl_id": i,
+                "chromosome": "1",
+                "start": i * 10000,
+                "end": i * 10000 + variants * 10,
+            }
+            for i in range(1, genes + 1)
+        ],
+    )
+    db.session.execute(
+        models.VariantAnnotation.__table__.insert(),
+        [
+            {
+                "annotation_id": i * variants + j,
+                "chromosome": "1",
+                "position": i * 10000 + j * 10,
+                "reference_allele": "A",
+                "alt_allele": "G",
+                "variation": "missense_variant",
+                "cadd_score": j / 3,
+                "uce_100bp": False,
+            }
+            for i in range(1, genes + 1)
+            for j in range(variants)
+        ],
+    )
+    db.session.execute(
+        models.Variant.__table__.insert(),
+        [
+            {
+                "variant_id": i * variants + j,
+                "analysis_id": 1,
+                "annotation_id": i * variants + j,
+                "depth": 40,
+                "info": "x" * 200,
+            }
+            for i in range(1, genes + 1)
+            for j in range(variants)
+        ],
+    )
+    db.session.execute(
+        models.Genotype.__table__.insert(),
+        [
+            {
+                "variant_id": i * variants + j,
+                "analysis_id": 1,
+                "dataset_id": k,
+                "zygosity": "Het",
+                "burden": 1,
+                "alt_depths": 20,
+                "genotype": "A/G",
+                "coverage": 40,
+            }
+            for i in range(1, genes + 1)
+            for j in range(variants)
+            for k in range(1, genotypes + 1)
+        ],
+    )
+    db.session.commit()
+
+
+def measure(repeat: int, fn, *args):
+    times = []
+    for _ in range(repeat):
+        db.session.expunge_all()
+        start = perf_counter()
+        fn(*args)
+        times.append(perf_counter() - start)
+    db.session.expunge_all()
+    tracemalloc.start()
+    fn(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--genes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--variants", type=int, default=20)
+    parser.add_argument("--genotypes", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # The bin filter is one OR branch per region, deeper than SQLite allows for 1000 genes.
+    # Rows are the same without it since the join already matches variants to genes.
+    variants.panel_variant_filter = lambda regions: true()
+
+    app = create_app(BenchmarkConfig)
+    with app.app_context():
+        # MySQL functions used by check constraints
+        event.listen(
+            db.engine,
+            "connect",
+            lambda connection, record: connection.create_function(
+                "DAY", 1, lambda value: value and int(value[8:10])
+            ),
+        )
+        # Only the tables the summary reads, as some constraints are MySQL-specific
+        db.metadata.create_all(
+            db.engine,
+            tables=[
+                model.__table__
+                for model in (
+                    models.User,
+                    models.Family,
+                    models.Participant,
+                    models.TissueSample,
+                    models.Dataset,
+                    models.DatasetFile,
+                    models.Analysis,
+                    models.Pipeline,
+                    models.PipelineDatasets,
+                    models.Gene,
+                    models.VariantAnnotation,
+                    models.Variant,
+                    models.Genotype,
+                    models.DataVersion,
+                )
+            ]
+            + [models.datasets_analyses_table],
+        )
+        seed(max(args.genes), args.variants, args.genotypes)
+        print(
+            f"{'genes':>6} {'legacy (s)':>11} {'current (s)':>12} {'speedup':>8}"
+            f" {'legacy (MiB)':>13} {'current (MiB)':>14}"
+        )
+        for panel in args.genes:
+            query = summary_query(list(range(1, panel + 1)))
+            assert json.loads(legacy_variant_summary(query)) == json.loads(
+                variant_summary(query)
+            )
+            legacy, legacy_memory = measure(args.repeat, legacy_variant_summary, query)
+            current, current_memory = measure(args.repeat, variant_summary, query)
+            print(
+                f"{panel:>6} {legacy:>11.3f} {current:>12.3f} {legacy / current:>7.1f}x"
+                f" {legacy_memory:>13.1f} {current_memory:>14.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+"""
+Gunicorn settings, read from the working directory on startup. Worker and thread counts
+stay on the command line (see the Dockerfile CMD).
+
+Each worker records its Prometheus metrics in files under PROMETHEUS_MULTIPROC_DIR so that
+/api/_metrics reports the totals of every worker. The variable is set here, before the app
+is loaded, because prometheus_client reads it on import.
+"""
+import glob
+import os
+import tempfile
+
+metrics_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "stager-metrics")
+)
+
+
+def on_starting(server):
+    # Samples left by a previous server would be added to this one's
+    os.makedirs(metrics_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(metrics_dir, "*.db")):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    # Drops the live gauges, such as requests in progress, of the exited worker
+    multiprocess.mark_process_dead(worker.pid)
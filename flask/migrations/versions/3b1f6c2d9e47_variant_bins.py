@@ -0,0 +1,53 @@
+"""Add UCSC bins to variants
+
+Revision ID: 3b1f6c2d9e47
+Revises: 99955a52d781
+Create Date: 2021-07-12 10:04:51.337912
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "3b1f6c2d9e47"
+down_revision = "99955a52d781"
+branch_labels = None
+depends_on = None
+
+
+def bin_sql(start: str, end: str) -> str:
+    """
+    Mirrors app.binning.bin_from_range for a 0-based, half-open [start, end) in SQL.
+    """
+    levels = [(17, 585), (20, 73), (23, 9), (26, 1)]
+    cases = " ".join(
+        f"WHEN ({start}) >> {shift} = (({end}) - 1) >> {shift} THEN {offset} + (({start}) >> {shift})"
+        for shift, offset in levels
+    )
+    return f"CASE {cases} ELSE 0 END"
+
+
+def upgrade():
+    # Generated, so that variants inserted outside of the ORM are binned as well.
+    # Variants are stored 1-based and fully closed.
+    op.add_column(
+        "variant",
+        sa.Column(
+            "bin",
+            sa.Integer(),
+            sa.Computed(bin_sql("position - 1", "position"), persisted=True),
+            nullable=False,
+        ),
+    )
+    op.create_index(
+        "ix_variant_chromosome_bin_position",
+        "variant",
+        ["chromosome", "bin", "position"],
+        unique=False,
+    )
+
+
+def downgrade():
+    op.drop_index("ix_variant_chromosome_bin_position", table_name="variant")
+    op.drop_column("variant", "bin")
@@ -0,0 +1,232 @@
+"""Share variant annotations between analyses
+
+Revision ID: 7c4f1d2b8a60
+Revises: e5c2a7d91f36
+Create Date: 2021-08-09 11:42:07.193856
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "7c4f1d2b8a60"
+down_revision = "e5c2a7d91f36"
+branch_labels = None
+depends_on = None
+
+
+def bin_sql(start: str, end: str) -> str:
+    """
+    Mirrors app.binning.bin_from_range for a 0-based, half-open [start, end) in SQL.
+    """
+    levels = [(17, 585), (20, 73), (23, 9), (26, 1)]
+    cases = " ".join(
+        f"WHEN ({start}) >> {shift} = (({end}) - 1) >> {shift} THEN {offset} + (({start}) >> {shift})"
+        for shift, offset in levels
+    )
+    return f"CASE {cases} ELSE 0 END"
+
+
+# Columns moved from variant to variant_annotation that cannot be null. The bin of variant is
+# generated from the position and is left alone, it is 0 for variants without one.
+required_columns = [
+    ("chromosome", sa.String(length=2)),
+    ("position", sa.Integer()),
+    ("reference_allele", sa.String(length=300)),
+    ("alt_allele", sa.String(length=300)),
+    ("variation", sa.String(length=50)),
+]
+
+# The other columns moved, which are nullable
+annotation_columns = [
+    "refseq_change",
+    "conserved_in_20_mammals",
+    "sift_score",
+    "polyphen_score",
+    "cadd_score",
+    "gnomad_af",
+    "ucsc_link",
+    "gnomad_link",
+    "clinvar",
+    "gnomad_af_popmax",
+    "gnomad_ac",
+    "gnomad_hom",
+    "aa_position",
+    "exon",
+    "protein_domains",
+    "gnomad_oe_lof_score",
+    "gnomad_oe_mis_score",
+    "exac_pli_score",
+    "exac_prec_score",
+    "exac_pnull_score",
+    "spliceai_impact",
+    "spliceai_score",
+    "vest3_score",
+    "revel_score",
+    "gerp_score",
+    "imprinting_status",
+    "imprinting_expressed_allele",
+    "pseudoautosomal",
+    "uce_100bp",
+    "uce_200bp",
+]
+
+
+def upgrade():
+    op.create_table(
+        "variant_annotation",
+        sa.Column("annotation_id", sa.Integer(), nullable=False),
+        sa.Column("chromosome", sa.String(length=2), nullable=False),
+        sa.Column("position", sa.Integer(), nullable=False),
+        sa.Column(
+            "bin",
+            sa.Integer(),
+            sa.Computed(bin_sql("position - 1", "position"), persisted=True),
+            nullable=False,
+        ),
+        sa.Column("reference_allele", sa.String(length=300), nullable=False),
+        sa.Column("alt_allele", sa.String(length=300), nullable=False),
+        sa.Column("variation", sa.String(length=50), nullable=False),
+        sa.Column("refseq_change", sa.String(length=500), nullable=True),
+        sa.Column("conserved_in_20_mammals", sa.Float(), nullable=True),
+        sa.Column("sift_score", sa.Float(), nullable=True),
+        sa.Column("polyphen_score", sa.Float(), nullable=True),
+        sa.Column("cadd_score", sa.Float(), nullable=True),
+        sa.Column("gnomad_af", sa.Float(), nullable=True),
+        sa.Column("ucsc_link", sa.String(length=300), nullable=True),
+        sa.Column("gnomad_link", sa.String(length=500), nullable=True),
+        sa.Column("clinvar", sa.String(length=200), nullable=True),
+        sa.Column("gnomad_af_popmax", sa.Float(), nullable=True),
+        sa.Column("gnomad_ac", sa.Integer(), nullable=True),
+        sa.Column("gnomad_hom", sa.Integer(), nullable=True),
+        sa.Column("aa_position", sa.String(length=50), nullable=True),
+        sa.Column("exon", sa.String(length=50), nullable=True),
+        sa.Column("protein_domains", sa.String(length=750), nullable=True),
+        sa.Column("gnomad_oe_lof_score", sa.Float(), nullable=True),
+        sa.Column("gnomad_oe_mis_score", sa.Float(), nullable=True),
+        sa.Column("exac_pli_score", sa.Float(), nullable=True),
+        sa.Column("exac_prec_score", sa.Float(), nullable=True),
+        sa.Column("exac_pnull_score", sa.Float(), nullable=True),
+        sa.Column("spliceai_impact", sa.String(length=1000), nullable=True),
+        sa.Column("spliceai_score", sa.Float(), nullable=True),
+        sa.Column("vest3_score", sa.Float(), nullable=True),
+        sa.Column("revel_score", sa.Float(), nullable=True),
+        sa.Column("gerp_score", sa.Float(), nullable=True),
+        sa.Column("imprinting_status", sa.String(length=50), nullable=True),
+        sa.Column("imprinting_expressed_allele", sa.String(length=50), nullable=True),
+        sa.Column("pseudoautosomal", sa.Boolean(), nullable=True),
+        sa.Column("uce_100bp", sa.Boolean(), nullable=True),
+        sa.Column("uce_200bp", sa.Boolean(), nullable=True),
+        sa.PrimaryKeyConstraint("annotation_id"),
+    )
+    op.create_index(
+        "ix_variant_annotation_locus",
+        "variant_annotation",
+        ["chromosome", "position", "reference_allele", "alt_allele"],
+        unique=True,
+    )
+    op.create_index(
+        "ix_variant_annotation_chromosome_bin_position",
+        "variant_annotation",
+        ["chromosome", "bin", "position"],
+        unique=False,
+    )
+
+    # Variants are linked to their annotations by `flask backfill-variant-annotations` or the next
+    # revision. Until then, new variants are loaded without the columns that are moving.
+    op.add_column("variant", sa.Column("annotation_id", sa.Integer(), nullable=True))
+    op.create_index(
+        "ix_variant_annotation_id", "variant", ["annotation_id"], unique=False
+    )
+    op.create_foreign_key(
+        "variant_ibfk_annotation",
+        "variant",
+        "variant_annotation",
+        ["annotation_id"],
+        ["annotation_id"],
+    )
+    for column, column_type in required_columns:
+        op.alter_column("variant", column, existing_type=column_type, nullable=True)
+
+    # Summary rows are keyed by annotation instead of position and alleles.
+    # Populate with `flask refresh-variant-summary` once variants are linked.
+    op.drop_index(
+        "ix_variant_summary_ensembl_id_position", table_name="variant_summary"
+    )
+    op.execute("DELETE FROM variant_summary")
+    for column in ["chromosome", "position", "reference_allele", "alt_allele"]:
+        op.drop_column("variant_summary", column)
+    op.add_column(
+        "variant_summary",
+        sa.Column("annotation_id", sa.Integer(), nullable=False),
+    )
+    op.create_foreign_key(
+        "variant_summary_ibfk_annotation",
+        "variant_summary",
+        "variant_annotation",
+        ["annotation_id"],
+        ["annotation_id"],
+        onupdate="cascade",
+        ondelete="cascade",
+    )
+    op.create_index(
+        "ix_variant_summary_ensembl_id_annotation_id",
+        "variant_summary",
+        ["ensembl_id", "annotation_id"],
+        unique=True,
+    )
+
+
+def downgrade():
+    op.drop_index(
+        "ix_variant_summary_ensembl_id_annotation_id", table_name="variant_summary"
+    )
+    op.drop_constraint(
+        "variant_summary_ibfk_annotation", "variant_summary", type_="foreignkey"
+    )
+    op.execute("DELETE FROM variant_summary")
+    op.drop_column("variant_summary", "annotation_id")
+    op.add_column(
+        "variant_summary",
+        sa.Column("chromosome", sa.String(length=2), nullable=False),
+    )
+    op.add_column(
+        "variant_summary", sa.Column("position", sa.Integer(), nullable=False)
+    )
+    op.add_column(
+        "variant_summary",
+        sa.Column("reference_allele", sa.String(length=300), nullable=False),
+    )
+    op.add_column(
+        "variant_summary",
+        sa.Column("alt_allele", sa.String(length=300), nullable=False),
+    )
+    op.create_index(
+        "ix_variant_summary_ensembl_id_position",
+        "variant_summary",
+        ["ensembl_id", "position"],
+        unique=False,
+    )
+
+    # Variants loaded since the upgrade only have their annotations in variant_annotation
+    op.execute(
+        "UPDATE variant JOIN variant_annotation USING (annotation_id) SET "
+        + ", ".join(
+            f"variant.{column} = variant_annotation.{column}"
+            for column in [column for column, _ in required_columns]
+            + annotation_columns
+        )
+        + " WHERE variant.chromosome IS NULL"
+    )
+    for column, column_type in required_columns:
+        op.alter_column("variant", column, existing_type=column_type, nullable=False)
+    op.drop_constraint("variant_ibfk_annotation", "variant", type_="foreignkey")
+    op.drop_index("ix_variant_annotation_id", table_name="variant")
+    op.drop_column("variant", "annotation_id")
+    op.drop_index(
+        "ix_variant_annotation_chromosome_bin_position",
+        table_name="variant_annotation",
+    )
+    op.drop_index("ix_variant_annotation_locus", table_name="variant_annotation")
+    op.drop_table("variant_annotation")
@@ -0,0 +1,128 @@
+"""Drop the annotation columns of variants
+
+Revision ID: 9a3e6b0f5d27
+Revises: 7c4f1d2b8a60
+Create Date: 2021-08-09 11:58:31.604219
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "9a3e6b0f5d27"
+down_revision = "7c4f1d2b8a60"
+branch_labels = None
+depends_on = None
+
+
+def bin_sql(start: str, end: str) -> str:
+    """
+    Mirrors app.binning.bin_from_range for a 0-based, half-open [start, end) in SQL.
+    """
+    levels = [(17, 585), (20, 73), (23, 9), (26, 1)]
+    cases = " ".join(
+        f"WHEN ({start}) >> {shift} = (({end}) - 1) >> {shift} THEN {offset} + (({start}) >> {shift})"
+        for shift, offset in levels
+    )
+    return f"CASE {cases} ELSE 0 END"
+
+
+locus_columns = ["chromosome", "position", "reference_allele", "alt_allele"]
+
+# The columns moved to variant_annotation, as they were on variant, besides the generated bin
+moved_columns = [
+    ("chromosome", sa.String(length=2)),
+    ("position", sa.Integer()),
+    ("reference_allele", sa.String(length=300)),
+    ("alt_allele", sa.String(length=300)),
+    ("variation", sa.String(length=50)),
+    ("refseq_change", sa.String(length=500)),
+    ("conserved_in_20_mammals", sa.Float()),
+    ("sift_score", sa.Float()),
+    ("polyphen_score", sa.Float()),
+    ("cadd_score", sa.Float()),
+    ("gnomad_af", sa.Float()),
+    ("ucsc_link", sa.String(length=300)),
+    ("gnomad_link", sa.String(length=500)),
+    ("clinvar", sa.String(length=200)),
+    ("gnomad_af_popmax", sa.Float()),
+    ("gnomad_ac", sa.Integer()),
+    ("gnomad_hom", sa.Integer()),
+    ("aa_position", sa.String(length=50)),
+    ("exon", sa.String(length=50)),
+    ("protein_domains", sa.String(length=750)),
+    ("gnomad_oe_lof_score", sa.Float()),
+    ("gnomad_oe_mis_score", sa.Float()),
+    ("exac_pli_score", sa.Float()),
+    ("exac_prec_score", sa.Float()),
+    ("exac_pnull_score", sa.Float()),
+    ("spliceai_impact", sa.String(length=1000)),
+    ("spliceai_score", sa.Float()),
+    ("vest3_score", sa.Float()),
+    ("revel_score", sa.Float()),
+    ("gerp_score", sa.Float()),
+    ("imprinting_status", sa.String(length=50)),
+    ("imprinting_expressed_allele", sa.String(length=50)),
+    ("pseudoautosomal", sa.Boolean()),
+    ("uce_100bp", sa.Boolean()),
+    ("uce_200bp", sa.Boolean()),
+]
+
+
+def upgrade():
+    # Link whatever `flask backfill-variant-annotations` has not, in one pass. Mirrors
+    # app.annotations: each new locus takes the annotations of its latest variant.
+    columns = ", ".join(column for column, _ in moved_columns)
+    same_locus = " AND ".join(
+        f"variant_annotation.{column} = variant.{column}" for column in locus_columns
+    )
+    op.execute(
+        f"INSERT INTO variant_annotation ({columns}) SELECT {columns} FROM variant "
+        "WHERE variant_id IN (SELECT MAX(variant_id) FROM variant WHERE annotation_id IS NULL "
+        f"GROUP BY {', '.join(locus_columns)}) "
+        f"AND NOT EXISTS (SELECT 1 FROM variant_annotation WHERE {same_locus})"
+    )
+    op.execute(
+        "UPDATE variant SET annotation_id = (SELECT annotation_id FROM variant_annotation "
+        f"WHERE {same_locus}) WHERE annotation_id IS NULL"
+    )
+
+    op.drop_index("ix_variant_chromosome_bin_position", table_name="variant")
+    op.drop_column("variant", "bin")
+    for column, _ in moved_columns:
+        op.drop_column("variant", column)
+    op.alter_column(
+        "variant", "annotation_id", existing_type=sa.Integer(), nullable=False
+    )
+    # Rebuild with `flask refresh-variant-summary` before enabling USE_VARIANT_SUMMARY
+
+
+def downgrade():
+    op.alter_column(
+        "variant", "annotation_id", existing_type=sa.Integer(), nullable=True
+    )
+    for column, column_type in moved_columns:
+        op.add_column("variant", sa.Column(column, column_type, nullable=True))
+    op.execute(
+        "UPDATE variant JOIN variant_annotation USING (annotation_id) SET "
+        + ", ".join(
+            f"variant.{column} = variant_annotation.{column}"
+            for column, _ in moved_columns
+        )
+    )
+    op.add_column(
+        "variant",
+        sa.Column(
+            "bin",
+            sa.Integer(),
+            sa.Computed(bin_sql("position - 1", "position"), persisted=True),
+            nullable=False,
+        ),
+    )
+    op.create_index(
+        "ix_variant_chromosome_bin_position",
+        "variant",
+        ["chromosome", "bin", "position"],
+        unique=False,
+    )
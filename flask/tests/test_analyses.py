@@ -42,6 +42,33 @@ def test_list_analyses_user_from_admin(test_database, client, login_as):
     assert len(response.get_json()["data"]) == 1
 
 
+def test_analyses_cursor_pagination_by_state(test_database, client, login_as):
+    # Enums sort by their definition, not alphabetically
+    for analysis_id, state in [(1, "Running"), (2, "Done"), (3, "Requested")]:
+        models.Analysis.query.get(analysis_id).analysis_state = state
+    db.session.commit()
+    login_as("admin")
+
+    for order_dir, expected in [("asc", [3, 1, 2]), ("desc", [2, 1, 3])]:
+        order = f"order_by=analysis_state&order_dir={order_dir}"
+        response = client.get(f"/api/analyses?{order}")
+        assert response.status_code == 200
+        assert [
+            analysis["analysis_id"] for analysis in response.get_json()["data"]
+        ] == expected
+
+        body = client.get(f"/api/analyses?limit=1&{order}").get_json()
+        seen = [analysis["analysis_id"] for analysis in body["data"]]
+        while body["next_cursor"]:
+            response = client.get(
+                f"/api/analyses?limit=1&{order}&cursor={body['next_cursor']}"
+            )
+            assert response.status_code == 200
+            body = response.get_json()
+            seen += [analysis["analysis_id"] for analysis in body["data"]]
+        assert seen == expected
+
+
 # GET /api/analyses/:id
 
 
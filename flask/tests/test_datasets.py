@@ -562,3 +562,47 @@ def test_dataset_order_by_related_column(client, test_database, login_as):
     body = response.get_json()
     assert len(body["data"]) == 4
     assert body["data"][0]["tissue_sample_type"] == "Blood"
+
+
+def test_dataset_cursor_pagination(client, test_database, login_as):
+    login_as("admin")
+
+    for order in [
+        "",
+        "&order_by=family_codename&order_dir=desc",
+        "&order_by=notes&order_dir=asc",
+    ]:
+        expected = [
+            dataset["dataset_id"]
+            for dataset in client.get(f"/api/datasets?{order}").get_json()["data"]
+        ]
+        assert len(expected) == 4
+
+        response = client.get(f"/api/datasets?limit=3{order}")
+        assert response.status_code == 200
+        body = response.get_json()
+        assert body["page"] == 0
+        assert body["total_count"] == 4
+        seen = [dataset["dataset_id"] for dataset in body["data"]]
+        while body["next_cursor"]:
+            response = client.get(
+                f"/api/datasets?limit=1{order}&cursor={body['next_cursor']}"
+            )
+            assert response.status_code == 200
+            page = body["page"]
+            body = response.get_json()
+            assert body["page"] == page + 1
+            assert body["total_count"] == 4
+            seen += [dataset["dataset_id"] for dataset in body["data"]]
+        assert seen == expected
+
+    cursor = client.get("/api/datasets?limit=1").get_json()["next_cursor"]
+    # a cursor is only valid for the listing it came from
+    assert (
+        client.get(
+            f"/api/datasets?limit=1&dataset_type=WGS&cursor={cursor}"
+        ).status_code
+        == 400
+    )
+    assert client.get(f"/api/datasets?cursor={cursor}").status_code == 400
+    assert client.get("/api/datasets?limit=1&cursor=garbage").status_code == 400
@@ -0,0 +1,287 @@
+from csv import DictReader
+from datetime import datetime, timedelta
+import gzip
+from io import StringIO
+import json
+import os
+from time import sleep
+
+import pytest
+from app import db, exports, models
+
+
+@pytest.fixture
+def export_config(application, tmp_path):
+    config = application.config
+    saved = {
+        key: config[key]
+        for key in [
+            "EXPORT_DIR",
+            "EXPORT_CHUNK_SIZE",
+            "EXPORT_MAX_ACTIVE",
+            "EXPORT_STALE_SECONDS",
+        ]
+    }
+    config["EXPORT_DIR"] = str(tmp_path)
+    # Small enough that every export spans several chunks
+    config["EXPORT_CHUNK_SIZE"] = 2
+    yield config
+    config.update(saved)
+
+
+def submit(client, kind: str, params: dict = {}, **body):
+    return client.post("/api/exports", json={"kind": kind, "params": params, **body})
+
+
+def wait_for(client, export_id: int) -> dict:
+    for _ in range(300):
+        job = client.get(f"/api/exports/{export_id}").get_json()
+        if job["state"] not in ("Pending", "Running"):
+            return job
+        sleep(0.1)
+    raise AssertionError(f"Export {export_id} did not finish")
+
+
+def download(client, export_id: int) -> bytes:
+    response = client.get(f"/api/exports/{export_id}/download")
+    assert response.status_code == 200
+    assert response.mimetype == "application/gzip"
+    return gzip.decompress(response.get_data())
+
+
+def add_job(requester: str, **values) -> models.ExportJob:
+    job = models.ExportJob(
+        kind="datasets",
+        params="{}",
+        requester_id=models.User.query.filter_by(username=requester).one().user_id,
+        **values,
+    )
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+@pytest.mark.parametrize(
+    "kind,url,params",
+    [
+        ("datasets", "/api/datasets", {}),
+        ("datasets", "/api/datasets", {"order_by": "updated", "order_dir": "desc"}),
+        ("analyses", "/api/analyses", {}),
+        ("analyses", "/api/analyses", {"analysis_state": "Requested"}),
+    ],
+)
+def test_export_list(test_database, client, login_as, export_config, kind, url, params):
+    for user in ["admin", "user"]:
+        login_as(user)
+        response = submit(client, kind, params)
+        assert response.status_code == 202
+        assert response.headers["Location"].endswith(
+            f"/api/exports/{response.get_json()['export_id']}"
+        )
+        job = wait_for(client, response.get_json()["export_id"])
+        assert job["state"] == "Done", job["error"]
+        assert job["download"]
+
+        inline = client.get(url, query_string=params, headers={"Accept": "text/csv"})
+        # the same CSV as the inline request, read a chunk at a time
+        assert download(client, job["export_id"]) == inline.get_data()
+        assert job["rows"] == inline.get_data().count(b"\r\n") - 1
+
+
+@pytest.mark.parametrize("kind", ["variants", "participants"])
+def test_export_summary(test_database, client, login_as, export_config, kind):
+    panel = "ENSG00000138131,ENSG00000258366"
+    for user in ["admin", "user"]:
+        login_as(user)
+        response = submit(client, kind, {"panel": panel})
+        assert response.status_code == 202
+        job = wait_for(client, response.get_json()["export_id"])
+        assert job["state"] == "Done", job["error"]
+
+        streamed = client.get(
+            f"/api/summary/{kind}?panel={panel}&stream=true",
+            headers={"Accept": "text/csv"},
+        )
+        assert download(client, job["export_id"]) == streamed.get_data()
+        assert job["rows"] > 0
+        assert (
+            client.get(f"/api/exports/{job['export_id']}/download").headers[
+                "Content-Disposition"
+            ]
+            == f"attachment; filename={kind[:-1]}_wise_report.csv.gz"
+        )
+
+
+def test_export_invalid(test_database, client, login_as, export_config):
+    login_as("user")
+    assert submit(client, "genes").status_code == 400
+    assert submit(client, "datasets", {"limit": 5}).status_code == 400
+    assert submit(client, "variants").status_code == 400
+    assert submit(client, "variants", {"panel": "ENSG00000000001"}).status_code == 400
+    assert submit(client, "datasets", group_code="nonexistent").status_code == 404
+    # user is only a member of ach
+    assert submit(client, "datasets", group_code="bcch").status_code == 403
+    assert (
+        client.post(
+            "/api/exports", data="{}", headers={"Content-Type": "text/plain"}
+        ).status_code
+        == 415
+    )
+    assert client.get("/api/exports/1").status_code == 404
+
+
+def test_export_permissions(test_database, client, login_as, export_config):
+    login_as("admin")
+    admin_job = wait_for(client, submit(client, "datasets").get_json()["export_id"])
+    login_as("user")
+    user_job = wait_for(client, submit(client, "datasets").get_json()["export_id"])
+
+    # regular users only see their own jobs, and only export what they can see
+    assert [job["export_id"] for job in client.get("/api/exports").get_json()] == [
+        user_job["export_id"]
+    ]
+    assert user_job["params"]["user"] == str(
+        models.User.query.filter_by(username="user").one().user_id
+    )
+    for path in ["", "/download"]:
+        assert (
+            client.get(f"/api/exports/{admin_job['export_id']}{path}").status_code
+            == 404
+        )
+    assert client.delete(f"/api/exports/{admin_job['export_id']}").status_code == 404
+
+    login_as("admin")
+    assert [job["export_id"] for job in client.get("/api/exports").get_json()] == [
+        user_job["export_id"],
+        admin_job["export_id"],
+    ]
+
+
+def test_export_group(test_database, client, login_as, export_config):
+    # user_a is a member of ach and bcch, and only dataset 3 is shared with both
+    bcch = models.Group.query.filter_by(group_code="bcch").one()
+    dataset = models.Dataset.query.get(3)
+    dataset.groups.append(bcch)
+    db.session.commit()
+    user_id = str(models.User.query.filter_by(username="user_a").one().user_id)
+    panel = "ENSG00000138131,ENSG00000258366"
+
+    def exported_datasets(kind, params, group_code=None):
+        out = StringIO()
+        exports.write_export(kind, params, out, lambda rows: None, group_code)
+        return {row["dataset_id"] for row in DictReader(StringIO(out.getvalue()))}
+
+    assert exported_datasets("datasets", {"user": user_id}) == {"2", "3"}
+    # the file lands in the group's bucket, so it only has what the group can see
+    for params in [{"user": user_id}, {}]:
+        assert exported_datasets("datasets", params, "bcch") == {"3"}
+        assert exported_datasets(
+            "participants", {**params, "panel": panel}, "bcch"
+        ) == {"3"}
+    assert exported_datasets("participants", {"user": user_id, "panel": panel}) == {
+        "2",
+        "3",
+    }
+
+
+def test_export_limit(test_database, client, login_as, export_config):
+    export_config["EXPORT_MAX_ACTIVE"] = 1
+    # never submitted, so it stays pending
+    add_job("user")
+    login_as("user")
+    assert submit(client, "datasets").status_code == 429
+    login_as("admin")
+    assert submit(client, "datasets").status_code == 202
+
+
+def test_export_cancel_pending(test_database, client, login_as, export_config):
+    job = add_job("user")
+    login_as("user")
+    response = client.post(f"/api/exports/{job.export_id}/cancel")
+    assert response.status_code == 200
+    assert response.get_json()["state"] == "Cancelled"
+    assert client.post(f"/api/exports/{job.export_id}/cancel").status_code == 409
+    assert client.get(f"/api/exports/{job.export_id}/download").status_code == 409
+
+    # a cancelled job is not run when the pool gets to it
+    exports.run_job(job.export_id)
+    db.session.refresh(job)
+    assert job.state == models.ExportState.Cancelled
+    assert job.started is None
+
+
+def test_export_cancel_running(
+    test_database, application, client, login_as, export_config, monkeypatch
+):
+    job = add_job("user")
+    login_as("user")
+
+    def write_export(kind, params, out, progress, group_code):
+        out.write("dataset_id\r\n1\r\n")
+        progress(1)
+        assert client.post(f"/api/exports/{job.export_id}/cancel").status_code == 200
+        out.write("2\r\n")
+        progress(2)
+        raise AssertionError("The export was not stopped")
+
+    monkeypatch.setattr(exports, "write_export", write_export)
+    exports.run_job(job.export_id)
+    db.session.refresh(job)
+    assert job.state == models.ExportState.Cancelled
+    assert job.rows == 1
+    assert os.listdir(export_config["EXPORT_DIR"]) == []
+
+
+def test_export_failure(test_database, client, login_as, export_config, monkeypatch):
+    job = add_job("user")
+    login_as("user")
+
+    def write_export(kind, params, out, progress, group_code):
+        raise ValueError("Out of cheese")
+
+    monkeypatch.setattr(exports, "write_export", write_export)
+    exports.run_job(job.export_id)
+    response = client.get(f"/api/exports/{job.export_id}").get_json()
+    assert (response["state"], response["error"]) == ("Failed", "Out of cheese")
+    assert os.listdir(export_config["EXPORT_DIR"]) == []
+
+
+def test_export_interrupted(test_database, client, login_as, export_config):
+    job = add_job(
+        "user",
+        state=models.ExportState.Running,
+        updated=datetime.utcnow() - timedelta(days=1),
+    )
+    login_as("user")
+    # polling alone leaves the job be, each worker recovers jobs on a timer
+    assert client.get(f"/api/exports/{job.export_id}").get_json()["state"] == "Running"
+    exports.recover_stale_exports()
+    response = client.get(f"/api/exports/{job.export_id}").get_json()
+    assert (response["state"], response["error"]) == ("Failed", "Interrupted")
+
+
+def test_export_heartbeat(test_database, client, login_as, export_config, monkeypatch):
+    export_config["EXPORT_STALE_SECONDS"] = 1
+    job = add_job("user")
+
+    def write_export(kind, params, out, progress, group_code):
+        # a chunk that takes longer than EXPORT_STALE_SECONDS
+        sleep(1.5)
+        exports.recover_stale_exports()
+        out.write("dataset_id\r\n")
+        return 0
+
+    monkeypatch.setattr(exports, "write_export", write_export)
+    exports.run_job(job.export_id)
+    db.session.refresh(job)
+    assert job.state == models.ExportState.Done
+
+
+def test_export_delete(test_database, client, login_as, export_config):
+    login_as("user")
+    job = wait_for(client, submit(client, "analyses").get_json()["export_id"])
+    assert len(os.listdir(export_config["EXPORT_DIR"])) == 1
+    assert client.delete(f"/api/exports/{job['export_id']}").status_code == 204
+    assert os.listdir(export_config["EXPORT_DIR"]) == []
+    assert client.get(f"/api/exports/{job['export_id']}").status_code == 404
+    assert json.loads(client.get("/api/exports").get_data()) == []
@@ -56,6 +56,32 @@ def test_search_genes(test_database, client, login_as):
     assert no_response.get_json()["total_count"] == 0
 
 
+def test_search_genes_ranking(test_database, client, login_as):
+    """are exact and current symbol matches ranked first, with a full total?"""
+    setup_db()
+    db.session.add(Gene(ensembl_id=1001, chromosome="X", start=5, end=9))
+    db.session.flush()
+    db.session.add_all(
+        [
+            GeneAlias(ensembl_id=1001, name="FOOBARBAZ", kind="previous gene symbol"),
+            GeneAlias(ensembl_id=1001, name="AFOOBAR", kind="current hgnc gene symbol"),
+            GeneAlias(ensembl_id=1001, name="FOO", kind="synonym"),
+        ]
+    )
+    db.session.commit()
+    login_as("user")
+    response = client.get(
+        "/api/summary/genes?search=foo&limit=3", headers={"Accept": "application/json"}
+    )
+    assert response.status_code == 200
+    assert [alias["name"] for alias in response.get_json()["data"]] == [
+        "FOO",
+        "AFOOBAR",
+        "FOOBARBAZ",
+    ]
+    assert response.get_json()["total_count"] == 4
+
+
 def test_fetch_gene_by_alias(test_database, client, login_as):
     """can we fetch a gene by alias"""
     setup_db()
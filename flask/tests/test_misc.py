@@ -435,3 +435,65 @@ def test_bulk_multiple_json(test_database, client, login_as):
     assert models.TissueSample.query.count() == 5
     assert models.Participant.query.count() == 4
     assert models.Family.query.count() == 3
+
+
+def test_bulk_rejects_before_writing(test_database, client, login_as):
+    login_as("admin")
+
+    response = client.post(
+        "/api/_bulk?groups=ach",
+        json=[
+            {
+                "family_codename": "HOOD",
+                "participant_codename": "HERO",
+                "participant_type": "Proband",
+                "tissue_sample_type": "Saliva",
+                "dataset_type": "WGS",
+                "institution": "Nowhere General",
+                "condition": "GermLine",
+                "sequencing_date": "2020-12-17",
+            },
+            {
+                "family_codename": "HOOD",
+                "participant_codename": "SIDEKICK",
+                "participant_type": "Sibling",
+                "tissue_sample_type": "NOT AN ENUM",
+                "dataset_type": "WES",
+                "condition": "GermLine",
+                "sequencing_date": "2020-12-17",
+            },
+        ],
+    )
+    assert response.status_code == 400
+    assert "Error on line 2" in response.get_json()["error"]
+
+    assert models.Family.query.count() == 2
+    assert models.Participant.query.count() == 3
+    assert (
+        models.Institution.query.filter(
+            models.Institution.institution == "Nowhere General"
+        ).count()
+        == 0
+    )
+
+
+# GET /api/_metrics
+
+
+def test_get_metrics(test_database, client, login_as):
+    assert client.get("/api/_metrics").status_code == 401
+    login_as("user")
+    assert client.get("/api/_metrics").status_code == 401
+
+    login_as("admin")
+    client.get("/api/pipelines")
+    response = client.get("/api/_metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/plain")
+    body = response.get_data(as_text=True)
+    assert (
+        'stager_request_duration_seconds_count{blueprint="routes",endpoint="routes.pipelines_list",method="GET",status="200"}'
+        in body
+    )
+    assert "stager_requests_in_progress" in body
+    assert "stager_db_pool_checkouts_total" in body
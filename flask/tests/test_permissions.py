@@ -0,0 +1,47 @@
+from app import db, models
+from app.permissions import permitted_dataset_ids
+
+
+def test_permitted_datasets_are_cached(test_database, application):
+    user = models.User.query.filter_by(username="user").one()
+    group = models.Group.query.filter_by(group_code="bcch").one()
+    datasets = {
+        dataset.dataset_id
+        for dataset in models.Dataset.query.join(models.Dataset.groups).filter(
+            models.Group.group_code == "ach"
+        )
+    }
+
+    assert permitted_dataset_ids(user.user_id) == datasets
+    assert permitted_dataset_ids(None) is None
+    # reused until permissions change
+    cached = application.extensions["dataset_permissions"]
+    assert (
+        permitted_dataset_ids(str(user.user_id)) is cached.datasets[str(user.user_id)]
+    )
+
+    # sharing a dataset with one of the user's groups invalidates the cache
+    dataset = models.Dataset.query.filter(
+        ~models.Dataset.dataset_id.in_(datasets)
+    ).first()
+    user.groups.append(group)
+    dataset.groups.append(group)
+    db.session.commit()
+    assert permitted_dataset_ids(user.user_id) == datasets | {dataset.dataset_id}
+    assert application.extensions["dataset_permissions"] is not cached
+
+    # as does leaving a group
+    user.groups.remove(group)
+    db.session.commit()
+    assert permitted_dataset_ids(user.user_id) == datasets
+
+
+def test_no_permitted_datasets(test_database, client, login_as):
+    login_as("user_b")
+    assert (
+        permitted_dataset_ids(
+            models.User.query.filter_by(username="user_b").one().user_id
+        )
+        == frozenset()
+    )
+    assert client.get("/api/datasets").get_json()["data"] == []
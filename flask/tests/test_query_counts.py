@@ -0,0 +1,183 @@
+"""
+Guards against N+1 queries: every list and detail route is requested on a small seeded
+database and again after many more, larger families are added, and must execute no more
+statements the second time than the first, nor more than its budget. A serializer that
+touches a relationship the query did not eager load, such as participant.updated_by,
+adds a statement per row and fails both checks.
+
+Synthetic rows are created by the test users and many more in turn, so lazy loads of
+users are not hidden by the session already holding them. QUERY_COUNT_FAMILIES scales the
+seeded data; the budgets do not depend on it.
+"""
+import os
+from typing import Any, Callable, Dict
+
+from sqlalchemy import event, func
+
+from app import db, models
+from app.synthetic import seed_synthetic_data
+
+
+# Families added before the first measurement, with three times as many added before the second
+QUERY_COUNT_FAMILIES = int(os.getenv("QUERY_COUNT_FAMILIES", 3))
+
+# Most statements each route may execute, including loading the logged in user. Lower
+# these when a route gets cheaper; raise one only when the route now does more work.
+BUDGETS = {
+    "families": 3,
+    "families_detail": 3,
+    "participants": 4,
+    "participants_csv": 4,
+    "tissue_samples_detail": 3,
+    "datasets": 6,
+    "datasets_csv": 6,
+    "datasets_detail": 3,
+    "analyses": 8,
+    "analyses_csv": 8,
+    "analyses_detail": 4,
+    "groups": 2,
+    "groups_detail": 3,
+    "users": 2,
+    "users_detail": 2,
+    "pipelines": 2,
+    "institutions": 2,
+    "metadatasettypes": 2,
+    "enums": 3,
+    "genes": 2,
+    "genes_detail": 2,
+    "summary_variants": 5,
+    "summary_variants_csv": 5,
+    "summary_participants": 5,
+    "summary_participants_csv": 5,
+}
+
+CSV = {"Accept": "text/csv"}
+
+
+def seed(families: int, participants: int, genes: int, seed: int) -> None:
+    # Enough users that no two rows in a family share one
+    start = db.session.query(func.count(models.User.user_id)).scalar()
+    db.session.execute(
+        models.User.__table__.insert(),
+        [
+            {
+                "username": f"auditor{i}",
+                "email": f"auditor{i}@sickkids.ca",
+                "password_hash": "!",
+                "deactivated": False,
+            }
+            for i in range(start, start + families * participants * 3)
+        ],
+    )
+    db.session.commit()
+    seed_synthetic_data(families, participants, 20, genes, seed=seed)
+
+
+def routes(client) -> Dict[str, Callable[[], Any]]:
+    """
+    A request for each route, with detail routes pointed at the newest entity the
+    logged in user can see, which after the second seeding is one of the larger families.
+    """
+    family_id = max(family["family_id"] for family in client.get("/api/families").json)
+    family = client.get(f"/api/families/{family_id}").json[0]
+    tissue_sample_id = max(
+        tissue_sample["tissue_sample_id"]
+        for participant in family["participants"]
+        for tissue_sample in participant["tissue_samples"]
+    )
+    dataset_id = max(d["dataset_id"] for d in client.get("/api/datasets").json["data"])
+    analysis_id = max(
+        a["analysis_id"] for a in client.get("/api/analyses").json["data"]
+    )
+    panel = ",".join(
+        gene
+        for (gene,) in db.session.query(models.Variant.report_ensembl_gene_id)
+        .filter(models.Variant.report_ensembl_gene_id.isnot(None))
+        .group_by(models.Variant.report_ensembl_gene_id)
+        .order_by(func.count().desc())
+        .limit(10)
+    )
+    ensembl_id = int(panel.split(",")[0][4:])
+
+    def get(url: str, headers: Dict[str, str] = {}) -> Callable[[], Any]:
+        return lambda: client.get(url, headers=headers)
+
+    return {
+        "families": get("/api/families"),
+        "families_detail": get(f"/api/families/{family_id}"),
+        "participants": get("/api/participants"),
+        "participants_csv": get("/api/participants", CSV),
+        "tissue_samples_detail": get(f"/api/tissue_samples/{tissue_sample_id}"),
+        "datasets": get("/api/datasets"),
+        "datasets_csv": get("/api/datasets", CSV),
+        "datasets_detail": get(f"/api/datasets/{dataset_id}"),
+        "analyses": get("/api/analyses"),
+        "analyses_csv": get("/api/analyses", CSV),
+        "analyses_detail": get(f"/api/analyses/{analysis_id}"),
+        "groups": get("/api/groups"),
+        "groups_detail": get("/api/groups/ach"),
+        "users": get("/api/users"),
+        "users_detail": get("/api/users/user"),
+        "pipelines": get("/api/pipelines"),
+        "institutions": get("/api/institutions"),
+        "metadatasettypes": get("/api/metadatasettypes"),
+        "enums": get("/api/enums"),
+        "genes": get("/api/summary/genes"),
+        "genes_detail": get(f"/api/summary/genes/ensg/{ensembl_id}"),
+        "summary_variants": get(f"/api/summary/variants?panel={panel}"),
+        "summary_variants_csv": get(f"/api/summary/variants?panel={panel}", CSV),
+        "summary_participants": get(f"/api/summary/participants?panel={panel}"),
+        "summary_participants_csv": get(
+            f"/api/summary/participants?panel={panel}", CSV
+        ),
+    }
+
+
+def count_queries(client, login_as, username: str) -> Dict[str, int]:
+    """
+    Returns the statements executed by each route for the user, after a first request
+    to warm the per-worker caches. The session is emptied before each request, so that
+    nothing loaded earlier spares a lazy load.
+    """
+    login_as(username)
+    counts = {}
+    statements = []
+
+    def record(conn, cursor, statement, *args) -> None:
+        statements.append(statement)
+
+    for name, request in routes(client).items():
+        request()
+        db.session.remove()
+        statements.clear()
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            response = request()
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        if response.status_code == 401:  # admin-only routes
+            continue
+        assert response.status_code == 200, (username, name, response.status_code)
+        counts[name] = len(statements)
+    return counts
+
+
+def test_query_counts(test_database, client, login_as):
+    seed(QUERY_COUNT_FAMILIES, 2, genes=100, seed=0)
+    small = {user: count_queries(client, login_as, user) for user in ["admin", "user"]}
+    seed(QUERY_COUNT_FAMILIES * 3, 4, genes=0, seed=1)
+    large = {user: count_queries(client, login_as, user) for user in ["admin", "user"]}
+
+    failures = []
+    for user, counts in large.items():
+        for name, count in counts.items():
+            if count > small[user][name]:
+                failures.append(
+                    f"{name} as {user} grew from {small[user][name]} to {count} statements"
+                )
+            if count > BUDGETS[name]:
+                failures.append(
+                    f"{name} as {user} executed {count} statements, over its budget of {BUDGETS[name]}"
+                )
+    assert set(large["admin"]) == set(BUDGETS)
+    assert not failures, "\n".join(failures)
@@ -0,0 +1,52 @@
+import os
+
+from app import db
+from app.mapping_utils import (
+    ReportFingerprint,
+    filter_changed_reports,
+    record_report_ingestion,
+    report_sha256,
+    report_stat,
+)
+from app.models import ReportIngestion, ReportIngestionState
+
+
+def write_report(path, contents):
+    with open(path, "w") as report:
+        report.write(contents)
+
+
+def test_filter_changed_reports(test_database, tmp_path):
+    unchanged = str(tmp_path / "unchanged.csv")
+    touched = str(tmp_path / "touched.csv")
+    edited = str(tmp_path / "edited.csv")
+    unmapped = str(tmp_path / "unmapped.csv")
+    new = str(tmp_path / "new.csv")
+    for path in [unchanged, touched, edited, unmapped, new]:
+        write_report(path, "Position,Ref,Alt\n1:100,A,T\n")
+
+    def fingerprint(path):
+        return ReportFingerprint(*report_stat(path), report_sha256(path))
+
+    for path in [unchanged, touched, edited]:
+        record_report_ingestion(
+            path, ReportIngestionState.Ingesting, 1, fingerprint=fingerprint(path)
+        )
+    db.session.commit()
+    for path in [unchanged, touched, edited]:
+        # finishing an ingestion keeps the fingerprint taken when it started
+        record_report_ingestion(path, ReportIngestionState.Ingested, 1, 1)
+    record_report_ingestion(
+        unmapped, ReportIngestionState.Unmapped, fingerprint=fingerprint(unmapped)
+    )
+    db.session.commit()
+
+    size, mtime = report_stat(touched)
+    os.utime(touched, (mtime + 60, mtime + 60))
+    write_report(edited, "Position,Ref,Alt\n1:100,A,C\n")
+    os.utime(edited, (mtime + 60, mtime + 60))
+
+    changed = filter_changed_reports([unchanged, touched, edited, unmapped, new])
+    assert changed == [edited, unmapped, new]
+    # a touched but identical report is remembered under its new modification time
+    assert ReportIngestion.query.get(touched).mtime == mtime + 60
@@ -0,0 +1,58 @@
+from app import db
+from app.annotations import store_variant_annotations, variant_calls
+from app.models import Variant, VariantAnnotation
+
+
+def variant(position, **values):
+    return {
+        "chromosome": "4",
+        "position": position,
+        "reference_allele": "A",
+        "alt_allele": "G",
+        "variation": "missense_variant",
+        "depth": 30,
+        **values,
+    }
+
+
+def test_store_variant_annotations(test_database):
+    existing = Variant.query.first().annotation
+    before = VariantAnnotation.query.count()
+    rows = [
+        variant(10, cadd_score=1.5),
+        {
+            "chromosome": existing.chromosome,
+            "position": existing.position,
+            "reference_allele": existing.reference_allele,
+            "alt_allele": existing.alt_allele,
+            "variation": existing.variation,
+            "cadd_score": 99.0,
+            "depth": 12,
+        },
+        variant(20),
+        # the same locus again, whose annotations win
+        variant(10, cadd_score=2.5),
+    ]
+    ids = store_variant_annotations(rows, batch_size=2)
+    db.session.commit()
+
+    assert ids[1] == existing.annotation_id
+    assert ids[0] == ids[3] != ids[2]
+    assert VariantAnnotation.query.count() == before + 2
+    assert VariantAnnotation.query.get(ids[0]).cadd_score == 2.5
+    assert VariantAnnotation.query.get(ids[0]).bin == 585
+    # reports loaded later overwrite the annotations of earlier ones
+    db.session.refresh(existing)
+    assert existing.cadd_score == 99.0
+
+    # loading the same rows again reuses every annotation
+    assert store_variant_annotations(rows) == ids
+    assert VariantAnnotation.query.count() == before + 2
+
+
+def test_variant_calls(test_database):
+    calls = variant_calls([variant(10, variant_id=5, analysis_id=2)], [8])
+    assert calls[0]["annotation_id"] == 8
+    assert calls[0]["variant_id"] == 5
+    assert calls[0]["depth"] == 30
+    assert "position" not in calls[0] and "cadd_score" not in calls[0]
@@ -1,5 +1,11 @@
 from io import BytesIO
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from app import db, models
+from app.report_cache import MemoryReportCache
+from app.variants import refresh_variant_summary, variant_summary_keys
 
 
 def test_variant_wise_json_single_gene(test_database, client, login_as):
@@ -22,6 +28,23 @@ def test_variant_wise_json_multiple_genes(test_database, client, login_as):
     assert len(response.get_json()) == 6  # variants across the two genes
 
 
+def test_variant_wise_json_shape(test_database, client, login_as):
+    login_as("admin")
+    response = client.get(
+        "/api/summary/variants?panel=ENSG00000138131",
+        headers={"Accept": "application/json"},
+    )
+    assert response.status_code == 200
+    for variant in response.get_json():
+        assert variant["ensembl_id"] == 138131
+        assert {"variant_id", "position", "start", "end", "genotype"} <= set(variant)
+        assert len(variant["genotype"])
+        for genotype in variant["genotype"]:
+            assert genotype["variant_id"] == variant["variant_id"]
+            assert genotype["participant_codename"]
+            assert "zygosity" in genotype
+
+
 def test_variant_wise_json_invalid_gene(test_database, client, login_as):
     login_as("admin")
     response = client.get(
@@ -59,6 +82,104 @@ def test_variant_wise_csv_multiple_genes(test_database, client, login_as):
     assert df.shape[0] == 6
 
 
+def test_variant_wise_csv_stream(test_database, client, login_as):
+    login_as("admin")
+    response = client.get(
+        "/api/summary/variants?panel=ENSG00000138131,ENSG00000258366&stream=true",
+        headers={"Accept": "text/csv"},
+    )
+    assert response.status_code == 200
+    assert response.is_streamed
+    df = pd.read_csv(BytesIO(response.get_data()), encoding="utf8")
+    # each variant is aggregated once even though its genotypes span chunks
+    assert df.shape[0] == 6
+    assert list(df["position"]) == sorted(df["position"])
+    assert "frequency" in df.columns
+
+
+def test_variant_wise_csv_materialized(test_database, application, client, login_as):
+    with application.app_context():
+        refresh_variant_summary(variant_summary_keys())
+        db.session.commit()
+
+    for user in ["admin", "user"]:
+        login_as(user)
+        url = "/api/summary/variants?panel=ENSG00000138131,ENSG00000258366"
+        live = client.get(url, headers={"Accept": "text/csv"}).get_data()
+        application.config["USE_VARIANT_SUMMARY"] = True
+        try:
+            response = client.get(url, headers={"Accept": "text/csv"})
+        finally:
+            application.config["USE_VARIANT_SUMMARY"] = False
+        assert response.status_code == 200
+        # the same report, read from the summary table
+        assert response.get_data() == live
+
+
+def test_variant_wise_csv_cached(test_database, application, client, login_as):
+    login_as("admin")
+    url = "/api/summary/variants?panel=ENSG00000138131"
+    application.extensions["report_cache"] = cache = MemoryReportCache(1 << 20)
+    try:
+        first = client.get(url, headers={"Accept": "text/csv"})
+        second = client.get(url, headers={"Accept": "text/csv"})
+        assert first.get_data() == second.get_data()
+        assert (
+            second.headers["Content-Disposition"]
+            == first.headers["Content-Disposition"]
+        )
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert client.get("/api/summary/cache").get_json()["hits"] == 1
+
+        # removing genotypes bumps the data version, so the report is rebuilt
+        models.Genotype.query.filter(models.Genotype.dataset_id == 3).delete()
+        db.session.commit()
+        third = client.get(url, headers={"Accept": "text/csv"})
+        assert (cache.hits, cache.misses) == (1, 2)
+        assert third.get_data() != first.get_data()
+
+        # users with different datasets never share entries
+        login_as("user")
+        client.get(url, headers={"Accept": "text/csv"})
+        assert (cache.hits, cache.misses) == (1, 3)
+    finally:
+        del application.extensions["report_cache"]
+
+
+def test_variant_wise_parquet(test_database, client, login_as):
+    login_as("admin")
+    url = "/api/summary/variants?panel=ENSG00000138131"
+    csv = pd.read_csv(
+        BytesIO(client.get(url, headers={"Accept": "text/csv"}).get_data())
+    )
+    response = client.get(url, headers={"Accept": "application/vnd.apache.parquet"})
+    assert response.status_code == 200
+    assert response.headers["Content-Disposition"].endswith(
+        "variant_wise_report.parquet"
+    )
+    table = pq.read_table(BytesIO(response.get_data()))
+    assert table.num_rows == 3
+    assert table.schema.field("position").type == pa.int64()
+    assert table.column("position").to_pylist() == list(csv["position"])
+    assert table.column("frequency").to_pylist() == list(csv["frequency"])
+    assert [
+        "; ".join(codenames)
+        for codenames in table.column("participant_codename").to_pylist()
+    ] == list(csv["participant_codename"])
+
+
+def test_participant_wise_arrow_stream(test_database, client, login_as):
+    login_as("admin")
+    response = client.get(
+        "/api/summary/participants?panel=ENSG00000138131",
+        headers={"Accept": "application/vnd.apache.arrow.stream"},
+    )
+    assert response.status_code == 200
+    table = pa.ipc.open_stream(response.get_data()).read_all()
+    assert table.num_rows == 5
+    assert pa.types.is_dictionary(table.schema.field("participant_codename").type)
+
+
 def test_variant_wise_invalid_accept(test_database, client, login_as):
     login_as("admin")
     response = client.get(
@@ -141,6 +262,18 @@ def test_participant_wise_csv_multiple_genes(test_database, client, login_as):
     assert df.shape[0] == 9
 
 
+def test_participant_wise_csv_stream(test_database, client, login_as):
+    login_as("admin")
+    response = client.get(
+        "/api/summary/participants?panel=ENSG00000138131,ENSG00000258366&stream=true",
+        headers={"Accept": "text/csv"},
+    )
+    assert response.status_code == 200
+    assert response.is_streamed
+    df = pd.read_csv(BytesIO(response.get_data()), encoding="utf8")
+    assert df.shape[0] == 9
+
+
 def test_participant_wise_invalid_accept(test_database, client, login_as):
     login_as("admin")
     response = client.get(
@@ -0,0 +1,86 @@
+""" test the backfill of variant annotations from the legacy variant columns """
+from unittest import TestCase
+
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, select
+
+from app.annotations import (
+    LEGACY_COLUMNS,
+    insert_legacy_annotations,
+    link_legacy_annotations,
+)
+from app.models import VariantAnnotation
+
+
+def legacy_variant(variant_id, position, cadd_score, alt_allele="G"):
+    return {
+        "variant_id": variant_id,
+        "chromosome": "1",
+        "position": position,
+        "reference_allele": "A",
+        "alt_allele": alt_allele,
+        "variation": "missense_variant",
+        "cadd_score": cadd_score,
+    }
+
+
+class BackfillTest(TestCase):
+    """test class for insert_legacy_annotations and link_legacy_annotations"""
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        metadata = MetaData()
+        annotation = VariantAnnotation.__table__.tometadata(metadata)
+        # the variant table before the annotation columns were dropped
+        self.variant = Table(
+            "variant",
+            metadata,
+            Column("variant_id", Integer, primary_key=True),
+            Column("annotation_id", Integer, nullable=True),
+            *[annotation.c[column].copy() for column in LEGACY_COLUMNS],
+        )
+        metadata.create_all(self.engine)
+        self.annotation = annotation
+        self.engine.execute(
+            self.variant.insert(),
+            [
+                legacy_variant(1, 100, 1.0),
+                legacy_variant(2, 200, 2.0),
+                legacy_variant(3, 100, 3.0),
+                legacy_variant(4, 100, 4.0, alt_allele="T"),
+                legacy_variant(5, 100, 5.0),
+            ],
+        )
+
+    def backfill(self, lower, upper):
+        self.engine.execute(insert_legacy_annotations(lower, upper))
+        return self.engine.execute(link_legacy_annotations(lower, upper)).rowcount
+
+    def annotations(self):
+        return {
+            (row.position, row.alt_allele): (row.annotation_id, row.cadd_score)
+            for row in self.engine.execute(select([self.annotation]))
+        }
+
+    def test_newest_variants_win(self):
+        """test that chunks from the newest variants keep each locus' latest annotations"""
+        self.assertEqual(self.backfill(4, 5), 2)
+        self.assertEqual(self.backfill(1, 3), 3)
+        annotations = self.annotations()
+        self.assertEqual(
+            {locus: cadd_score for locus, (_, cadd_score) in annotations.items()},
+            {(100, "G"): 5.0, (100, "T"): 4.0, (200, "G"): 2.0},
+        )
+        linked = dict(
+            self.engine.execute(
+                select([self.variant.c.variant_id, self.variant.c.annotation_id])
+            ).fetchall()
+        )
+        self.assertEqual(linked[1], annotations[(100, "G")][0])
+        self.assertEqual(linked[3], linked[5])
+        self.assertEqual(linked[4], annotations[(100, "T")][0])
+
+    def test_resume(self):
+        """test that linked variants are skipped when the backfill runs again"""
+        self.assertEqual(self.backfill(1, 5), 5)
+        self.assertEqual(self.backfill(1, 5), 0)
+        self.assertEqual(len(self.annotations()), 3)
@@ -0,0 +1,81 @@
+""" test UCSC binning helpers """
+from unittest import TestCase
+
+from sqlalchemy import create_engine, literal_column, select
+
+from app.binning import (
+    MAX_BIN_END,
+    bin_from_range,
+    bin_sql,
+    overlapping_bins,
+    position_bin,
+)
+
+
+class BinningTest(TestCase):
+    """test class for binning"""
+
+    def test_bin_from_range_levels(self):
+        """test that intervals land in the smallest bin containing them"""
+        # 128kb leaf bins start at offset 585
+        self.assertEqual(bin_from_range(0, 1), 585)
+        self.assertEqual(bin_from_range((1 << 17) - 1, 1 << 17), 585)
+        self.assertEqual(bin_from_range(1 << 17, (1 << 17) + 1), 586)
+        # crossing a 128kb boundary moves up to the 1Mb level
+        self.assertEqual(bin_from_range((1 << 17) - 1, (1 << 17) + 1), 73)
+        # crossing a 1Mb boundary moves up to the 8Mb level
+        self.assertEqual(bin_from_range((1 << 20) - 1, (1 << 20) + 1), 9)
+        # crossing a 64Mb boundary moves up to the 512Mb level
+        self.assertEqual(bin_from_range((1 << 26) - 1, (1 << 26) + 1), 0)
+
+    def test_bin_from_range_rejects_invalid(self):
+        """test that empty, negative or oversized ranges raise"""
+        for start, end in [(5, 5), (6, 5), (-1, 3), (0, MAX_BIN_END + 1)]:
+            with self.assertRaises(ValueError):
+                bin_from_range(start, end)
+
+    def test_one_based_helpers(self):
+        """test that 1-based closed coordinates are converted before binning"""
+        self.assertEqual(position_bin(1), 585)
+        self.assertEqual(position_bin(1 << 17), 585)
+        self.assertEqual(position_bin((1 << 17) + 1), 586)
+
+    def test_bin_sql_matches_bin_from_range(self):
+        """test that the SQL expression behind generated bin columns agrees with Python"""
+        engine = create_engine("sqlite://")
+        ranges = [
+            (0, 1),
+            ((1 << 17) - 1, 1 << 17),
+            (1 << 17, (1 << 17) + 1),
+            ((1 << 17) - 1, (1 << 17) + 1),
+            ((1 << 20) - 1, (1 << 20) + 1),
+            ((1 << 26) - 1, (1 << 26) + 1),
+            (248_956_421, 248_956_422),
+        ]
+        for start, end in ranges:
+            self.assertEqual(
+                engine.execute(
+                    select([literal_column(bin_sql(str(start), str(end)))])
+                ).scalar(),
+                bin_from_range(start, end),
+            )
+
+    def test_overlapping_bins_finds_every_overlapping_feature(self):
+        """test that any feature overlapping a query range is in one of its bins"""
+        query_start, query_end = 1_000_000, 1_300_000
+        bins = set(overlapping_bins(query_start, query_end))
+        features = [
+            (query_start, query_start + 1),
+            (query_end - 1, query_end),
+            (query_start - 500_000, query_start + 10),
+            (0, 100_000_000),
+            (1_100_000, 1_150_000),
+        ]
+        for start, end in features:
+            self.assertIn(bin_from_range(start, end), bins)
+        # one bin per level in the worst case, plus the leaves spanned
+        self.assertLess(len(bins), 15)
+
+    def test_overlapping_bins_clamps_to_max(self):
+        """test that ranges past the binned space are clamped rather than rejected"""
+        self.assertIn(0, overlapping_bins(MAX_BIN_END - 10, MAX_BIN_END + 10))
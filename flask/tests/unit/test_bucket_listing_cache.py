@@ -0,0 +1,96 @@
+""" test the per-bucket object listing cache """
+import threading
+from types import SimpleNamespace
+from unittest import TestCase
+
+from flask import Flask
+
+from app.buckets import BucketListingCache
+
+
+class FakeMinio:
+    def __init__(self, buckets):
+        self.contents = buckets
+        self.listed = 0
+
+    def list_buckets(self):
+        return [SimpleNamespace(name=name) for name in self.contents]
+
+    def list_objects(self, bucket, recursive=False):
+        self.listed += 1
+        return [SimpleNamespace(object_name=name) for name in self.contents[bucket]]
+
+
+def notification(event_name, bucket, key):
+    return {
+        "Records": [
+            {
+                "eventName": event_name,
+                "s3": {"bucket": {"name": bucket}, "object": {"key": key}},
+            }
+        ]
+    }
+
+
+class BucketListingCacheTest(TestCase):
+    """test class for BucketListingCache"""
+
+    def setUp(self):
+        self.context = Flask(__name__).app_context()
+        self.context.push()
+        self.client = FakeMinio({"ach": ["b.bam", "a.fastq"], "sch": []})
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_listing_is_sorted_and_reused_within_ttl(self):
+        """test that a bucket is listed once until its TTL expires"""
+        cache = BucketListingCache(ttl=60)
+        self.assertEqual(cache.buckets(self.client), ["ach", "sch"])
+        self.assertEqual(cache.objects(self.client, "ach"), ["a.fastq", "b.bam"])
+        self.client.contents["ach"].append("c.cram")
+        self.assertEqual(cache.objects(self.client, "ach"), ["a.fastq", "b.bam"])
+        self.assertEqual(self.client.listed, 1)
+
+        cache.invalidate("ach")
+        self.assertEqual(
+            cache.objects(self.client, "ach"), ["a.fastq", "b.bam", "c.cram"]
+        )
+        self.assertEqual(self.client.listed, 2)
+
+    def test_zero_ttl_always_lists(self):
+        """test that a zero TTL disables caching"""
+        cache = BucketListingCache(ttl=0)
+        cache.objects(self.client, "ach")
+        cache.objects(self.client, "ach")
+        self.assertEqual(self.client.listed, 2)
+
+    def test_notifications_update_listing(self):
+        """test that replayed notifications keep a listing current"""
+        cache = BucketListingCache(ttl=60)
+        snapshot = cache.objects(self.client, "ach")
+        cache.apply_event(notification("s3:ObjectCreated:Put", "ach", "aa.bam"))
+        cache.apply_event(notification("s3:ObjectCreated:Put", "ach", "aa.bam"))
+        cache.apply_event(notification("s3:ObjectRemoved:Delete", "ach", "b.bam"))
+        # buckets that were never listed are ignored
+        cache.apply_event(notification("s3:ObjectCreated:Put", "sch", "x.bam"))
+        self.assertEqual(cache.objects(self.client, "ach"), ["a.fastq", "aa.bam"])
+        self.assertNotIn("sch", cache.listings)
+        # earlier results are snapshots and not changed underneath the caller
+        self.assertEqual(snapshot, ["a.fastq", "b.bam"])
+        self.assertEqual(self.client.listed, 1)
+
+    def test_listen_replays_stream(self):
+        """test that a listener applies a stream and then falls back to the TTL"""
+        cache = BucketListingCache(ttl=0)
+        cache.objects(self.client, "ach")
+        events = [
+            notification("s3:ObjectCreated:Put", "ach", "c.cram"),
+            notification("s3:ObjectRemoved:Delete", "ach", "a.fastq"),
+        ]
+        cache.listen("ach", lambda: iter(events))
+        for thread in threading.enumerate():
+            if thread.name == "minio-events-ach":
+                thread.join(timeout=5)
+        self.assertEqual(cache.listings["ach"], ["b.bam", "c.cram"])
+        self.assertNotIn("ach", cache.listening)
@@ -0,0 +1,121 @@
+""" test the Parquet and Arrow stream reports """
+from collections import defaultdict
+from unittest import TestCase
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import Boolean, Float, Integer, String
+from app.columnar import write_table
+from app.variants import relevant_cols, report_table
+
+from test_report_df import report_rows
+
+
+types = defaultdict(
+    String,
+    position=Integer(),
+    depth=Integer(),
+    cadd_score=Float(),
+    uce_100bp=Boolean(),
+)
+
+genotypes = [
+    {
+        "annotation_id": 1,
+        "position": 200,
+        "reference_allele": "A",
+        "alt_allele": "T",
+        "ensembl_id": 138131,
+        "zygosity": "Het",
+        "participant_codename": "P1",
+        "family_codename": "F1",
+        "depth": 10,
+        "cadd_score": 20.5,
+        "uce_100bp": True,
+    },
+    {
+        "annotation_id": 2,
+        "position": 1000,
+        "reference_allele": "G",
+        "alt_allele": "C",
+        "ensembl_id": 138131,
+        "zygosity": "Hom",
+        "participant_codename": "P1",
+        "family_codename": "F1",
+        "depth": None,
+        "cadd_score": None,
+        "uce_100bp": False,
+    },
+    {
+        "annotation_id": 1,
+        "position": 200,
+        "reference_allele": "A",
+        "alt_allele": "T",
+        "ensembl_id": 138131,
+        "zygosity": "Hom",
+        "participant_codename": "P2",
+        "family_codename": "F1",
+        "depth": 20,
+        "cadd_score": 20.5,
+        "uce_100bp": True,
+    },
+    {
+        "annotation_id": 1,
+        "position": 200,
+        "reference_allele": "A",
+        "alt_allele": "T",
+        "ensembl_id": 138131,
+        "zygosity": "Insufficient coverage",
+        "participant_codename": "P3",
+        "family_codename": "F2",
+        "depth": 1,
+        "cadd_score": 20.5,
+        "uce_100bp": True,
+    },
+]
+
+
+class ColumnarReportTest(TestCase):
+    """test class for report_table"""
+
+    def test_participants(self):
+        """test that genotypes keep their column types"""
+        table = report_table(report_rows(genotypes), "participants", types)
+        self.assertEqual(table.column_names, relevant_cols)
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.schema.field("position").type, pa.int64())
+        self.assertEqual(table.column("depth").to_pylist(), [10, None, 20])
+        self.assertEqual(table.column("cadd_score").to_pylist(), [20.5, None, 20.5])
+        self.assertEqual(table.column("uce_100bp").to_pylist(), [True, False, True])
+        self.assertTrue(pa.types.is_dictionary(table.schema.field("zygosity").type))
+        self.assertEqual(
+            table.column("ensembl_id").to_pylist(), ["ENSG00000138131"] * 3
+        )
+
+    def test_variants(self):
+        """test that variants are aggregated in the order of the csv report, into lists"""
+        table = report_table(report_rows(genotypes), "variants", types)
+        self.assertEqual(table.column_names, relevant_cols + ["frequency"])
+        self.assertEqual(table.column("position").to_pylist(), [1000, 200])
+        self.assertEqual(table.column("frequency").to_pylist(), [1, 2])
+        self.assertEqual(table.column("depth").to_pylist(), [[None], [10, 20]])
+        self.assertEqual(
+            table.column("participant_codename").to_pylist(), [["P1"], ["P1", "P2"]]
+        )
+        self.assertEqual(table.column("family_codename").to_pylist(), [["F1"], ["F1"]])
+        self.assertEqual(table.column("cadd_score").to_pylist(), [None, 20.5])
+
+    def test_no_sufficient_genotypes(self):
+        """test that an empty report keeps its columns"""
+        table = report_table(report_rows(genotypes[3:]), "variants", types)
+        self.assertEqual(table.num_rows, 0)
+        self.assertEqual(table.column_names, relevant_cols + ["frequency"])
+        self.assertEqual(table.schema.field("depth").type, pa.list_(pa.int64()))
+
+    def test_round_trip(self):
+        """test that both formats read back as the same table"""
+        table = report_table(report_rows(genotypes), "variants", types)
+        parquet = pq.read_table(pa.BufferReader(write_table(table, "parquet")))
+        self.assertEqual(parquet.to_pydict(), table.to_pydict())
+        stream = pa.ipc.open_stream(write_table(table, "arrow")).read_all()
+        self.assertTrue(stream.equals(table))
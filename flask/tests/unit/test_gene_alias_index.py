@@ -0,0 +1,65 @@
+""" test the gene alias autocomplete index """
+from unittest import TestCase
+
+from app.genes import GeneAliasIndex
+
+ALIASES = [
+    # alias_id, ensembl_id, name, kind
+    (1, 138131, "LOXL4", "current hgnc gene symbol"),
+    (2, 138131, "LOXC", "synonym"),
+    (3, 258366, "RTEL1", "current hgnc gene symbol"),
+    (4, 258366, "NHL", "previous gene symbol"),
+    (5, 1000, "LOX", "current hgnc gene symbol"),
+    (6, 1001, "LOXL1", "current hgnc gene symbol"),
+    (7, 1002, "ALOX5", "current hgnc gene symbol"),
+    (8, 1003, "LOXL4-AS1", None),
+    (9, 1004, "XLOX", "previous gene symbol"),
+]
+
+
+def names(results):
+    return [alias["name"] for alias in results]
+
+
+class GeneAliasIndexTest(TestCase):
+    """test class for GeneAliasIndex"""
+
+    def setUp(self):
+        self.index = GeneAliasIndex(ALIASES)
+
+    def test_no_term_lists_everything(self):
+        """test that an empty search pages through every alias in table order"""
+        results, total = self.index.search("", 0, 3)
+        self.assertEqual(names(results), ["LOXL4", "LOXC", "RTEL1"])
+        self.assertEqual(total, len(ALIASES))
+        self.assertEqual(len(self.index.search(None)[0]), len(ALIASES))
+
+    def test_ranking(self):
+        """test exact matches, then kinds, then prefixes, then names"""
+        results, total = self.index.search("lox")
+        self.assertEqual(
+            names(results),
+            # exact, current prefix, current substring, previous, other kinds
+            ["LOX", "LOXL1", "LOXL4", "ALOX5", "XLOX", "LOXC", "LOXL4-AS1"],
+        )
+        self.assertEqual(total, 7)
+        self.assertEqual(
+            results[0], {"ensembl_id": 1000, "name": "LOX", "kind": ALIASES[4][3]}
+        )
+
+    def test_substrings_and_paging(self):
+        """test short and long substrings and that totals count every match"""
+        self.assertEqual(names(self.index.search("l4")[0]), ["LOXL4", "LOXL4-AS1"])
+        self.assertEqual(names(self.index.search("xl4-a")[0]), ["LOXL4-AS1"])
+        self.assertEqual(names(self.index.search("TEL")[0]), ["RTEL1"])
+        self.assertEqual(self.index.search("loxl4x"), ([], 0))
+        self.assertEqual(self.index.search("zz"), ([], 0))
+        results, total = self.index.search("lox", 2, 2)
+        self.assertEqual(names(results), ["LOXL4", "ALOX5"])
+        self.assertEqual(total, 7)
+
+    def test_long_terms_are_verified(self):
+        """test that n-gram candidates without the whole term are dropped"""
+        # OXLXL4 has both trigrams of "oxl4", but not next to each other
+        index = GeneAliasIndex([(1, 1, "OXLXL4", None), (2, 2, "OXL4", None)])
+        self.assertEqual(names(index.search("oxl4")[0]), ["OXL4"])
@@ -0,0 +1,59 @@
+""" test the in-memory gene coordinate index """
+from unittest import TestCase
+
+from app.genes import GeneIndex
+
+GENES = [
+    # ensembl_id, chromosome, start, end
+    (138131, "10", 100017408, 100028007),
+    (258366, "20", 62289163, 62327606),
+    (1, "1", 1000, 2000),
+    (2, "1", 1500, 1800),  # inside 1
+    (3, "1", 1900, 3000),  # overlaps 1
+    (4, "1", 3001, 3500),  # adjacent to 3
+    (5, "1", 5000, 6000),
+    (6, "X", 10, 20),
+]
+
+
+class GeneIndexTest(TestCase):
+    """test class for GeneIndex"""
+
+    def setUp(self):
+        self.index = GeneIndex(GENES)
+
+    def test_missing(self):
+        """test that unknown ensembl ids are reported"""
+        self.assertEqual(len(self.index), len(GENES))
+        self.assertEqual(self.index.missing([138131, 258366, 6]), [])
+        self.assertEqual(
+            self.index.missing([138131, 7, 0, 999999999]), [0, 7, 999999999]
+        )
+        self.assertEqual(GeneIndex([]).missing([1]), [1])
+
+    def test_regions_merge_overlapping_genes(self):
+        """test that overlapping and adjacent genes are merged into one region"""
+        self.assertEqual(
+            self.index.regions([1, 2, 3, 4, 5]), [("1", 1000, 3500), ("1", 5000, 6000)]
+        )
+        self.assertEqual(
+            self.index.regions([2, 5]), [("1", 1500, 1800), ("1", 5000, 6000)]
+        )
+        # a gene contained in an earlier one does not end the region early
+        self.assertEqual(self.index.regions([1, 2]), [("1", 1000, 2000)])
+
+    def test_regions_per_chromosome(self):
+        """test that regions are grouped by chromosome and unknown genes are ignored"""
+        self.assertEqual(
+            self.index.regions([6, 258366, 138131, 7]),
+            [("10", 100017408, 100028007), ("20", 62289163, 62327606), ("X", 10, 20)],
+        )
+        self.assertEqual(self.index.regions([]), [])
+
+    def test_overlapping(self):
+        """test finding the genes that cover each position"""
+        self.assertEqual(
+            self.index.overlapping("1", [999, 1000, 1600, 1950, 3001, 4000, 6000]),
+            [[], [1], [1, 2], [1, 3], [4], [], [5]],
+        )
+        self.assertEqual(self.index.overlapping("Y", [1, 2]), [[], []])
@@ -0,0 +1,89 @@
+""" test per-request instrumentation """
+import json
+import re
+from unittest import TestCase
+
+from flask import Flask, jsonify
+from sqlalchemy import create_engine, text
+from app.instrumentation import RequestMetrics, register_instrumentation, timed
+
+
+class InstrumentationTest(TestCase):
+    """test class for the Server-Timing header and N+1 detection"""
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        self.app = Flask(__name__)
+        self.app.config.update(
+            INSTRUMENT_REQUESTS=True, REQUEST_LOG=True, N_PLUS_ONE_THRESHOLD=3
+        )
+        register_instrumentation(self.app)
+
+        @self.app.route("/queries/<int:count>")
+        def queries(count):
+            with self.engine.connect() as connection:
+                rows = [
+                    connection.execute(text("SELECT :i"), i=i).scalar()
+                    for i in range(count)
+                ]
+            with timed("pandas"):
+                pass
+            return jsonify(rows)
+
+        self.client = self.app.test_client()
+
+    def test_server_timing(self):
+        """test that the request's queries and timed sections are reported"""
+        response = self.client.get("/queries/2")
+        timing = response.headers["Server-Timing"]
+        self.assertRegex(timing, r'^db;dur=[\d.]+;desc="2 queries, \d+ rows"')
+        self.assertIn("pandas;dur=", timing)
+        self.assertIn("serialize;dur=", timing)
+        self.assertRegex(timing, r"app;dur=[\d.]+$")
+
+    def test_repeated_statements(self):
+        """test that statements repeated more than the threshold are logged"""
+        with self.assertLogs(self.app.logger, "WARNING") as logs:
+            self.client.get("/queries/4")
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn("executed 4 times in GET /queries/4: SELECT ?", logs.output[0])
+
+    def test_request_log(self):
+        """test that each request is logged as a line of JSON"""
+        with self.assertLogs("app.requests", "INFO") as logs:
+            self.client.get("/queries/1")
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record["path"], "/queries/1")
+        self.assertEqual(record["status"], 200)
+        self.assertEqual(record["queries"], 1)
+        self.assertEqual(record["repeated_statements"], 0)
+
+    def test_outside_requests(self):
+        """test that queries outside a request are not counted"""
+        with self.app.app_context():
+            with self.engine.connect() as connection:
+                connection.execute(text("SELECT 1"))
+        response = self.client.get("/queries/0")
+        self.assertIn('"0 queries', response.headers["Server-Timing"])
+
+    def test_repeated(self):
+        """test that repeated statements are listed most repeated first"""
+        metrics = RequestMetrics()
+        for statement in ["a", "b", "b", "b", "a", "c"]:
+            metrics.add_query(statement, 0.001, -1)
+        self.assertEqual(metrics.repeated(1), [("b", 3), ("a", 2)])
+        self.assertEqual(metrics.rows, 0)
+        self.assertEqual(metrics.queries, 6)
+
+    def test_server_timing_is_opt_in(self):
+        """test that the request log alone does not send metrics to clients"""
+        app = Flask(__name__)
+        app.config.update(
+            INSTRUMENT_REQUESTS=False, REQUEST_LOG=True, N_PLUS_ONE_THRESHOLD=3
+        )
+        register_instrumentation(app)
+        app.route("/")(lambda: "")
+        with self.assertLogs("app.requests", "INFO") as logs:
+            response = app.test_client().get("/")
+        self.assertNotIn("Server-Timing", response.headers)
+        self.assertEqual(json.loads(logs.records[0].getMessage())["path"], "/")
@@ -0,0 +1,55 @@
+""" test keyset pagination conditions """
+from itertools import product
+from unittest import TestCase
+
+from sqlalchemy import Column, Integer, MetaData, String, Table, create_engine, select
+
+from app.utils import keyset_filter
+
+metadata = MetaData()
+rows = Table(
+    "rows",
+    metadata,
+    Column("row_id", Integer, primary_key=True),
+    Column("name", String(10)),
+)
+
+
+class KeysetFilterTest(TestCase):
+    """test class for keyset_filter"""
+
+    def setUp(self):
+        # SQLite sorts NULLs the same way MySQL does: first ascending, last descending
+        self.engine = create_engine("sqlite://")
+        metadata.create_all(self.engine)
+        self.engine.execute(
+            rows.insert(),
+            [
+                {"row_id": row_id, "name": name}
+                for row_id, name in enumerate(
+                    ["b", None, "a", "b", None, "c", "a", "b"], start=1
+                )
+            ],
+        )
+
+    def order(self, column, descending):
+        direction = "desc" if descending else "asc"
+        order = [getattr(rows.c.row_id, direction)()]
+        if column is not None:
+            order.insert(0, getattr(column, direction)())
+        return order
+
+    def test_seeking_matches_full_ordering(self):
+        """test that seeking past every row yields the rest of the ordering"""
+        for column, descending in product([None, rows.c.name], [False, True]):
+            order = self.order(column, descending)
+            expected = self.engine.execute(select([rows]).order_by(*order)).fetchall()
+            for i, (row_id, name) in enumerate(expected):
+                after = self.engine.execute(
+                    select([rows])
+                    .where(
+                        keyset_filter(column, rows.c.row_id, descending, name, row_id)
+                    )
+                    .order_by(*order)
+                ).fetchall()
+                self.assertEqual(after, expected[i + 1 :], (column, descending, i))
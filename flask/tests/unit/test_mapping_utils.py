@@ -0,0 +1,206 @@
+""" test report to row mapping for bulk insertion """
+import os
+from datetime import datetime
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import pandas as pd
+from app.mapping_utils import (
+    MappingIndex,
+    get_analysis_ids,
+    get_report_records,
+    get_sample_dataset_ids,
+    preprocess_reports,
+    report_sha256,
+    report_stat,
+)
+
+
+class ReportRecordsTest(TestCase):
+    """test class for get_report_records"""
+
+    def setUp(self):
+        row = {
+            "chromosome": "1",
+            "position": "100",
+            "reference_allele": "A",
+            "alt_allele": "T",
+            "ensembl_gene_id": "ENSG00000138131",
+            "exac_pli_score": 0.3,
+            "gnomad_oe_mis_score": 0.9,
+            "number_of_callers": "2",
+            "gts": "A/T,A/A",
+            "trio_coverage": "10/20",
+            "zygosity.123_ch-1": "Het",
+            "zygosity.123_ch_2": "Hom",
+            "burden.123_ch-1": "1",
+            "burden.123_ch_2": "0",
+            "alt_depths.123_ch-1": "5",
+            "alt_depths.123_ch_2": "None",
+        }
+        self.df = pd.DataFrame([row, {**row, "position": "200"}])
+        self.samples = ["123_CH-1", "123_CH_2"]
+
+    def test_sample_dataset_ids(self):
+        """test that report sample names are normalized to look up their datasets"""
+        dataset_analysis_ids = {
+            "CH-1": (1, None, None, 11),
+            "CH-2": (1, None, None, 12),
+        }
+        self.assertEqual(
+            get_sample_dataset_ids(dataset_analysis_ids, self.samples, "123"),
+            [11, 12],
+        )
+
+    def test_report_records(self):
+        """test that variants get consecutive ids referenced by their genotypes"""
+        variants, genotypes = get_report_records(
+            self.df, self.samples, [11, 12], 7, 100
+        )
+        self.assertEqual([variant["variant_id"] for variant in variants], [100, 101])
+        self.assertEqual(variants[0]["analysis_id"], 7)
+        self.assertEqual(variants[0]["report_ensembl_gene_id"], "ENSG00000138131")
+        self.assertEqual(variants[0]["exac_pli_score"], 0.3)
+        self.assertEqual(variants[0]["number_of_callers"], 2)
+        self.assertEqual(len(genotypes), 4)
+        self.assertEqual(
+            genotypes[1],
+            {
+                "variant_id": 100,
+                "analysis_id": 7,
+                "dataset_id": 12,
+                "zygosity": "Hom",
+                "burden": 0,
+                "alt_depths": None,
+                "coverage": 20,
+                "genotype": "A/A",
+            },
+        )
+        self.assertEqual(genotypes[2]["variant_id"], 101)
+
+
+class PreprocessReportsTest(TestCase):
+    """test class for preprocess_reports"""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.reports = []
+        for family in ["100", "200", "300", "400"]:
+            path = os.path.join(self.directory.name, f"{family}.wes.2021-01-01.csv")
+            pd.DataFrame(
+                {
+                    "Position": [f"1:{family}", "X:5"],
+                    "Ref": ["A", "G"],
+                    "Alt": ["T", "C"],
+                    "Variation": ["SNV", "Stop_Gain"],
+                    "Depth": [10, None],
+                    "Clinvar": ["5", None],
+                    "UCSC_Link": ['=HYPERLINK("http://ucsc")'] * 2,
+                    "Gnomad_Link": ['=HYPERLINK("http://gnomad")'] * 2,
+                    f"Zygosity.{family}_CH1": ["Het", "Hom"],
+                }
+            ).to_csv(path, index=False)
+            self.reports.append(path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_pool_matches_serial(self):
+        """test that parsing in a process pool yields the same reports in the same order"""
+        serial = list(preprocess_reports(self.reports))
+        pooled = list(preprocess_reports(self.reports, workers=2, max_pending=2))
+        self.assertEqual([report for report, _, _, _ in pooled], self.reports)
+        for serial_report, pooled_report in zip(serial, pooled):
+            _, serial_samples, serial_df, serial_fingerprint = serial_report
+            _, samples, df, fingerprint = pooled_report
+            self.assertEqual(samples, serial_samples)
+            pd.testing.assert_frame_equal(df, serial_df)
+            self.assertEqual(fingerprint, serial_fingerprint)
+        self.assertEqual(serial[0][1], ["100_CH1"])
+        self.assertEqual(list(serial[0][2]["chromosome"]), ["1", "X"])
+
+    def test_fingerprint(self):
+        """test that each report is fingerprinted from the bytes that were parsed"""
+        for report, _, _, fingerprint in preprocess_reports(self.reports):
+            self.assertEqual(
+                tuple(fingerprint), (*report_stat(report), report_sha256(report))
+            )
+
+
+class MappingIndexTest(TestCase):
+    """test class for resolving report samples with a MappingIndex"""
+
+    def setUp(self):
+        older, newer = datetime(2020, 1, 1), datetime(2021, 1, 1)
+        self.index = MappingIndex()
+        for row in [
+            (1, "100", "AB100", 10, "CH1", None, 101, 1001, older, "/a/100.bam"),
+            (1, "100", "AB100", 10, "CH1", None, 101, 1002, newer, "/b/100.bam"),
+            (
+                1,
+                "100",
+                "AB100",
+                11,
+                "CH2",
+                "100-ch2-alt",
+                102,
+                1003,
+                older,
+                "/a/ch2.bam",
+            ),
+            (
+                1,
+                "100",
+                "AB100",
+                11,
+                "CH2",
+                "100-ch2-alt",
+                103,
+                1004,
+                newer,
+                "/b/ch2.bam",
+            ),
+            (1, "100", "AB100", 12, "CH3", None, 104),
+            (2, "200", None),
+            (3, "DUP", None),
+            (4, "300", "dup"),
+        ]:
+            self.index.add(*row)
+
+    def test_family_lookup(self):
+        """test that families resolve by codename or alias, case-insensitively"""
+        self.assertEqual(self.index.find_family("100"), 1)
+        self.assertEqual(self.index.find_family("ab100"), 1)
+        self.assertIsNone(self.index.find_family("999"))
+        # ambiguous codenames are treated as not found
+        self.assertIsNone(self.index.find_family("dup"))
+
+    def test_analysis_ids(self):
+        """test that each sample resolves to its dataset's latest analysis"""
+        resolved = get_analysis_ids(
+            "100",
+            ["100_CH1", "100_ch2-alt", "100_CH3", "100_CH4"],
+            "r.csv",
+            index=self.index,
+        )
+        self.assertEqual(
+            resolved["CH1"], (1002, datetime(2021, 1, 1), "/b/100.bam", 101, "r.csv")
+        )
+        # the earlier dataset's analysis is kept over a more recently updated one
+        self.assertEqual(resolved["ch2-alt"][0], 1003)
+        # no analyses, so the participant has no entry
+        self.assertNotIn("CH3", resolved)
+        self.assertEqual(resolved["CH4"], "No match")
+        self.assertIsNone(
+            get_analysis_ids("999", ["999_CH1"], "r.csv", index=self.index)
+        )
+
+    def test_collapse_and_result_path(self):
+        """test that changes made while mapping are reflected in later lookups"""
+        self.index.collapse_analysis(101, 1002, 1003)
+        self.index.update_result_path(1003, "/a")
+        self.assertEqual(
+            self.index.latest_analysis(101), (1001, datetime(2020, 1, 1), "/a/100.bam")
+        )
+        self.assertEqual(self.index.dataset_analyses[101], [1001, 1003])
+        self.assertEqual(self.index.analyses[1003][1], "/a")
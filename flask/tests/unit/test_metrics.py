@@ -0,0 +1,75 @@
+""" test Prometheus metrics for the database pool and MinIO admin calls """
+import os
+import tempfile
+from unittest import TestCase
+
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
+from app.metrics import InstrumentedQueuePool, minio_admin_timer
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class PoolMetricsTest(TestCase):
+    """test class for InstrumentedQueuePool"""
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".sqlite")
+        os.close(handle)
+        self.engine = create_engine(
+            f"sqlite:///{self.path}",
+            poolclass=InstrumentedQueuePool,
+            pool_size=1,
+            max_overflow=1,
+            pool_timeout=0.05,
+        )
+
+    def tearDown(self):
+        self.engine.dispose()
+        os.remove(self.path)
+
+    def test_checkouts_and_overflow(self):
+        """test that checkouts and occupancy are recorded"""
+        checkouts = sample("stager_db_pool_checkouts_total")
+        first = self.engine.connect()
+        second = self.engine.connect()
+        self.assertEqual(sample("stager_db_pool_checkouts_total"), checkouts + 2)
+        self.assertEqual(sample("stager_db_pool_checked_out"), 2)
+        self.assertEqual(sample("stager_db_pool_overflow"), 1)
+        self.assertEqual(sample("stager_db_pool_size"), 1)
+        second.close()
+        first.close()
+        self.assertEqual(sample("stager_db_pool_checked_out"), 0)
+
+    def test_waits_and_timeouts(self):
+        """test that checkouts from an exhausted pool count as waits and timeouts"""
+        waits = sample("stager_db_pool_waits_total")
+        timeouts = sample("stager_db_pool_timeouts_total")
+        connections = [self.engine.connect(), self.engine.connect()]
+        self.assertEqual(sample("stager_db_pool_waits_total"), waits)
+        with self.assertRaises(TimeoutError):
+            self.engine.connect()
+        self.assertEqual(sample("stager_db_pool_waits_total"), waits + 1)
+        self.assertEqual(sample("stager_db_pool_timeouts_total"), timeouts + 1)
+        for connection in connections:
+            connection.close()
+
+
+class MinioAdminTimerTest(TestCase):
+    """test class for minio_admin_timer"""
+
+    def test_outcomes(self):
+        """test that calls are labelled by command and whether they raised"""
+        name = "stager_minio_admin_duration_seconds_count"
+        ok = sample(name, command="list-users", outcome="ok")
+        error = sample(name, command="list-users", outcome="error")
+        with minio_admin_timer("list-users"):
+            pass
+        with self.assertRaises(RuntimeError):
+            with minio_admin_timer("list-users"):
+                raise RuntimeError("unreachable")
+        self.assertEqual(sample(name, command="list-users", outcome="ok"), ok + 1)
+        self.assertEqual(sample(name, command="list-users", outcome="error"), error + 1)
@@ -0,0 +1,91 @@
+""" test the concurrent MinIO admin task runner """
+from threading import Barrier
+from unittest import TestCase
+
+from app.madmin import MinioAdminError
+from app.minio_sync import admin_call, run_admin_tasks
+
+
+class FakeAdmin:
+    """Records calls, raising the errors queued for each (method, group) first"""
+
+    def __init__(self, errors=None, barrier=None):
+        self.errors = errors or {}
+        self.barrier = barrier
+        self.calls = []
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            if self.barrier:
+                self.barrier.wait(timeout=5)
+            self.calls.append((method, args, kwargs))
+            if self.errors.get((method, args[0])):
+                raise self.errors[(method, args[0])].pop(0)
+
+        return call
+
+
+class RunAdminTasksTest(TestCase):
+    """test class for run_admin_tasks"""
+
+    def test_tasks_run_concurrently(self):
+        """test that independent tasks run at the same time"""
+        # Every call waits for the other two, which deadlocks unless they overlap
+        admin = FakeAdmin(barrier=Barrier(3))
+        tasks = [[admin_call("group_add", code, "alice")] for code in "abc"]
+        self.assertEqual(run_admin_tasks(admin, tasks, workers=3), [])
+        self.assertEqual(len(admin.calls), 3)
+
+    def test_transient_errors_are_retried(self):
+        """test that server errors are retried and calls in a task stay in order"""
+        admin = FakeAdmin(
+            {
+                ("group_add", "ach"): [
+                    MinioAdminError("Unavailable", 503, "ServiceUnavailable")
+                ]
+            }
+        )
+        task = [
+            admin_call("group_add", "ach", "alice"),
+            admin_call("set_policy", "ach", group="ach"),
+        ]
+        self.assertEqual(run_admin_tasks(admin, [task], workers=4, retries=1), [])
+        self.assertEqual(
+            [method for method, args, kwargs in admin.calls],
+            ["group_add", "group_add", "set_policy"],
+        )
+
+    def test_failures_are_reported(self):
+        """test that a failed task reports the calls it did not complete"""
+        admin = FakeAdmin(
+            {
+                ("group_add", "ach"): [
+                    MinioAdminError("No such user", 404, "NoSuchUser")
+                ],
+                ("group_remove", "sch"): [MinioAdminError("Unavailable", 503)] * 2,
+            }
+        )
+        failures = run_admin_tasks(
+            admin,
+            [
+                [
+                    admin_call("group_add", "ach", "alice"),
+                    admin_call("set_policy", "ach", group="ach"),
+                ],
+                [admin_call("group_remove", "sch", "alice")],
+                [admin_call("group_add", "c4r", "bob")],
+            ],
+            workers=4,
+            retries=1,
+        )
+        failed = sorted((str(f.calls[0]), len(f.calls), f.error) for f in failures)
+        self.assertEqual(
+            failed,
+            [
+                ("group_add('ach', 'alice')", 2, "No such user"),
+                ("group_remove('sch', 'alice')", 1, "Unavailable"),
+            ],
+        )
+        # client errors are not retried and the rest of the task is skipped
+        self.assertNotIn("set_policy", [method for method, _, _ in admin.calls])
+        self.assertEqual(len(admin.calls), 4)
@@ -0,0 +1,79 @@
+""" test the report cache backends """
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from app.report_cache import MemoryReportCache, SharedReportCache, report_cache_key
+
+
+class ReportCacheTest(TestCase):
+    """test class for the report cache backends"""
+
+    def setUp(self):
+        self.directory = TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "cache.sqlite")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def check_lru(self, cache):
+        cache.set("a", b"1234")
+        cache.set("b", b"5678")
+        self.assertEqual(cache.get("a"), b"1234")
+        # b is now the least recently used and makes room for c
+        cache.set("c", b"901")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), b"901")
+        # too large to ever fit
+        cache.set("d", b"0123456789a")
+        self.assertIsNone(cache.get("d"))
+        stats = cache.stats()
+        self.assertEqual(
+            {name: stats[name] for name in ["hits", "misses", "evictions"]},
+            {"hits": 2, "misses": 2, "evictions": 1},
+        )
+        self.assertEqual((stats["entries"], stats["bytes"]), (2, 7))
+
+    def test_memory_lru(self):
+        """test that the in-process cache evicts the least recently used reports"""
+        self.check_lru(MemoryReportCache(max_bytes=10))
+
+    def test_shared_lru(self):
+        """test that the shared cache evicts the least recently used reports"""
+        self.check_lru(SharedReportCache(self.path, max_bytes=10, used_resolution=0))
+
+    def test_shared_get_read_only(self):
+        """test that shared cache lookups are counted in batches and rarely touch entries"""
+        cache = SharedReportCache(self.path, max_bytes=100, flush_every=3)
+        other = SharedReportCache(self.path, max_bytes=100)
+        cache.set("a", b"report")
+        changes = cache.connect().total_changes
+        self.assertEqual(cache.get("a"), b"report")
+        self.assertIsNone(cache.get("b"))
+        # recently used and below the batch size, so nothing was written
+        self.assertEqual(cache.connect().total_changes, changes)
+        self.assertEqual(other.stats()["hits"], 0)
+        cache.get("a")
+        self.assertEqual([other.stats()[name] for name in ["hits", "misses"]], [2, 1])
+
+    def test_shared_between_instances(self):
+        """test that entries and statistics are shared through the file"""
+        first = SharedReportCache(self.path, max_bytes=100)
+        second = SharedReportCache(self.path, max_bytes=100)
+        first.set("a", b"report")
+        self.assertEqual(second.get("a"), b"report")
+        second.flush()
+        self.assertEqual(first.stats()["hits"], 1)
+        second.clear()
+        self.assertIsNone(first.get("a"))
+
+    def test_key(self):
+        """test that keys ignore panel order but not the visible datasets or version"""
+        key = report_cache_key("variants", "csv", [2, 1], [3, 4], 7)
+        self.assertEqual(key, report_cache_key("variants", "csv", [1, 2, 2], {4, 3}, 7))
+        self.assertNotEqual(key, report_cache_key("variants", "csv", [1, 2], None, 7))
+        self.assertNotEqual(key, report_cache_key("variants", "csv", [1, 2], [3], 7))
+        self.assertNotEqual(key, report_cache_key("variants", "csv", [1, 2], [3, 4], 8))
+        self.assertNotEqual(
+            key, report_cache_key("variants", "json", [1, 2], [3, 4], 7)
+        )
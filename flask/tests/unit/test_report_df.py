@@ -0,0 +1,173 @@
+""" test variant-wise report aggregation """
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+from flask import Flask
+from app.variants import get_report_df, join_groups, merge_report_rows, relevant_cols
+
+
+def report_rows(rows):
+    df = pd.DataFrame([{column: "" for column in relevant_cols} for _ in rows])
+    for i, row in enumerate(rows):
+        for column, value in row.items():
+            df.at[i, column] = value
+    return df
+
+
+class ReportTest(TestCase):
+    """test class for get_report_df"""
+
+    def setUp(self):
+        # get_report_df logs through current_app
+        self.context = Flask(__name__).app_context()
+        self.context.push()
+
+    def tearDown(self):
+        self.context.pop()
+
+    def test_join_groups(self):
+        """test that contiguous runs are joined independently"""
+        values = np.array(["a", "b", "c", "d", "e"], dtype=object)
+        self.assertEqual(
+            join_groups(values, np.array([0, 1, 4])), ["a", "b; c; d", "e"]
+        )
+
+    def test_variants_are_aggregated(self):
+        """test that genotypes collapse into one row per variant in position order"""
+        df = report_rows(
+            [
+                {
+                    "annotation_id": 1,
+                    "position": 200,
+                    "reference_allele": "A",
+                    "alt_allele": "T",
+                    "ensembl_id": 138131,
+                    "zygosity": "Het",
+                    "participant_codename": "P1",
+                    "family_codename": "F1",
+                    "depth": 10,
+                    "clinvar": None,
+                },
+                {
+                    "annotation_id": 2,
+                    "position": 1000,
+                    "reference_allele": "G",
+                    "alt_allele": "C",
+                    "ensembl_id": 138131,
+                    "zygosity": "Hom",
+                    "participant_codename": "P1",
+                    "family_codename": "F1",
+                    "depth": 30,
+                    "clinvar": "Benign",
+                },
+                {
+                    "annotation_id": 1,
+                    "position": 200,
+                    "reference_allele": "A",
+                    "alt_allele": "T",
+                    "ensembl_id": 138131,
+                    "zygosity": "Hom",
+                    "participant_codename": "P2",
+                    "family_codename": "F1",
+                    "depth": 20,
+                    "clinvar": "Pathogenic",
+                },
+                {
+                    "annotation_id": 1,
+                    "position": 200,
+                    "reference_allele": "A",
+                    "alt_allele": "T",
+                    "ensembl_id": 138131,
+                    "zygosity": "Insufficient coverage",
+                    "participant_codename": "P3",
+                    "family_codename": "F2",
+                    "depth": 1,
+                    "clinvar": "Pathogenic",
+                },
+            ]
+        )
+        report = get_report_df(df, type="variants")
+        self.assertEqual(list(report.columns), relevant_cols + ["frequency"])
+        # positions are grouped as strings, as the report has always ordered them
+        self.assertEqual(list(report["position"]), ["1000", "200"])
+        variant = report.iloc[1]
+        self.assertEqual(variant["participant_codename"], "P1; P2")
+        self.assertEqual(variant["zygosity"], "Het; Hom")
+        self.assertEqual(variant["depth"], "10; 20")
+        self.assertEqual(variant["family_codename"], "F1")
+        self.assertEqual(variant["ensembl_id"], "ENSG00000138131")
+        # "first" takes the first genotype's value, with missing values blank
+        self.assertEqual(variant["clinvar"], "")
+        self.assertEqual(variant["frequency"], 2)
+
+    def test_variants_are_grouped_by_annotation(self):
+        """test that variants at the same position of different chromosomes stay apart"""
+        df = report_rows(
+            [
+                {
+                    "annotation_id": annotation_id,
+                    "chromosome": chromosome,
+                    "position": 200,
+                    "reference_allele": "A",
+                    "alt_allele": "T",
+                    "zygosity": "Het",
+                    "participant_codename": participant,
+                }
+                for annotation_id, chromosome, participant in [
+                    (7, "X", "P1"),
+                    (3, "1", "P2"),
+                    (7, "X", "P3"),
+                ]
+            ]
+        )
+        report = get_report_df(df, type="variants")
+        self.assertEqual(list(report["chromosome"]), ["1", "X"])
+        self.assertEqual(list(report["participant_codename"]), ["P2", "P1; P3"])
+        self.assertEqual(list(report["frequency"]), [1, 2])
+
+    def test_no_sufficient_genotypes(self):
+        """test that an empty report keeps its columns"""
+        df = report_rows(
+            [
+                {
+                    "annotation_id": 1,
+                    "position": 200,
+                    "reference_allele": "A",
+                    "alt_allele": "T",
+                    "zygosity": "-",
+                }
+            ]
+        )
+        report = get_report_df(df, type="variants")
+        self.assertTrue(report.empty)
+        self.assertEqual(list(report.columns), relevant_cols + ["frequency"])
+
+    def test_merge_report_rows(self):
+        """test that per-gene rows of a variant merge as if aggregated together"""
+        genotypes = [
+            {"ensembl_id": 1, "participant_codename": "P1", "family_codename": "F1"},
+            {"ensembl_id": 1, "participant_codename": "P2", "family_codename": "F2"},
+            {"ensembl_id": 2, "participant_codename": "P1", "family_codename": "F1"},
+            {"ensembl_id": 2, "participant_codename": "P2", "family_codename": "F2"},
+        ]
+        for genotype in genotypes:
+            genotype.update(
+                annotation_id=1,
+                position=200,
+                reference_allele="A",
+                alt_allele="T",
+                zygosity="Het",
+            )
+        rows = [
+            get_report_df(report_rows(genotypes[i : i + 2]), type="variants").to_dict(
+                orient="records"
+            )[0]
+            for i in (0, 2)
+        ]
+        merged = merge_report_rows(*rows)
+        expected = get_report_df(report_rows(genotypes), type="variants")
+        self.assertEqual(merged, expected.to_dict(orient="records")[0])
+        self.assertEqual(merged["ensembl_id"], "ENSG00000000001; ENSG00000000002")
+        self.assertEqual(merged["family_codename"], "F1; F2")
+        self.assertEqual(merged["frequency"], 4)
@@ -0,0 +1,65 @@
+""" test synthetic data generation """
+from unittest import TestCase
+
+import numpy as np
+from app.synthetic import (
+    GRCH37_CHROMOSOME_LENGTHS,
+    synthetic_genes,
+    synthetic_genotypes,
+    synthetic_variants,
+)
+
+
+class SyntheticTest(TestCase):
+    """test class for the synthetic row generators"""
+
+    def test_genes_fit_chromosomes(self):
+        """test that genes get consecutive ids and lie within their chromosome"""
+        genes = synthetic_genes(np.random.default_rng(0), 500, 10)
+        self.assertEqual([gene["ensembl_id"] for gene in genes], list(range(10, 510)))
+        for gene in genes:
+            self.assertLess(gene["start"], gene["end"])
+            self.assertGreaterEqual(gene["start"], 1)
+            self.assertLessEqual(
+                gene["end"], GRCH37_CHROMOSOME_LENGTHS[gene["chromosome"]]
+            )
+
+    def test_variants_are_reproducible(self):
+        """test that the same seed generates the same variants"""
+        genes = [(1, "1", 1000, 2000, "GENE1")]
+        first = synthetic_variants(np.random.default_rng(1), 50, genes)
+        second = synthetic_variants(np.random.default_rng(1), 50, genes)
+        self.assertEqual(first, second)
+
+    def test_genic_variants(self):
+        """test that variants placed in genes are annotated with them"""
+        genes = [(1, "1", 1000, 2000, "GENE1"), (2, "X", 5000, 9000, None)]
+        variants = synthetic_variants(np.random.default_rng(2), 200, genes)
+        genic = [variant for variant in variants if variant["gene"]]
+        self.assertTrue(genic)
+        for variant in genic:
+            if variant["gene"] == "GENE1":
+                self.assertEqual(variant["chromosome"], "1")
+                self.assertTrue(1000 <= variant["position"] <= 2000)
+            else:
+                self.assertEqual(variant["gene"], "ENSG00000000002")
+                self.assertTrue(5000 <= variant["position"] <= 9000)
+        for variant in variants:
+            self.assertNotEqual(variant["reference_allele"], variant["alt_allele"])
+
+    def test_genotypes(self):
+        """test that each variant is genotyped in every sample, consistently with zygosity"""
+        rng = np.random.default_rng(3)
+        variants = synthetic_variants(rng, 100, [])
+        genotypes = synthetic_genotypes(rng, variants, 3)
+        self.assertEqual(len(genotypes), 100)
+        for variant, calls in zip(variants, genotypes):
+            self.assertEqual(len(calls), 3)
+            for call in calls:
+                if call["zygosity"] == "Hom":
+                    self.assertEqual(
+                        call["genotype"],
+                        f"{variant['alt_allele']}/{variant['alt_allele']}",
+                    )
+                elif call["zygosity"] == "-":
+                    self.assertEqual(call["alt_depths"], 0)